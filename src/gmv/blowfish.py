@@ -43,8 +43,65 @@ equivalently 8 and 56 bytes. The encryption and decryption functions operate
 on 64-bit blocks, or 8-byte strings.
 """
 import array
+import binascii
 import struct
  
+# Optional native backends used to compute the CTR keystream in bulk.
+# The pure python code is used when none of them is available.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+ 
+try:
+    from Crypto.Cipher import Blowfish as _pycrypto_blowfish
+except ImportError:
+    _pycrypto_blowfish = None
+ 
+try:
+    from cryptography.hazmat.backends import default_backend as _crypto_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher as _crypto_cipher, \
+                                                       algorithms as _crypto_algos, \
+                                                       modes as _crypto_modes
+except ImportError:
+    _crypto_cipher = None
+ 
+def _native_ecb_encryptor(key):
+    """
+    Return a function encrypting a string of 8-byte blocks in ECB mode with a
+    native Blowfish implementation or None if there is none.
+    """
+    if _crypto_cipher is not None:
+        try:
+            cipher = _crypto_cipher(_crypto_algos.Blowfish(key), _crypto_modes.ECB(), \
+                                    backend = _crypto_backend())
+            return lambda data: cipher.encryptor().update(data)
+        except Exception: #pylint:disable-msg=W0703
+            pass
+ 
+    if _pycrypto_blowfish is not None:
+        try:
+            return _pycrypto_blowfish.new(key, _pycrypto_blowfish.MODE_ECB).encrypt
+        except Exception: #pylint:disable-msg=W0703
+            pass
+ 
+    return None
+ 
+def _xor_strings(data, keystream):
+    """
+    XOR two strings of the same length in one go.
+    """
+    if not data:
+        return ''
+ 
+    if numpy is not None:
+        return numpy.bitwise_xor(numpy.frombuffer(data, dtype = numpy.uint8), \
+                                 numpy.frombuffer(keystream, dtype = numpy.uint8)).tostring()
+ 
+    # xor the strings as big integers. Conversions from and to hexadecimal are linear
+    val = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(keystream), 16)
+    return binascii.unhexlify('%0*x' % (2 * len(data), val))
+ 
 class Blowfish:
     """
     Implements the encryption and decryption functionality of the Blowfish
@@ -380,6 +437,15 @@ class Blowfish:
                 self._s_boxes[i][j] = l
                 self._s_boxes[i][j + 1] = r
  
+        # Bulk CTR keystream. Use a native implementation if there is one
+        # and it agrees with this one.
+        self._ctr_tables = None
+        self._ecb_encrypt = _native_ecb_encryptor(key)
+        if self._ecb_encrypt is not None:
+            test_block = struct.pack("Q", 0x0123456789abcdef)
+            if self._ecb_encrypt(test_block) != self.encrypt(test_block):
+                self._ecb_encrypt = None
+ 
     def initCTR(self, iv=0):
         """
         Initializes CTR engine for encryption or decryption.
@@ -476,7 +542,7 @@ class Blowfish:
         if not type(data) is str:
             raise TypeError("Only 8-bit strings are supported")
  
-        return ''.join([chr(ord(ch) ^ self._nextCTRByte()) for ch in data])
+        return _xor_strings(data, self._nextCTRBytes(len(data)))
  
     def decryptCTR(self, data):
         """
@@ -504,6 +570,61 @@ class Blowfish:
             self._calcCTRBuf()
         return b
  
+    def _nextCTRBytes(self, nb_bytes):
+        """
+        Returns the next nb_bytes of CTR keystream as a string.
+ 
+        Equivalent to nb_bytes calls to _nextCTRByte() but the keystream
+        blocks are computed in bulk.
+        """
+        avail = self._BLOCK_SIZE - self._ctr_pos
+        if nb_bytes < avail:
+            keystream = self._ctr_cks[self._ctr_pos:self._ctr_pos + nb_bytes]
+            self._ctr_pos += nb_bytes
+            return keystream
+ 
+        # consume the current block then compute all the blocks needed
+        # including the one following the last consumed byte
+        head = self._ctr_cks[self._ctr_pos:]
+        nb_blocks = (nb_bytes - avail) // self._BLOCK_SIZE + 1
+        blocks = self._calcCTRBlocks(self._ctr_iv, nb_blocks)
+ 
+        self._ctr_iv += nb_blocks
+        self._ctr_cks = blocks[-self._BLOCK_SIZE:]
+        self._ctr_pos = (nb_bytes - avail) % self._BLOCK_SIZE
+ 
+        return head + blocks[:nb_bytes - avail]
+ 
+    def _calcCTRBlocks(self, first_iv, nb_blocks):
+        """
+        Calculates nb_blocks consecutive blocks of CTR keystream starting at
+        counter first_iv.
+        """
+        counters = struct.pack("%dQ" % nb_blocks, *xrange(first_iv, first_iv + nb_blocks))
+ 
+        if self._ecb_encrypt is not None:
+            return self._ecb_encrypt(counters)
+ 
+        if self._ctr_tables is None:
+            self._ctr_tables = (self._p_boxes.tolist(),) + tuple(s_box.tolist() for s_box in self._s_boxes)
+        (p_boxes, s0, s1, s2, s3) = self._ctr_tables
+        p_pairs = zip(p_boxes[0:16:2], p_boxes[1:16:2])
+        p16, p17 = p_boxes[16], p_boxes[17]
+ 
+        # Same as cipher() with the round function inlined and two rounds
+        # per iteration to avoid swapping the halves
+        words = list(struct.unpack(">%dI" % (2 * nb_blocks), counters))
+        for i in xrange(0, len(words), 2):
+            xl, xr = words[i], words[i + 1]
+            for (p_even, p_odd) in p_pairs:
+                xl ^= p_even
+                xr ^= ((((s0[xl >> 24] + s1[(xl >> 16) & 0xFF]) & 0xFFFFFFFF) ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]) & 0xFFFFFFFF
+                xr ^= p_odd
+                xl ^= ((((s0[xr >> 24] + s1[(xr >> 16) & 0xFF]) & 0xFFFFFFFF) ^ s2[(xr >> 8) & 0xFF]) + s3[xr & 0xFF]) & 0xFFFFFFFF
+            words[i], words[i + 1] = xr ^ p17, xl ^ p16
+ 
+        return struct.pack(">%dI" % (2 * nb_blocks), *words)
+ 
     def _round(self, xl):
         """
         Performs an obscuring function on the 32-bit block of data, 'xl', which
@@ -16,7 +16,11 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
+import array
+import bisect
 import collections
+import heapq
+import itertools
 
 ## {{{ http://code.activestate.com/recipes/576669/ (r18)
 class OrderedDict(dict, collections.MutableMapping):
@@ -170,3 +174,307 @@ class DictMultimap(Map):
         """ remove key"""
         del self._dict[key][value]
 
+if array.array('L').itemsize >= 8:
+    def id_array(values=()):
+        """ typed array of 64 bits ids """
+        return array.array('L', values)
+else:
+    def id_array(values=()):
+        """ no 64 bits typed array on this platform: list of ids """
+        return list(values)
+
+class IdSet(object):
+    """
+       Immutable set of positive integer ids (imap uids, gmail ids) stored as sorted runs
+       of consecutive ids in typed arrays. The ids are iterated in increasing order and can
+       be accessed by position. The imap uids are mostly consecutive so millions of uids
+       take a few runs. Sparse ids (gmail ids) take 24 bytes per id instead of about 100
+       in a set of longs.
+    """
+    __slots__ = ('_starts', '_ends', '_offsets', '_len')
+
+    def __init__(self, ids=()):
+        """
+           ids: iterable of ids in any order (duplicates are ignored)
+        """
+        self._starts  = id_array() # first id of each run
+        self._ends    = id_array() # last id of each run
+        self._offsets = id_array() # position of the first id of each run
+        self._len     = 0
+
+        if isinstance(ids, IdSet):
+            self._starts, self._ends, self._offsets, self._len = \
+                id_array(ids._starts), id_array(ids._ends), id_array(ids._offsets), ids._len #pylint:disable=W0212
+            return
+
+        start = end = None
+        for the_id in sorted(ids): # (linear on sorted ids)
+            if end is not None and the_id <= end + 1:
+                end = max(end, the_id)
+                continue
+            if end is not None:
+                self._append_run(start, end)
+            start = end = the_id
+        if end is not None:
+            self._append_run(start, end)
+
+    @classmethod
+    def from_runs(cls, runs):
+        """
+           IdSet from sorted, disjoint and non adjacent (first, last) runs
+        """
+        the_set = cls()
+        for first, last in runs:
+            the_set._append_run(first, last) #pylint:disable=W0212
+        return the_set
+
+    def _append_run(self, first, last):
+        """ add a run after the last one """
+        if self._ends and first <= self._ends[-1] + 1:
+            # adjacent to the last run
+            self._len -= self._ends[-1] - self._starts[-1] + 1
+            first = self._starts[-1]
+            self._starts.pop()
+            self._ends.pop()
+            self._offsets.pop()
+        self._starts.append(first)
+        self._ends.append(last)
+        self._offsets.append(self._len)
+        self._len += last - first + 1
+
+    def runs(self):
+        """ iterate over the (first, last) runs of consecutive ids """
+        return itertools.izip(self._starts, self._ends)
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for first, last in itertools.izip(self._starts, self._ends):
+            if first == last:
+                yield first
+            else:
+                for the_id in itertools.islice(itertools.count(first), last - first + 1):
+                    yield the_id
+
+    def __contains__(self, the_id):
+        run = bisect.bisect_right(self._starts, the_id) - 1
+        return run >= 0 and the_id <= self._ends[run]
+
+    def index(self, the_id):
+        """ position of the_id in the set. Raise ValueError if it is not in the set """
+        run = bisect.bisect_right(self._starts, the_id) - 1
+        if run < 0 or the_id > self._ends[run]:
+            raise ValueError('%s is not in the IdSet' % (the_id))
+        return self._offsets[run] + the_id - self._starts[run]
+
+    def __getitem__(self, pos):
+        """ id at a position or list of the ids of a slice """
+        if isinstance(pos, slice):
+            start, stop, step = pos.indices(self._len)
+            if step != 1:
+                return list(itertools.islice(self, start, stop, step))
+            return list(self._iter_from(start, stop))
+
+        if pos < 0:
+            pos += self._len
+        if not 0 <= pos < self._len:
+            raise IndexError('IdSet index out of range')
+        run = bisect.bisect_right(self._offsets, pos) - 1
+        return self._starts[run] + pos - self._offsets[run]
+
+    def _iter_from(self, start, stop):
+        """ iterate over the ids from position start to stop (excluded) """
+        if start >= stop:
+            return
+        run = bisect.bisect_right(self._offsets, start) - 1
+        the_id, left = self._starts[run] + start - self._offsets[run], stop - start
+        while left > 0:
+            nb_ids = min(left, self._ends[run] - the_id + 1)
+            for value in itertools.islice(itertools.count(the_id), nb_ids):
+                yield value
+            left -= nb_ids
+            run  += 1
+            if run < len(self._starts):
+                the_id = self._starts[run]
+
+    def after(self, the_id):
+        """ IdSet of the ids greater or equal to the_id """
+        first_run = max(0, bisect.bisect_right(self._starts, the_id) - 1)
+
+        def runs():
+            """ runs from the one containing the_id """
+            for first, last in itertools.islice(self.runs(), first_run, None):
+                if last >= the_id:
+                    yield max(first, the_id), last
+
+        return IdSet.from_runs(runs())
+
+    def difference(self, other):
+        """ IdSet of the ids that are not in other (IdSet or iterable of ids) """
+        if not isinstance(other, IdSet):
+            other = IdSet(other)
+
+        def runs():
+            """ merge the runs of both sets """
+            others = other.runs()
+            o_first, o_last = next(others, (None, None))
+            for first, last in self.runs():
+                while o_first is not None and first <= last:
+                    if o_last < first:
+                        o_first, o_last = next(others, (None, None))
+                    elif o_first > last:
+                        break
+                    else:
+                        if o_first > first:
+                            yield first, o_first - 1
+                        first = o_last + 1
+                        if o_last <= last:
+                            o_first, o_last = next(others, (None, None))
+                if first <= last:
+                    yield first, last
+
+        return IdSet.from_runs(runs())
+
+    __sub__ = difference
+
+    def sequence_set(self):
+        """ IMAP sequence set of the ids (1:500,502,504:900) """
+        return ','.join([('%d' % (first)) if first == last else ('%d:%d' % (first, last)) \
+                         for first, last in itertools.izip(self._starts, self._ends)])
+
+    def chunks(self, nb_ids):
+        """ iterate over IdSets of at most nb_ids consecutive ids of the set """
+        for pos in xrange(0, self._len, nb_ids):
+            yield IdSet(self._iter_from(pos, min(pos + nb_ids, self._len)))
+
+    def __eq__(self, other):
+        if not isinstance(other, IdSet):
+            return NotImplemented
+        return self._len == other._len and self._starts == other._starts and self._ends == other._ends #pylint:disable=W0212
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(arr.__sizeof__() for arr in (self._starts, self._ends, self._offsets))
+
+    def __repr__(self):
+        return 'IdSet(%s)' % (self.sequence_set())
+
+
+class SortedIdMap(object):
+    """
+       Read only map id => value for many ids and few distinct values (gm_id => directory
+       of the db) iterated in increasing id order. The ids are stored in a typed array,
+       each value once and a small value code per id.
+       The ids are found by binary search and tail(pos) / after(id) are views sharing the
+       arrays (no copy).
+    """
+    __slots__ = ('_keys', '_codes', '_values', '_start')
+
+    def __init__(self, items=()):
+        """
+           items: iterable of (id, value) in any order. The ids are unique.
+        """
+        groups = {} # value => ids
+        for the_id, value in items:
+            ids = groups.get(value)
+            if ids is None:
+                ids = groups[value] = id_array()
+            ids.append(the_id)
+
+        self._values = list(groups)
+        self._codes  = array.array('H' if len(self._values) <= 0xFFFF else 'L')
+        self._keys   = id_array()
+        self._start  = 0
+
+        sorted_groups = []
+        for code, value in enumerate(self._values):
+            sorted_groups.append((id_array(sorted(groups.pop(value))), code))
+        sorted_groups.sort(key = lambda group: group[0][0])
+
+        if all(prev[0][-1] < group[0][0] for prev, group in itertools.izip(sorted_groups, sorted_groups[1:])):
+            # the ids of the values do not overlap (gm_ids of the months): concatenate them
+            for ids, code in sorted_groups:
+                self._keys.extend(ids)
+                self._codes.extend(array.array(self._codes.typecode, [code]) * len(ids))
+        else:
+            for the_id, code in heapq.merge(*[itertools.izip(ids, itertools.repeat(code)) \
+                                              for ids, code in sorted_groups]):
+                self._keys.append(the_id)
+                self._codes.append(code)
+
+    def _view(self, start):
+        """ map sharing the arrays from position start """
+        the_map = SortedIdMap.__new__(SortedIdMap)
+        the_map._keys, the_map._codes, the_map._values = self._keys, self._codes, self._values #pylint:disable=W0212
+        the_map._start = min(start, len(self._keys)) #pylint:disable=W0212
+        return the_map
+
+    def _find(self, the_id):
+        """ position of the_id in the arrays or -1 """
+        pos = bisect.bisect_left(self._keys, the_id, self._start)
+        if pos < len(self._keys) and self._keys[pos] == the_id:
+            return pos
+        return -1
+
+    def __len__(self):
+        return len(self._keys) - self._start
+
+    def __iter__(self):
+        keys = self._keys
+        return (keys[pos] for pos in xrange(self._start, len(keys)))
+
+    def __contains__(self, the_id):
+        return self._find(the_id) >= 0
+
+    def __getitem__(self, the_id):
+        pos = self._find(the_id)
+        if pos < 0:
+            raise KeyError(the_id)
+        return self._values[self._codes[pos]]
+
+    def get(self, the_id, default = None):
+        """ value of the_id or default """
+        pos = self._find(the_id)
+        return self._values[self._codes[pos]] if pos >= 0 else default
+
+    def index(self, the_id):
+        """ position of the_id in the map. Raise ValueError if not found """
+        pos = self._find(the_id)
+        if pos < 0:
+            raise ValueError("%s not in map" % (the_id))
+        return pos - self._start
+
+    def tail(self, pos):
+        """ map of the ids from position pos """
+        return self._view(self._start + pos)
+
+    def after(self, the_id):
+        """ map of the ids greater than the_id """
+        return self._view(bisect.bisect_right(self._keys, the_id, self._start))
+
+    def keys(self):
+        """ typed array of the ids """
+        return self._keys[self._start:]
+
+    def iteritems(self):
+        """ iterate over the (id, value) """
+        keys, codes, values = self._keys, self._codes, self._values
+        return ((keys[pos], values[codes[pos]]) for pos in xrange(self._start, len(keys)))
+
+    def items(self):
+        """ list of (id, value) """
+        return list(self.iteritems())
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self._keys.__sizeof__() + self._codes.__sizeof__() + \
+               sum(value.__sizeof__() for value in self._values) + self._values.__sizeof__()
+
+    def __repr__(self):
+        return 'SortedIdMap(%d ids, %d values)' % (len(self), len(self._values))
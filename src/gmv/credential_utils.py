@@ -371,7 +371,8 @@ class CredentialHelper(object):
         Used once the connection has been lost. Return an auth_str obtained from a refresh token or
         with the current access token if it is still valid
         :param email: user email used to load refresh token from peristent file
-        :return: credential { 'type' : 'oauth2', 'value' : auth_str, 'option':None }
+        :return: credential { 'type' : 'oauth2', 'value' : auth_str, 'option':None, 'expiry': epoch }
+                 expiry is the time (epoch seconds) when the access token becomes invalid
         """
         oauth2_creds = cls.read_oauth2_tok_sec(email)
 
@@ -391,6 +392,7 @@ class CredentialHelper(object):
 
                 #store newly created token
                 cls.store_oauth2_credentials(email, access_token, refresh_token, validity, type)
+                expiry = gmvault_utils.get_utcnow_epoch() + validity
         else:
 
             # check if the access token is still valid otherwise renew it from the refresh token
@@ -404,6 +406,7 @@ class CredentialHelper(object):
             if  now < tok_creation + validity:
                 LOG.debug("Access Token is still valid")
                 access_token = oauth2_creds['access_token']
+                expiry       = tok_creation + validity
             else:
                 #expired so request a new access token and store it
                 LOG.debug("Access Token is expired. Renew it")
@@ -411,10 +414,11 @@ class CredentialHelper(object):
                 access_token, type = cls._get_oauth2_acc_tok_from_ref_tok(oauth2_creds['refresh_token'])
                 # update stored information
                 cls.store_oauth2_credentials(email, access_token, oauth2_creds['refresh_token'], validity, type)
+                expiry = now + validity
 
         auth_str = cls._generate_oauth2_auth_string(email, access_token, base64_encode=False)
 
         LOG.debug("auth_str generated: %s" % (auth_str))
         LOG.debug("Successfully read oauth2 credentials with get_oauth2_credential_from_refresh_token\n")
 
-        return { 'type' : 'oauth2', 'value' : auth_str, 'option':None }
+        return { 'type' : 'oauth2', 'value' : auth_str, 'option':None, 'expiry': expiry }
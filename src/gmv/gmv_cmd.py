@@ -30,6 +30,7 @@ import gmv.log_utils as log_utils
 import gmv.gmvault_utils as gmvault_utils
 import gmv.gmvault as gmvault
 import gmv.gmvault_export as gmvault_export
+import gmv.gmvault_db as gmvault_db
 import gmv.collections_utils as collections_utils
 
 from gmv.cmdline_utils  import CmdLineParser
@@ -42,6 +43,7 @@ GLOBAL_HELP_EPILOGUE = """Examples:
 a) Get help for each of the individual commands
 
 #> gmvault sync -h
+#> gmvault daemon -h
 #> gmvault restore --help
 #> gmvault check -h
 #> gmvault export -h
@@ -77,25 +79,43 @@ b) Quick daily synchronisation (only the last 2 months are scanned)
 
 #> gmvault sync --type quick foo.bar@gmail.com
 
-c) Resume Full synchronisation from where it failed to not go through your mailbox again
+c) Incremental synchronisation of the emails received since the last full or watermark
+   synchronisation (and of the labels changes of the last days)
+
+#> gmvault sync --type watermark foo.bar@gmail.com
+
+d) Resume Full synchronisation from where it failed to not go through your mailbox again
 
 #> gmvault sync foo.bar@gmail.com --resume
 
-d) Encrypt stored emails to save them safely anywhere
+e) Encrypt stored emails to save them safely anywhere
 
 #> gmvault sync foo.bar@gmail.com --encrypt
 
-d) Custom synchronisation with an IMAP request for advance users
+f) Custom synchronisation with an IMAP request for advance users
 
 #> gmvault sync --type custom --imap-req "Since 1-Nov-2011 Before 10-Nov-2011" foo.bar@gmail.com
 
-e) Custom synchronisation with an Gmail request for advance users.
+g) Custom synchronisation with an Gmail request for advance users.
    Get all emails with label work and sent by foo.
 
 #> gmvault sync --type custom --gmail-req "in:work from:foo" foo.bar@gmail.com
 
 """
 
+DAEMON_HELP_EPILOGUE = """Examples:
+
+a) Keep foo.bar@gmail.com synchronised in ./gmvault-db: the new emails are stored as soon
+   as Gmail reports them (IMAP IDLE). Stop it with CTRL-C.
+
+#> gmvault daemon foo.bar@gmail.com
+
+b) Same thing for the emails only with encryption
+
+#> gmvault daemon --emails-only --encrypt foo.bar@gmail.com
+
+"""
+
 EXPORT_HELP_EPILOGUE = """Warning: Experimental Functionality requiring more testing.
 
 Examples:
@@ -117,6 +137,33 @@ d) Use one of the export type dedicated to a specific tool (dovecot or offlineIM
 #> gmvault export -t dovecot /tmp/a-dovecot-dir
 """
 
+MIGRATE_HELP_EPILOGUE = """Examples:
+
+a) Store the emails of the default gmvault-db ($HOME/gmvault-db or %HOME$/gmvault-db) in large segment files.
+
+#> gmvault migrate
+
+b) Go back to 2 files per email for a gmvault-db.
+
+#> gmvault migrate -b files -d /tmp/gmvault-db
+
+c) Store the metadata of all emails in one SQLite database instead of one .meta file per email.
+
+#> gmvault migrate -m sqlite
+
+d) Export the metadata back to .meta files.
+
+#> gmvault migrate -m json
+
+e) Convert the emails stored as fetched (raw) to utf-8.
+
+#> gmvault migrate --utf8
+
+f) Store the next emails as fetched (raw) instead of converting them to utf-8.
+
+#> gmvault migrate --raw
+"""
+
 LOG = log_utils.LoggerFactory.get_logger('gmv')
 
 class NotSeenAction(argparse.Action): #pylint:disable=R0903,w0232
@@ -134,7 +181,7 @@ class GMVaultLauncher(object):
        GMVault launcher handling the command parsing
     """
     
-    SYNC_TYPES    = ['full', 'quick', 'custom']
+    SYNC_TYPES    = ['full', 'quick', 'custom', 'watermark']
     RESTORE_TYPES = ['full', 'quick']
     CHECK_TYPES   = ['full']
     EXPORT_TYPES  = collections_utils.OrderedDict([
@@ -173,7 +220,7 @@ class GMVaultLauncher(object):
         # sync typ
         sync_parser.add_argument('-t', '-type', '--type', \
                                  action='store', dest='type', \
-                                 default='full', help='type of synchronisation: full|quick|custom. (default: full)')
+                                 default='full', help='type of synchronisation: full|quick|custom|watermark. (default: full)')
         
         sync_parser.add_argument("-d", "--db-dir", \
                                  action='store', help="Database root directory. (default: $HOME/gmvault-db)",\
@@ -229,6 +276,11 @@ class GMVaultLauncher(object):
                                  action='store_true', dest='only_chats', \
                                  default=False, help= 'Only sync chats.')
         
+        sync_parser.add_argument("--connections", metavar = "N", type = int, \
+                                 help="sync the emails with N IMAP connections in parallel (max %d). (default: 1)" \
+                                      % (gmvault.GMVaulter.MAX_SYNC_CONNECTIONS),\
+                                 dest="connections", default=1)
+        
         sync_parser.add_argument("-e", "--encrypt", \
                                  help="encrypt stored email messages in the database.",\
                                  action='store_true',dest="encrypt", default=False)
@@ -264,6 +316,66 @@ class GMVaultLauncher(object):
     
         sync_parser.epilogue = SYNC_HELP_EPILOGUE
         
+        # daemon command
+        daemon_parser = subparsers.add_parser('daemon', \
+                                              help='keep a given gmail account synchronized (new emails stored within seconds).')
+        daemon_parser.add_argument('email', \
+                                   action='store', default='empty_$_email', help='email to sync with.')
+
+        daemon_parser.add_argument("-d", "--db-dir", \
+                                   action='store', help="Database root directory. (default: $HOME/gmvault-db)",\
+                                   dest="db_dir", default= self.DEFAULT_GMVAULT_DB)
+
+        # for both when seen add const empty otherwise not_seen
+        # this allow to distinguish between an empty value and a non seen option
+        daemon_parser.add_argument("-y", "--oauth2", \
+                          help="use oauth for authentication. (default recommended method)",\
+                          action='store_const', dest="oauth2_token", const='empty', default='not_seen')
+
+        daemon_parser.add_argument("-p", "--passwd", \
+                          help="use interactive password authentication. (not recommended)",
+                          action= 'store_const' , dest="passwd", const='empty', default='not_seen')
+
+        daemon_parser.add_argument("--renew-oauth2-tok", \
+                          help="renew the stored oauth token (two legged or normal) via an interactive authentication session.",
+                          action= 'store_const' , dest="oauth2_token", const='renew')
+
+        daemon_parser.add_argument("--emails-only", \
+                                   action='store_true', dest='only_emails', \
+                                   default=False, help= 'Only sync emails.')
+
+        daemon_parser.add_argument("--chats-only", \
+                                   action='store_true', dest='only_chats', \
+                                   default=False, help= 'Only sync chats.')
+
+        daemon_parser.add_argument("-e", "--encrypt", \
+                                   help="encrypt stored email messages in the database.",\
+                                   action='store_true',dest="encrypt", default=False)
+
+        daemon_parser.add_argument("-m", "--multiple-db-owner", \
+                                   help="Allow the email database to be synchronized with emails from multiple accounts.",\
+                                   action='store_true',dest="allow_mult_owners", default=False)
+
+        daemon_parser.add_argument("--no-compression", \
+                                   action='store_false', dest='compression', \
+                                   default=True, help= 'disable email storage compression (gzip).')
+
+        daemon_parser.add_argument("--server", metavar = "HOSTNAME", \
+                              action='store', help="Gmail imap server hostname. (default: imap.gmail.com)",\
+                              dest="host", default="imap.gmail.com")
+
+        daemon_parser.add_argument("--port", metavar = "PORT", \
+                              action='store', help="Gmail imap server port. (default: 993)",\
+                              dest="port", default=993)
+
+        daemon_parser.add_argument("--debug", "-debug", \
+                              action='store_true', help="Activate debugging info",\
+                              dest="debug", default=False)
+
+        daemon_parser.set_defaults(verb='daemon')
+
+        daemon_parser.epilogue = DAEMON_HELP_EPILOGUE
+
         # restore command
         rest_parser = subparsers.add_parser('restore', \
                                             help='restore gmvault-db to a given email account.')
@@ -285,6 +397,11 @@ class GMVaultLauncher(object):
         rest_parser.add_argument("--resume", "--restart", \
                                  action='store_true', dest='restart', \
                                  default=False, help= 'Restart from the last saved gmail id.')
+
+        rest_parser.add_argument("--connections", metavar = "N", type = int, \
+                                 help="push the emails with N IMAP connections in parallel (max %d). (default: 1)" \
+                                      % (gmvault.GMVaulter.MAX_RESTORE_CONNECTIONS),\
+                                 dest="connections", default=1)
                                  
         # activate the resume mode --restart is deprecated
         rest_parser.add_argument("--emails-only", \
@@ -364,6 +481,10 @@ class GMVaultLauncher(object):
                               action='store', help="Gmail imap server port. (default: 993)",\
                               dest="port", default=993)
         
+        check_parser.add_argument("--rebuild-index", \
+                              action='store_true', help="Recreate the gm_id index of the gmvault-db from the files on disk.",\
+                              dest="rebuild_index", default=False)
+
         check_parser.add_argument("--debug", "-debug", \
                               action='store_true', help="Activate debugging info",\
                               dest="debug", default=False)
@@ -397,6 +518,39 @@ class GMVaultLauncher(object):
         
         export_parser.epilogue = EXPORT_HELP_EPILOGUE
 
+        # migrate command
+        migrate_parser = subparsers.add_parser('migrate', \
+                                            help='Convert the gmvault-db to another storage backend or metadata storage.')
+
+        migrate_parser.add_argument("-d", "--db-dir", \
+                                 action='store', help="Database root directory. (default: $HOME/gmvault-db)",\
+                                 dest="db_dir", default= self.DEFAULT_GMVAULT_DB)
+
+        migrate_parser.add_argument('-b', '--backend', \
+                          action='store', dest='backend', default=None, \
+                          help='storage backend: files (2 files per email) or segments (large append only files).'\
+                               ' (default: segments if no metadata storage is given)')
+
+        migrate_parser.add_argument('-m', '--metadata', \
+                          action='store', dest='metadata', default=None, \
+                          help='metadata storage: json (one json per email) or sqlite (one database for all emails).')
+
+        migrate_parser.add_argument('--utf8', \
+                          action='store_true', dest='utf8', default=False, \
+                          help='convert the emails stored as fetched (raw) to utf-8.')
+
+        migrate_parser.add_argument('--raw', \
+                          action='store_true', dest='raw', default=False, \
+                          help='store the next emails as fetched (raw) instead of converting them to utf-8.')
+
+        migrate_parser.add_argument("--debug", "-debug", \
+                       action='store_true', help="Activate debugging info",\
+                       dest="debug", default=False)
+
+        migrate_parser.set_defaults(verb='migrate')
+
+        migrate_parser.epilogue = MIGRATE_HELP_EPILOGUE
+
         return parser
       
     @classmethod
@@ -532,8 +686,33 @@ class GMVaultLauncher(object):
             
             #compression flag
             parsed_args['compression'] = options.compression
+
+            #nb of connections used in parallel
+            if options.connections < 1 or options.connections > gmvault.GMVaulter.MAX_SYNC_CONNECTIONS:
+                parser.error("--connections should be between 1 and %d." % (gmvault.GMVaulter.MAX_SYNC_CONNECTIONS))
+            parsed_args['connections'] = options.connections
                 
                 
+        elif parsed_args.get('command', '') == 'daemon':
+
+            #add defaults for type
+            options.type    = 'full'
+            options.restart = False
+
+            # parse common arguments for sync and restore
+            self._parse_common_args(options, parser, parsed_args, self.CHECK_TYPES)
+
+            # handle emails or chats only
+            if options.only_emails and options.only_chats:
+                parser.error("--emails-only and --chats-only cannot be used together. Please choose one.")
+
+            parsed_args['emails_only'] = options.only_emails
+            parsed_args['chats_only']  = options.only_chats
+
+            parsed_args['encrypt']           = options.encrypt
+            parsed_args['ownership_control'] = not options.allow_mult_owners
+            parsed_args['compression']       = options.compression
+
         elif parsed_args.get('command', '') == 'restore':
             
             # parse common arguments for sync and restore
@@ -543,6 +722,11 @@ class GMVaultLauncher(object):
             parsed_args['apply_label'] = options.apply_label
             
             parsed_args['restart'] = options.restart
+
+            #nb of connections used in parallel
+            if options.connections < 1 or options.connections > gmvault.GMVaulter.MAX_RESTORE_CONNECTIONS:
+                parser.error("--connections should be between 1 and %d." % (gmvault.GMVaulter.MAX_RESTORE_CONNECTIONS))
+            parsed_args['connections'] = options.connections
             
             # handle emails or chats only
             if options.only_emails and options.only_chats:
@@ -559,6 +743,8 @@ class GMVaultLauncher(object):
             
             # parse common arguments for sync and restore
             self._parse_common_args(options, parser, parsed_args, self.CHECK_TYPES)
+
+            parsed_args['rebuild_index'] = options.rebuild_index
     
         elif parsed_args.get('command', '') == 'export':
             parsed_args['labels']     = options.label
@@ -570,6 +756,32 @@ class GMVaultLauncher(object):
                 parser.error('Unknown type for command export. The type should be one of %s' % self.EXPORT_TYPE_NAMES)
             parsed_args['debug'] = options.debug
 
+        elif parsed_args.get('command', '') == 'migrate':
+            parsed_args['db-dir'] = options.db_dir
+
+            backend = options.backend
+            if backend is None and options.metadata is None and not options.utf8 and not options.raw:
+                backend = gmvault_db.GmailSegmentStorer.STORAGE_BACKEND
+
+            if backend is None or backend.lower() in gmvault_db.STORERS:
+                parsed_args['backend'] = backend.lower() if backend else None
+            else:
+                parser.error('Unknown storage backend for command migrate. It should be one of %s' \
+                             % (", ".join(gmvault_db.STORERS)))
+
+            if options.metadata is None or options.metadata.lower() in gmvault_db.METADATA_STORAGES:
+                parsed_args['metadata'] = options.metadata.lower() if options.metadata else None
+            else:
+                parser.error('Unknown metadata storage for command migrate. It should be one of %s' \
+                             % (", ".join(gmvault_db.METADATA_STORAGES)))
+
+            if options.utf8 and options.raw:
+                parser.error('--utf8 and --raw cannot be used together.')
+
+            parsed_args['utf8'] = options.utf8
+            parsed_args['raw']  = options.raw
+            parsed_args['debug'] = options.debug
+
         elif parsed_args.get('command', '') == 'config':
             pass
     
@@ -606,6 +818,24 @@ class GMVaultLauncher(object):
         exporter.export()
         output_dir.close()
 
+    @classmethod
+    def _migrate(cls, args):
+        """
+           Convert gmvault-db to another storage backend or metadata storage
+        """
+        if args['backend']:
+            gmvault_db.migrate_storage(args['db-dir'], args['backend'])
+
+        if args['metadata']:
+            gmvault_db.migrate_metadata(args['db-dir'], args['metadata'])
+
+        if args['utf8']:
+            gmvault_db.normalize_emails(args['db-dir'])
+
+        if args['raw']:
+            gmvault_db.write_email_format(args['db-dir'], gmvault_db.GmailStorer.RAW_FORMAT)
+            LOG.critical("The next emails will be stored as fetched (raw).\n")
+
     @classmethod
     def _restore(cls, args, credential):
         """
@@ -622,7 +852,8 @@ class GMVaultLauncher(object):
             #call restore
             labels = [args['apply_label']] if args['apply_label'] else []
             restorer.restore(extra_labels = labels, restart = args['restart'], \
-                             emails_only = args['emails_only'], chats_only = args['chats_only'])
+                             emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                             connections = args['connections'])
             
         elif args.get('type', '') == 'quick':
             
@@ -637,7 +868,8 @@ class GMVaultLauncher(object):
             #call restore
             labels = [args['apply_label']] if args['apply_label'] else []
             restorer.restore(pivot_dir = starting_dir, extra_labels = labels, restart = args['restart'], \
-                             emails_only = args['emails_only'], chats_only = args['chats_only'])
+                             emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                             connections = args['connections'])
         
         else:
             raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick.")
@@ -662,14 +894,16 @@ class GMVaultLauncher(object):
             #choose full sync. Ignore the request
             syncer.sync({ 'mode': 'full', 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
                         db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'],\
-                        restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'])
+                        restart = args['restart'], emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                        connections = args['connections'])
         
         elif args.get('type', '') == 'auto':
         
             #choose auto sync. imap request = ALL and restart = True
             syncer.sync({ 'mode': 'auto', 'type': 'imap', 'req': 'ALL' } , compress_on_disk = args['compression'], \
                         db_cleaning = args['db-cleaning'], ownership_checking = args['ownership_control'],\
-                        restart = True, emails_only = args['emails_only'], chats_only = args['chats_only'])
+                        restart = True, emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                        connections = args['connections'])
               
         elif args.get('type', '') == 'quick':
             
@@ -693,7 +927,21 @@ class GMVaultLauncher(object):
                          compress_on_disk = args['compression'], \
                          db_cleaning = args['db-cleaning'], \
                          ownership_checking = args['ownership_control'], restart = args['restart'], \
-                         emails_only = args['emails_only'], chats_only = args['chats_only'])
+                         emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                         connections = args['connections'])
+            
+        elif args.get('type', '') == 'watermark':
+            
+            #sync the uids above the highest uid synced by the last full or watermark sync
+            #and the emails of the last quick_days days (for their labels changes)
+            LOG.critical("Watermark sync mode. Check for new emails since the last sync.")
+            
+            syncer.sync({ 'mode': 'watermark', 'type': 'imap', 'req': 'ALL' }, \
+                        compress_on_disk = args['compression'], \
+                        db_cleaning = args['db-cleaning'], \
+                        ownership_checking = args['ownership_control'], restart = args['restart'], \
+                        emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                        connections = args['connections'])
             
         elif args.get('type', '') == 'custom':
             
@@ -709,14 +957,32 @@ class GMVaultLauncher(object):
             
             syncer.sync(args['request'], compress_on_disk = args['compression'], db_cleaning = args['db-cleaning'], \
                         ownership_checking = args['ownership_control'], restart = args['restart'], \
-                        emails_only = args['emails_only'], chats_only = args['chats_only'])
+                        emails_only = args['emails_only'], chats_only = args['chats_only'], \
+                        connections = args['connections'])
         else:
-            raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick or custom.")
+            raise ValueError("Unknown synchronisation mode %s. Please use full (default), quick, watermark or custom.")
         
         
         #print error report
         LOG.critical(syncer.get_operation_report())
     
+    @classmethod
+    def _daemon(cls, args, credential):
+        """
+           Keep the account synchronised until interrupted
+        """
+        LOG.critical("Connect to Gmail server.\n")
+
+        syncer = gmvault.GMVaulter(args['db-dir'], args['host'], args['port'], \
+                                   args['email'], credential, read_only_access = True, \
+                                   use_encryption = args['encrypt'])
+        try:
+            syncer.daemon(compress_on_disk = args['compression'], ownership_checking = args['ownership_control'], \
+                          emails_only = args['emails_only'], chats_only = args['chats_only'])
+        finally:
+            #print error report
+            LOG.critical(syncer.get_operation_report())
+
     @classmethod
     def _check_db(cls, args, credential):
         """
@@ -727,6 +993,10 @@ class GMVaultLauncher(object):
         # handle credential in all levels
         checker = gmvault.GMVaulter(args['db-dir'], args['host'], args['port'], \
                                    args['email'], credential, read_only_access = True)
+
+        if args.get('rebuild_index', False):
+            LOG.critical("Rebuild the gm_id index of the gmvault-db.\n")
+            checker.gstorer.rebuild_index()
         
         checker.check_clean_db(db_cleaning = True)
             
@@ -739,12 +1009,16 @@ class GMVaultLauncher(object):
         die_with_usage = True
         
         try:
-            if args.get('command') not in ('export'):
+            if args.get('command') not in ('export', 'migrate'):
                 credential = CredentialHelper.get_credential(args)
             
             if args.get('command', '') == 'sync':
                 self._sync(args, credential)
                 
+            elif args.get('command', '') == 'daemon':
+
+                self._daemon(args, credential)
+
             elif args.get('command', '') == 'restore':
                 
                 self._restore(args, credential)
@@ -757,6 +1031,10 @@ class GMVaultLauncher(object):
 
                 self._export(args)
 
+            elif args.get('command', '') == 'migrate':
+
+                self._migrate(args)
+
             elif args.get('command', '') == 'config':
                 
                 LOG.critical("Configure something. TBD.\n")
@@ -21,19 +21,31 @@ import time
 import datetime
 import os
 import itertools
+import collections
 import imaplib
+import threading
+import Queue
+import multiprocessing
+import signal
+import glob
+import socket
+import ssl
 
 import gmv.log_utils as log_utils
 import gmv.collections_utils as collections_utils
 import gmv.gmvault_utils as gmvault_utils
 import gmv.imap_utils as imap_utils
 import gmv.gmvault_db as gmvault_db
+import gmv.gmvault_index as gmvault_index
+import gmv.gmvault_snapshot as gmvault_snapshot
 
 LOG = log_utils.LoggerFactory.get_logger('gmvault')
 
-def handle_restore_imap_error(the_exception, gm_id, db_gmail_ids_info, gmvaulter):
+def handle_restore_imap_error(the_exception, gm_id, db_gmail_ids_info, gmvaulter, reconnect = True):
     """
        function to handle restore IMAPError and OSError([Errno 2] No such file or directory) in restore functions 
+       reconnect: reconnect the main connection of gmvaulter to restart cleanly. False when the error
+                  happened on another connection (restore uploaders)
     """
     if isinstance(the_exception, imaplib.IMAP4.abort):
         # if this is a Gmvault SSL Socket error quarantine the email and continue the restore
@@ -42,8 +54,9 @@ def handle_restore_imap_error(the_exception, gm_id, db_gmail_ids_info, gmvaulter
                          " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(the_exception)))
             gmvaulter.gstorer.quarantine_email(gm_id)
             gmvaulter.error_report['emails_in_quarantine'].append(gm_id)
-            LOG.critical("Disconnecting and reconnecting to restart cleanly.")
-            gmvaulter.src.reconnect() #reconnect
+            if reconnect:
+                LOG.critical("Disconnecting and reconnecting to restart cleanly.")
+                gmvaulter.src.reconnect() #reconnect
         else:
             raise the_exception
     elif isinstance(the_exception, IOError) and str(the_exception).find('[Errno 2] No such file or directory:') >=0:
@@ -51,8 +64,9 @@ def handle_restore_imap_error(the_exception, gm_id, db_gmail_ids_info, gmvaulter
                          " err={%s}" % (gm_id, db_gmail_ids_info[gm_id], str(the_exception)))  
         gmvaulter.gstorer.quarantine_email(gm_id)
         gmvaulter.error_report['emails_in_quarantine'].append(gm_id)
-        LOG.critical("Disconnecting and reconnecting to restart cleanly.")
-        gmvaulter.src.reconnect() #reconnect      
+        if reconnect:
+            LOG.critical("Disconnecting and reconnecting to restart cleanly.")
+            gmvaulter.src.reconnect() #reconnect      
            
     elif isinstance(the_exception, imaplib.IMAP4.error): 
         LOG.error("Catched IMAP Error %s" % (str(the_exception)))
@@ -83,10 +97,12 @@ def handle_restore_imap_error(the_exception, gm_id, db_gmail_ids_info, gmvaulter
         LOG.exception(the_exception)
         raise the_exception
 
-def handle_sync_imap_error(the_exception, the_id, error_report, src):
+def handle_sync_imap_error(the_exception, the_id, error_report, src, gmail_id = None):
     """
       function to handle IMAPError in gmvault
       type = chat or email
+      gmail_id: gmail id of the_id if known. src is not used to get it
+      (the error did not occur on src: body downloader)
     """    
     if isinstance(the_exception, imaplib.IMAP4.abort):
         # imap abort error 
@@ -96,24 +112,23 @@ def handle_sync_imap_error(the_exception, the_id, error_report, src):
         LOG.critical("\n=== Exception traceback ===\n")
         LOG.critical(gmvault_utils.get_exception_traceback())
         LOG.critical("=== End of Exception traceback ===\n")
-        try:
-            #try to get the gmail_id
-            curr = src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
-        except Exception, _: #pylint:disable-msg=W0703
-            curr = None
-            LOG.critical("Error when trying to get gmail id for message with imap id %s." % (the_id))
-            LOG.critical("Disconnect, wait for 10 sec then reconnect.")
-            src.disconnect()
-            #could not fetch the gm_id so disconnect and sleep
-            #sleep 10 sec
-            time.sleep(10)
-            LOG.critical("Reconnecting ...")
-            src.connect()
+        if gmail_id is None:
+            try:
+                #try to get the gmail_id
+                curr = src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
+            except Exception, _: #pylint:disable-msg=W0703
+                curr = None
+                LOG.critical("Error when trying to get gmail id for message with imap id %s." % (the_id))
+                LOG.critical("Disconnect, wait for 10 sec then reconnect.")
+                src.disconnect(keep_standby = True)
+                #could not fetch the gm_id so disconnect and sleep
+                #sleep 10 sec
+                time.sleep(10)
+                LOG.critical("Reconnecting ...")
+                src.connect()
             
-        if curr:
-            gmail_id = curr[the_id].get(imap_utils.GIMAPFetcher.GMAIL_ID)
-        else:
-            gmail_id = None
+            if curr:
+                gmail_id = curr[the_id].get(imap_utils.GIMAPFetcher.GMAIL_ID)
             
         #add ignored id
         error_report['cannot_be_fetched'].append((the_id, gmail_id))
@@ -131,17 +146,16 @@ def handle_sync_imap_error(the_exception, the_id, error_report, src):
          
         #quarantine emails that have raised an abort error
         if str(the_exception).find("'Some messages could not be FETCHed (Failure)'") >= 0:
-            try:
-                #try to get the gmail_id
-                LOG.critical("One more attempt. Trying to fetch the Gmail ID for %s" % (the_id) )
-                curr = src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
-            except Exception, _: #pylint:disable-msg=W0703
-                curr = None
+            if gmail_id is None:
+                try:
+                    #try to get the gmail_id
+                    LOG.critical("One more attempt. Trying to fetch the Gmail ID for %s" % (the_id) )
+                    curr = src.fetch(the_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID) 
+                except Exception, _: #pylint:disable-msg=W0703
+                    curr = None
             
-            if curr:
-                gmail_id = curr[the_id].get(imap_utils.GIMAPFetcher.GMAIL_ID)
-            else:
-                gmail_id = None
+                if curr:
+                    gmail_id = curr[the_id].get(imap_utils.GIMAPFetcher.GMAIL_ID)
             
             #add ignored id
             error_report['cannot_be_fetched'].append((the_id, gmail_id))
@@ -155,8 +169,16 @@ def handle_sync_imap_error(the_exception, the_id, error_report, src):
 
 class IMAPBatchFetcher(object):
     """
-       Fetch IMAP data in batch 
+       Fetch IMAP data in batch.
+       The batch size adapts to the server (AIMD): it grows by a step after each fast batch
+       and is halved when a batch fails, takes more than TARGET_BATCH_TIME or returns
+       more than TARGET_BATCH_BYTES. A failing batch is bisected to find the culprits.
     """
+    MIN_BATCH_SIZE     = 10
+    MAX_BATCH_SIZE     = 5000
+    TARGET_BATCH_TIME  = 5.0              # sec
+    TARGET_BATCH_BYTES = 8 * 1024 * 1024
+
     def __init__(self, src, imap_ids, error_report, request, default_batch_size = 100):
         """
            constructor
@@ -167,7 +189,17 @@ class IMAPBatchFetcher(object):
         self.request            = request
         self.error_report       = error_report  
         
-        self.to_fetch           = list(imap_ids)
+        self.to_fetch           = imap_ids
+        self._pos               = 0 # next id of to_fetch to fetch
+
+        # current batch size (adaptive) and its additive increase
+        self.batch_size         = default_batch_size
+        self.min_batch_size     = min(self.MIN_BATCH_SIZE, default_batch_size)
+        self.max_batch_size     = max(self.MAX_BATCH_SIZE, default_batch_size)
+        self._increase_step     = max(1, default_batch_size / 10)
+
+        # with the pipelined engine the next batch is requested before the current one is returned
+        self._prefetched        = None # (position, batch, command)
     
     def individual_fetch(self, imap_ids):
         """
@@ -191,31 +223,599 @@ class IMAPBatchFetcher(object):
         """
             Return the next batch of elements
         """
-        new_data = {}
-        batch = self.to_fetch[:self.def_batch_size]
-        
-        if len(batch) <= 0:
+        if self._pos >= len(self.to_fetch):
             raise StopIteration
-        
+
+        if self._prefetched is not None and self._prefetched[0] == self._pos:
+            batch = self._prefetched[1]
+        else:
+            self._prefetched = None
+            batch = self.to_fetch[self._pos:self._pos + self.batch_size]
+        self._pos += len(batch)
+
         try:
-        
-            new_data = self.src.fetch(batch, self.request)
-            
-            self.to_fetch = self.to_fetch[self.def_batch_size:]
-            
-            return new_data
+            new_data, elapsed, nb_bytes = self._fetch(batch)
+        except imaplib.IMAP4.error, error:
+            LOG.debug("Fetch of a batch of %d ids failed (%s). Bisect it." % (len(batch), error))
+            self._decrease()
+            return self._bisect(batch, error)
 
-        except imaplib.IMAP4.error, _:
-            new_data = self.individual_fetch(batch) 
+        if elapsed > self.TARGET_BATCH_TIME or (nb_bytes or 0) > self.TARGET_BATCH_BYTES:
+            self._decrease()
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self._increase_step)
     
         return new_data
+
+    def _decrease(self):
+        """ halve the batch size """
+        self.batch_size = max(self.min_batch_size, self.batch_size / 2)
+        LOG.debug("Batch size reduced to %d." % (self.batch_size))
+
+    def _fetch(self, batch):
+        """
+           Fetch batch. Return (data, elapsed time, response bytes or None).
+           With the pipelined engine, request the following batch before waiting for this one
+        """
+        if not self.src.is_pipelined():
+            stats = self.src.get_transfer_stats()
+            start = time.time()
+            new_data = self._try_fetch(batch)
+            end_stats = self.src.get_transfer_stats()
+            nb_bytes = end_stats['data_in'] - stats['data_in'] if stats and end_stats else None
+            return new_data, time.time() - start, nb_bytes
+
+        if self._prefetched is None:
+            self._prefetched = (self._pos - len(batch), batch, self.src.fetch_async(batch, self.request))
+        command = self._prefetched[2]
+
+        following = self.to_fetch[self._pos:self._pos + self.batch_size]
+        self._prefetched = (self._pos, following, self.src.fetch_async(following, self.request)) if following else None
+
+        try:
+            # time waited for the batch (it may be received while the caller is busy)
+            start = time.time()
+            self.src.wait([command])
+            return command.result(), max(0, command.done_time - max(start, command.sent_time)), command.size
+        except imaplib.IMAP4.abort, _:
+            # connection lost: fetch it again with the reconnection
+            return self._try_fetch(batch), 0, None
+
+    def _try_fetch(self, imap_ids):
+        """
+           Fetch imap_ids. The connection errors are retried after a reconnection
+           but the imap errors (NO, BAD) are raised immediately
+        """
+        try:
+            return self.src.fetch_no_retry(imap_ids, self.request)
+        except imaplib.IMAP4.abort, _:
+            return self.src.fetch(imap_ids, self.request)
+        except imaplib.IMAP4.error, _:
+            raise
+        except (socket.error, ssl.SSLError), _:
+            return self.src.fetch(imap_ids, self.request)
+
+    def _bisect(self, imap_ids, error):
+        """
+           The fetch of imap_ids failed with error: fetch each half and bisect the failing
+           ones to find the culprits in O(log n) fetches. Return the data of the other ids
+        """
+        if len(imap_ids) == 1:
+            handle_sync_imap_error(error, imap_ids[0], self.error_report, self.src) #do everything in this handler
+            return {}
+
+        new_data = {}
+        middle   = len(imap_ids) / 2
+        for half in (imap_ids[:middle], imap_ids[middle:]):
+            try:
+                new_data.update(self._try_fetch(half))
+            except imaplib.IMAP4.error, err:
+                new_data.update(self._bisect(half, err))
+
+        return new_data
     
     def reset(self):
         """
            Restart from the beginning
         """
-        self.to_fetch = self.imap_ids              
+        self.to_fetch    = self.imap_ids              
+        self._pos        = 0
+        self._prefetched = None
+
+class IMAPBodyDownloader(object):
+    """
+       Download email bodies in a separate thread with its own IMAP connection.
+       Bodies are requested by batch (one FETCH for several ids) and the size of
+       the bodies downloaded but not yet consumed is bounded by max_bytes_in_flight.
+       The results are returned in the order of submission.
+    """
+    STOP = 'STOP' # sentinel to stop the download thread
+
+    def __init__(self, src, batch_size = 50, max_bytes_in_flight = 32 * 1024 * 1024, \
+                 spool_dir = None, spool_min_size = 0): #pylint:disable=R0913
+        """
+           constructor
+           args:
+              src: GIMAPFetcher. A new connection on its current folder is spawned
+              batch_size: max nb of bodies requested in one FETCH
+              max_bytes_in_flight: max nb of bytes downloaded and not yet consumed
+              spool_dir: if set the bodies of at least spool_min_size bytes are
+                         received in files of spool_dir instead of in memory
+        """
+        self.src                 = src
+        self.batch_size          = max(batch_size, 1)
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.spool_dir           = spool_dir
+        self.spool_min_size      = spool_min_size
+
+        self._jobs            = Queue.Queue()
+        self._results         = Queue.Queue()
+        self._cond            = threading.Condition()
+        self._bytes_in_flight = 0 # bytes requested and not consumed
+        self._nb_outstanding  = 0 # bodies submitted and not consumed
+
+        self._conn            = None
+        self._thread          = None
+
+    def start(self):
+        """
+           Spawn the connection and start the download thread
+        """
+        self._conn = self.src.spawn_connection()
+        self._conn.select_folder(self.src.current_folder, use_predef_names = False)
+        if self.spool_dir:
+            self._conn.set_literal_spool(self.spool_dir, self.spool_min_size)
+
+        self._thread = threading.Thread(target = self._run, name = 'gmv-body-downloader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+           Stop the download thread and close its connection
+        """
+        if self._thread:
+            self._jobs.put(self.STOP)
+            with self._cond:
+                # unblock the thread if it is waiting for room
+                self._bytes_in_flight = 0
+                self._cond.notify()
+            self._thread.join()
+            self._thread = None
+
+        if self._conn:
+            self._conn.disconnect()
+            self._conn = None
+
+    def nb_outstanding(self):
+        """
+           Nb of bodies submitted and not yet consumed
+        """
+        return self._nb_outstanding
+
+    def submit(self, the_id, size, payload):
+        """
+           Request the body of the_id. size is the expected size (RFC822.SIZE)
+           and payload is returned untouched with the body
+        """
+        self._nb_outstanding += 1
+        self._jobs.put((the_id, size or 0, payload))
+
+    def _next_batch(self):
+        """
+           Get the next batch of jobs. Return (batch, batch_bytes, stop)
+        """
+        batch, batch_bytes = [], 0
+        job = self._jobs.get()
+        while job != self.STOP:
+            batch.append(job)
+            batch_bytes += job[1]
+            if len(batch) >= self.batch_size or batch_bytes >= self.max_bytes_in_flight:
+                break
+            try:
+                job = self._jobs.get_nowait()
+            except Queue.Empty:
+                break
+
+        return batch, batch_bytes, job == self.STOP
+
+    def _run(self):
+        """
+           download thread
+        """
+        try:
+            stop = False
+            while not stop:
+                batch, batch_bytes, stop = self._next_batch()
+                if batch:
+                    with self._cond:
+                        # wait for the consumer if too many bytes are in flight
+                        while self._bytes_in_flight > 0 and \
+                              self._bytes_in_flight + batch_bytes > self.max_bytes_in_flight:
+                            self._cond.wait()
+                        self._bytes_in_flight += batch_bytes
+
+                    self._results.put((batch, batch_bytes) + self._download([job[0] for job in batch]))
+        except Exception, err: #pylint:disable-msg=W0703
+            LOG.debug(gmvault_utils.get_exception_traceback())
+            self._results.put(err)
+
+    def _download(self, ids):
+        """
+           Fetch the bodies of ids. If the batch fails find the culprits with individual fetches.
+           Return (data, errors)
+        """
+        errors = {}
+        try:
+            data = self._conn.fetch(ids, imap_utils.GIMAPFetcher.GET_DATA_ONLY)
+        except imaplib.IMAP4.error, _:
+            data = {}
+            for the_id in ids:
+                try:
+                    data.update(self._conn.fetch(the_id, imap_utils.GIMAPFetcher.GET_DATA_ONLY))
+                except Exception, error: #pylint:disable-msg=W0703
+                    errors[the_id] = error
+
+        return data, errors
+
+    def downloaded(self, max_outstanding = 0):
+        """
+           Generator returning (the_id, payload, data, error) for the downloaded bodies.
+           Wait for the download as long as more than max_outstanding bodies are pending
+           then return only the bodies that are already downloaded.
+        """
+        while self._nb_outstanding > 0:
+            block = self._nb_outstanding > max_outstanding
+            try:
+                # use a timeout to not block the KeyboardInterrupt
+                result = self._results.get(block, 1) if block else self._results.get_nowait()
+            except Queue.Empty:
+                if block:
+                    continue
+                return
+
+            if isinstance(result, Exception):
+                raise result #pylint:disable-msg=E0702
+
+            batch, batch_bytes, data, errors = result
+            for the_id, _, payload in batch:
+                self._nb_outstanding -= 1
+                yield the_id, payload, data.get(the_id), errors.get(the_id)
+
+            with self._cond:
+                self._bytes_in_flight -= batch_bytes
+                self._cond.notify()
                
+class PipelinedBodyDownloader(IMAPBodyDownloader):
+    """
+       IMAPBodyDownloader for the pipelined engine: no thread. The FETCH of the bodies
+       are pipelined on a connection driven by the loop of the src connection.
+       The bodies are received while the metadata are fetched on src (and inversely).
+    """
+    def __init__(self, src, batch_size = 50, max_bytes_in_flight = 32 * 1024 * 1024, \
+                 spool_dir = None, spool_min_size = 0): #pylint:disable=R0913
+        """
+           constructor (see IMAPBodyDownloader)
+        """
+        super(PipelinedBodyDownloader, self).__init__(src, batch_size, max_bytes_in_flight, spool_dir, spool_min_size)
+
+        self._pending  = []                  # jobs submitted and not requested yet
+        self._requests = collections.deque() # (batch, batch_bytes, command) in order
+
+    def start(self):
+        """
+           Spawn the connection on the loop of src
+        """
+        self._conn = self.src.spawn_connection(share_loop = True)
+        self._conn.select_folder(self.src.current_folder, use_predef_names = False)
+        if self.spool_dir:
+            self._conn.set_literal_spool(self.spool_dir, self.spool_min_size)
+
+    def stop(self):
+        """
+           Close the connection
+        """
+        # the bodies not consumed are discarded with their commands (spool files removed)
+        self._requests.clear()
+        self._pending = []
+
+        if self._conn:
+            self._conn.disconnect()
+            self._conn = None
+
+    def submit(self, the_id, size, payload):
+        """
+           Request the body of the_id. size is the expected size (RFC822.SIZE)
+           and payload is returned untouched with the body
+        """
+        self._nb_outstanding += 1
+        self._pending.append((the_id, size or 0, payload))
+        if len(self._pending) >= self.batch_size:
+            self._request(force = False)
+
+    def _request(self, force):
+        """
+           Send the FETCH of the pending jobs by batch as long as less than max_bytes_in_flight
+           are requested. With force, send at least one batch if nothing is requested.
+        """
+        while self._pending:
+            batch, batch_bytes = [], 0
+            for job in self._pending:
+                if batch and (len(batch) >= self.batch_size or batch_bytes + job[1] > self.max_bytes_in_flight):
+                    break
+                batch.append(job)
+                batch_bytes += job[1]
+
+            if len(batch) < self.batch_size and not force:
+                return
+            if self._bytes_in_flight > 0 and self._bytes_in_flight + batch_bytes > self.max_bytes_in_flight:
+                return
+
+            self._pending = self._pending[len(batch):]
+            self._bytes_in_flight += batch_bytes
+            command = self._conn.fetch_async([job[0] for job in batch], imap_utils.GIMAPFetcher.GET_DATA_ONLY)
+            self._requests.append((batch, batch_bytes, command))
+            force = False
+
+    def _result(self, batch, command):
+        """
+           Return (data, errors) of a completed FETCH. If it failed, fetch the bodies
+           again without pipelining (reconnection and individual fetches)
+        """
+        try:
+            return command.result(), {}
+        except imaplib.IMAP4.error, _:
+            return self._download([job[0] for job in batch])
+
+    def downloaded(self, max_outstanding = 0):
+        """
+           Generator returning (the_id, payload, data, error) for the downloaded bodies.
+           Drive the loop as long as more than max_outstanding bodies are pending
+           then return only the bodies that are already downloaded.
+        """
+        while self._nb_outstanding > 0:
+            if not self._requests:
+                self._request(force = True)
+
+            batch, batch_bytes, command = self._requests[0]
+            if not command.done():
+                if self._nb_outstanding <= max_outstanding:
+                    return
+                self._conn.wait([command])
+
+            self._requests.popleft()
+            data, errors = self._result(batch, command)
+
+            self._bytes_in_flight -= batch_bytes
+            self._request(force = False)
+
+            for the_id, _, payload in batch:
+                self._nb_outstanding -= 1
+                yield the_id, payload, data.get(the_id), errors.get(the_id)
+
+class InlineBodyDownloader(IMAPBodyDownloader):
+    """
+       IMAPBodyDownloader fetching the bodies with the src connection when they are consumed.
+       No connection to open: used for the small syncs (the new emails of the daemon).
+    """
+    def __init__(self, src, batch_size = 50, max_bytes_in_flight = 32 * 1024 * 1024, \
+                 spool_dir = None, spool_min_size = 0): #pylint:disable=R0913
+        """
+           constructor (see IMAPBodyDownloader)
+        """
+        super(InlineBodyDownloader, self).__init__(src, batch_size, max_bytes_in_flight, spool_dir, spool_min_size)
+
+        self._pending = [] # jobs submitted and not fetched yet
+
+    def start(self):
+        """
+           Use the src connection
+        """
+        self._conn = self.src
+        if self.spool_dir:
+            self._conn.set_literal_spool(self.spool_dir, self.spool_min_size)
+
+    def stop(self):
+        """
+           Forget the jobs (the src connection stays open)
+        """
+        self._pending = []
+        if self._conn:
+            self._conn.set_literal_spool(None)
+            self._conn = None
+
+    def submit(self, the_id, size, payload):
+        """
+           Request the body of the_id. size is the expected size (RFC822.SIZE)
+           and payload is returned untouched with the body
+        """
+        self._nb_outstanding += 1
+        self._pending.append((the_id, size or 0, payload))
+
+    def downloaded(self, max_outstanding = 0):
+        """
+           Generator returning (the_id, payload, data, error) for the downloaded bodies.
+           Fetch the bodies by batch as long as more than max_outstanding are pending.
+        """
+        while self._nb_outstanding > max_outstanding:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            data, errors = self._download([job[0] for job in batch])
+
+            for the_id, _, payload in batch:
+                self._nb_outstanding -= 1
+                yield the_id, payload, data.get(the_id), errors.get(the_id)
+
+class LabelJob(object): #pylint:disable=R0903
+    """
+       Labels to apply to a batch of restored emails
+    """
+    def __init__(self, batch_nb, labels_to_apply, labels_to_create, last_id, nb_items): #pylint:disable=R0913
+        self.batch_nb         = batch_nb
+        self.labels_to_apply  = labels_to_apply  # SetMultimap label => imap ids
+        self.labels_to_create = labels_to_create
+        self.last_id          = last_id          # last gm_id of the batch
+        self.nb_items         = nb_items
+
+class LabellingThread(threading.Thread):
+    """
+       Create and apply the labels of the restored emails with its own connection (in ALLMAIL).
+       The jobs are treated in the order of the batches and the last id of a batch 
+       is saved once its labels are applied to be able to resume the restore.
+    """
+    def __init__(self, gmvaulter, conn, op_type, total_nb_emails_to_restore, timer): #pylint:disable=R0913
+        threading.Thread.__init__(self, name = 'gmv-labelling')
+        self.daemon = True
+
+        self.queue                      = Queue.Queue()
+        self.gmvaulter                  = gmvaulter
+        self.src                        = conn
+        self.op_type                    = op_type
+        self.total_nb_emails_to_restore = total_nb_emails_to_restore
+        self.timer                      = timer
+        self.nb_emails_restored         = 0
+        self.error                      = None
+
+    def run(self):
+        """
+           Apply the labels of each job then save the last id of the job
+        """
+        try:
+            self.src.select_folder('ALLMAIL') #go to ALL MAIL to make STORE usable
+            existing_labels = set()
+
+            job = self.queue.get()
+            while job is not None:
+                labels_to_create = [ label for label in job.labels_to_create if label not in existing_labels ]
+                if len(labels_to_create) > 0:
+                    existing_labels = self.src.create_gmail_labels(labels_to_create, existing_labels)
+
+                self._apply_labels(job)
+
+                self.nb_emails_restored += job.nb_items
+                
+                left_emails = (self.total_nb_emails_to_restore - self.nb_emails_restored)
+                if (left_emails > 0): 
+                    elapsed = self.timer.elapsed() #elapsed time in seconds
+                    LOG.critical("\n== Processed %d emails in %s. %d left to be restored "\
+                                 "(time estimate %s). ==\n" % \
+                                 (self.nb_emails_restored, self.timer.seconds_to_human_time(elapsed), \
+                                  left_emails, self.timer.estimate_time_left(self.nb_emails_restored, elapsed, left_emails)))
+
+                # all the previous batches are labelled so the restore can resume after this id
+                if job.last_id is not None:
+                    self.gmvaulter.save_lastid(self.op_type, job.last_id)
+
+                job = self.queue.get()
+        except Exception, err: #pylint:disable-msg=W0703
+            LOG.debug(gmvault_utils.get_exception_traceback())
+            self.error = err
+        finally:
+            self.src.disconnect()
+
+    def _apply_labels(self, job):
+        """
+           associate labels with emails
+        """
+        LOG.critical("Applying labels to the batch %d of emails." % (job.batch_nb))
+        label = None
+        try:
+            for label in job.labels_to_apply.keys():
+                self.src.apply_labels_to(job.labels_to_apply[label], [label]) 
+        except Exception, err:
+            LOG.error("Problem when applying labels %s to the following ids: %s" \
+                      % (label, job.labels_to_apply[label] if label else []), err)
+            if isinstance(err, imap_utils.LabelError) and err.ignore() == True:
+                LOG.critical("Ignore labelling: %s" % (err))
+                LOG.critical("Disconnecting and reconnecting to restart cleanly.")
+                self.src.reconnect() #reconnect
+            elif isinstance(err, imaplib.IMAP4.abort) and str(err).find("=> Gmvault ssl socket error: EOF") >= 0:
+                # if this is a Gmvault SSL Socket error ignore labelling and continue the restore
+                LOG.critical("Ignore labelling")
+                LOG.critical("Disconnecting and reconnecting to restart cleanly.")
+                self.src.reconnect() #reconnect
+            else:
+                raise err
+
+class RestoreUploader(threading.Thread):
+    """
+       Push the emails in the Gmail account with its own connection.
+       Jobs are (batch_nb, gm_id, email_meta, email_data) and results
+       (batch_nb, gm_id, email_meta, imap_id, error).
+    """
+    def __init__(self, conn, folder_def_location, all_mail_name, jobs, results): #pylint:disable=R0913
+        threading.Thread.__init__(self, name = 'gmv-uploader')
+        self.daemon = True
+
+        self.src                 = conn
+        self.folder_def_location = folder_def_location
+        self.all_mail_name       = all_mail_name
+        self.jobs                = jobs
+        self.results             = results
+        self.error               = None
+
+    def run(self):
+        """
+           APPEND the emails received in the jobs queue
+        """
+        try:
+            # stay in an empty folder (Drafts) to be fast
+            self.src.select_folder(self.folder_def_location)
+
+            job = self.jobs.get()
+            while job is not None:
+                batch_nb, gm_id, email_meta, email_data = job
+                try:
+                    LOG.critical("Pushing email body with id %s." % (gm_id))
+                    imap_id = self.src.push_data(self.all_mail_name, email_data, \
+                                                 email_meta[gmvault_db.GmailStorer.FLAGS_K] , \
+                                                 email_meta[gmvault_db.GmailStorer.INT_DATE_K] )
+                    self.results.put((batch_nb, gm_id, email_meta, imap_id, None))
+                except Exception, err: #pylint:disable-msg=W0703
+                    if isinstance(err, imaplib.IMAP4.abort):
+                        LOG.critical("Disconnecting and reconnecting to restart cleanly.")
+                        self.src.reconnect()
+                    self.results.put((batch_nb, gm_id, email_meta, None, err))
+
+                job = self.jobs.get()
+        except Exception, err: #pylint:disable-msg=W0703
+            LOG.debug(gmvault_utils.get_exception_traceback())
+            self.error = err
+        finally:
+            self.src.disconnect()
+
+def _init_sync_worker():
+    """
+       Ignore Ctrl-C in the workers. It is handled by the parent process
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _sync_emails_worker(args):
+    """
+       Sync a part of the ALLMAIL ids in a worker process with its own connection.
+       Return the error report of the worker
+    """
+    db_root_dir, host, port, use_ssl, login, credential, use_encryption, imap_req, compress, part_name, imap_ids = args
+
+    try:
+        # connect like the parent process
+        src = imap_utils.GIMAPFetcher(host, port, login, credential, readonly_folder = True)
+        src.ssl = use_ssl
+        worker = GMVaulter(db_root_dir, host, port, login, credential, read_only_access = True, \
+                           use_encryption = use_encryption, process_safe = True, src = src)
+        worker.sync_part = part_name
+
+        worker.timer.start()
+        worker.src.select_folder('ALLMAIL')
+        worker._common_sync(worker.timer, "email", imap_req, compress, False, imap_ids = imap_ids) #pylint:disable=W0212
+        worker.src.disconnect()
+
+        worker.error_report['reconnections'] = worker.src.total_nb_reconns
+
+        return worker.error_report
+    except Exception, _: #pylint:disable-msg=W0703
+        # tracebacks cannot be sent to the parent process so send the text
+        raise Exception("Error in sync worker %s:\n%s" % (part_name, gmvault_utils.get_exception_traceback()))
+
 class GMVaulter(object):
     """
        Main object operating over gmail
@@ -238,10 +838,22 @@ class GMVaulter(object):
                      }
     
     
+    # Gmail accepts 15 simultaneous connections per account.
+    # sync: 2 per worker (metadata and bodies), the main connection is logged out meanwhile = 14
+    MAX_SYNC_CONNECTIONS    = 7
+    # restore: 1 per uploader + the labelling connection + the main connection and its standby = 13
+    MAX_RESTORE_CONNECTIONS = 10
+
+    # lists of the error report with the (uid, gm_id) of the ids that could not be synced
+    SYNC_ERROR_KEYS = ('empty', 'cannot_be_fetched', 'key_error')
+
     def __init__(self, db_root_dir, host, port, login, \
-                 credential, read_only_access = True, use_encryption = False): #pylint:disable-msg=R0913,R0914
+                 credential, read_only_access = True, use_encryption = False, process_safe = False, \
+                 src = None): #pylint:disable-msg=R0913,R0914
         """
            constructor
+           src: GIMAPFetcher (not connected) to use instead of a new one created from
+                host, port, login and credential
         """   
         self.db_root_dir = db_root_dir
         
@@ -252,8 +864,13 @@ class GMVaulter(object):
         self.login = login
             
         # create source and try to connect
-        self.src = imap_utils.GIMAPFetcher(host, port, login, credential, \
-                                           readonly_folder = read_only_access)
+        # (the sync workers do not keep a standby connection to limit the nb of connections)
+        if src is None:
+            use_standby = gmvault_utils.get_conf_defaults().get_boolean('General', 'keep_standby_connection', True)
+            src = imap_utils.GIMAPFetcher(host, port, login, credential, \
+                                          readonly_folder = read_only_access, \
+                                          use_standby = use_standby and not process_safe)
+        self.src = src
         
         self.src.connect()
         
@@ -269,11 +886,36 @@ class GMVaulter(object):
                               'key_error' : []}
         
         #instantiate gstorer
-        self.gstorer =  gmvault_db.GmailStorer(self.db_root_dir, self.use_encryption)
+        self.gstorer =  gmvault_db.create_storer(self.db_root_dir, self.use_encryption, process_safe)
+
+        # uid => gm_id indexes of ALLMAIL and CHATS (see _get_uid_index)
+        self._uid_indexes = {}
+        self._process_safe = process_safe
+
+        # part of the ids synced by this object when it is a sync worker (see _sync_emails_parallel)
+        self.sync_part = None
+
+        # snapshots taken by _search_ids and deletions planned from them (see _apply_snapshot_plan)
+        self._snapshots      = {}
+        self._deletion_plans = {}
+
+        # batches of emails being restored in parallel (see _restore_emails_parallel)
+        self._restore_batches     = {}
+        self._next_batch_to_label = 0
         
         #timer used to mesure time spent in the different values
         self.timer = gmvault_utils.Timer()
         
+    def _get_uid_index(self, folder):
+        """
+           uid => gm_id index of the predefined folder (ALLMAIL or CHATS)
+        """
+        uid_index = self._uid_indexes.get(folder)
+        if uid_index is None:
+            uid_index = self._uid_indexes[folder] = gmvault_index.UidIndex(self.gstorer.get_info_dir(), self.login, \
+                                                                             folder, shared = self._process_safe)
+        return uid_index
+
     @classmethod
     def get_imap_request_btw_2_dates(cls, begin_date, end_date):
         """
@@ -375,6 +1017,40 @@ class GMVaulter(object):
         return False
     
     
+    def _get_metadata_changes(self, batch, new_data, chat_metadata = False):
+        """
+           Compare the metadata of a batch [(imap id, gmail id, internal date, dir)]
+           with the db. Return (ids not in the db, ids with changed flags or labels).
+           The whole batch is compared in a few queries with the SQLite metadata store.
+        """
+        missing, changed = set(), set()
+
+        metadata_store = self.gstorer.get_metadata_store()
+        if metadata_store is not None:
+            extra_labels = [gmvault_db.GmailStorer.CHAT_GM_LABEL] if chat_metadata else []
+            remote       = []
+            for (the_id, gid, _, the_dir) in batch:
+                if gid is None:
+                    missing.add(gid)
+                    continue
+                remote.append((gid, the_dir, new_data[the_id][imap_utils.GIMAPFetcher.IMAP_FLAGS], \
+                               self.gstorer.normalize_labels(new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_LABELS], \
+                                                             extra_labels)))
+
+            db_missing, db_changed = metadata_store.diff(remote)
+            return missing | db_missing, db_changed
+
+        for (the_id, gid, _, the_dir) in batch:
+            #pass the dir and the ID
+            curr_metadata = GMVaulter.check_email_on_disk(self.gstorer, gid, the_dir)
+
+            if not curr_metadata:
+                missing.add(gid)
+            elif self._metadata_needs_update(curr_metadata, new_data[the_id], chat_metadata):
+                changed.add(gid)
+
+        return missing, changed
+
     def _check_email_db_ownership(self, ownership_control):
         """
            Check email database ownership.
@@ -427,12 +1103,25 @@ class GMVaulter(object):
         return imap_ids
 
 
-    def _common_sync(self, a_timer, a_type, imap_req, compress, restart):
+    def _common_sync(self, a_timer, a_type, imap_req, compress, restart, imap_ids = None):
         """
            common syncing method for both emails and chats. 
+           If imap_ids is passed only these ids are synced.
         """
-        # get all imap ids in All Mail
-        imap_ids = self.src.search(imap_req)
+        folder    = 'ALLMAIL' if a_type == "email" else 'CHATS'
+        watermark = None # watermark to save at the end
+        all_new   = False # True if the ids are known to be missing from the db
+        nb_errors = self._get_nb_sync_errors()
+        if imap_ids is None:
+            # get all imap ids in All Mail
+            imap_ids, modseq = self._search_ids(folder, imap_req)
+            imap_ids  = collections_utils.IdSet(imap_ids)
+            watermark = self._get_new_watermark(folder, imap_req, imap_ids, modseq)
+
+            new_ids = self._apply_snapshot_plan(folder, a_type)
+            if new_ids is not None:
+                imap_ids, all_new = new_ids, True
+        imap_ids = collections_utils.IdSet(imap_ids)
 
         last_id_file = self.OP_EMAIL_SYNC if a_type == "email" else self.OP_CHAT_SYNC
         
@@ -445,12 +1134,29 @@ class GMVaulter(object):
         
         LOG.critical("%d %ss to be fetched." % (total_nb_msgs_to_process, a_type))
         
-        nb_msgs_processed = 0
+        # the uid => gm_id of the fetched ids are kept to find the deleted ones quickly
+        self._get_uid_index(folder).set_uidvalidity(self.src.uidvalidity)
         
-        to_fetch = set(imap_ids)
+        fetched = collections_utils.id_array() # ids returned by the server
+        nb_messages_per_batch = gmvault_utils.get_conf_defaults().getint("General","nb_messages_per_batch",500)
         batch_fetcher = IMAPBatchFetcher(self.src, imap_ids, self.error_report, imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA, \
-                                         default_batch_size = \
-                                         gmvault_utils.get_conf_defaults().getint("General","nb_messages_per_batch",500))
+                                         default_batch_size = nb_messages_per_batch)
+
+        # the bodies of the new emails are downloaded with another connection
+        # while the metadata of the next batch are requested (with the same one when
+        # there are few emails to not open a connection for them).
+        # The big bodies are written to disk while they are received
+        spool_min_size = gmvault_utils.get_conf_defaults().getint("General", "spool_body_min_size", 1048576)
+        nb_messages_per_body_batch = gmvault_utils.get_conf_defaults().getint("General", "nb_messages_per_body_batch", 50)
+        if total_nb_msgs_to_process <= nb_messages_per_body_batch:
+            downloader_class = InlineBodyDownloader
+        elif self.src.is_pipelined():
+            downloader_class = PipelinedBodyDownloader
+        else:
+            downloader_class = IMAPBodyDownloader
+        downloader = downloader_class(self.src, nb_messages_per_body_batch, \
+                                      gmvault_utils.get_conf_defaults().getint("General", "max_body_bytes_in_flight", 33554432), \
+                                      self.gstorer.get_spool_dir() if spool_min_size > 0 else None, spool_min_size)
         
         #choose different bury methods if it is an email or a chat
         if a_type == "email":
@@ -464,8 +1170,104 @@ class GMVaulter(object):
         else:
             raise Exception("Error a_type %s in _common_sync is unknown" % (a_type))
         
+        if total_nb_msgs_to_process > 0:
+            downloader.start()
+
+        try:
+            self._common_sync_loop(a_timer, a_type, imap_req, compress, last_id_file, \
+                                   batch_fetcher, downloader, fetched, total_nb_msgs_to_process, \
+                                   (bury_metadata_fn, bury_data_fn, chat_metadata), nb_messages_per_batch, all_new)
+        finally:
+            downloader.stop()
+                
+        for the_id in imap_ids - collections_utils.IdSet(fetched):
+            # case when gmail IMAP server returns OK without any data whatsoever
+            # eg. imap uid 142221L ignore it
+            LOG.info("Could not process imap with id %s. Ignore it\n" % (the_id))
+            self.error_report['empty'].append((the_id, None))
+        
+        if watermark is not None:
+            # the ids that could not be synced are synced again next time
+            watermark['failed_uids'] = self._get_failed_uids(nb_errors)
+            self.save_watermark(folder, watermark)
+        
+        return imap_ids
+
+    def _sync_progress(self, a_timer, nb_msgs_processed, total_nb_msgs_to_process, last_id_file, gid, eml_date, \
+                       imap_req, can_save_lastid = True):
+        """
+           Report the sync progress and save the last id
+        """
+        #indicate every 50 messages the number of messages left to process
+        left_emails = (total_nb_msgs_to_process - nb_msgs_processed)
+        
+        if (nb_msgs_processed % 50) == 0 and (left_emails > 0):
+            elapsed = a_timer.elapsed() #elapsed time in seconds
+            LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" % \
+                         (nb_msgs_processed,  \
+                          a_timer.seconds_to_human_time(elapsed), left_emails, \
+                          a_timer.estimate_time_left(nb_msgs_processed, elapsed, left_emails)))
+        
+        # save id every 10 restored emails
+        if (nb_msgs_processed % 10) == 0 and can_save_lastid:
+            if gid:
+                self.save_lastid(last_id_file, gid, eml_date, imap_req)
+
+    def _store_downloaded_bodies(self, a_timer, a_type, imap_req, compress, last_id_file, downloader, \
+                                 nb_msgs_processed, total_nb_msgs_to_process, bury_data_fn, max_outstanding = 0):
+        """
+           Store on disk the bodies downloaded by the downloader.
+           Wait while more than max_outstanding bodies are still to be downloaded.
+           Return the new number of processed messages
+        """
+        for the_id, (gid, eml_date, the_dir, metadata), email_data, error in downloader.downloaded(max_outstanding):
+            try:
+                if error:
+                    raise error #pylint:disable-msg=E0702
+
+                if email_data is None:
+                    LOG.info("Could not get the data of %s with imap id %s. Ignore it\n" % (a_type, the_id))
+                    self.error_report['empty'].append((the_id, gid))
+                else:
+                    metadata[imap_utils.GIMAPFetcher.EMAIL_BODY] = email_data[imap_utils.GIMAPFetcher.EMAIL_BODY]
+                    
+                    LOG.debug("Storing on disk data for %s" % (gid))
+                    # store data on disk within year month dir 
+                    gid  = bury_data_fn(metadata, local_dir = the_dir, compress = compress)
+                    
+                    #update local index id gid => index per directory to be thought out
+                    LOG.debug("Create and store email with imap id %s, gmail id %s." % (the_id, gid))   
+            except Exception, error:
+                # the error comes from the downloader connection: do not use src, the gmail id is known
+                handle_sync_imap_error(error, the_id, self.error_report, self.src, gmail_id = gid)
+
+            nb_msgs_processed += 1
+
+            # bodies are returned in order so all the previous messages are stored
+            self._sync_progress(a_timer, nb_msgs_processed, total_nb_msgs_to_process, last_id_file, \
+                                gid, eml_date, imap_req)
+
+        return nb_msgs_processed
+
+    def _common_sync_loop(self, a_timer, a_type, imap_req, compress, last_id_file, batch_fetcher, downloader, \
+                          fetched, total_nb_msgs_to_process, bury_fns, nb_messages_per_batch, \
+                          all_new = False): #pylint:disable=R0912,R0913,R0914
+        """
+           Process the metadata batches and store the downloaded bodies.
+           The ids returned by the server are appended to fetched.
+           all_new: the messages are not compared with the db (they are known to be missing)
+           Return the number of processed messages
+        """
+        bury_metadata_fn, bury_data_fn, chat_metadata = bury_fns
+
+        uid_index = self._get_uid_index('ALLMAIL' if a_type == "email" else 'CHATS')
+
+        nb_msgs_processed = 0
+
         #LAST Thing to do remove all found ids from imap_ids and if ids left add missing in report
         for new_data in batch_fetcher:            
+            # (imap id, gmail id, internal date, dir) of the emails to check against the db
+            batch = []
             for the_id in new_data:
                 if new_data.get(the_id, None):
                     LOG.debug("\nProcess imap id %s" % ( the_id ))
@@ -485,8 +1287,6 @@ class GMVaulter(object):
                     else:
                         raise Exception("Error a_type %s in _common_sync is unknown" % (a_type))
                     
-                    LOG.critical("Process %s num %d (imap_id:%s) from %s." % (a_type, nb_msgs_processed, the_id, the_dir))
-                    
                     #decode the labels that are received as utf7 => unicode
                     try:
                         new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_LABELS] = \
@@ -507,74 +1307,61 @@ class GMVaulter(object):
                             continue
 
                     LOG.debug("metadata info collected: %s\n" % (new_data[the_id]))
-                
-                    #pass the dir and the ID
-                    curr_metadata = GMVaulter.check_email_on_disk( self.gstorer , \
-                                                                   new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_ID], \
-                                                                   the_dir)
-                    
-                    #if on disk check that the data is not different
-                    if curr_metadata:
-                        
-                        LOG.debug("metadata for %s already exists. Check if different." % (gid))
-                        
-                        if self._metadata_needs_update(curr_metadata, new_data[the_id], chat_metadata):
-                            
-                            LOG.debug("%s with imap id %s and gmail id %s has changed. Updated it." % (a_type, the_id, gid))
-                            
-                            #restore everything at the moment
-                            gid  = bury_metadata_fn(new_data[the_id], local_dir = the_dir)
-                            
-                            #update local index id gid => index per directory to be thought out
-                        else:
-                            LOG.debug("On disk metadata for %s is up to date." % (gid))
-                    else:  
-                        try:
-                            #get the data
-                            LOG.debug("Get Data for %s." % (gid))
-                            email_data = self.src.fetch(the_id, imap_utils.GIMAPFetcher.GET_DATA_ONLY )
-                            
-                            new_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY] = \
-                            email_data[the_id][imap_utils.GIMAPFetcher.EMAIL_BODY]
-                            
-                            LOG.debug("Storing on disk data for %s" % (gid))
-                            # store data on disk within year month dir 
-                            gid  = bury_data_fn(new_data[the_id], local_dir = the_dir, compress = compress)
-                            
-                            #update local index id gid => index per directory to be thought out
-                            LOG.debug("Create and store email with imap id %s, gmail id %s." % (the_id, gid))   
-                        except Exception, error:
-                            handle_sync_imap_error(error, the_id, self.error_report, self.src) #do everything in this handler    
-                    
-                    nb_msgs_processed += 1
-                    
-                    #indicate every 50 messages the number of messages left to process
-                    left_emails = (total_nb_msgs_to_process - nb_msgs_processed)
-                    
-                    if (nb_msgs_processed % 50) == 0 and (left_emails > 0):
-                        elapsed = a_timer.elapsed() #elapsed time in seconds
-                        LOG.critical("\n== Processed %d emails in %s. %d left to be stored (time estimate %s).==\n" % \
-                                     (nb_msgs_processed,  \
-                                      a_timer.seconds_to_human_time(elapsed), left_emails, \
-                                      a_timer.estimate_time_left(nb_msgs_processed, elapsed, left_emails)))
-                    
-                    # save id every 10 restored emails
-                    if (nb_msgs_processed % 10) == 0:
-                        if gid:
-                            self.save_lastid(last_id_file, gid, eml_date, imap_req)
+
+                    batch.append((the_id, gid, eml_date, the_dir))
                 else:
                     LOG.info("Could not process message with id %s. Ignore it\n" % (the_id))
-                    self.error_report['empty'].append((the_id, gid if gid else None))
+                    self.error_report['empty'].append((the_id, None))
+
+            # compare the whole batch with the db
+            if all_new:
+                missing, changed = set(gid for (_, gid, _, _) in batch), set()
+            else:
+                missing, changed = self._get_metadata_changes(batch, new_data, chat_metadata)
+
+            for (the_id, gid, eml_date, the_dir) in batch:
+                LOG.critical("Process %s num %d (imap_id:%s) from %s." % (a_type, nb_msgs_processed, the_id, the_dir))
+
+                #if on disk check that the data is not different
+                if gid not in missing:
                     
-            to_fetch -= set(new_data.keys()) #remove all found keys from to_fetch set
+                    LOG.debug("metadata for %s already exists. Check if different." % (gid))
+                    
+                    if gid in changed:
+                        
+                        LOG.debug("%s with imap id %s and gmail id %s has changed. Updated it." % (a_type, the_id, gid))
+                        
+                        #restore everything at the moment
+                        gid  = bury_metadata_fn(new_data[the_id], local_dir = the_dir)
+                        
+                        #update local index id gid => index per directory to be thought out
+                    else:
+                        LOG.debug("On disk metadata for %s is up to date." % (gid))
+                else:  
+                    #get the data with the downloader. It will be stored when received
+                    LOG.debug("Get Data for %s." % (gid))
+                    downloader.submit(the_id, new_data[the_id].get(imap_utils.GIMAPFetcher.IMAP_RFC822_SIZE), \
+                                      (gid, eml_date, the_dir, new_data[the_id]))
+                    continue
                 
-        for the_id in to_fetch:
-            # case when gmail IMAP server returns OK without any data whatsoever
-            # eg. imap uid 142221L ignore it
-            LOG.info("Could not process imap with id %s. Ignore it\n" % (the_id))
-            self.error_report['empty'].append((the_id, None))
-        
-        return imap_ids
+                nb_msgs_processed += 1
+
+                # save the last id only if no previous body is still being downloaded
+                self._sync_progress(a_timer, nb_msgs_processed, total_nb_msgs_to_process, last_id_file, \
+                                    gid, eml_date, imap_req, can_save_lastid = (downloader.nb_outstanding() == 0))
+                    
+            fetched.extend(new_data.keys()) #the ids never returned are reported at the end
+            uid_index.update((the_id, new_data[the_id][imap_utils.GIMAPFetcher.GMAIL_ID]) for the_id in new_data \
+                             if new_data[the_id] and new_data[the_id].get(imap_utils.GIMAPFetcher.GMAIL_ID))
+
+            # store the bodies downloaded in the meantime and wait if the downloader
+            # is late by more than one batch of metadata
+            nb_msgs_processed = self._store_downloaded_bodies(a_timer, a_type, imap_req, compress, last_id_file, \
+                                                              downloader, nb_msgs_processed, total_nb_msgs_to_process, \
+                                                              bury_data_fn, max_outstanding = nb_messages_per_batch)
+
+        return self._store_downloaded_bodies(a_timer, a_type, imap_req, compress, last_id_file, downloader, \
+                                             nb_msgs_processed, total_nb_msgs_to_process, bury_data_fn)
 
     def _sync_emails(self, imap_req, compress, restart):
         """
@@ -588,6 +1375,95 @@ class GMVaulter(object):
 
         imap_ids = self._common_sync(timer, "email", imap_req, compress, restart)
 
+        # the sync is complete so the checkpoints of a previous parallel sync are obsolete
+        self._delete_sync_parts(self.OP_EMAIL_SYNC)
+
+        LOG.critical("\nEmails synchronisation operation performed in %s.\n" % (timer.seconds_to_human_time(timer.elapsed())))
+
+        return imap_ids
+
+    def _sync_emails_parallel(self, imap_req, compress, restart, nb_connections):
+        """
+           sync emails with nb_connections workers. 
+           The ALLMAIL ids are split in nb_connections ranges of consecutive ids and each
+           range is synced by a worker process with its own IMAP connection.
+        """
+        timer = gmvault_utils.Timer()
+        timer.start()
+
+        nb_errors = self._get_nb_sync_errors()
+
+        self.src.select_folder('ALLMAIL')
+
+        imap_ids, modseq = self._search_ids('ALLMAIL', imap_req)
+        imap_ids  = collections_utils.IdSet(imap_ids)
+        watermark = self._get_new_watermark('ALLMAIL', imap_req, imap_ids, modseq)
+
+        new_ids = self._apply_snapshot_plan('ALLMAIL', 'email')
+        if new_ids is not None:
+            imap_ids = collections_utils.IdSet(new_ids)
+
+        if restart:
+            LOG.critical("Restart mode activated for emails. Need to find information in Gmail, be patient ...")
+            imap_ids = self.get_gmails_ids_left_to_sync(self.OP_EMAIL_SYNC, imap_ids, imap_req)
+
+        if not imap_ids:
+            LOG.critical("0 emails to be fetched.")
+            return imap_ids
+
+        # the workers add their uids to the shared uid index
+        self._get_uid_index('ALLMAIL').set_uidvalidity(self.src.uidvalidity)
+
+        # create the shared state of the db before the workers start:
+        # encryption key and compacted gm_id index
+        if self.use_encryption:
+            self.gstorer.get_encryption_cipher()
+        self.gstorer.get_index().compact()
+
+        nb_connections = min(nb_connections, len(imap_ids))
+        part_size      = (len(imap_ids) + nb_connections - 1) / nb_connections
+        parts          = [imap_ids[i:i + part_size] for i in xrange(0, len(imap_ids), part_size)]
+
+        LOG.critical("%d emails to be fetched with %d connections." % (len(imap_ids), len(parts)))
+
+        jobs = [ (self.db_root_dir, self.src.host, self.src.port, self.src.ssl, self.login, self.src.credential, \
+                  self.use_encryption, imap_req, compress, '%s-%s' % (part[0], part[-1]), part) for part in parts ]
+
+        # leave the main connection and its standby to the workers (see MAX_SYNC_CONNECTIONS)
+        self.src.disconnect()
+
+        pool = multiprocessing.Pool(len(parts), _init_sync_worker)
+        try:
+            # use a timeout with get to be able to catch a KeyboardInterrupt
+            reports = pool.map_async(_sync_emails_worker, jobs, chunksize = 1).get(365 * 24 * 3600)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.src.connect(go_to_current_folder = True)
+
+        #merge the workers reports
+        for report in reports:
+            for key in ('empty', 'cannot_be_fetched', 'emails_in_quarantine', 'key_error'):
+                self.error_report[key].extend(report[key])
+            self.src.total_nb_reconns += report['reconnections']
+
+        # get the emails stored by the workers
+        self.gstorer.reload_index()
+        self._get_uid_index('ALLMAIL').reload()
+
+        # all ranges are synced: replace the checkpoints of the workers by a global one
+        last = self.src.fetch(imap_ids[-1], imap_utils.GIMAPFetcher.GET_GMAIL_ID)
+        if last.get(imap_ids[-1]):
+            self.save_lastid(self.OP_EMAIL_SYNC, last[imap_ids[-1]][imap_utils.GIMAPFetcher.GMAIL_ID])
+        self._delete_sync_parts(self.OP_EMAIL_SYNC)
+
+        if watermark is not None:
+            watermark['failed_uids'] = self._get_failed_uids(nb_errors)
+            self.save_watermark('ALLMAIL', watermark)
+
         LOG.critical("\nEmails synchronisation operation performed in %s.\n" % (timer.seconds_to_human_time(timer.elapsed())))
 
         return imap_ids
@@ -596,9 +1472,10 @@ class GMVaulter(object):
 
     def sync(self, imap_req, compress_on_disk = True, \
              db_cleaning = False, ownership_checking = True, \
-            restart = False, emails_only = False, chats_only = False):
+            restart = False, emails_only = False, chats_only = False, connections = 1):
         """
            sync mode 
+           connections: nb of IMAP connections used in parallel to sync the emails
         """
         #check ownership to have one email per db unless user wants different
         #save the owner if new
@@ -623,7 +1500,11 @@ class GMVaulter(object):
         if not chats_only:
             # backup emails
             LOG.critical("Start emails synchronization.")
-            self._sync_emails(imap_req, compress = compress_on_disk, restart = restart)
+            if connections > 1:
+                self._sync_emails_parallel(imap_req, compress = compress_on_disk, restart = restart, \
+                                           nb_connections = min(connections, self.MAX_SYNC_CONNECTIONS))
+            else:
+                self._sync_emails(imap_req, compress = compress_on_disk, restart = restart)
         else:
             LOG.critical("Skip emails synchronization.\n")
         
@@ -646,43 +1527,145 @@ class GMVaulter(object):
         
         return self.error_report
 
-    
-    def _delete_sync(self, imap_ids, db_gmail_ids, db_gmail_ids_info, msg_type):
+    def daemon(self, compress_on_disk = True, ownership_checking = True, \
+               emails_only = False, chats_only = False, max_nb_wakeups = None):
+        """
+           daemon mode: keep the connection open and run a watermark sync each time
+           the server reports changes in All Mail (IDLE, or a NOOP poll without IDLE).
+           The chats are synced at each wake up (no second connection to wait on Chats).
+           max_nb_wakeups: stop after this nb of wake ups (None: run until interrupted)
+        """
+        self.error_report['operation'] = 'Daemon'
+
+        self.timer.start()
+
+        self._check_email_db_ownership(ownership_checking)
+
+        if not compress_on_disk:
+            LOG.critical("Disable compression when storing emails.")
+
+        if self.use_encryption:
+            LOG.critical("Encryption activated. All emails will be encrypted before to be stored.")
+            LOG.critical("Please take care of the encryption key stored in (%s) or all"\
+                         " your stored emails will become unreadable." \
+                         % (gmvault_db.GmailStorer.get_encryption_key_path(self.db_root_dir)))
+
+        imap_req = { 'mode': 'watermark', 'type': 'imap', 'req': 'ALL' }
+        folder   = 'CHATS' if chats_only else 'ALLMAIL'
+
+        if self.src.has_idle():
+            timeout = gmvault_utils.get_conf_defaults().getint("Sync", "idle_timeout", 540)
+            LOG.critical("Daemon mode. Wait for the new emails with IMAP IDLE.\n")
+        else:
+            timeout = gmvault_utils.get_conf_defaults().getint("Sync", "poll_interval", 60)
+            LOG.critical("Daemon mode. IMAP IDLE not available, check for new emails every %d sec.\n" % (timeout))
+
+        nb_wakeups, changes = 0, True
+        try:
+            while True:
+                # the emails are synced only when the server reported changes or IDLE timed out
+                if not chats_only and (changes or self.src.has_idle()):
+                    self._sync_emails(imap_req, compress = compress_on_disk, restart = False)
+
+                if not emails_only:
+                    self._sync_chats(imap_req, compress = compress_on_disk, restart = False)
+
+                self.error_report["reconnections"] = self.src.total_nb_reconns
+
+                if max_nb_wakeups is not None and nb_wakeups >= max_nb_wakeups:
+                    break
+
+                if folder == 'CHATS' and not self.src.is_visible('CHATS'):
+                    # nothing to wait on
+                    time.sleep(timeout)
+                else:
+                    self.src.select_folder(folder)
+                    responses = self.src.wait_for_changes(timeout)
+                    changes = any(isinstance(resp, tuple) and len(resp) > 1 and \
+                                  resp[1] in ('EXISTS', 'EXPUNGE', 'FETCH') for resp in responses)
+                    LOG.debug("Wake up. Server responses: %s" % (responses))
+
+                nb_wakeups += 1
+        finally:
+            self.error_report["operation_time"] = self.timer.seconds_to_human_time(self.timer.elapsed())
+
+        return self.error_report
+
+    def _delete_sync(self, imap_ids, db_gmail_ids, db_gmail_ids_info, msg_type, uid_index): #pylint:disable=R0913,R0914
         """
            Delete emails or chats from the database if necessary
            imap_ids      : all remote imap_ids to check
+           db_gmail_ids  : IdSet of the gmail ids of the db
            db_gmail_ids_info : info read from metadata
            msg_type : email or chat
+           uid_index : gmvault_index.UidIndex of the folder. Only the gmail ids of
+                       the uids that are not in it are fetched
         """
+        imap_ids = collections_utils.IdSet(imap_ids)
+        
+        # forget the uids deleted from the folder
+        uid_index.remove_uids([uid for uid, _ in uid_index.iteritems() if uid not in imap_ids])
+        
+        # one flag per db gmail id (in the order of the IdSet) set when it is found in Gmail
+        found = bytearray(len(db_gmail_ids))
+        
+        def mark_found(gm_id):
+            """ flag gm_id. Return 1 if it is a db id not yet flagged """
+            if gm_id in db_gmail_ids:
+                index = db_gmail_ids.index(gm_id)
+                if not found[index]:
+                    found[index] = 1
+                    return 1
+            return 0
+        
+        nb_found     = 0
+        unknown_uids = collections_utils.id_array()
+        for uid in imap_ids:
+            gm_id = uid_index.get(uid)
+            if gm_id is None:
+                unknown_uids.append(uid)
+            else:
+                nb_found += mark_found(gm_id)
+        unknown_uids = collections_utils.IdSet(unknown_uids)
         
         # optimize nb of items
-        nb_items = self.NB_GRP_OF_ITEMS if len(imap_ids) >= self.NB_GRP_OF_ITEMS else len(imap_ids)
+        nb_items = max(1, min(self.NB_GRP_OF_ITEMS, len(unknown_uids)))
         
-        LOG.critical("Call Gmail to check the stored %ss against the Gmail %ss ids and see which ones have been deleted.\n\n"\
-                     "This might take a few minutes ...\n" % (msg_type, msg_type)) 
+        LOG.critical("Call Gmail to check the stored %ss against the Gmail %ss ids and see which ones have been deleted.\n"\
+                     "%d ids known from the previous syncs, get the gmail ids of %d ids ...\n" \
+                     % (msg_type, msg_type, len(imap_ids) - len(unknown_uids), len(unknown_uids))) 
          
-        #calculate the list elements to delete
         #query nb_items items in one query to minimise number of imap queries
-        for group_imap_id in itertools.izip_longest(fillvalue=None, *[iter(imap_ids)]*nb_items):
+        #the ids are sent as a sequence set (1:500,502) to keep the requests small
+        for group_imap_id in unknown_uids.chunks(nb_items):
             
-            # if None in list remove it
-            if None in group_imap_id: 
-                group_imap_id = [ im_id for im_id in group_imap_id if im_id != None ]
+            if nb_found == len(db_gmail_ids):
+                break
             
-            data = self.src.fetch(group_imap_id, imap_utils.GIMAPFetcher.GET_GMAIL_ID)
+            data = self.src.fetch(group_imap_id.sequence_set(), imap_utils.GIMAPFetcher.GET_GMAIL_ID)
             
-            # syntax for 2.7 set comprehension { data[key][imap_utils.GIMAPFetcher.GMAIL_ID] for key in data }
-            # need to create a list for 2.6
-            db_gmail_ids.difference_update([data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID) for key in data if data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID)])
+            uid_index.update((key, data[key][imap_utils.GIMAPFetcher.GMAIL_ID]) \
+                             for key in data if data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID))
             
-            if len(db_gmail_ids) == 0:
-                break
+            for key in data:
+                nb_found += mark_found(data[key].get(imap_utils.GIMAPFetcher.GMAIL_ID))
         
-        LOG.critical("Will delete %s %s(s) from gmvault db.\n" % (len(db_gmail_ids), msg_type) )
-        for gm_id in db_gmail_ids:
+        LOG.critical("Will delete %s %s(s) from gmvault db.\n" % (len(db_gmail_ids) - nb_found, msg_type) )
+        for gm_id in itertools.compress(db_gmail_ids, (not flag for flag in found)):
             LOG.critical("gm_id %s not in the Gmail server. Delete it." % (gm_id))
             self.gstorer.delete_emails([(gm_id, db_gmail_ids_info[gm_id])], msg_type)
         
+    def _delete_planned(self, deleted, msg_type):
+        """
+           Delete the (gm_id, dir) of a sync plan from the database
+        """
+        LOG.critical("Will delete %s %s(s) from gmvault db.\n" % (len(deleted), msg_type))
+        for gm_id, _ in deleted:
+            LOG.critical("gm_id %s not in the Gmail server. Delete it." % (gm_id))
+
+        # delete_emails expects the last part of the dirs (month or sub chats dir)
+        self.gstorer.delete_emails([(gm_id, the_dir[the_dir.rfind('/') + 1:]) for gm_id, the_dir in deleted], msg_type)
+
     def search_on_date(self, a_eml_date):
         """
            get eml_date and format it to search 
@@ -695,10 +1678,214 @@ class GMVaulter(object):
         
         return imap_ids
             
+    def _get_watermark_path(self, folder):
+        """
+           Path of the watermark of the predefined folder (ALLMAIL or CHATS)
+        """
+        return '%s/%s_%s.watermark' % (self.gstorer.get_info_dir(), self.login, folder.lower())
+
+    def load_watermark(self, folder):
+        """
+           Return the watermark of folder { 'last_uid' : highest synced uid,
+           'highestmodseq' : HIGHESTMODSEQ when it was synced (or None),
+           'failed_uids' : uids that could not be synced } if it was saved
+           for its current UIDVALIDITY, otherwise None
+        """
+        filepath = self._get_watermark_path(folder)
+        if not os.path.exists(filepath):
+            return None
+
+        with open(filepath, 'r') as f:
+            watermark = json.load(f)
+
+        if watermark.get('uidvalidity') != self.src.uidvalidity:
+            LOG.critical("UIDVALIDITY of %s changed (%s => %s). Ignore the watermark." \
+                         % (folder, watermark.get('uidvalidity'), self.src.uidvalidity))
+            return None
+
+        return { 'last_uid' : watermark['last_uid'], 'highestmodseq' : watermark.get('highestmodseq'), \
+                 'failed_uids' : watermark.get('failed_uids', []) }
+
+    def save_watermark(self, folder, watermark):
+        """
+           Save the watermark of folder (see load_watermark) with its UIDVALIDITY
+        """
+        filepath = self._get_watermark_path(folder)
+        with open('%s.tmp' % (filepath), 'w') as f:
+            json.dump(dict(watermark, uidvalidity = self.src.uidvalidity), f)
+        gmvault_utils.atomic_rename('%s.tmp' % (filepath), filepath)
+
+    def _search_ids(self, folder, imap_req):
+        """
+           Search the ids to sync in the selected folder.
+           All the ids come from a snapshot of the folder with [Sync] metadata_snapshot.
+           In watermark mode, these are the uids above the watermark, the uids that could
+           not be synced last time and the ids whose labels or flags changed since the
+           watermark (CONDSTORE) or, without CONDSTORE, the emails of the last quick_days days.
+           Return the ids and the HIGHESTMODSEQ up to which the changes are in the ids
+        """
+        if imap_req.get('mode') != 'watermark':
+            if imap_req.get('type') == 'imap' and imap_req.get('req', '').upper() == 'ALL' and \
+               gmvault_utils.get_conf_defaults().get_boolean("Sync", "metadata_snapshot", False):
+                modseq = self.src.highestmodseq
+                return self._get_snapshot_ids(folder), modseq
+            return self.src.search(imap_req), self.src.highestmodseq
+
+        watermark = self.load_watermark(folder)
+        if watermark is None:
+            LOG.critical("No watermark for %s. Sync all the ids." % (folder))
+            return self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL), self.src.highestmodseq
+
+        last_uid = watermark['last_uid']
+
+        # UID n:* returns the highest uid even if it is lower than n
+        new_ids = [uid for uid in self.src.search({'type': 'imap', 'req': 'UID %d:*' % (last_uid + 1)}) \
+                   if uid > last_uid]
+
+        # the failed uids that still exist
+        if watermark['failed_uids']:
+            failed_ids = self.src.search({'type': 'imap', 'req': 'UID %s' \
+                                          % (collections_utils.IdSet(watermark['failed_uids']).sequence_set())})
+            LOG.critical("%d ids in %s could not be synced last time. Sync them again." % (len(failed_ids), folder))
+            new_ids += failed_ids
+
+        modseq = watermark['highestmodseq']
+        if modseq is not None and self.src.has_condstore():
+            changed_ids, highest_modseq = self.src.get_changed_since(modseq)
+            LOG.critical("%d new ids in %s above the watermark (uid %s). %d ids changed since modseq %s." \
+                         % (len(new_ids), folder, last_uid, len(changed_ids), modseq))
+            return new_ids + changed_ids, highest_modseq
+
+        begin = datetime.date.today() - datetime.timedelta(gmvault_utils.get_conf_defaults().getint("Sync", "quick_days", 8))
+        recent_ids = self.src.search({'type': 'imap', 'req': 'SINCE %s' % (gmvault_utils.datetime2imapdate(begin))})
+
+        LOG.critical("%d new ids in %s above the watermark (uid %s). Check the %d ids since %s." \
+                     % (len(new_ids), folder, last_uid, len(recent_ids), begin.strftime('%d-%b-%Y')))
+
+        return new_ids + recent_ids, self.src.highestmodseq
+
+    def take_snapshot(self, folder):
+        """
+           Snapshot of the metadata of all the messages of the selected predefined folder
+           (ALLMAIL or CHATS) taken with one streamed FETCH. Return (snapshot, nb of messages)
+        """
+        filepath = '%s/%s_%s.snapshot' % (self.gstorer.get_info_dir(), self.login, folder.lower())
+        return gmvault_snapshot.MetadataSnapshot.take(filepath, self.src)
+
+    def _get_snapshot_ids(self, folder):
+        """
+           Take a snapshot of folder instead of searching all its ids.
+           Its gm_ids are added to the uid index (no fetch in the deletion check).
+        """
+        timer = gmvault_utils.Timer()
+        timer.start()
+
+        snapshot, nb_messages = self.take_snapshot(folder)
+        LOG.critical("Snapshot of the metadata of the %d messages of %s taken in %s." \
+                     % (nb_messages, folder, timer.elapsed_human_time()))
+        self._snapshots[folder] = snapshot
+
+        imap_ids = collections_utils.id_array()
+
+        def uid_gm_ids():
+            """ (uid, gm_id) of the snapshot """
+            for record in snapshot:
+                imap_ids.append(record[snapshot.UID])
+                yield record[snapshot.UID], record[snapshot.GM_ID]
+
+        uid_index = self._get_uid_index(folder)
+        uid_index.set_uidvalidity(self.src.uidvalidity)
+        uid_index.update(uid_gm_ids())
+
+        return imap_ids
+
+    def get_sync_plan(self, snapshot, a_type):
+        """
+           Merge-join the snapshot (sorted by gm_id) with the emails or chats (a_type)
+           of the db read in gm_id order. Return the gmvault_snapshot.SyncPlan
+        """
+        extra_labels = [gmvault_db.GmailStorer.CHAT_GM_LABEL] if a_type == "chat" else []
+        normalised   = {} # the same few label lists are normalised once
+
+        def remote():
+            """ (gm_id, uid, dir, flags, labels) of the snapshot """
+            for record in snapshot.iter_by_gm_id():
+                # the chats are stored in any sub chats dir
+                the_dir = gmvault_utils.get_ym_from_datetime(gmvault_utils.e2datetime(record[snapshot.INT_DATE])) \
+                          if a_type == "email" else None
+
+                labels = tuple(record[snapshot.LABELS])
+                if labels not in normalised:
+                    normalised[labels] = self.gstorer.normalize_labels(labels, extra_labels)
+
+                yield record[snapshot.GM_ID], record[snapshot.UID], the_dir, record[snapshot.FLAGS], normalised[labels]
+
+        msg_type = 'chat' if a_type == "chat" else 'email'
+        return gmvault_snapshot.diff(remote(), self.gstorer.iter_sorted_metadata(msg_type))
+
+    def _apply_snapshot_plan(self, folder, a_type):
+        """
+           If a snapshot of folder was taken by _search_ids, plan the sync with it,
+           update the changed metadata and keep the deletions for check_clean_db.
+           Return the uids of the messages to fetch or None without snapshot
+        """
+        snapshot = self._snapshots.pop(folder, None)
+        if snapshot is None:
+            return None
+
+        timer = gmvault_utils.Timer()
+        timer.start()
+
+        plan = self.get_sync_plan(snapshot, a_type)
+
+        LOG.critical("Compared the snapshot of %s with the db in %s: %d new %ss, %d with new flags or labels, "\
+                     "%d only in the db." % (folder, timer.elapsed_human_time(), len(plan.new), a_type, \
+                                             len(plan.updated), len(plan.deleted)))
+
+        self.gstorer.update_metadata(plan.updated)
+
+        if snapshot.complete:
+            self._deletion_plans[folder] = plan.deleted
+        else:
+            LOG.critical("The snapshot of %s is incomplete. Its deletions are ignored." % (folder))
+
+        return plan.new
+
+    def _get_new_watermark(self, folder, imap_req, imap_ids, modseq):
+        """
+           Watermark to save once imap_ids (searched with imap_req) are synced.
+           modseq is the HIGHESTMODSEQ returned by _search_ids.
+           None if imap_req does not return all the new and changed ids.
+        """
+        if imap_req.get('mode') != 'watermark' and \
+           (imap_req.get('type') != 'imap' or imap_req.get('req', '').upper() != 'ALL'):
+            return None
+
+        # the changed ids are below the previous watermark
+        previous = self.load_watermark(folder)
+        last_uid = max(imap_ids[-1] if imap_ids else 0, previous['last_uid'] if previous else 0)
+
+        # HIGHESTMODSEQ read before the search:
+        # the changes done during the sync will be synced again next time
+        return { 'last_uid' : last_uid, 'highestmodseq' : modseq }
+
+    def _get_nb_sync_errors(self):
+        """
+           Nb of ids in each list of sync errors of the error report
+        """
+        return dict((key, len(self.error_report[key])) for key in self.SYNC_ERROR_KEYS)
+
+    def _get_failed_uids(self, nb_errors):
+        """
+           Sorted uids reported in the sync errors since _get_nb_sync_errors returned nb_errors
+        """
+        return sorted(set(the_id for key in self.SYNC_ERROR_KEYS \
+                          for (the_id, _) in self.error_report[key][nb_errors[key]:]))
+
     def get_gmails_ids_left_to_sync(self, op_type, imap_ids, imap_req):#pylint:disable-msg=W0613
         """
            Get the ids that still needs to be sync
-           Return a list of ids
+           imap_ids is an IdSet. Return an IdSet of ids
         """
         filename = self.OP_TO_FILENAME.get(op_type, None)
         
@@ -707,6 +1894,10 @@ class GMVaulter(object):
                   "This should not happen, send the error to the software developers." % (op_type))
         
         filepath = '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login, filename)
+
+        parts = self._load_sync_parts(op_type)
+        if parts:
+            return self._get_ids_left_in_sync_parts(parts, imap_ids)
         
         if not os.path.exists(filepath):
             LOG.critical("last_id.sync file %s doesn't exist.\nSync the full list of backed up emails." %(filepath))
@@ -716,8 +1907,6 @@ class GMVaulter(object):
         
         last_id = json_obj['last_id']
         
-        last_id_index = -1
-        
         new_gmail_ids = imap_ids
         
         try:
@@ -726,11 +1915,12 @@ class GMVaulter(object):
             
             imap_id = dummy[0]
             
-            last_id_index = imap_ids.index(imap_id)
+            if imap_id not in imap_ids:
+                raise ValueError("imap id %s not in the ids to sync" % (imap_id))
             
             LOG.critical("Restart from gmail id %s (imap id %s)." % (last_id, imap_id))
             
-            new_gmail_ids = imap_ids[last_id_index:]   
+            new_gmail_ids = imap_ids.after(imap_id)
         except Exception, _: #ignore any exception and try to get all ids in case of problems. pylint:disable=W0703
             #element not in keys return current set of keys
             LOG.critical("Error: Cannot restore from last restore gmail id. It is not in Gmail."\
@@ -738,6 +1928,57 @@ class GMVaulter(object):
         
         return new_gmail_ids
         
+    def _get_sync_part_path(self, op_type, part_name = '*'):
+        """
+           Path of the checkpoint file of a sync worker
+        """
+        return '%s/%s_%s.%s' % (self.gstorer.get_info_dir(), self.login, self.OP_TO_FILENAME[op_type], part_name)
+
+    def _load_sync_parts(self, op_type):
+        """
+           Load the checkpoints saved by the workers of a parallel sync
+        """
+        parts = []
+        for filepath in glob.glob(self._get_sync_part_path(op_type)):
+            try:
+                with open(filepath, 'r') as f:
+                    parts.append(json.load(f))
+            except ValueError, err:
+                LOG.critical("Ignore invalid sync checkpoint %s (%s)." % (filepath, err))
+        return parts
+
+    def _delete_sync_parts(self, op_type):
+        """
+           Delete the checkpoints saved by the workers of a parallel sync
+        """
+        for filepath in glob.glob(self._get_sync_part_path(op_type)):
+            os.remove(filepath)
+
+    def _get_ids_left_in_sync_parts(self, parts, imap_ids):
+        """
+           Merge the checkpoints of the workers of a parallel sync.
+           Keep the ids after the last saved id of each range and all the ids
+           outside of the ranges (new emails)
+        """
+        done = [] # ids of each range already synced
+        for part in parts:
+            first, last = part['range']
+            restart_id  = first
+            try:
+                #get imap_id from stored gmail_id
+                dummy = self.src.search({'type':'imap', 'req':'X-GM-MSGID %s' % (part['last_id'])})
+                if dummy and first <= dummy[0] <= last:
+                    restart_id = dummy[0]
+            except Exception, _: #ignore any exception and sync the complete range. pylint:disable=W0703
+                LOG.critical("Error: Cannot find gmail id %s in Gmail. Sync the range %s-%s again." \
+                             % (part['last_id'], first, last))
+
+            LOG.critical("Restart range %s-%s from imap id %s." % (first, last, restart_id))
+            if restart_id > first:
+                done.append((first, restart_id - 1))
+
+        return imap_ids - collections_utils.IdSet.from_runs(sorted(done))
+
     def check_clean_db(self, db_cleaning):
         """
            Check and clean the database (remove file that are not anymore in Gmail)
@@ -767,33 +2008,45 @@ class GMVaulter(object):
             LOG.critical("Found %s email(s) in the Gmvault db.\n" % (len(db_gmail_ids_info)) )
         
             #create a set of keys
-            db_gmail_ids = set(db_gmail_ids_info.keys())
+            db_gmail_ids = collections_utils.IdSet(db_gmail_ids_info)
             
-            # get all imap ids in All Mail
-            self.src.select_folder('ALLMAIL') #go to all mail
-            imap_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL) #search all
+            deleted = self._deletion_plans.pop('ALLMAIL', None)
+            if deleted is not None:
+                # planned with the snapshot taken by the sync
+                self._delete_planned(deleted, 'email')
+            else:
+                # get all imap ids in All Mail
+                self.src.select_folder('ALLMAIL') #go to all mail
+                uid_index = self._get_uid_index('ALLMAIL')
+                uid_index.set_uidvalidity(self.src.uidvalidity)
+                imap_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL) #search all
             
-            LOG.debug("Got %s emails imap_id(s) from the Gmail Server." % (len(imap_ids)))
+                LOG.debug("Got %s emails imap_id(s) from the Gmail Server." % (len(imap_ids)))
             
-            #delete supress emails from DB since last sync
-            self._delete_sync(imap_ids, db_gmail_ids, db_gmail_ids_info, 'email')
+                #delete supress emails from DB since last sync
+                self._delete_sync(imap_ids, db_gmail_ids, db_gmail_ids_info, 'email', uid_index)
             
             # get all chats ids
-            if self.src.is_visible('CHATS'):
+            deleted = self._deletion_plans.pop('CHATS', None)
+            if deleted is not None:
+                self._delete_planned(deleted, 'chat')
+            elif self.src.is_visible('CHATS'):
             
                 db_gmail_ids_info = self.gstorer.get_all_chats_gmail_ids()
                 
                 LOG.critical("Found %s chat(s) in the Gmvault db.\n" % (len(db_gmail_ids_info)) )
                 
                 self.src.select_folder('CHATS') #go to chats
+                uid_index = self._get_uid_index('CHATS')
+                uid_index.set_uidvalidity(self.src.uidvalidity)
                 chat_ids = self.src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
                 
-                db_chat_ids = set(db_gmail_ids_info.keys())
+                db_chat_ids = collections_utils.IdSet(db_gmail_ids_info)
                 
                 LOG.debug("Got %s chat imap_ids from the Gmail Server." % (len(chat_ids)))
             
                 #delete supress emails from DB since last sync
-                self._delete_sync(chat_ids, db_chat_ids, db_gmail_ids_info , 'chat')
+                self._delete_sync(chat_ids, db_chat_ids, db_gmail_ids_info , 'chat', uid_index)
             else:
                 LOG.critical("Chats IMAP Directory not visible on Gmail. Ignore deletion of chats.")
                 
@@ -825,6 +2078,13 @@ class GMVaulter(object):
         filepath = '%s/%s_%s' % (self.gstorer.get_info_dir(), self.login,
                                  filename)
 
+        checkpoint = { 'last_id': gm_id }
+
+        # a sync worker saves the last id of its range of ids in its own file
+        if self.sync_part and op_type == self.OP_EMAIL_SYNC:
+            filepath = self._get_sync_part_path(op_type, self.sync_part)
+            checkpoint['range'] = [long(val) for val in self.sync_part.split('-')]
+
         with open(filepath, 'w') as f:
 
             #json.dump({
@@ -833,14 +2093,12 @@ class GMVaulter(object):
             #            'req'     : imap_req
             #          }, the_fd)
 
-            json.dump({
-                'last_id': gm_id,
-            }, f)
+            json.dump(checkpoint, f)
 
     def get_gmails_ids_left_to_restore(self, op_type, db_gmail_ids_info):
         """
            Get the ids that still needs to be restored
-           Return a dict key = gm_id, val = directory
+           Return a collections_utils.SortedIdMap key = gm_id, val = directory
         """
         filename = self.OP_TO_FILENAME.get(op_type, None)
 
@@ -861,28 +2119,21 @@ class GMVaulter(object):
 
         last_id = json_obj['last_id']
 
-        last_id_index = -1
-        try:
-            keys = db_gmail_ids_info.keys()
-            last_id_index = keys.index(last_id)
-            LOG.critical("Restart from gmail id %s." % last_id)
-        except ValueError, _:
+        if last_id not in db_gmail_ids_info:
             #element not in keys return current set of keys
             LOG.error("Cannot restore from last restore gmail id. It is not in the disk database.")
+            return db_gmail_ids_info
 
-        new_gmail_ids_info = collections_utils.OrderedDict()
-        if last_id_index != -1:
-            for key in db_gmail_ids_info.keys()[last_id_index+1:]:
-                new_gmail_ids_info[key] =  db_gmail_ids_info[key]
-        else:
-            new_gmail_ids_info = db_gmail_ids_info    
-            
-        return new_gmail_ids_info 
+        LOG.critical("Restart from gmail id %s." % last_id)
+
+        # the ids after last_id (view of db_gmail_ids_info)
+        return db_gmail_ids_info.after(last_id)
            
     def restore(self, pivot_dir = None, extra_labels = [], \
-                restart = False, emails_only = False, chats_only = False): #pylint:disable=W0102
+                restart = False, emails_only = False, chats_only = False, connections = 1): #pylint:disable=W0102
         """
            Restore emails in a gmail account
+           connections: nb of IMAP connections used in parallel to push the emails
         """
         
         self.error_report['operation'] = 'Sync'
@@ -898,7 +2149,8 @@ class GMVaulter(object):
             if pivot_dir:
                 LOG.critical("Quick mode activated. Will only restore all emails since %s.\n" % (pivot_dir))
             
-            self.restore_emails(pivot_dir, extra_labels, restart)
+            self.restore_emails(pivot_dir, extra_labels, restart, \
+                                min(connections, self.MAX_RESTORE_CONNECTIONS))
         else:
             LOG.critical("Skip emails restoration.\n")
         
@@ -930,7 +2182,7 @@ class GMVaulter(object):
         #get gmail_ids from db
         db_gmail_ids_info = self.gstorer.get_all_chats_gmail_ids()
         
-        LOG.critical("Total number of chats to restore %s." % (len(db_gmail_ids_info.keys())))
+        LOG.critical("Total number of chats to restore %s." % (len(db_gmail_ids_info)))
         
         if restart:
             db_gmail_ids_info = self.get_gmails_ids_left_to_restore(self.OP_CHAT_RESTORE, db_gmail_ids_info)
@@ -1050,7 +2302,7 @@ class GMVaulter(object):
             
         return self.error_report 
                     
-    def restore_emails(self, pivot_dir = None, extra_labels = [], restart = False):
+    def restore_emails(self, pivot_dir = None, extra_labels = [], restart = False, connections = 1): #pylint:disable=W0102
         """
            restore emails in a gmail account using batching to group restore
            If you are not in "All Mail" Folder, it is extremely fast to push emails.
@@ -1058,6 +2310,8 @@ class GMVaulter(object):
            is dependant on the folder. On the other hand, you can restore labels in batch which would help gaining lots of time.
            The idea is to get a batch of 50 emails and push them all in the mailbox one by one and get the uid for each of them.
            Then create a dict of labels => uid_list and for each label send a unique store command after having changed dir
+           With more than one connection, emails are pushed in parallel and labelled by another connection
+           (see _restore_emails_parallel).
         """
         LOG.critical("Restore emails in gmail account %s." % (self.login) ) 
         
@@ -1066,7 +2320,7 @@ class GMVaulter(object):
         #get gmail_ids from db
         db_gmail_ids_info = self.gstorer.get_all_existing_gmail_ids(pivot_dir)
         
-        LOG.critical("Total number of elements to restore %s." % (len(db_gmail_ids_info.keys())))
+        LOG.critical("Total number of elements to restore %s." % (len(db_gmail_ids_info)))
         
         if restart:
             db_gmail_ids_info = self.get_gmails_ids_left_to_restore(self.OP_EMAIL_RESTORE, db_gmail_ids_info)
@@ -1074,6 +2328,9 @@ class GMVaulter(object):
         total_nb_emails_to_restore = len(db_gmail_ids_info)
         
         LOG.critical("Got all emails id left to restore. Still %s emails to do.\n" % (total_nb_emails_to_restore) )
+
+        if connections > 1:
+            return self._restore_emails_parallel(db_gmail_ids_info, extra_labels, connections)
         
         existing_labels     = set() #set of existing labels to not call create_gmail_labels all the time
         reserved_labels_map = gmvault_utils.get_conf_defaults().get_dict("Restore", "reserved_labels_map", { u'migrated' : u'gmv-migrated', u'\muted' : u'gmv-muted' })
@@ -1119,27 +2376,12 @@ class GMVaulter(object):
                                     email_meta[self.gstorer.INT_DATE_K] )      
                 
                     #labels for this email => real_labels U extra_labels
-                    labels = set(email_meta[self.gstorer.LABELS_K])
-
-                    # add in the labels_to_create struct
-                    for label in labels:
-                        if label != "\\Starred":
-                            #LOG.debug("label = %s\n" % (label.encode('utf-8')))
-                            LOG.debug("label = %s\n" % (label))
-                            if label.lower() in reserved_labels_map.keys(): #exclude creation of migrated label
-                                n_label = reserved_labels_map.get(label.lower(), "gmv-default-label")
-                                LOG.info("Apply label '%s' instead of '%s' (lower or uppercase)"\
-                                 " because it is a Gmail reserved label." % (n_label, label)) 
-                                label = n_label
-                            labels_to_apply[label] = imap_id #add item in multimap
+                    self._add_labels_to_apply(labels_to_apply, email_meta, imap_id, extra_labels, reserved_labels_map)
             
                     # get list of labels to create (do a union with labels to create)
                     #labels_to_create.update([ label for label in labels if label not in existing_labels]) 
                     labels_to_create.update([ label for label in labels_to_apply.keys() \
                                               if label not in existing_labels])                      
-
-                    for ex_label in extra_labels: 
-                        labels_to_apply[ex_label] = imap_id
                 
                 except Exception, err:
                     handle_restore_imap_error(err, gm_id, db_gmail_ids_info, self)
@@ -1193,4 +2435,163 @@ class GMVaulter(object):
             self.save_lastid(self.OP_EMAIL_RESTORE, last_id)
             
         return self.error_report 
+
+    @classmethod
+    def _add_labels_to_apply(cls, labels_to_apply, email_meta, imap_id, extra_labels, reserved_labels_map): #pylint:disable=R0913
+        """
+           Add the labels of a pushed email (real_labels U extra_labels) in the labels_to_apply multimap
+        """
+        labels = set(email_meta[gmvault_db.GmailStorer.LABELS_K])
+
+        # add in the labels_to_create struct
+        for label in labels:
+            if label != "\\Starred":
+                #LOG.debug("label = %s\n" % (label.encode('utf-8')))
+                LOG.debug("label = %s\n" % (label))
+                if label.lower() in reserved_labels_map.keys(): #exclude creation of migrated label
+                    n_label = reserved_labels_map.get(label.lower(), "gmv-default-label")
+                    LOG.info("Apply label '%s' instead of '%s' (lower or uppercase)"\
+                     " because it is a Gmail reserved label." % (n_label, label)) 
+                    label = n_label
+                labels_to_apply[label] = imap_id #add item in multimap
+
+        for ex_label in extra_labels: 
+            labels_to_apply[ex_label] = imap_id
+
+    def _restore_emails_parallel(self, db_gmail_ids_info, extra_labels, nb_connections): #pylint:disable=R0912,R0914
+        """
+           Restore emails with nb_connections upload connections and a labelling connection.
+           The emails are read from the disk by batch and pushed by the RestoreUploader threads.
+           Once all the emails of a batch are pushed, a LabelJob is sent to the LabellingThread
+           which applies the labels of the batches in order and saves the last id of each batch.
+        """
+        reserved_labels_map = gmvault_utils.get_conf_defaults().get_dict("Restore", "reserved_labels_map", \
+                              { u'migrated' : u'gmv-migrated', u'\muted' : u'gmv-muted' })
+        all_mail_name       = self.src.get_folder_name("ALLMAIL")
+        folder_def_location = gmvault_utils.get_conf_defaults().get("General", "restore_default_location", "DRAFTS")
+        nb_items            = gmvault_utils.get_conf_defaults().getint("General", "nb_messages_per_restore_batch", 80)
+
+        timer = gmvault_utils.Timer() # local timer for restore emails
+        timer.start()
+
+        LOG.critical("Restore emails with %d connections." % (nb_connections))
+
+        jobs      = Queue.Queue(2 * nb_connections) # bounded to not read too many emails in advance
+        results   = Queue.Queue()
+        uploaders = [ RestoreUploader(self.src.spawn_connection(), folder_def_location, all_mail_name, jobs, results) \
+                      for _ in xrange(nb_connections) ]
+        labeller  = LabellingThread(self, self.src.spawn_connection(), self.OP_EMAIL_RESTORE, len(db_gmail_ids_info), timer)
+
+        for thread in uploaders + [labeller]:
+            thread.start()
+
+        # batch_nb => [nb emails being pushed, all emails read, labels_to_apply, last_id, nb_items]
+        self._restore_batches     = {}
+        self._next_batch_to_label = 0
+        try:
+            for batch_nb, group_imap_ids in enumerate(gmvault_utils.chunker(db_gmail_ids_info.keys(), nb_items)):
+
+                batch = [0, False, collections_utils.SetMultimap(), group_imap_ids[-1], len(group_imap_ids)]
+                self._restore_batches[batch_nb] = batch
+
+                LOG.critical("Processing next batch of %s emails.\n" % (len(group_imap_ids)))
+
+                for gm_id in group_imap_ids:
+                    try:
+                        LOG.debug("Unbury email with gm_id %s." % (gm_id))
+                        email_meta, email_data = self.gstorer.unbury_email(gm_id)
+                    except Exception, err:
+                        handle_restore_imap_error(err, gm_id, db_gmail_ids_info, self)
+                        continue
+
+                    batch[0] += 1
+                    self._put_restore_job(jobs, (batch_nb, gm_id, email_meta, email_data), uploaders, \
+                                          results, labeller, db_gmail_ids_info, extra_labels, reserved_labels_map)
+
+                batch[1] = True
+                self._process_restore_results(results, labeller, db_gmail_ids_info, extra_labels, reserved_labels_map)
+
+            # stop the uploaders and wait for the last results
+            for _ in uploaders:
+                self._put_restore_job(jobs, None, uploaders, results, labeller, db_gmail_ids_info, \
+                                      extra_labels, reserved_labels_map)
+
+            while self._restore_batches:
+                if not any(uploader.is_alive() for uploader in uploaders) and results.empty():
+                    raise Exception("Emails could not be pushed: %s" % (uploaders[0].error))
+                self._process_restore_results(results, labeller, db_gmail_ids_info, extra_labels, \
+                                              reserved_labels_map, block = True)
+
+            labeller.queue.put(None)
+            while labeller.is_alive():
+                labeller.join(1)
+
+            if labeller.error:
+                raise labeller.error #pylint:disable-msg=E0702
+        finally:
+            # in case of errors drop the pending jobs and stop the threads
+            labeller.queue.put(None)
+            try:
+                while True:
+                    jobs.get_nowait()
+            except Queue.Empty:
+                pass
+            for _ in uploaders:
+                jobs.put_nowait(None)
+
+        return self.error_report
+
+    def _put_restore_job(self, jobs, job, uploaders, results, labeller, db_gmail_ids_info, \
+                         extra_labels, reserved_labels_map): #pylint:disable=R0913
+        """
+           Put a job in the uploaders queue and process the results while waiting
+        """
+        while True:
+            try:
+                # use a timeout to process the results and to not block the KeyboardInterrupt
+                jobs.put(job, True, 1)
+                break
+            except Queue.Full:
+                if not any(uploader.is_alive() for uploader in uploaders):
+                    raise Exception("Emails could not be pushed: %s" % (uploaders[0].error))
+                self._process_restore_results(results, labeller, db_gmail_ids_info, extra_labels, reserved_labels_map)
+
+        self._process_restore_results(results, labeller, db_gmail_ids_info, extra_labels, reserved_labels_map)
+
+    def _process_restore_results(self, results, labeller, db_gmail_ids_info, extra_labels, \
+                                 reserved_labels_map, block = False): #pylint:disable=R0913
+        """
+           Handle the pushed emails and send the label jobs of the complete batches in order
+        """
+        while True:
+            try:
+                batch_nb, gm_id, email_meta, imap_id, error = results.get(block, 1) if block else results.get_nowait()
+            except Queue.Empty:
+                break
+
+            block = False # only wait for the first result
+            batch = self._restore_batches[batch_nb]
+            batch[0] -= 1
+
+            try:
+                if error:
+                    # raise it again to handle it in an except clause
+                    raise error #pylint:disable-msg=E0702
+                self._add_labels_to_apply(batch[2], email_meta, imap_id, extra_labels, reserved_labels_map)
+            except Exception, err:
+                # the uploaders reconnect their own connection after an abort
+                handle_restore_imap_error(err, gm_id, db_gmail_ids_info, self, reconnect = False)
+
+        if labeller.error:
+            raise labeller.error #pylint:disable-msg=E0702
+
+        # the batches are labelled in order to be able to resume after the last labelled batch
+        batch = self._restore_batches.get(self._next_batch_to_label)
+        while batch and batch[0] == 0 and batch[1]:
+            labels_to_apply = batch[2]
+            labeller.queue.put(LabelJob(self._next_batch_to_label, labels_to_apply, \
+                                        set(labels_to_apply.keys()) | set(extra_labels), batch[3], batch[4]))
+            del self._restore_batches[self._next_batch_to_label]
+            self._next_batch_to_label += 1
+            batch = self._restore_batches.get(self._next_batch_to_label)
         
@@ -39,6 +39,13 @@ DEFAULT_CONF_FILE = """#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 [Sync]
 quick_days=10
+#gmvault daemon: IDLE is restarted every X sec (Gmail ends it after 30 min)
+idle_timeout=540
+#gmvault daemon: the mailbox is polled every X sec when IDLE is not available
+poll_interval=60
+#full sync: get the metadata of all the messages with one streamed FETCH saved
+#in a snapshot file (.info dir) instead of searching all the ids
+metadata_snapshot=False
 
 [Restore]
 # it is 10 days but currently it will always be the current month or the last 2 months
@@ -50,10 +57,36 @@ reserved_labels_map = { u'migrated' : u'gmv-migrated', u'\muted' : u'gmv-muted'
 limit_per_chat_dir=2000
 errors_if_chat_not_visible=False
 nb_messages_per_batch=500
+#email bodies are downloaded with a second connection by batch of X messages
+nb_messages_per_body_batch=50
+#max bytes of email bodies downloaded and not yet stored on disk (32 MB)
+max_body_bytes_in_flight=33554432
+#email bodies of at least X bytes are written to disk while they are received (1 MB). 0 to keep them in memory
+spool_body_min_size=1048576
 nb_messages_per_restore_batch=80
 restore_default_location=DRAFTS
 keep_in_bin=False
-enable_imap_compression=False
+enable_imap_compression=True
+#imap engine: imapclient (one blocking connection per thread) or pipelined
+#(commands pipelined and connections driven by a select loop)
+imap_engine=imapclient
+#keep a second connection logged in to replace the main one immediately when it is lost
+keep_standby_connection=True
+#keep the gm_id index of the gmvault-db on disk (.info/gm_id.index)
+#if False, it is rebuilt from the db at each run
+persist_gm_id_index=True
+#storage of new gmvault-dbs: files (2 files per email) or segments (large append only files)
+#use gmvault migrate to convert an existing gmvault-db
+storage_backend=files
+#size from which a new segment file is started (256 MB)
+segment_max_size=268435456
+#metadata of new gmvault-dbs: json (one json per email) or sqlite (one database for all emails)
+#use gmvault migrate -m to convert an existing gmvault-db
+metadata_storage=json
+#store the emails of new gmvault-dbs as fetched (no charset guessing nor conversion to utf-8)
+#use gmvault migrate --raw to store the next emails of an existing gmvault-db raw
+#and gmvault migrate --utf8 to convert the emails stored raw to utf-8
+store_raw_emails=False
 
 [Localisation]
 #example with Russian
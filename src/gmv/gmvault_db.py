@@ -18,20 +18,24 @@
 """
 from contextlib import contextmanager
 import json
-import gzip
 import re
 import os
 import itertools
-import fnmatch
 import shutil
+import time
 import codecs
 import StringIO
+import tempfile
 
 import gmv.blowfish as blowfish
 import gmv.log_utils as log_utils
 
 import gmv.collections_utils as collections_utils
 import gmv.gmvault_utils as gmvault_utils
+import gmv.gmvault_index as gmvault_index
+import gmv.gmvault_segment as gmvault_segment
+import gmv.gmvault_metadata as gmvault_metadata
+import gmv.stream_utils as stream_utils
 import gmv.imap_utils as imap_utils
 import gmv.credential_utils as credential_utils
 
@@ -55,6 +59,12 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
     SUBJECT_K    = 'subject'
     MSGID_K      = 'msg_id'
     XGM_RECV_K   = 'x_gmail_received'
+    EMAIL_FMT_K  = 'email_format'
+
+    # format of the stored email contents (recorded in the metadata).
+    # No format recorded: utf-8 for emails stored in clear and raw for encrypted ones
+    RAW_FORMAT   = 'raw'   # BODY[] bytes as fetched
+    UTF8_FORMAT  = 'utf-8' # converted to utf-8 after guessing the charset
 
     HF_MSGID_PATTERN       = r"[M,m][E,e][S,s][S,s][a,A][G,g][E,e]-[I,i][D,d]:\s+<(?P<msgid>.*)>"
     HF_SUB_PATTERN         = r"[S,s][U,u][b,B][J,j][E,e][C,c][T,t]:\s+(?P<subject>.*)\s*"
@@ -74,19 +84,37 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
     BIN_AREA                   = 'bin'
     SUB_CHAT_AREA              = 'chats/%s'
     INFO_AREA                  = '.info'  # contains metadata concerning the database
+    SPOOL_AREA                 = 'spool'  # in INFO_AREA: bodies received and not yet stored
+    SPOOL_MAX_AGE              = 24 * 3600 # spool files older than that are left by an interrupted sync
     ENCRYPTION_KEY_FILENAME    = '.storage_key.sec'
     EMAIL_OWNER                = '.owner_account.info'
     GMVAULTDB_VERSION          = '.gmvault_db_version.info'   
+    STORAGE_BACKEND_FILENAME   = '.storage_backend.info'
+    METADATA_STORAGE_FILENAME  = '.metadata_storage.info'
+    EMAIL_FORMAT_FILENAME      = '.email_format.info'
+
+    # storage layout of the emails in the db
+    STORAGE_BACKEND            = 'files'
+
+    # storage of the metadata: one json per email (.meta file or segment record)
+    # or one SQLite database for all emails
+    JSON_METADATA              = 'json'
+    SQLITE_METADATA            = 'sqlite'
 
-    def __init__(self, a_storage_dir, encrypt_data=False):
+    def __init__(self, a_storage_dir, encrypt_data=False, process_safe=False):
         """
            Store on disks
            args:
               a_storage_dir: Storage directory
               a_use_encryption: Encryption key. If there then encrypt
+              process_safe: True if other processes write in the same db at the same time
         """
         self._top_dir = a_storage_dir
 
+        # read before creating the dirs of a new db
+        metadata_storage = get_metadata_storage(a_storage_dir)
+        email_format     = get_email_format(a_storage_dir)
+
         self._db_dir          = '%s/%s' % (a_storage_dir, GmailStorer.DB_AREA)
         self._quarantine_dir  = '%s/%s' % (a_storage_dir, GmailStorer.QUARANTINE_AREA)
         self._info_dir        = '%s/%s' % (a_storage_dir, GmailStorer.INFO_AREA)
@@ -100,6 +128,9 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         self._limit_per_chat_dir = gmvault_utils.get_conf_defaults().getint(
             "General", "limit_per_chat_dir", 1500)
 
+        # store the fetched bytes without guessing the charset and converting to utf-8
+        self._store_raw = (email_format == self.RAW_FORMAT)
+
         #make dirs
         if not os.path.exists(self._db_dir):
             LOG.critical("No Storage DB in %s. Create it.\n" % a_storage_dir)
@@ -109,7 +140,13 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         gmvault_utils.makedirs(self._quarantine_dir)
         gmvault_utils.makedirs(self._info_dir)
 
-        self.fsystem_info_cache = {}
+        self._metadata = gmvault_metadata.MetadataStore(self._info_dir) \
+                         if metadata_storage == self.SQLITE_METADATA else None
+
+        # gm_id index (loaded lazily). It can be kept in memory only (read-only db for ex)
+        self._index = self._create_index(gmvault_utils.get_conf_defaults().getboolean(
+                                             "General", "persist_gm_id_index", True), process_safe)
+        self._index_checked = False # True once the db has been walked for the ids missing in the index
 
         self._encrypt_data   = encrypt_data
         self._encryption_key = None
@@ -118,6 +155,23 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         #add version if it is needed to migrate gmvault-db in the future
         self._create_gmvault_db_version()
 
+        #record the storage backend of a new db
+        if not os.path.exists('%s/%s' % (self._info_dir, self.STORAGE_BACKEND_FILENAME)):
+            write_storage_backend(a_storage_dir, self.STORAGE_BACKEND)
+
+        if not os.path.exists('%s/%s' % (self._info_dir, self.METADATA_STORAGE_FILENAME)):
+            write_metadata_storage(a_storage_dir, metadata_storage)
+
+        if not os.path.exists('%s/%s' % (self._info_dir, self.EMAIL_FORMAT_FILENAME)):
+            write_email_format(a_storage_dir, email_format)
+
+    def _create_index(self, persist, process_safe):
+        """
+           Create the gm_id index of the db
+        """
+        return gmvault_index.GmailIndex(self._info_dir, self._db_dir, persist = persist, \
+                                        shared = process_safe, metadata = self._metadata)
+
     def _init_sub_chats_dir(self):
         """
            get info from existing sub chats
@@ -148,7 +202,8 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
             else:
                 the_max = max(nb_to_dir)
                 files = os.listdir("%s/%s" % (self._chats_dir, nb_to_dir[the_max]))
-                self._sub_chats_nb  = len(files)/2
+                # .eml and .meta files or only .eml files with the SQLite metadata
+                self._sub_chats_nb  = len(files)/2 if self._metadata is None else len(files)
                 self._sub_chats_inc = the_max
                 self._sub_chats_dir = self.SUB_CHAT_AREA % nb_to_dir[the_max] 
 
@@ -208,12 +263,57 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
         return []
 
+    def get_index(self):
+        """
+           Return the gm_id index of gmvault-db
+        """
+        return self._index
+
+    def rebuild_index(self):
+        """
+           Recreate the gm_id index from the files of the db
+        """
+        self._index.rebuild()
+
+    def reload_index(self):
+        """
+           Read again the gm_id index to get the emails stored by other processes
+        """
+        self._index.reload()
+
     def get_info_dir(self):
         """
            Return the info dir of gmvault-db
         """ 
         return self._info_dir
 
+    def get_metadata_store(self):
+        """
+           Return the SQLite metadata store or None if the metadata is stored as json
+        """
+        return self._metadata
+
+    def get_spool_dir(self):
+        """
+           Return the dir where the fetched bodies are received before to be stored.
+           It is in the db to move the bodies in place without copy.
+           The files left by an interrupted sync are removed.
+        """
+        spool_dir = '%s/%s' % (self._info_dir, self.SPOOL_AREA)
+        gmvault_utils.makedirs(spool_dir)
+
+        now = time.time()
+        for fname in os.listdir(spool_dir):
+            path = os.path.join(spool_dir, fname)
+            try:
+                if now - os.path.getmtime(path) > self.SPOOL_MAX_AGE:
+                    LOG.debug("Remove old spool file %s." % (path))
+                    os.remove(path)
+            except OSError: # removed by another process
+                pass
+
+        return spool_dir
+
     def get_encryption_cipher(self):
         """
            Return the cipher to encrypt an decrypt.
@@ -292,25 +392,17 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         """
            Get only chats dirs 
         """
-        # first create a normal dir and sort it below with an OrderedDict
-        # beware orderedDict preserve order by insertion and not by key order
-        gmail_ids = {}
-
-        chat_dir = '%s/%s' % (self._db_dir, self.CHATS_AREA)
-        if os.path.exists(chat_dir):
-            the_iter = gmvault_utils.ordered_dirwalk(chat_dir, "*.meta")
+        chat_prefix = '%s/' % (self.CHATS_AREA)
 
-            #get all ids
-            for filepath in the_iter:
-                directory, fname = os.path.split(filepath)
-                gmail_ids[long(os.path.splitext(fname)[0])] = os.path.basename(directory)
+        def chats():
+            """ (gm_id, sub chats dir) of the chats """
+            for gm_id, rec in self._index.iteritems():
+                the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+                if the_dir.startswith(chat_prefix):
+                    yield gm_id, the_dir[the_dir.rfind('/') + 1:]
 
-            #sort by key 
-            #used own orderedDict to be compliant with version 2.5
-            gmail_ids = collections_utils.OrderedDict(
-                sorted(gmail_ids.items(), key=lambda t: t[0]))
-
-        return gmail_ids
+        # sorted by gm_id
+        return collections_utils.SortedIdMap(chats())
 
     def get_all_existing_gmail_ids(self, pivot_dir=None,
                                    ignore_sub_dir=('chats',)):
@@ -318,39 +410,78 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
            get all existing gmail_ids from the database within the passed month 
            and all posterior months
         """
-        # first create a normal dir and sort it below with an OrderedDict
-        # beware orderedDict preserve order by insertion and not by key order
-        gmail_ids = {}
-
-        if pivot_dir is None:
-            #the_iter = gmvault_utils.dirwalk(self._db_dir, "*.meta")
-            the_iter = gmvault_utils.ordered_dirwalk(self._db_dir, "*.meta",
-                                                     ignore_sub_dir)
-        else:
+        # cache the result of the dir filtering (only few dirs for many ids)
+        selected_dirs = {}
+
+        def emails():
+            """ (gm_id, dir) of the selected emails """
+            for gm_id, rec in self._index.iteritems():
+                the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+                selected = selected_dirs.get(the_dir)
+                if selected is None:
+                    selected = selected_dirs[the_dir] = select_dir(the_dir)
+                if selected:
+                    yield gm_id, selected
+
+        def select_dir(the_dir):
+            """ dir name of the ids of the_dir or False if they are ignored """
+            top_dir = the_dir.split('/', 1)[0]
+            if not the_dir:
+                # file at the root of the db
+                selected = pivot_dir is None
+            elif top_dir in ignore_sub_dir:
+                selected = False
+            elif pivot_dir is None:
+                selected = True
+            else:
+                selected = gmvault_utils.compare_yymm_dir(pivot_dir, top_dir) <= 0
 
-            # get all yy-mm dirs to list
-            dirs = gmvault_utils.get_all_dirs_posterior_to(
-                pivot_dir, gmvault_utils.get_all_dirs_under(self._db_dir,
-                                                            ignore_sub_dir))
+            return (the_dir[the_dir.rfind('/') + 1:] or os.path.basename(self._db_dir)) if selected else False
 
-            #create all iterators and chain them to keep the same interface
-            iter_dirs = [gmvault_utils.ordered_dirwalk('%s/%s' %
-                         (self._db_dir, the_dir), "*.meta", ignore_sub_dir)
-                         for the_dir in dirs]
+        # sorted by gm_id
+        return collections_utils.SortedIdMap(emails())
 
-            the_iter = itertools.chain.from_iterable(iter_dirs)
+    def iter_sorted_metadata(self, msg_type='email'):
+        """
+           Return an iterator on the (gm_id, dir, flags, labels) of the stored emails
+           or chats (msg_type) sorted by gm_id. dir is relative to the db dir.
+        """
+        chat_prefix = '%s/' % (self.CHATS_AREA)
+        chats       = (msg_type == 'chat')
+
+        if self._metadata is not None:
+            for row in self._metadata.iter_sorted():
+                if row[1].startswith(chat_prefix) == chats:
+                    yield row
+            return
+
+        for gm_id, rec in sorted(self._index.iteritems()):
+            the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+            if the_dir.startswith(chat_prefix) != chats:
+                continue
+            try:
+                meta_obj = self._read_metadata(gm_id, '%s/%s' % (self._db_dir, the_dir) if the_dir else self._db_dir)
+            except (IOError, KeyError, ValueError), err:
+                LOG.critical("Ignore id %s. Cannot read its metadata: %s" % (gm_id, err))
+                continue
 
-        #get all ids
-        for filepath in the_iter:
-            directory, fname = os.path.split(filepath)
-            gmail_ids[long(os.path.splitext(fname)[0])] = os.path.basename(directory)
+            # labels that are numbers are read as numbers (see unbury_metadata)
+            yield gm_id, the_dir, meta_obj[self.FLAGS_K], [unicode(label) for label in meta_obj[self.LABELS_K]]
 
-        #sort by key 
-        #used own orderedDict to be compliant with version 2.5
-        gmail_ids = collections_utils.OrderedDict(sorted(gmail_ids.items(),
-                                                         key=lambda t: t[0]))
+    def update_metadata(self, updates):
+        """
+           Replace the flags and labels of stored emails.
+           updates: iterable of (gm_id, dir, flags, labels) as returned by iter_sorted_metadata
+        """
+        if self._metadata is not None:
+            self._metadata.update_many((gm_id, flags, labels) for (gm_id, _, flags, labels) in updates)
+            return
 
-        return gmail_ids
+        for gm_id, the_dir, flags, labels in updates:
+            meta_obj = self._read_metadata(gm_id, '%s/%s' % (self._db_dir, the_dir) if the_dir else self._db_dir)
+            meta_obj[self.FLAGS_K]  = flags
+            meta_obj[self.LABELS_K] = labels
+            self._write_metadata(meta_obj, the_dir)
 
     def bury_chat_metadata(self, email_info, local_dir = None):
         """
@@ -366,49 +497,100 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
              email_info: metadata info
              local_dir : intermediary dir (month dir)
         """
+        int_date = self._save_metadata(email_info, local_dir, extra_labels)
+
+        self._index.add(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], self._get_index_dir(local_dir), \
+                        int_date = int_date)
+
+        return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
+
+    @classmethod
+    def _get_index_dir(cls, local_dir):
+        """
+           dir as stored in the index (relative to the db dir)
+        """
+        return local_dir.strip('/') if local_dir else ''
+
+    @classmethod
+    def normalize_labels(cls, a_labels, extra_labels=()):
+        """
+            Return the labels as stored in the metadata
+        """
+        # need to convert labels that are number as string
+        # come from imap_lib when label is a number
+        labels = []
+        for label in a_labels:
+            if isinstance(label, (int, long, float, complex)):
+                label = str(label)
+
+            labels.append(unicode(gmvault_utils.remove_consecutive_spaces_and_strip(label)))
+
+        labels.extend(extra_labels) #add extra labels
+
+        return labels
+
+    def _create_metadata(self, email_info, extra_labels=(), email_format=None):
+        """
+            Return the metadata (json structure) of an email
+        """
+        # parse header fields to extract subject and msgid
+        subject, msgid, received = self.parse_header_fields(
+            email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY])
+
+        labels = self.normalize_labels(email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS], extra_labels)
+
+        #create json structure for metadata
+        meta_obj = {
+                     self.ID_K         : email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
+                     self.LABELS_K     : labels,
+                     self.FLAGS_K      : email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS],
+                     self.THREAD_IDS_K : email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
+                     self.INT_DATE_K   : gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
+                     self.SUBJECT_K    : subject,
+                     self.MSGID_K      : msgid,
+                     self.XGM_RECV_K   : received
+                   }
+
+        if email_format:
+            meta_obj[self.EMAIL_FMT_K] = email_format
+
+        return meta_obj
+
+    def _save_metadata(self, email_info, local_dir=None, extra_labels=(), email_format=None):
+        """
+            Store the metadata in the SQLite store or as json and return
+            the internal date (epoch) of the email.
+            Without email_format the format of the stored email is kept.
+        """
+        if email_format is None:
+            email_format = self._get_email_format(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], local_dir)
+
+        meta_obj = self._create_metadata(email_info, extra_labels, email_format)
+
+        if self._metadata is not None:
+            self._metadata.put(meta_obj, self._get_index_dir(local_dir))
+        else:
+            self._write_metadata(meta_obj, local_dir)
+
+        return meta_obj[self.INT_DATE_K]
+
+    def _write_metadata(self, meta_obj, local_dir=None):
+        """
+            Write the .meta file
+        """
         if local_dir:
             the_dir = '%s/%s' % (self._db_dir, local_dir)
             gmvault_utils.makedirs(the_dir)
         else:
             the_dir = self._db_dir
 
-        meta_path = self.METADATA_FNAME % (
-            the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID])
+        meta_path = self.METADATA_FNAME % (the_dir, meta_obj[self.ID_K])
 
         with open(meta_path, 'w') as meta_desc:
-            # parse header fields to extract subject and msgid
-            subject, msgid, received = self.parse_header_fields(
-                email_info[imap_utils.GIMAPFetcher.IMAP_HEADER_FIELDS_KEY])
-
-            # need to convert labels that are number as string
-            # come from imap_lib when label is a number
-            labels = []
-            for label in email_info[imap_utils.GIMAPFetcher.GMAIL_LABELS]:
-                if isinstance(label, (int, long, float, complex)):
-                    label = str(label)
-
-                labels.append(unicode(gmvault_utils.remove_consecutive_spaces_and_strip(label)))
-
-            labels.extend(extra_labels) #add extra labels
-
-            #create json structure for metadata
-            meta_obj = {
-                         self.ID_K         : email_info[imap_utils.GIMAPFetcher.GMAIL_ID],
-                         self.LABELS_K     : labels,
-                         self.FLAGS_K      : email_info[imap_utils.GIMAPFetcher.IMAP_FLAGS],
-                         self.THREAD_IDS_K : email_info[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID],
-                         self.INT_DATE_K   : gmvault_utils.datetime2e(email_info[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]),
-                         self.SUBJECT_K    : subject,
-                         self.MSGID_K      : msgid,
-                         self.XGM_RECV_K   : received
-                       }
-
             json.dump(meta_obj, meta_desc)
 
             meta_desc.flush()
 
-        return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
-
     def bury_chat(self, chat_info, local_dir=None, compress=False):
         """
             Like bury email but with a special label: gmvault-chats
@@ -430,69 +612,55 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
              local_dir : intermediary dir (month dir)
              compress  : if compress is True, use gzip compression
         """
-        if local_dir:
-            the_dir = '%s/%s' % (self._db_dir, local_dir)
-            gmvault_utils.makedirs(the_dir)
-        else:
-            the_dir = self._db_dir
+        # the data is streamed in chunks: first compressed then encrypted.
+        # Encrypted data is written without encoding.
+        variant = ''
+        cipher  = None
 
-        data_path = self.DATA_FNAME % (
-            the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID])
+        if compress:
+            variant = 'gz'
 
-        # TODO: First compress then encrypt
-        # create a compressed CIOString  and encrypt it
+        # if the data has to be encrypted
+        if self._encrypt_data:
+            variant = '%s.crypt' % (variant) if variant else 'crypt'
+            # need to be done for every encryption (initCTR called by the writer)
+            cipher  = self.get_encryption_cipher()
+            LOG.debug("Encrypt data.")
 
-        #if compress:
-        #   data_path = '%s.gz' % data_path
-        #   data_desc = StringIO.StringIO()
-        #else:
-        #    data_desc = open(data_path, 'wb')
+        # the charset is only guessed to convert to utf-8 (encrypted data is always stored raw)
+        email_format = self.RAW_FORMAT if (self._encrypt_data or self._store_raw) else self.UTF8_FORMAT
 
-        #if self._encrypt_data:
-        #    data_path = '%s.crypt2' % data_path
+        size = self._write_data(email_info, local_dir, variant, compress, cipher, \
+                                to_utf8 = (email_format == self.UTF8_FORMAT))
 
-        #TODO create a wrapper fileobj that compress in io string
-        #then chunk write
-        #then compress
-        #then encrypt if it is required
+        #store metadata info
+        int_date = self._save_metadata(email_info, local_dir, extra_labels, email_format)
 
-        # if the data has to be encrypted
-        if self._encrypt_data:
-            data_path = '%s.crypt' % data_path
+        self._index.add(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], self._get_index_dir(local_dir), \
+                        variant, size, int_date)
 
-        if compress:
-            data_path = '%s.gz' % data_path
-            data_desc = gzip.open(data_path, 'wb')
-        else:
-            data_desc = open(data_path, 'wb')
-        try:
-            if self._encrypt_data:
-                # need to be done for every encryption
-                cipher = self.get_encryption_cipher()
-                cipher.initCTR()
-                data = cipher.encryptCTR(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY])
-                LOG.debug("Encrypt data.")
+        return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
 
-                #write encrypted data without encoding
-                data_desc.write(data)
+    def _write_data(self, email_info, local_dir, variant, compress, cipher, to_utf8=False):
+        """
+           Write the .eml file of the email in the given storage variant. Return its size
+        """
+        if local_dir:
+            the_dir = '%s/%s' % (self._db_dir, local_dir)
+            gmvault_utils.makedirs(the_dir)
+        else:
+            the_dir = self._db_dir
 
-            #no encryption then utf-8 encode and write
-            else:
-                #convert email content to unicode
-                data = gmvault_utils.convert_to_unicode(email_info[imap_utils.GIMAPFetcher.EMAIL_BODY])
-      
-                # write in chunks of one 1 MB
-                for chunk in gmvault_utils.chunker(data, 1048576):
-                    data_desc.write(chunk.encode('utf-8'))
+        data_path = self.DATA_FNAME % (
+            the_dir, email_info[imap_utils.GIMAPFetcher.GMAIL_ID])
 
-            #store metadata info
-            self.bury_metadata(email_info, local_dir, extra_labels)
-            data_desc.flush()
+        if variant:
+            data_path = '%s.%s' % (data_path, variant)
 
-        finally:
-            data_desc.close()
+        stream_utils.write_data(data_path, email_info[imap_utils.GIMAPFetcher.EMAIL_BODY], \
+                                compress = compress, cipher = cipher, to_utf8 = to_utf8)
 
-        return email_info[imap_utils.GIMAPFetcher.GMAIL_ID]
+        return os.path.getsize(data_path)
 
     def get_directory_from_id(self, a_id, a_local_dir=None):
         """
@@ -500,46 +668,25 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
            Return the directory path if id located.
            Return None if not found
         """
-        filename = '%s.meta' % a_id
-
         #local_dir can be passed to avoid scanning the filesystem (because of WIN7 fs weaknesses)
         if a_local_dir:
             the_dir = '%s/%s' % (self._db_dir, a_local_dir)
-            if os.path.exists(self.METADATA_FNAME % (the_dir, a_id)):
-                return the_dir
-        else:
-            # first look in cache
-            for the_dir in self.fsystem_info_cache:
-                if filename in self.fsystem_info_cache[the_dir]:
+            if self._metadata is not None:
+                if self._metadata.get_dir(a_id) == self._get_index_dir(a_local_dir):
                     return the_dir
-
-            #walk the filesystem
-            for the_dir, _, files in os.walk(os.path.abspath(self._db_dir)):
-                self.fsystem_info_cache[the_dir] = files
-                for filename in fnmatch.filter(files, filename):
-                    return the_dir
-
-    @contextmanager
-    def _get_data_file_from_id(self, a_dir, a_id):
-        """
-           Return data file from the id
-        """
-        data_p = self.DATA_FNAME % (a_dir, a_id)
-
-        # check if encrypted and compressed or not
-        if os.path.exists('%s.crypt.gz' % data_p):
-            f = gzip.open('%s.crypt.gz' % data_p, 'r')
-        elif os.path.exists('%s.gz' % data_p):
-            f = gzip.open('%s.gz' % data_p, 'r')
-        elif os.path.exists('%s.crypt' % data_p):
-            f = open('%s.crypt' % data_p, 'r')
+            elif os.path.exists(self.METADATA_FNAME % (the_dir, a_id)):
+                return the_dir
         else:
-            f = open(data_p)
-
-        try:
-            yield f
-        finally:
-            f.close()
+            # emails and chats (chats/subchats-x) are all in the gm_id index
+            rec = self._index.get(a_id)
+            if rec is None and not self._index_checked:
+                # the index can be stale: walk the db once to add what is missing
+                self._index_checked = True
+                if self._index.add_missing():
+                    rec = self._index.get(a_id)
+            if rec is not None:
+                the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+                return '%s/%s' % (self._db_dir, the_dir) if the_dir else self._db_dir
 
     @contextmanager
     def _get_metadata_file_from_id(self, a_dir, a_id):
@@ -559,17 +706,9 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         #get the dir where the email is stored
         the_dir = self.get_directory_from_id(a_id)
 
-        data = self.DATA_FNAME % (the_dir, a_id)
+        data = self._get_data_path(the_dir, a_id)
         meta = self.METADATA_FNAME % (the_dir, a_id)
 
-        # check if encrypted and compressed or not
-        if os.path.exists('%s.crypt.gz' % data):
-            data = '%s.crypt.gz' % data
-        elif os.path.exists('%s.gz' % data):
-            data = '%s.gz' % data
-        elif os.path.exists('%s.crypt' % data):
-            data = '%s.crypt' % data
-
         #remove files if already quarantined
         q_data_path = os.path.join(self._quarantine_dir, os.path.basename(data))
         q_meta_path = os.path.join(self._quarantine_dir, os.path.basename(meta))
@@ -585,11 +724,37 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         else:
             LOG.info("Warning: %s file doesn't exist." % data)
 
-        if os.path.exists(meta):
+        if self._metadata is not None:
+            # quarantined as a .meta file
+            self._metadata.write_meta_file(a_id, q_meta_path)
+            self._metadata.delete(a_id)
+        elif os.path.exists(meta):
             shutil.move(meta, self._quarantine_dir)
         else:
             LOG.info("Warning: %s file doesn't exist." % meta)
 
+        self._index.remove(a_id)
+
+    def _get_data_path(self, a_dir, a_id):
+        """
+           Return the path of the data file of a_id in a_dir.
+           Use the storage variant of the index if the id is indexed
+           otherwise check which variant exists on disk.
+        """
+        data_p = self.DATA_FNAME % (a_dir, a_id)
+
+        rec = self._index.get(a_id)
+        if rec is not None:
+            variant = rec[gmvault_index.GmailIndex.VARIANT_F]
+            return '%s.%s' % (data_p, variant) if variant else data_p
+
+        # check if encrypted and compressed or not
+        for variant in ('gz.crypt', 'crypt.gz', 'gz', 'crypt'):
+            if os.path.exists('%s.%s' % (data_p, variant)):
+                return '%s.%s' % (data_p, variant)
+
+        return data_p
+
     def email_encrypted(self, a_email_fn):
         """
            True is filename contains .crypt otherwise False
@@ -604,48 +769,52 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
         """
         the_dir = self.get_directory_from_id(a_id)
 
-        with self._get_data_file_from_id(the_dir, a_id) as f:
-            if self.email_encrypted(f.name):
-                LOG.debug("Restore encrypted email %s." % a_id)
-                # need to be done for every encryption
-                cipher = self.get_encryption_cipher()
-                cipher.initCTR()
-                LOG.debug("Decrypt data.")
-                data = cipher.decryptCTR(f.read())
-            else:
-                #data = codecs.decode(f.read(), "utf-8" )
-                data = f.read()
-
-        return self.unbury_metadata(a_id, the_dir), data
+        return self.unbury_metadata(a_id, the_dir), self.unbury_data(a_id, the_dir)
 
     def unbury_data(self, a_id, a_id_dir=None):
         """
            Get the only the email content from the DB
         """
+        with self.unbury_stream(a_id, a_id_dir) as f:
+            return f.read()
+
+    def unbury_stream(self, a_id, a_id_dir=None):
+        """
+           Return a file object reading the email content from the DB.
+           The content is decrypted and decompressed chunk by chunk when read.
+           The caller has to close it. The encryption cipher being shared,
+           only one encrypted email can be read or stored at a time.
+        """
         if not a_id_dir:
             a_id_dir = self.get_directory_from_id(a_id)
 
-        with self._get_data_file_from_id(a_id_dir, a_id) as f:
-            if self.email_encrypted(f.name):
-                LOG.debug("Restore encrypted email %s" % a_id)
-                # need to be done for every encryption
-                cipher = self.get_encryption_cipher()
-                cipher.initCTR()
-                data = cipher.decryptCTR(f.read())
-            else:
-                data = f.read()
+        data_p  = self._get_data_path(a_id_dir, a_id)
+        variant = data_p[len(self.DATA_FNAME % (a_id_dir, a_id)):].lstrip('.')
+
+        return self._data_reader(a_id, open(data_p, 'rb'), variant)
+
+    def _data_reader(self, a_id, fileobj, variant):
+        """
+           Return a file object decoding the stored data of a_id read from fileobj
+           according to its storage variant
+        """
+        cipher = None
+        if 'crypt' in variant:
+            LOG.debug("Restore encrypted email %s" % a_id)
+            cipher = self.get_encryption_cipher()
+
+        if variant == 'crypt.gz':
+            # old layout: encrypted then compressed
+            return stream_utils.DataReader(stream_utils.DataReader(fileobj, compressed = True), \
+                                           cipher = cipher)
 
-        return data    
+        return stream_utils.DataReader(fileobj, cipher = cipher, compressed = variant.startswith('gz'))
 
     def unbury_metadata(self, a_id, a_id_dir=None):
         """
            Get metadata info from DB
         """
-        if not a_id_dir:
-            a_id_dir = self.get_directory_from_id(a_id)
-
-        with self._get_metadata_file_from_id(a_id_dir, a_id) as f:
-            metadata = json.load(f)
+        metadata = self._load_metadata(a_id, a_id_dir)
 
         metadata[self.INT_DATE_K] = gmvault_utils.e2datetime(
             metadata[self.INT_DATE_K])
@@ -663,6 +832,75 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
         return metadata
 
+    def _load_metadata(self, a_id, a_id_dir=None):
+        """
+           Return the metadata of a_id from the SQLite store or the json
+        """
+        if self._metadata is not None:
+            metadata = self._metadata.get(a_id)
+            if metadata is None:
+                raise KeyError("No metadata stored for id %s." % (a_id))
+            return metadata
+
+        return self._read_metadata(a_id, a_id_dir)
+
+    def _get_email_format(self, a_id, local_dir=None):
+        """
+           Return the recorded format of the stored email or None
+        """
+        the_dir = self.get_directory_from_id(a_id, local_dir)
+        if not the_dir:
+            return None
+
+        try:
+            return self._load_metadata(a_id, the_dir).get(self.EMAIL_FMT_K)
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def normalize_email(self, a_id):
+        """
+           Convert the content of an email stored raw to utf-8 (the charset is guessed).
+           Return True if the email has been converted
+        """
+        rec = self._index.get(a_id)
+        if rec is None:
+            return False
+
+        the_dir  = self.get_directory_from_id(a_id)
+        metadata = self._load_metadata(a_id, the_dir)
+        variant  = rec[gmvault_index.GmailIndex.VARIANT_F]
+
+        # encrypted emails are always stored raw
+        if metadata.get(self.EMAIL_FMT_K) != self.RAW_FORMAT or 'crypt' in variant:
+            return False
+
+        local_dir = rec[gmvault_index.GmailIndex.DIR_F]
+        email_info = { imap_utils.GIMAPFetcher.GMAIL_ID   : a_id,
+                       imap_utils.GIMAPFetcher.EMAIL_BODY : self.unbury_data(a_id, the_dir) }
+
+        size = self._write_data(email_info, local_dir, variant, compress = (variant == 'gz'), \
+                                cipher = None, to_utf8 = True)
+
+        metadata[self.EMAIL_FMT_K] = self.UTF8_FORMAT
+        if self._metadata is not None:
+            self._metadata.put(metadata, local_dir)
+        else:
+            self._write_metadata(metadata, local_dir)
+
+        self._index.add(a_id, local_dir, variant, size)
+
+        return True
+
+    def _read_metadata(self, a_id, a_id_dir=None):
+        """
+           Return the stored json metadata of a_id
+        """
+        if not a_id_dir:
+            a_id_dir = self.get_directory_from_id(a_id)
+
+        with self._get_metadata_file_from_id(a_id_dir, a_id) as f:
+            return json.load(f)
+
     def delete_emails(self, emails_info, msg_type):
         """
            Delete all emails and metadata with ids
@@ -682,37 +920,558 @@ class GmailStorer(object): #pylint:disable=R0902,R0904,R0914
 
             the_dir = '%s/%s' % (db_dir, date_dir)
 
-            data_p      = self.DATA_FNAME % (the_dir, a_id)
-            comp_data_p = '%s.gz' % data_p
-            cryp_comp_data_p = '%s.crypt.gz' % data_p
-
+            data_p      = self._get_data_path(the_dir, a_id)
             metadata_p  = self.METADATA_FNAME % (the_dir, a_id)
 
             if move_to_bin:
                 #move files to the bin
                 gmvault_utils.makedirs(self._bin_dir)
 
-                # create bin filenames
-                bin_p          = self.DATA_FNAME % (self._bin_dir, a_id)
+                # create bin filenames (keep the data file extension)
+                bin_p          = os.path.join(self._bin_dir, os.path.basename(data_p))
                 metadata_bin_p = self.METADATA_FNAME % (self._bin_dir, a_id)
 
                 if os.path.exists(data_p):
                     os.rename(data_p, bin_p)
-                elif os.path.exists(comp_data_p):
-                    os.rename(comp_data_p, '%s.gz' % bin_p)
-                elif os.path.exists(cryp_comp_data_p):
-                    os.rename(cryp_comp_data_p, '%s.crypt.gz' % bin_p)   
                 
-                if os.path.exists(metadata_p):
+                if self._metadata is not None:
+                    if a_id in self._metadata:
+                        self._metadata.write_meta_file(a_id, metadata_bin_p)
+                elif os.path.exists(metadata_p):
                     os.rename(metadata_p, metadata_bin_p)
             else:
                 #delete files if they exists
                 if os.path.exists(data_p):
                     os.remove(data_p)
-                elif os.path.exists(comp_data_p):
-                    os.remove(comp_data_p)
-                elif os.path.exists(cryp_comp_data_p):
-                    os.remove(cryp_comp_data_p)   
 
                 if os.path.exists(metadata_p):
                     os.remove(metadata_p)
+
+            if self._metadata is not None:
+                self._metadata.delete(a_id)
+
+            self._index.remove(a_id)
+
+
+class GmailSegmentStorer(GmailStorer): #pylint:disable=R0904
+    """
+       Store emails and metadata in large append only segment files
+       (see gmvault_segment) instead of 2 files per email.
+       The month and chats dirs only exist in the gm_id index.
+    """
+    SEGMENTS_AREA   = 'segments'
+    STORAGE_BACKEND = 'segments'
+
+    def __init__(self, a_storage_dir, encrypt_data=False, process_safe=False):
+        """
+           Store in segments
+           args:
+              a_storage_dir: Storage directory
+              a_use_encryption: Encryption key. If there then encrypt
+              process_safe: True if other processes write in the same db at the same time
+        """
+        self._store = gmvault_segment.SegmentStore('%s/%s' % (a_storage_dir, self.SEGMENTS_AREA), \
+                                                   '%s/%s' % (a_storage_dir, self.INFO_AREA), \
+                                                   gmvault_utils.get_conf_defaults().getint(
+                                                       "General", "segment_max_size", 268435456), \
+                                                   persist = gmvault_utils.get_conf_defaults().getboolean(
+                                                       "General", "persist_gm_id_index", True), \
+                                                   shared = process_safe)
+
+        super(GmailSegmentStorer, self).__init__(a_storage_dir, encrypt_data, process_safe)
+
+    def _create_index(self, persist, process_safe):
+        """
+           Create the gm_id index of the db (rebuilt from the segments)
+        """
+        return gmvault_segment.SegmentGmailIndex(self._info_dir, self._store, persist = persist, \
+                                                 shared = process_safe, metadata = self._metadata)
+
+    def get_store(self):
+        """
+           Return the segment store
+        """
+        return self._store
+
+    def rebuild_index(self):
+        """
+           Recreate the segments and gm_id indexes from the segments
+        """
+        self._store.locations.rebuild()
+        self._index.rebuild()
+
+    def reload_index(self):
+        """
+           Read again the indexes to get the emails stored by other processes
+        """
+        self._store.locations.reload()
+        self._index.reload()
+
+    def _init_sub_chats_dir(self):
+        """
+           get info from existing sub chats
+        """
+        nb_per_inc = {}
+        chat_prefix = '%s/' % (self.CHATS_AREA)
+        for _, rec in self._index.iteritems():
+            the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+            if the_dir.startswith(chat_prefix):
+                inc = int(the_dir.split('-')[-1])
+                nb_per_inc[inc] = nb_per_inc.get(inc, 0) + 1
+
+        if nb_per_inc:
+            self._sub_chats_inc = max(nb_per_inc)
+            self._sub_chats_nb  = nb_per_inc[self._sub_chats_inc]
+        else:
+            self._sub_chats_inc = 1
+            self._sub_chats_nb  = 0
+
+        self._sub_chats_dir = self.SUB_CHAT_AREA % ("subchats-%s" % (self._sub_chats_inc))
+
+    def _write_data(self, email_info, local_dir, variant, compress, cipher, to_utf8=False):
+        """
+           Append the email content in the given storage variant to the segments. Return its size
+        """
+        body = email_info[imap_utils.GIMAPFetcher.EMAIL_BODY]
+        if stream_utils.is_spooled(body) and not (compress or cipher or to_utf8):
+            # stored as received: append the spool file directly
+            size = len(body)
+            with body.open() as data:
+                self._store.append(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], gmvault_segment.DATA_KIND, \
+                                   self._get_index_dir(local_dir), variant, data, size)
+            return size
+
+        # encode in a temporary file (kept in memory if small) to know the size of the record
+        data = tempfile.SpooledTemporaryFile(max_size = 16 * stream_utils.CHUNK_SIZE)
+        try:
+            stream_utils.encode_data(data, body, compress = compress, cipher = cipher, to_utf8 = to_utf8)
+            size = data.tell()
+            data.seek(0)
+            self._store.append(email_info[imap_utils.GIMAPFetcher.GMAIL_ID], gmvault_segment.DATA_KIND, \
+                               self._get_index_dir(local_dir), variant, data, size)
+        finally:
+            data.close()
+
+        return size
+
+    def _write_metadata(self, meta_obj, local_dir=None):
+        """
+            Append the metadata to the segments
+        """
+        self._store.append_str(meta_obj[self.ID_K], gmvault_segment.META_KIND, \
+                               self._get_index_dir(local_dir), '', json.dumps(meta_obj))
+
+    def _has_metadata(self, a_id):
+        """ True if metadata is stored for a_id """
+        if self._metadata is not None:
+            return a_id in self._metadata
+        return self._store.has(a_id, gmvault_segment.META_KIND)
+
+    def get_directory_from_id(self, a_id, a_local_dir=None):
+        """
+           Return the (virtual) directory path of the id or None if it is not stored.
+           If a_local_dir (yy_mm dir) is passed, the id has to be stored in it.
+        """
+        rec = self._index.get(a_id)
+        if rec is None or not self._has_metadata(a_id):
+            return None
+
+        the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+        if a_local_dir and the_dir != self._get_index_dir(a_local_dir):
+            return None
+
+        return '%s/%s' % (self._db_dir, the_dir) if the_dir else self._db_dir
+
+    def _get_variant(self, a_id):
+        """ storage variant of the data of a_id """
+        rec = self._index.get(a_id)
+        return rec[gmvault_index.GmailIndex.VARIANT_F] if rec else ''
+
+    def unbury_stream(self, a_id, a_id_dir=None):
+        """
+           Return a file object reading the email content from the segments.
+           The content is decrypted and decompressed chunk by chunk when read.
+           The caller has to close it.
+        """
+        return self._data_reader(a_id, self._store.open(a_id, gmvault_segment.DATA_KIND), \
+                                 self._get_variant(a_id))
+
+    def _read_metadata(self, a_id, a_id_dir=None):
+        """
+           Return the stored json metadata of a_id
+        """
+        with self._store.open(a_id, gmvault_segment.META_KIND) as f:
+            return json.load(f)
+
+    def extract_email(self, a_id, a_dir, with_metadata=True):
+        """
+           Write the stored records of a_id as .eml and .meta files in a_dir
+           (same format as the files storage).
+           The .meta file is not written if with_metadata is False.
+        """
+        variant = self._get_variant(a_id)
+        data_p  = self.DATA_FNAME % (a_dir, a_id)
+        paths   = [(gmvault_segment.DATA_KIND, '%s.%s' % (data_p, variant) if variant else data_p)]
+
+        if not with_metadata:
+            pass
+        elif self._metadata is not None:
+            if a_id in self._metadata:
+                self._metadata.write_meta_file(a_id, self.METADATA_FNAME % (a_dir, a_id))
+            else:
+                LOG.info("Warning: no metadata stored for %s." % (a_id))
+        else:
+            paths.append((gmvault_segment.META_KIND, self.METADATA_FNAME % (a_dir, a_id)))
+
+        for kind, path in paths:
+            if not self._store.has(a_id, kind):
+                LOG.info("Warning: no %s stored for %s." % (kind, a_id))
+                continue
+
+            with self._store.open(a_id, kind) as src:
+                with open(path, 'wb') as dst:
+                    stream_utils.copy(src, dst)
+
+    def quarantine_email(self, a_id):
+        """
+           Quarantine the email
+        """
+        self.extract_email(a_id, self._quarantine_dir)
+
+        self._store.delete(a_id)
+        if self._metadata is not None:
+            self._metadata.delete(a_id)
+        self._index.remove(a_id)
+
+    def delete_emails(self, emails_info, msg_type):
+        """
+           Delete all emails and metadata with ids
+        """
+        move_to_bin = gmvault_utils.get_conf_defaults().get_boolean(
+            "General", "keep_in_bin" , False)
+
+        if move_to_bin:
+            LOG.critical("Move emails to the bin:%s" % self._bin_dir)
+            gmvault_utils.makedirs(self._bin_dir)
+
+        for (a_id, _) in emails_info:
+            if move_to_bin:
+                self.extract_email(a_id, self._bin_dir)
+
+            self._store.delete(a_id)
+            if self._metadata is not None:
+                self._metadata.delete(a_id)
+            self._index.remove(a_id)
+
+        # reclaim the space of the deleted emails
+        self._store.compact()
+
+def get_storage_backend(a_storage_dir):
+    """
+       Return the storage backend of the db in a_storage_dir:
+       the recorded one, files for dbs created before it was recorded
+       and the conf default for a new db
+    """
+    backend_file = '%s/%s/%s' % (a_storage_dir, GmailStorer.INFO_AREA, GmailStorer.STORAGE_BACKEND_FILENAME)
+    if os.path.exists(backend_file):
+        with open(backend_file) as f:
+            return f.read().strip()
+
+    if os.path.exists('%s/%s' % (a_storage_dir, GmailStorer.DB_AREA)):
+        return GmailStorer.STORAGE_BACKEND
+
+    return gmvault_utils.get_conf_defaults().get("General", "storage_backend", GmailStorer.STORAGE_BACKEND)
+
+def _write_info_file(a_storage_dir, a_filename, a_value):
+    """
+       Atomically write a_value in the a_filename file of the .info dir
+    """
+    info_dir = '%s/%s' % (a_storage_dir, GmailStorer.INFO_AREA)
+    gmvault_utils.makedirs(info_dir)
+
+    info_file = '%s/%s' % (info_dir, a_filename)
+    with open('%s.tmp' % (info_file), 'w') as f:
+        f.write(a_value)
+
+    gmvault_utils.atomic_rename('%s.tmp' % (info_file), info_file)
+
+def write_storage_backend(a_storage_dir, a_backend):
+    """
+       Record the storage backend of the db in a_storage_dir
+    """
+    _write_info_file(a_storage_dir, GmailStorer.STORAGE_BACKEND_FILENAME, a_backend)
+
+def get_metadata_storage(a_storage_dir):
+    """
+       Return the metadata storage (json or sqlite) of the db in a_storage_dir:
+       the recorded one, json for dbs created before it was recorded
+       and the conf default for a new db
+    """
+    storage_file = '%s/%s/%s' % (a_storage_dir, GmailStorer.INFO_AREA, GmailStorer.METADATA_STORAGE_FILENAME)
+    if os.path.exists(storage_file):
+        with open(storage_file) as f:
+            return f.read().strip()
+
+    if os.path.exists('%s/%s' % (a_storage_dir, GmailStorer.DB_AREA)):
+        return GmailStorer.JSON_METADATA
+
+    return gmvault_utils.get_conf_defaults().get("General", "metadata_storage", GmailStorer.JSON_METADATA)
+
+def write_metadata_storage(a_storage_dir, a_storage):
+    """
+       Record the metadata storage of the db in a_storage_dir
+    """
+    _write_info_file(a_storage_dir, GmailStorer.METADATA_STORAGE_FILENAME, a_storage)
+
+def get_email_format(a_storage_dir):
+    """
+       Return the format (raw or utf-8) of the emails stored in the db in a_storage_dir:
+       the recorded one, utf-8 for dbs created before it was recorded
+       and the conf default for a new db
+    """
+    format_file = '%s/%s/%s' % (a_storage_dir, GmailStorer.INFO_AREA, GmailStorer.EMAIL_FORMAT_FILENAME)
+    if os.path.exists(format_file):
+        with open(format_file) as f:
+            return f.read().strip()
+
+    if os.path.exists('%s/%s' % (a_storage_dir, GmailStorer.DB_AREA)):
+        return GmailStorer.UTF8_FORMAT
+
+    if gmvault_utils.get_conf_defaults().getboolean("General", "store_raw_emails", False):
+        return GmailStorer.RAW_FORMAT
+    return GmailStorer.UTF8_FORMAT
+
+def write_email_format(a_storage_dir, a_format):
+    """
+       Record the format of the emails stored from now on in the db in a_storage_dir
+       (the emails already stored keep theirs)
+    """
+    _write_info_file(a_storage_dir, GmailStorer.EMAIL_FORMAT_FILENAME, a_format)
+
+STORERS = { GmailStorer.STORAGE_BACKEND        : GmailStorer,
+            GmailSegmentStorer.STORAGE_BACKEND : GmailSegmentStorer }
+
+def create_storer(a_storage_dir, encrypt_data=False, process_safe=False):
+    """
+       Return the storer of the db in a_storage_dir according to its storage backend
+    """
+    backend = get_storage_backend(a_storage_dir)
+    if backend not in STORERS:
+        raise ValueError("Unknown storage backend %s for gmvault-db %s." % (backend, a_storage_dir))
+
+    return STORERS[backend](a_storage_dir, encrypt_data, process_safe)
+
+def migrate_storage(a_storage_dir, a_backend):
+    """
+       Convert the db in a_storage_dir to the a_backend storage backend.
+       The stored data is copied as it is (no decryption or decompression).
+       The db is switched to the new backend once everything has been copied
+       so an interrupted migration can be run again.
+    """
+    if a_backend not in STORERS:
+        raise ValueError("Unknown storage backend %s. It should be one of %s." % (a_backend, STORERS.keys()))
+
+    current = get_storage_backend(a_storage_dir)
+    if current == a_backend:
+        LOG.critical("gmvault-db %s already uses the %s storage." % (a_storage_dir, a_backend))
+        return
+
+    timer = gmvault_utils.Timer()
+    timer.start()
+
+    LOG.critical("Migrate gmvault-db %s from %s to %s storage.\n" % (a_storage_dir, current, a_backend))
+
+    if a_backend == GmailSegmentStorer.STORAGE_BACKEND:
+        _migrate_files_to_segments(a_storage_dir)
+    else:
+        _migrate_segments_to_files(a_storage_dir)
+
+    LOG.critical("Migration done in %s.\n" % (timer.elapsed_human_time()))
+
+def _migrate_files_to_segments(a_storage_dir):
+    """
+       Append the .eml and .meta files to segments then delete them
+    """
+    src    = GmailStorer(a_storage_dir)
+    store  = gmvault_segment.SegmentStore('%s/%s' % (a_storage_dir, GmailSegmentStorer.SEGMENTS_AREA), \
+                                          src.get_info_dir(), \
+                                          gmvault_utils.get_conf_defaults().getint(
+                                              "General", "segment_max_size", 268435456))
+
+    # remove what an interrupted migration left
+    store.remove_all()
+
+    paths = []
+    for nb_ids, (gm_id, rec) in enumerate(sorted(src.get_index().iteritems())):
+        the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+        a_dir   = '%s/%s' % (src._db_dir, the_dir) if the_dir else src._db_dir #pylint:disable=W0212
+        meta_p  = src.METADATA_FNAME % (a_dir, gm_id)
+        data_p  = src._get_data_path(a_dir, gm_id) #pylint:disable=W0212
+
+        for kind, path, variant in ((gmvault_segment.META_KIND, meta_p, ''), \
+                                    (gmvault_segment.DATA_KIND, data_p, rec[gmvault_index.GmailIndex.VARIANT_F])):
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    store.append(gm_id, kind, the_dir, variant, f, os.path.getsize(path))
+                paths.append(path)
+
+        if (nb_ids + 1) % 10000 == 0:
+            LOG.critical("%d emails migrated." % (nb_ids + 1))
+
+    store.close()
+    store.locations.compact()
+
+    write_storage_backend(a_storage_dir, GmailSegmentStorer.STORAGE_BACKEND)
+
+    # the emails are in the segments. Delete the files and the empty dirs
+    for path in paths:
+        os.remove(path)
+
+    db_dir = '%s/%s' % (a_storage_dir, GmailStorer.DB_AREA)
+    for the_dir, _, _ in sorted(os.walk(db_dir), reverse = True):
+        if the_dir not in (db_dir, '%s/%s' % (db_dir, GmailStorer.CHATS_AREA)) and not os.listdir(the_dir):
+            os.rmdir(the_dir)
+
+def _migrate_segments_to_files(a_storage_dir):
+    """
+       Write the segments records as .eml and .meta files then delete the segments
+    """
+    src = GmailSegmentStorer(a_storage_dir)
+
+    for nb_ids, (gm_id, rec) in enumerate(sorted(src.get_index().iteritems())):
+        the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+        a_dir   = '%s/%s' % (src._db_dir, the_dir) if the_dir else src._db_dir #pylint:disable=W0212
+        gmvault_utils.makedirs(a_dir)
+        src.extract_email(gm_id, a_dir, with_metadata = src.get_metadata_store() is None)
+
+        if (nb_ids + 1) % 10000 == 0:
+            LOG.critical("%d emails migrated." % (nb_ids + 1))
+
+    write_storage_backend(a_storage_dir, GmailStorer.STORAGE_BACKEND)
+
+    store = src.get_store()
+    store.remove_all()
+    os.remove('%s/%s' % (src.get_info_dir(), gmvault_segment.SegmentIndex.INDEX_FILENAME))
+    os.rmdir('%s/%s' % (a_storage_dir, GmailSegmentStorer.SEGMENTS_AREA))
+
+METADATA_STORAGES = (GmailStorer.JSON_METADATA, GmailStorer.SQLITE_METADATA)
+
+def migrate_metadata(a_storage_dir, a_storage):
+    """
+       Move the metadata of the db in a_storage_dir to the a_storage metadata
+       storage (json or sqlite). The json metadata can be exported back from
+       the SQLite store in the legacy .meta format.
+    """
+    if a_storage not in METADATA_STORAGES:
+        raise ValueError("Unknown metadata storage %s. It should be one of %s." % (a_storage, METADATA_STORAGES))
+
+    current = get_metadata_storage(a_storage_dir)
+    if current == a_storage:
+        LOG.critical("gmvault-db %s already stores its metadata as %s." % (a_storage_dir, a_storage))
+        return
+
+    timer = gmvault_utils.Timer()
+    timer.start()
+
+    LOG.critical("Move the metadata of gmvault-db %s from %s to %s.\n" % (a_storage_dir, current, a_storage))
+
+    if a_storage == GmailStorer.SQLITE_METADATA:
+        _migrate_json_to_sqlite(a_storage_dir)
+    else:
+        _migrate_sqlite_to_json(a_storage_dir)
+
+    LOG.critical("Migration done in %s.\n" % (timer.elapsed_human_time()))
+
+def _migrate_json_to_sqlite(a_storage_dir):
+    """
+       Insert the json metadata in the SQLite store then delete it
+    """
+    src      = create_storer(a_storage_dir)
+    metadata = gmvault_metadata.MetadataStore(src.get_info_dir())
+
+    # remove what an interrupted migration left
+    metadata.remove_all()
+
+    meta_paths = []
+    def iter_metadata():
+        """ (metadata, dir) of all emails """
+        for nb_ids, (gm_id, rec) in enumerate(sorted(src.get_index().iteritems())):
+            the_dir = rec[gmvault_index.GmailIndex.DIR_F]
+            a_dir   = '%s/%s' % (src._db_dir, the_dir) if the_dir else src._db_dir #pylint:disable=W0212
+            try:
+                yield src._read_metadata(gm_id, a_dir), the_dir #pylint:disable=W0212
+            except (IOError, KeyError, ValueError), err:
+                LOG.critical("Ignore id %s. Cannot read its metadata: %s" % (gm_id, err))
+                continue
+
+            meta_paths.append(src.METADATA_FNAME % (a_dir, gm_id))
+
+            if (nb_ids + 1) % 10000 == 0:
+                LOG.critical("%d metadata migrated." % (nb_ids + 1))
+
+    metadata.put_many(iter_metadata())
+    metadata.close()
+
+    write_metadata_storage(a_storage_dir, GmailStorer.SQLITE_METADATA)
+
+    # the metadata is in the SQLite store. Delete the json
+    if isinstance(src, GmailSegmentStorer):
+        src.get_store().drop_records(gmvault_segment.META_KIND)
+    else:
+        for path in meta_paths:
+            os.remove(path)
+
+def _migrate_sqlite_to_json(a_storage_dir):
+    """
+       Export the metadata of the SQLite store in the legacy json format then delete the store
+    """
+    src      = create_storer(a_storage_dir)
+    metadata = src.get_metadata_store()
+
+    for nb_ids, (gm_id, rec) in enumerate(sorted(src.get_index().iteritems())):
+        meta_obj = metadata.get(gm_id)
+        if meta_obj is None:
+            LOG.critical("Ignore id %s. No metadata stored." % (gm_id))
+            continue
+
+        src._write_metadata(meta_obj, rec[gmvault_index.GmailIndex.DIR_F]) #pylint:disable=W0212
+
+        if (nb_ids + 1) % 10000 == 0:
+            LOG.critical("%d metadata migrated." % (nb_ids + 1))
+
+    if isinstance(src, GmailSegmentStorer):
+        src.get_store().close()
+
+    write_metadata_storage(a_storage_dir, GmailStorer.JSON_METADATA)
+
+    metadata.destroy()
+
+def normalize_emails(a_storage_dir):
+    """
+       Convert the emails of the db in a_storage_dir stored raw to utf-8
+       (optional post processing of the raw storage)
+    """
+    timer = gmvault_utils.Timer()
+    timer.start()
+
+    storer = create_storer(a_storage_dir)
+
+    nb_converted = 0
+    for nb_ids, gm_id in enumerate(sorted(gm_id for gm_id, _ in storer.get_index().iteritems())):
+        try:
+            if storer.normalize_email(gm_id):
+                nb_converted += 1
+        except (IOError, KeyError, ValueError), err:
+            LOG.critical("Cannot convert email %s to utf-8: %s" % (gm_id, err))
+
+        if (nb_ids + 1) % 10000 == 0:
+            LOG.critical("%d emails processed." % (nb_ids + 1))
+
+    if isinstance(storer, GmailSegmentStorer):
+        # reclaim the space of the raw contents
+        storer.get_store().compact()
+
+    # the next emails are also converted
+    write_email_format(a_storage_dir, GmailStorer.UTF8_FORMAT)
+
+    LOG.critical("%d emails converted to utf-8 in %s.\n" % (nb_converted, timer.elapsed_human_time()))
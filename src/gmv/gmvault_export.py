@@ -22,6 +22,10 @@
 import os
 import re
 import mailbox
+import tempfile
+import itertools
+import StringIO
+import email.generator
 
 import imapclient.imap_utf7 as imap_utf7
 
@@ -29,6 +33,7 @@ import gmv.imap_utils as imap_utils
 import gmv.log_utils as log_utils
 import gmv.gmvault_utils as gmvault_utils
 import gmv.gmvault_db as gmvault_db
+import gmv.stream_utils as stream_utils
 
 LOG = log_utils.LoggerFactory.get_logger('gmvault_export')
 
@@ -53,7 +58,7 @@ class GMVaultExporter(object):
         """
            constructor
         """
-        self.storer = gmvault_db.GmailStorer(db_dir)
+        self.storer = gmvault_db.create_storer(db_dir)
         self.mailbox = a_mailbox
         self.labels = labels
 
@@ -87,7 +92,8 @@ class GMVaultExporter(object):
         done = 0
 
         for a_id in ids:
-            meta, msg = self.storer.unbury_email(a_id)
+            the_dir = self.storer.get_directory_from_id(a_id)
+            meta = self.storer.unbury_metadata(a_id, the_dir)
 
             folders = [default_folder]
             if use_labels:
@@ -100,8 +106,8 @@ class GMVaultExporter(object):
 
             LOG.debug("Processing id %s in labels %s." % \
                 (a_id, self.printable_label_list(folders)))
-            for folder in folders:
-                self.mailbox.add(msg, folder, meta[gmvault_db.GmailStorer.FLAGS_K])
+            if folders:
+                self._add_to_folders(a_id, the_dir, folders, meta[gmvault_db.GmailStorer.FLAGS_K])
 
             done += 1
             left = len(ids) - done
@@ -113,10 +119,53 @@ class GMVaultExporter(object):
 
         LOG.critical("Export completed in %s." % (timer.elapsed_human_time(),))
 
+    def _add_to_folders(self, a_id, a_dir, folders, flags):
+        """
+           Stream the email content in all the folders
+        """
+        with self.storer.unbury_stream(a_id, a_dir) as data:
+            if len(folders) == 1:
+                self.mailbox.add(data, folders[0], flags)
+                return
+
+            # decode the content once in a temporary file (kept in memory if small)
+            # and rewind it for each folder
+            msg = tempfile.SpooledTemporaryFile(max_size = stream_utils.CHUNK_SIZE)
+            try:
+                stream_utils.copy(data, msg)
+                for folder in folders:
+                    msg.seek(0)
+                    self.mailbox.add(msg, folder, flags)
+            finally:
+                msg.close()
+
+
+class LinesReader(object):
+    """ File object returning the lines of an iterator as expected by mailbox """
+    def __init__(self, lines):
+        self._lines = iter(lines)
+
+    def readline(self):
+        """ next line or '' at the end """
+        return next(self._lines, '')
+
+    def read(self):
+        """ all remaining lines """
+        return ''.join(self._lines)
+
+def read_headers(msg):
+    """ Read the header lines of a message file object up to the blank line included """
+    lines = []
+    for line in iter(msg.readline, ''):
+        lines.append(line)
+        if line in ('\n', '\r\n'):
+            break
+    return ''.join(lines)
 
 class Mailbox(object):
     """ Mailbox abstract class"""
     def add(self, msg, folder, flags):
+        """ add msg (a file object read line by line) in folder """
         raise NotImplementedError('implement in subclass')
     def close(self):
         pass
@@ -126,6 +175,7 @@ class Maildir(Mailbox):
     def __init__(self, path, separator = '/'):
         self.path = path
         self.subdirs = {}
+        self.subdir_paths = {}
         self.separator = separator
         if not self.root_is_maildir() and not os.path.exists(self.path):
             os.makedirs(self.path)
@@ -162,19 +212,20 @@ class Maildir(Mailbox):
         abspath = os.path.join(self.path, path)
         sub = mailbox.Maildir(abspath, create = True)
         self.subdirs[folder] = sub
+        self.subdir_paths[folder] = abspath
         return sub
 
     def add(self, msg, folder, flags):
         """ add message in a given subdir """
-        mmsg = mailbox.MaildirMessage(msg)
+        sub = self.subdir(folder)
+        # the message is streamed in new/ then moved in cur/ with its flags
+        key = sub.add(msg)
 
         if GMVaultExporter.GM_SEEN in flags:
-            mmsg.set_subdir('cur')
-            mmsg.add_flag('S')
-        if mmsg.get_subdir() == 'cur' and GMVaultExporter.GM_FLAGGED in flags:
-            mmsg.add_flag('F')
-
-        self.subdir(folder).add(mmsg)
+            info = 'FS' if GMVaultExporter.GM_FLAGGED in flags else 'S'
+            sub_path = self.subdir_paths[folder]
+            os.rename(os.path.join(sub_path, 'new', key), \
+                      os.path.join(sub_path, 'cur', '%s%s2,%s' % (key, sub.colon, info)))
 
 class OfflineIMAP(Maildir):
     """ Class dealing with offlineIMAP specificities """
@@ -280,9 +331,15 @@ class MBox(Mailbox):
         return self.open[real_label]
 
     def add(self, msg, folder, flags):
-        mmsg = mailbox.mboxMessage(msg)
+        """ add message in the mbox of folder. Only the headers are parsed to set the flags """
+        mmsg = mailbox.mboxMessage(read_headers(msg))
         if GMVaultExporter.GM_SEEN in flags:
             mmsg.add_flag('R')
         if GMVaultExporter.GM_FLAGGED in flags:
             mmsg.add_flag('F')
-        self.subdir(folder).add(mmsg)
+
+        headers = StringIO.StringIO()
+        email.generator.Generator(headers, False, 0).flatten(mmsg)
+        headers.seek(0)
+
+        self.subdir(folder).add(LinesReader(itertools.chain(headers, iter(msg.readline, ''))))
@@ -0,0 +1,537 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Persistent gm_id index of a gmvault-db.
+    It avoids walking the whole db tree to list the stored emails and chats.
+    Persistent uid => gm_id index of the synced Gmail folders.
+
+'''
+import os
+import json
+
+try:
+    import fcntl
+except ImportError: # no fcntl on windows
+    fcntl = None
+    import msvcrt
+
+import gmv.log_utils as log_utils
+import gmv.gmvault_utils as gmvault_utils
+
+LOG = log_utils.LoggerFactory.get_logger('gmvault_index')
+
+# byte locked with msvcrt: far after the end of the journal because
+# the locks are mandatory on windows (the locked bytes cannot be read)
+MSVCRT_LOCK_OFFSET = 0x7ffffffe
+
+def _lock(a_file):
+    """
+       Exclusive lock of a_file between processes. Wait until it is obtained
+    """
+    if fcntl:
+        fcntl.flock(a_file.fileno(), fcntl.LOCK_EX)
+        return
+
+    a_file.seek(MSVCRT_LOCK_OFFSET)
+    while True:
+        try:
+            msvcrt.locking(a_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except IOError:
+            # LK_LOCK gives up after 10 attempts (10 s)
+            continue
+
+def _unlock(a_file):
+    """
+       Release the lock taken by _lock
+    """
+    if fcntl:
+        fcntl.flock(a_file.fileno(), fcntl.LOCK_UN)
+        return
+
+    # the journal is opened in append mode: the writes do not depend on the position
+    a_file.seek(MSVCRT_LOCK_OFFSET)
+    msvcrt.locking(a_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+class JournalIndex(object):
+    """
+       gm_id => record index stored in the .info dir as a journal: one line
+       is appended for each stored or deleted id and the journal is replayed
+       when loaded. Subclasses define the records and how to rebuild them.
+    """
+    INDEX_FILENAME = None
+    INDEX_NAME     = 'index'
+    INDEX_VERSION  = '1'
+    HEADER         = '#gmvault-index %s\n'
+
+    ADD_OP = '+'
+    DEL_OP = '-'
+
+    # compact the journal when it contains more than X times the live entries
+    COMPACTION_RATIO = 2
+
+    def __init__(self, a_info_dir, persist=True, shared=False):
+        """
+           constructor
+           args:
+              a_info_dir: .info dir where the index is persisted
+              persist   : if False the index is built from the db and only kept in memory
+              shared    : True if several processes write in the index at the same time.
+                          The journal is then locked when written and never compacted.
+        """
+        self._info_dir   = a_info_dir
+        self._index_path = '%s/%s' % (a_info_dir, self.INDEX_FILENAME)
+        self._persist    = persist
+        self._shared     = shared
+
+        self._records    = None # loaded lazily
+        self._journal    = None # fd in append mode
+        self._nb_lines   = 0
+
+    def _get_records(self):
+        """
+           Return the in memory records. Load or build them if necessary
+        """
+        if self._records is None:
+            if not self._persist:
+                self.rebuild()
+            elif os.path.exists(self._index_path):
+                self._load()
+            else:
+                LOG.critical("No %s in %s. Build it from the db (done only once)." % (self.INDEX_NAME, self._info_dir))
+                self.rebuild()
+
+        return self._records
+
+    def _load(self):
+        """
+           Replay the journal
+        """
+        records  = {}
+        nb_lines = 0
+        with open(self._index_path, 'r') as f:
+            header = f.readline()
+            if header != self.HEADER % (self.INDEX_VERSION):
+                LOG.critical("Unknown %s format (%s). Rebuild it." % (self.INDEX_NAME, header.strip()))
+                self.rebuild()
+                return
+
+            for line in f:
+                if not line.endswith('\n'):
+                    # partially written line (crash while writing). ignore it
+                    LOG.debug("Ignore truncated line %r in %s." % (line, self.INDEX_NAME))
+                    continue
+                nb_lines += 1
+                fields = line[:-1].split('\t')
+                if fields[0] == self.ADD_OP:
+                    self._replay_add(records, fields)
+                elif fields[0] == self.DEL_OP:
+                    records.pop(long(fields[1]), None)
+
+        self._records  = records
+        self._nb_lines = nb_lines
+
+        if not self._shared and nb_lines > self.COMPACTION_RATIO * max(len(records), 1000):
+            self.compact()
+
+    def _replay_add(self, records, fields):
+        """
+           Apply an add line of the journal (split in fields) to the records
+        """
+        raise NotImplementedError('implement in subclass')
+
+    def _add_lines(self, gm_id, rec):
+        """
+           journal lines recreating the record of gm_id
+        """
+        raise NotImplementedError('implement in subclass')
+
+    def _build_records(self):
+        """
+           Create all records from the db
+        """
+        raise NotImplementedError('implement in subclass')
+
+    def _write_all(self, records):
+        """
+           Write all records in a new journal and atomically replace the current one
+        """
+        self.close()
+
+        if not self._persist:
+            self._records  = records
+            self._nb_lines = len(records)
+            return
+
+        tmp_path = '%s.tmp' % (self._index_path)
+        with open(tmp_path, 'w') as f:
+            f.write(self.HEADER % (self.INDEX_VERSION))
+            for gm_id, rec in records.iteritems():
+                f.write(self._add_lines(gm_id, rec))
+            f.flush()
+            os.fsync(f.fileno())
+
+        gmvault_utils.atomic_rename(tmp_path, self._index_path)
+
+        self._records  = records
+        self._nb_lines = len(records)
+
+    def _append(self, line, nb_lines=1):
+        """
+           Append a line (or nb_lines lines) to the journal
+        """
+        if not self._persist:
+            return
+
+        if not self._journal:
+            self._journal = open(self._index_path, 'a')
+
+        if self._shared:
+            _lock(self._journal)
+            try:
+                self._journal.write(line)
+                self._journal.flush()
+            finally:
+                _unlock(self._journal)
+        else:
+            self._journal.write(line)
+            self._journal.flush()
+
+        self._nb_lines += nb_lines
+
+    def reload(self):
+        """
+           Forget the in memory records. They will be read again from the journal
+           (to get the changes done by other processes)
+        """
+        self.close()
+        self._records = None
+
+    def compact(self):
+        """
+           Rewrite the journal with the live entries only
+        """
+        records = self._get_records()
+        LOG.debug("Compact %s %s (%d lines for %d ids)." \
+                  % (self.INDEX_NAME, self._index_path, self._nb_lines, len(records)))
+        self._write_all(records)
+
+    def rebuild(self):
+        """
+           Recreate the index from the db.
+           To be used when the index and the db drift apart.
+        """
+        timer = gmvault_utils.Timer()
+        timer.start()
+
+        records = self._build_records()
+
+        self._write_all(records)
+
+        LOG.critical("%s built with %d ids in %s." % (self.INDEX_NAME, len(records), timer.elapsed_human_time()))
+
+    def close(self):
+        """
+           close the journal
+        """
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def remove(self, gm_id):
+        """
+           Remove an id from the index
+        """
+        records = self._get_records()
+        if records.pop(gm_id, None) is not None:
+            self._append('%s\t%s\n' % (self.DEL_OP, gm_id))
+
+    def get(self, gm_id):
+        """
+           Return the record for gm_id or None
+        """
+        return self._get_records().get(gm_id)
+
+    def __len__(self):
+        return len(self._get_records())
+
+    def __contains__(self, gm_id):
+        return gm_id in self._get_records()
+
+    def iteritems(self):
+        """
+           iterate over (gm_id, record)
+        """
+        return self._get_records().iteritems()
+
+class GmailIndex(JournalIndex):
+    """
+       gm_id => (dir, storage variant, size, internal date) index.
+       dir is relative to the db dir (yyyy-mm or chats/subchats-x).
+    """
+    INDEX_FILENAME = 'gm_id.index'
+    INDEX_NAME     = 'gm_id index'
+
+    # records fields
+    DIR_F     = 0
+    VARIANT_F = 1
+    SIZE_F    = 2
+    DATE_F    = 3
+
+    # storage variants in the order they are probed on disk
+    VARIANTS = ('', 'gz', 'crypt', 'crypt.gz', 'gz.crypt')
+
+    def __init__(self, a_info_dir, a_db_dir, persist=True, shared=False, metadata=None):
+        """
+           constructor
+           args:
+              a_info_dir: .info dir where the index is persisted
+              a_db_dir  : db dir containing the emails
+              persist   : if False the index is built from the db and only kept in memory
+              shared    : True if several processes write in the index at the same time.
+              metadata  : MetadataStore if the metadata is not stored in .meta files
+        """
+        super(GmailIndex, self).__init__(a_info_dir, persist, shared)
+        self._db_dir   = a_db_dir
+        self._metadata = metadata
+
+    def _replay_add(self, records, fields):
+        """ + gm_id dir variant size int_date """
+        records[long(fields[1])] = (intern(fields[2]), intern(fields[3]), \
+                                    int(fields[4]), int(fields[5]))
+
+    @classmethod
+    def _add_lines(cls, gm_id, rec):
+        """ journal line for a stored id """
+        return '%s\t%s\t%s\t%s\t%d\t%d\n' % (cls.ADD_OP, gm_id, rec[cls.DIR_F], \
+                                              rec[cls.VARIANT_F], rec[cls.SIZE_F], rec[cls.DATE_F])
+
+    def _build_records(self):
+        """
+           Walk the db tree and recreate the records from the files on disk
+        """
+        if self._metadata is not None:
+            return self._build_records_from_metadata()
+
+        return dict(self._walk_records())
+
+    def _walk_records(self, known=()):
+        """
+           Walk the db tree and return (gm_id, record) of the .meta files on disk
+           whose gm_id is not in known
+        """
+        if not os.path.exists(self._db_dir):
+            return
+
+        for the_dir, _, files in os.walk(self._db_dir):
+            rel_dir = os.path.relpath(the_dir, self._db_dir)
+            rel_dir = '' if rel_dir == '.' else intern(rel_dir.replace(os.sep, '/'))
+            files   = set(files)
+            for fname in files:
+                if not fname.endswith('.meta'):
+                    continue
+                gm_id   = fname[:-5]
+                try:
+                    if long(gm_id) in known:
+                        continue
+                    rec = self._read_record(the_dir, rel_dir, gm_id, files)
+                except ValueError, err:
+                    LOG.critical("Ignore %s/%s when building the gm_id index: %s" % (the_dir, fname, err))
+                    continue
+                yield long(gm_id), rec
+
+    def add_missing(self):
+        """
+           Add the emails stored in the db but not in the index (stale index: db
+           modified by an older gmvault). Return the nb of added ids
+        """
+        records = self._get_records()
+        if self._metadata is not None:
+            missing = [(gm_id, rec) for gm_id, rec in self._build_records_from_metadata().iteritems() \
+                       if gm_id not in records]
+        else:
+            missing = list(self._walk_records(records))
+
+        for gm_id, rec in missing:
+            self.add(gm_id, *rec)
+
+        if missing:
+            LOG.critical("%d emails were missing in the %s. They have been added." % (len(missing), self.INDEX_NAME))
+        return len(missing)
+
+    def _build_records_from_metadata(self):
+        """
+           Recreate the records from the metadata store and the stored data
+        """
+        data    = self._scan_data()
+        records = {}
+        for gm_id, the_dir, int_date in self._metadata.iter_dirs():
+            variant, size = data.get(gm_id, ('', 0))
+            records[gm_id] = (intern(the_dir), intern(variant), size, \
+                              int(int_date) if int_date is not None else -1)
+
+        return records
+
+    def _scan_data(self):
+        """
+           Return gm_id => (variant, size) of the .eml files on disk
+        """
+        data = {}
+        if os.path.exists(self._db_dir):
+            for the_dir, _, files in os.walk(self._db_dir):
+                for fname in files:
+                    gm_id, ext, variant = fname.partition('.eml')
+                    variant = variant[1:]
+                    if not ext or variant not in self.VARIANTS:
+                        continue
+                    try:
+                        gm_id = long(gm_id)
+                    except ValueError:
+                        continue
+
+                    prev = data.get(gm_id)
+                    if prev is None or self.VARIANTS.index(variant) < self.VARIANTS.index(prev[0]):
+                        data[gm_id] = (intern(variant), os.path.getsize(os.path.join(the_dir, fname)))
+
+        return data
+
+    def _read_record(self, the_dir, rel_dir, gm_id, files):
+        """
+           Create the index record of an email from the files on disk
+        """
+        variant, size = '', 0
+        for var in self.VARIANTS:
+            data_name = '%s.eml.%s' % (gm_id, var) if var else '%s.eml' % (gm_id)
+            if data_name in files:
+                variant = var
+                size    = os.path.getsize(os.path.join(the_dir, data_name))
+                break
+
+        with open(os.path.join(the_dir, '%s.meta' % (gm_id))) as f:
+            int_date = json.load(f).get('internal_date', -1)
+
+        return (rel_dir, intern(variant), size, int(int_date) if int_date is not None else -1)
+
+    def add(self, gm_id, the_dir, variant=None, size=None, int_date=None):
+        """
+           Add or update an id in the index.
+           None values keep the previously indexed ones.
+        """
+        records = self._get_records()
+        prev    = records.get(gm_id)
+
+        if prev:
+            variant  = prev[self.VARIANT_F] if variant is None else variant
+            size     = prev[self.SIZE_F] if size is None else size
+            int_date = prev[self.DATE_F] if int_date is None else int_date
+
+        rec = (intern(the_dir or ''), intern(variant or ''), size or 0, \
+               int_date if int_date is not None else -1)
+
+        if rec != prev:
+            records[gm_id] = rec
+            self._append(self._add_lines(gm_id, rec))
+
+class UidIndex(JournalIndex):
+    """
+       uid => gm_id index of a Gmail folder (ALLMAIL or CHATS) filled by the syncs.
+       It is used to find the deleted emails without fetching the gm_id of all uids.
+       The uid 0 (not a valid uid) records the UIDVALIDITY of the folder: the index
+       is emptied when it changes.
+    """
+    INDEX_NAME   = 'uid index'
+    VALIDITY_UID = 0
+
+    def __init__(self, a_info_dir, a_login, a_folder, persist=True, shared=False): #pylint:disable=R0913
+        """
+           constructor
+           args:
+              a_info_dir: .info dir where the index is persisted
+              a_login   : gmail account
+              a_folder  : predefined folder name (ALLMAIL or CHATS)
+              persist   : if False the index is only kept in memory
+              shared    : True if several processes write in the index at the same time.
+        """
+        super(UidIndex, self).__init__(a_info_dir, persist, shared)
+        self._index_path = '%s/%s_%s.uid_index' % (a_info_dir, a_login, a_folder.lower())
+
+    def _replay_add(self, records, fields):
+        """ + uid gm_id """
+        records[long(fields[1])] = long(fields[2])
+
+    @classmethod
+    def _add_lines(cls, uid, gm_id):
+        """ journal line for a uid """
+        return '%s\t%s\t%s\n' % (cls.ADD_OP, uid, gm_id)
+
+    def _build_records(self):
+        """
+           The uids are only known from the syncs: start empty
+        """
+        return {}
+
+    def get_uidvalidity(self):
+        """
+           UIDVALIDITY of the indexed uids or None
+        """
+        return self._get_records().get(self.VALIDITY_UID)
+
+    def set_uidvalidity(self, uidvalidity):
+        """
+           Set the UIDVALIDITY of the selected folder.
+           Forget all uids if it is not the one of the indexed uids
+        """
+        previous = self.get_uidvalidity()
+        if previous != uidvalidity:
+            if previous is not None:
+                LOG.critical("UIDVALIDITY of %s changed (%s => %s). Forget the indexed uids." \
+                             % (self._index_path, previous, uidvalidity))
+            self._write_all({self.VALIDITY_UID : uidvalidity})
+
+    def update(self, uid_gm_ids):
+        """
+           Add the (uid, gm_id) pairs. Only the new ones are written (in one journal write)
+        """
+        records = self._get_records()
+        lines   = []
+        for uid, gm_id in uid_gm_ids:
+            if records.get(uid) != gm_id:
+                records[uid] = gm_id
+                lines.append(self._add_lines(uid, gm_id))
+        if lines:
+            self._append(''.join(lines), len(lines))
+
+    def remove_uids(self, uids):
+        """
+           Remove the uids (deleted from the folder)
+        """
+        records = self._get_records()
+        lines   = ['%s\t%s\n' % (self.DEL_OP, uid) for uid in uids if records.pop(uid, None) is not None]
+        if lines:
+            self._append(''.join(lines), len(lines))
+
+    def __len__(self):
+        return len(self._get_records()) - (self.VALIDITY_UID in self._get_records())
+
+    def __contains__(self, uid):
+        return uid != self.VALIDITY_UID and uid in self._get_records()
+
+    def iteritems(self):
+        """
+           iterate over (uid, gm_id)
+        """
+        return ((uid, gm_id) for uid, gm_id in self._get_records().iteritems() if uid != self.VALIDITY_UID)
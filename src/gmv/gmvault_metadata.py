@@ -0,0 +1,384 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    SQLite metadata store of a gmvault-db.
+    The metadata of all emails is kept in one database (.info/metadata.sqlite)
+    instead of one .meta json file per email. The metadata of a sync batch is
+    compared with the stored one in a few queries.
+
+'''
+import os
+import json
+import sqlite3
+import threading
+
+import gmv.log_utils as log_utils
+
+LOG = log_utils.LoggerFactory.get_logger('gmvault_metadata')
+
+class MetadataStore(object):
+    """
+       gm_id => metadata store in SQLite.
+       The metadata is returned as the json structure of the .meta files.
+    """
+    DB_FILENAME    = 'metadata.sqlite'
+    SCHEMA_VERSION = 2
+
+    # json keys of the .meta files (see GmailStorer)
+    ID_K         = 'gm_id'
+    THREAD_IDS_K = 'thread_ids'
+    LABELS_K     = 'labels'
+    INT_DATE_K   = 'internal_date'
+    FLAGS_K      = 'flags'
+    SUBJECT_K    = 'subject'
+    MSGID_K      = 'msg_id'
+    XGM_RECV_K   = 'x_gmail_received'
+    EMAIL_FMT_K  = 'email_format'
+
+    # flags are stored sorted in one column to be compared as a set
+    FLAGS_SEP = ' '
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            gm_id            INTEGER PRIMARY KEY,
+            dir              TEXT NOT NULL,
+            internal_date    INTEGER,
+            flags            TEXT NOT NULL,
+            subject          TEXT,
+            msg_id           TEXT,
+            x_gmail_received TEXT,
+            email_format     TEXT
+        );
+        CREATE TABLE IF NOT EXISTS labels (
+            gm_id INTEGER NOT NULL,
+            pos   INTEGER NOT NULL,
+            label TEXT NOT NULL,
+            PRIMARY KEY (gm_id, pos)
+        );
+        CREATE INDEX IF NOT EXISTS labels_label ON labels (label);
+        CREATE TABLE IF NOT EXISTS threads (
+            gm_id     INTEGER PRIMARY KEY,
+            thread_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS threads_thread_id ON threads (thread_id);
+    """
+
+    # remote metadata of the batch compared by diff
+    BATCH_SCHEMA = """
+        CREATE TEMP TABLE IF NOT EXISTS batch_messages (
+            gm_id INTEGER PRIMARY KEY,
+            dir   TEXT NOT NULL,
+            flags TEXT NOT NULL
+        );
+        CREATE TEMP TABLE IF NOT EXISTS batch_labels (
+            gm_id INTEGER NOT NULL,
+            label TEXT NOT NULL
+        );
+    """
+
+    # ids of the batch not stored in their dir
+    MISSING_QUERY = """
+        SELECT b.gm_id FROM batch_messages b LEFT JOIN messages m ON m.gm_id = b.gm_id
+        WHERE m.gm_id IS NULL OR m.dir != b.dir
+    """
+
+    # ids of the batch stored with other flags or labels
+    CHANGED_QUERY = """
+        SELECT b.gm_id FROM batch_messages b JOIN messages m ON m.gm_id = b.gm_id
+        WHERE m.dir = b.dir AND m.flags != b.flags
+        UNION
+        SELECT gm_id FROM (SELECT gm_id, label FROM batch_labels
+                           EXCEPT
+                           SELECT l.gm_id, l.label FROM labels l JOIN batch_messages b ON l.gm_id = b.gm_id)
+        UNION
+        SELECT gm_id FROM (SELECT l.gm_id, l.label FROM labels l JOIN batch_messages b ON l.gm_id = b.gm_id
+                           EXCEPT
+                           SELECT gm_id, label FROM batch_labels)
+    """
+
+    def __init__(self, a_info_dir):
+        """
+           constructor
+           args:
+              a_info_dir: .info dir containing the database
+        """
+        self._db_path = '%s/%s' % (a_info_dir, self.DB_FILENAME)
+        self._conn    = None # opened lazily
+        # the storer can be used by the restore threads
+        self._lock    = threading.RLock()
+
+    def _get_conn(self):
+        """
+           Return the connection. Create the database if necessary
+        """
+        if self._conn is None:
+            # wait for the other processes writing in the db (parallel sync)
+            self._conn = sqlite3.connect(self._db_path, timeout = 60, check_same_thread = False)
+            # the journal is only synced on checkpoints: a commit per email stays cheap
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            if version > self.SCHEMA_VERSION:
+                raise Exception("Metadata store %s has an unknown version %d." % (self._db_path, version))
+
+            if version == 1:
+                # version 1 had no email format
+                self._conn.execute('ALTER TABLE messages ADD COLUMN email_format TEXT')
+
+            self._conn.executescript(self.SCHEMA)
+            self._conn.executescript(self.BATCH_SCHEMA)
+            self._conn.execute('PRAGMA user_version=%d' % (self.SCHEMA_VERSION))
+            self._conn.commit()
+
+        return self._conn
+
+    @classmethod
+    def _to_unicode(cls, a_str):
+        """ sqlite needs unicode for non ascii text """
+        if isinstance(a_str, str):
+            return a_str.decode('utf-8', 'replace')
+        return a_str
+
+    @classmethod
+    def _flags_key(cls, flags):
+        """ flags as stored in the messages table """
+        return cls.FLAGS_SEP.join(sorted(set(cls._to_unicode(flag) for flag in flags)))
+
+    def _put(self, conn, meta_obj, the_dir):
+        """
+           Insert or replace the metadata of one email (json structure of the .meta files)
+        """
+        gm_id = meta_obj[self.ID_K]
+
+        conn.execute('INSERT OR REPLACE INTO messages (gm_id, dir, internal_date, flags, subject, msg_id, '
+                     'x_gmail_received, email_format) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', \
+                     (gm_id, self._to_unicode(the_dir or ''), meta_obj.get(self.INT_DATE_K), \
+                      self._flags_key(meta_obj.get(self.FLAGS_K, ())), \
+                      self._to_unicode(meta_obj.get(self.SUBJECT_K)), \
+                      self._to_unicode(meta_obj.get(self.MSGID_K)), \
+                      self._to_unicode(meta_obj.get(self.XGM_RECV_K)), \
+                      meta_obj.get(self.EMAIL_FMT_K)))
+
+        conn.execute('DELETE FROM labels WHERE gm_id = ?', (gm_id,))
+        conn.executemany('INSERT INTO labels VALUES (?, ?, ?)', \
+                         [(gm_id, pos, self._to_unicode(label)) \
+                          for pos, label in enumerate(meta_obj.get(self.LABELS_K, ()))])
+
+        thread_id = meta_obj.get(self.THREAD_IDS_K)
+        if thread_id is None:
+            conn.execute('DELETE FROM threads WHERE gm_id = ?', (gm_id,))
+        else:
+            conn.execute('INSERT OR REPLACE INTO threads VALUES (?, ?)', (gm_id, thread_id))
+
+    def put(self, meta_obj, the_dir):
+        """
+           Store the metadata of an email stored in the_dir (relative to the db dir)
+        """
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                self._put(conn, meta_obj, the_dir)
+
+    def put_many(self, metadata):
+        """
+           Store all the (metadata, dir) of the iterable in one transaction
+        """
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                for meta_obj, the_dir in metadata:
+                    self._put(conn, meta_obj, the_dir)
+
+    def get(self, gm_id):
+        """
+           Return the metadata of gm_id as in the .meta files or None if it is not stored
+        """
+        with self._lock:
+            conn = self._get_conn()
+            row  = conn.execute('SELECT m.internal_date, m.flags, m.subject, m.msg_id, m.x_gmail_received, '
+                                'm.email_format, t.thread_id FROM messages m LEFT JOIN threads t ON t.gm_id = m.gm_id '
+                                'WHERE m.gm_id = ?', (gm_id,)).fetchone()
+            if row is None:
+                return None
+
+            labels = [label for (label,) in conn.execute('SELECT label FROM labels WHERE gm_id = ? ORDER BY pos', \
+                                                         (gm_id,))]
+
+        (int_date, flags, subject, msgid, received, email_format, thread_id) = row
+
+        meta_obj = {
+                     self.ID_K         : gm_id,
+                     self.LABELS_K     : labels,
+                     self.FLAGS_K      : flags.split(self.FLAGS_SEP) if flags else [],
+                     self.THREAD_IDS_K : thread_id,
+                     self.INT_DATE_K   : int_date,
+                     self.SUBJECT_K    : subject,
+                     self.MSGID_K      : msgid,
+                     self.XGM_RECV_K   : received
+                   }
+
+        # not recorded for the emails stored before the raw format
+        if email_format:
+            meta_obj[self.EMAIL_FMT_K] = email_format
+
+        return meta_obj
+
+    def get_dir(self, gm_id):
+        """
+           Return the dir of gm_id or None if it is not stored
+        """
+        with self._lock:
+            row = self._get_conn().execute('SELECT dir FROM messages WHERE gm_id = ?', (gm_id,)).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, gm_id):
+        return self.get_dir(gm_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._get_conn().execute('SELECT count(*) FROM messages').fetchone()[0]
+
+    def iter_dirs(self):
+        """
+           Return the list of (gm_id, dir, internal date) of all stored emails
+        """
+        with self._lock:
+            return [(gm_id, str(the_dir), int_date) for (gm_id, the_dir, int_date) \
+                    in self._get_conn().execute('SELECT gm_id, dir, internal_date FROM messages')]
+
+    def iter_sorted(self, chunk_size = 1000):
+        """
+           Return an iterator on the (gm_id, dir, flags, labels) of all stored emails sorted by gm_id.
+           The rows are read by chunks of chunk_size.
+        """
+        with self._lock:
+            cursor = self._get_conn().execute('SELECT m.gm_id, m.dir, m.flags, l.label FROM messages m '
+                                              'LEFT JOIN labels l ON l.gm_id = m.gm_id ORDER BY m.gm_id, l.pos')
+
+        current = None
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            for (gm_id, the_dir, flags, label) in rows:
+                if current is None or current[0] != gm_id:
+                    if current is not None:
+                        yield current
+                    current = (gm_id, str(the_dir), flags.split(self.FLAGS_SEP) if flags else [], [])
+                if label is not None:
+                    current[3].append(label)
+
+        if current is not None:
+            yield current
+
+    def update_many(self, updates):
+        """
+           Replace the flags and labels of the (gm_id, flags, labels) of the iterable in one transaction
+        """
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                for gm_id, flags, labels in updates:
+                    conn.execute('UPDATE messages SET flags = ? WHERE gm_id = ?', (self._flags_key(flags), gm_id))
+                    conn.execute('DELETE FROM labels WHERE gm_id = ?', (gm_id,))
+                    conn.executemany('INSERT INTO labels VALUES (?, ?, ?)', \
+                                     [(gm_id, pos, self._to_unicode(label)) for pos, label in enumerate(labels)])
+
+    def delete(self, gm_id):
+        """
+           Delete the metadata of gm_id
+        """
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                for table in ('messages', 'labels', 'threads'):
+                    conn.execute('DELETE FROM %s WHERE gm_id = ?' % (table), (gm_id,))
+
+    def diff(self, batch):
+        """
+           Compare the metadata of a batch of emails with the stored one.
+           args:
+              batch: iterable of (gm_id, dir, flags, labels). The labels have to
+                     be normalised as when they are stored.
+           Return (missing ids, changed ids): the ids not stored in their dir and
+           the ids stored with other flags or labels.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.execute('DELETE FROM batch_messages')
+                conn.execute('DELETE FROM batch_labels')
+
+                labels = []
+                rows   = []
+                for (gm_id, the_dir, flags, b_labels) in batch:
+                    rows.append((gm_id, self._to_unicode(the_dir or ''), self._flags_key(flags)))
+                    labels.extend((gm_id, self._to_unicode(label)) for label in b_labels)
+
+                conn.executemany('INSERT OR REPLACE INTO batch_messages VALUES (?, ?, ?)', rows)
+                conn.executemany('INSERT INTO batch_labels VALUES (?, ?)', labels)
+
+                missing = set(gm_id for (gm_id,) in conn.execute(self.MISSING_QUERY))
+                changed = set(gm_id for (gm_id,) in conn.execute(self.CHANGED_QUERY)) - missing
+
+                conn.execute('DELETE FROM batch_messages')
+                conn.execute('DELETE FROM batch_labels')
+
+        return missing, changed
+
+    def write_meta_file(self, gm_id, a_path):
+        """
+           Export the metadata of gm_id as a legacy .meta file
+        """
+        meta_obj = self.get(gm_id)
+        if meta_obj is None:
+            raise KeyError("No metadata stored for id %s." % (gm_id))
+
+        with open(a_path, 'w') as meta_desc:
+            json.dump(meta_obj, meta_desc)
+            meta_desc.flush()
+
+    def remove_all(self):
+        """
+           Delete all stored metadata
+        """
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                for table in ('messages', 'labels', 'threads'):
+                    conn.execute('DELETE FROM %s' % (table))
+
+    def close(self):
+        """
+           close the database
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def destroy(self):
+        """
+           close and delete the database files
+        """
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists('%s%s' % (self._db_path, suffix)):
+                os.remove('%s%s' % (self._db_path, suffix))
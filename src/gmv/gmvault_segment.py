@@ -0,0 +1,455 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Segment storage of a gmvault-db.
+    The emails and their metadata are appended to large segment files instead
+    of being stored in 2 files per email. An index gives the location of each
+    record and deleted records are reclaimed by compacting the segments.
+
+'''
+import os
+import json
+import time
+import StringIO
+
+import gmv.log_utils as log_utils
+import gmv.gmvault_utils as gmvault_utils
+import gmv.gmvault_index as gmvault_index
+import gmv.stream_utils as stream_utils
+
+LOG = log_utils.LoggerFactory.get_logger('gmvault_segment')
+
+META_KIND = 'meta'
+DATA_KIND = 'data'
+DEL_KIND  = 'del'
+
+class SegmentIndex(gmvault_index.JournalIndex):
+    """
+       gm_id => (metadata location, data location) index.
+       A location is a tuple (segment name, offset, length).
+    """
+    INDEX_FILENAME = 'segments.index'
+    INDEX_NAME     = 'segments index'
+
+    # records fields
+    META_F = 0
+    DATA_F = 1
+
+    KIND_TO_F = { META_KIND : META_F, DATA_KIND : DATA_F }
+
+    def __init__(self, a_info_dir, a_store, persist=True, shared=False):
+        """
+           constructor
+           args:
+              a_info_dir: .info dir where the index is persisted
+              a_store   : SegmentStore scanned to rebuild the index
+        """
+        super(SegmentIndex, self).__init__(a_info_dir, persist, shared)
+        self._store = a_store
+
+    @classmethod
+    def _set_loc(cls, records, gm_id, kind, loc):
+        """ set the location of one kind of record of gm_id """
+        rec = list(records.get(gm_id, (None, None)))
+        rec[cls.KIND_TO_F[kind]] = loc
+        records[gm_id] = tuple(rec)
+
+    def _replay_add(self, records, fields):
+        """ + gm_id kind segment offset length """
+        self._set_loc(records, long(fields[1]), fields[2], (intern(fields[3]), long(fields[4]), long(fields[5])))
+
+    @classmethod
+    def _add_lines(cls, gm_id, rec):
+        """ journal lines for the locations of gm_id """
+        lines = []
+        for kind, field in cls.KIND_TO_F.iteritems():
+            if rec[field]:
+                lines.append(cls._add_line(gm_id, kind, rec[field]))
+        return ''.join(lines)
+
+    @classmethod
+    def _add_line(cls, gm_id, kind, loc):
+        """ journal line for one location """
+        return '%s\t%s\t%s\t%s\t%d\t%d\n' % (cls.ADD_OP, gm_id, kind, loc[0], loc[1], loc[2])
+
+    def _build_records(self):
+        """
+           Replay all the records of the segments
+        """
+        records = {}
+        for (segment, offset, kind, gm_id, _, _, length) in self._store.scan():
+            if kind == DEL_KIND:
+                records.pop(gm_id, None)
+            else:
+                self._set_loc(records, gm_id, kind, (intern(segment), offset, length))
+        return records
+
+    def set(self, gm_id, kind, loc):
+        """
+           Set the location of the kind (meta or data) record of gm_id
+        """
+        records = self._get_records()
+        self._set_loc(records, gm_id, kind, loc)
+        self._append(self._add_line(gm_id, kind, loc))
+
+    def get_loc(self, gm_id, kind):
+        """
+           Return the location of the kind record of gm_id or None
+        """
+        rec = self.get(gm_id)
+        return rec[self.KIND_TO_F[kind]] if rec else None
+
+    def clear(self, kind):
+        """
+           Forget the locations of the kind records of all ids
+        """
+        field   = self.KIND_TO_F[kind]
+        records = {}
+        for gm_id, rec in self._get_records().iteritems():
+            rec = list(rec)
+            rec[field] = None
+            if any(rec):
+                records[gm_id] = tuple(rec)
+
+        self._write_all(records)
+
+class SegmentGmailIndex(gmvault_index.GmailIndex):
+    """
+       gm_id index of a segment db. It is rebuilt from the segments.
+    """
+    def __init__(self, a_info_dir, a_store, persist=True, shared=False, metadata=None):
+        super(SegmentGmailIndex, self).__init__(a_info_dir, None, persist, shared, metadata)
+        self._store = a_store
+
+    def _scan_data(self):
+        """
+           Return gm_id => (variant, size) of the data records of the segments
+        """
+        data = {}
+        for (_, _, kind, gm_id, _, variant, length) in self._store.scan():
+            if kind == DEL_KIND:
+                data.pop(gm_id, None)
+            elif kind == DATA_KIND:
+                data[gm_id] = (variant, length)
+        return data
+
+    def _build_records(self):
+        """
+           Create the records from the last metadata and data records of the segments
+        """
+        if self._metadata is not None:
+            return self._build_records_from_metadata()
+
+        headers = {}
+        for (_, _, kind, gm_id, the_dir, variant, length) in self._store.scan():
+            if kind == DEL_KIND:
+                headers.pop(gm_id, None)
+            elif kind == META_KIND:
+                headers[gm_id] = (the_dir,) + headers.get(gm_id, (None, '', 0))[1:]
+            else:
+                headers[gm_id] = headers.get(gm_id, (the_dir,))[:1] + (variant, length)
+
+        records = {}
+        for gm_id, (the_dir, variant, size) in headers.iteritems():
+            if not self._store.has(gm_id, META_KIND):
+                continue
+
+            try:
+                with self._store.open(gm_id, META_KIND) as f:
+                    int_date = json.load(f).get('internal_date', -1)
+            except ValueError, err:
+                LOG.critical("Ignore id %s when building the gm_id index: %s" % (gm_id, err))
+                continue
+
+            records[gm_id] = (intern(the_dir or ''), intern(variant), size, \
+                              int(int_date) if int_date is not None else -1)
+
+        return records
+
+class SegmentStore(object):
+    """
+       Append only segment files containing records:
+       a header line 'GMVR gm_id kind dir variant length' followed by length bytes.
+       kind is meta, data or del (deletion of an id).
+    """
+    SEGMENT_PREFIX  = 'seg-'
+    SEGMENT_SUFFIX  = '.dat'
+    SEGMENT_FNAME   = 'seg-%013d-%d.dat' # creation time in ms, pid
+    MAGIC           = 'GMVR'
+    MAX_HEADER_SIZE = 256
+
+    # compact a segment when more than this ratio of it is dead
+    DEAD_RATIO      = 0.5
+
+    def __init__(self, a_segments_dir, a_info_dir, max_size, persist=True, shared=False):
+        """
+           constructor
+           args:
+              a_segments_dir: dir of the segment files
+              a_info_dir    : .info dir where the locations index is persisted
+              max_size      : size from which a new segment is started
+              shared        : True if several processes write in the db at the same time.
+                              Each process then appends to its own segment.
+        """
+        self._dir      = a_segments_dir
+        self._max_size = max_size
+        self._shared   = shared
+
+        self._writer      = None
+        self._writer_name = None
+
+        gmvault_utils.makedirs(self._dir)
+
+        self.locations = SegmentIndex(a_info_dir, self, persist, shared)
+
+    def list_segments(self):
+        """
+           Segment names in creation order
+        """
+        return sorted(fname for fname in os.listdir(self._dir) \
+                      if fname.startswith(self.SEGMENT_PREFIX) and fname.endswith(self.SEGMENT_SUFFIX))
+
+    def _path(self, segment):
+        """ path of a segment """
+        return os.path.join(self._dir, segment)
+
+    def _new_segment_name(self):
+        """
+           Name of a new segment sorted after all existing ones
+        """
+        the_time = int(time.time() * 1000)
+        segments = self.list_segments()
+        if segments:
+            the_time = max(the_time, int(segments[-1][len(self.SEGMENT_PREFIX):].split('-')[0]) + 1)
+        return self.SEGMENT_FNAME % (the_time, os.getpid())
+
+    def _get_writer(self, nb_bytes):
+        """
+           Return the segment file to append nb_bytes to
+        """
+        if self._writer and self._writer.tell() + nb_bytes > self._max_size:
+            self.close()
+
+        if not self._writer:
+            segments = self.list_segments()
+            if not self._shared and segments and \
+               os.path.getsize(self._path(segments[-1])) + nb_bytes <= self._max_size:
+                # continue the last segment after its last complete record
+                self._writer_name = segments[-1]
+                self._truncate_tail(self._writer_name)
+            else:
+                self._writer_name = self._new_segment_name()
+
+            self._writer = open(self._path(self._writer_name), 'ab')
+            self._writer.seek(0, os.SEEK_END)
+
+        return self._writer
+
+    def _truncate_tail(self, segment):
+        """
+           Remove a partially written record at the end of a segment (crash while writing)
+        """
+        end = 0
+        for (_, offset, _, _, _, _, length) in self.scan([segment]):
+            end = offset + length
+
+        if os.path.getsize(self._path(segment)) > end:
+            LOG.critical("Remove a truncated record at the end of segment %s." % (segment))
+            with open(self._path(segment), 'r+b') as f:
+                f.truncate(end)
+
+    def _append_record(self, gm_id, kind, the_dir, variant, fileobj, length):
+        """
+           Append a record to the current segment and return its location
+        """
+        header = '%s %s %s %s %s %d\n' % (self.MAGIC, gm_id, kind, the_dir or '.', variant or '-', length)
+        writer = self._get_writer(len(header) + length)
+
+        writer.write(header)
+        offset = writer.tell()
+
+        left = length
+        while left > 0:
+            data = fileobj.read(min(left, stream_utils.CHUNK_SIZE))
+            if not data:
+                raise IOError("Cannot append %s of %s: %d bytes missing." % (kind, gm_id, left))
+            writer.write(data)
+            left -= len(data)
+        writer.flush()
+
+        return (self._writer_name, offset, length)
+
+    def append(self, gm_id, kind, the_dir, variant, fileobj, length):
+        """
+           Append length bytes read from fileobj as the kind (meta or data) record of gm_id
+        """
+        loc = self._append_record(gm_id, kind, the_dir, variant, fileobj, length)
+        self.locations.set(gm_id, kind, loc)
+
+    def append_str(self, gm_id, kind, the_dir, variant, a_str):
+        """
+           Append a_str as the kind (meta or data) record of gm_id
+        """
+        self.append(gm_id, kind, the_dir, variant, StringIO.StringIO(a_str), len(a_str))
+
+    def delete(self, gm_id):
+        """
+           Delete all records of gm_id
+        """
+        if gm_id in self.locations:
+            self._append_record(gm_id, DEL_KIND, None, None, None, 0)
+            self.locations.remove(gm_id)
+
+    def __contains__(self, gm_id):
+        return gm_id in self.locations
+
+    def has(self, gm_id, kind):
+        """ True if there is a kind record for gm_id """
+        return self.locations.get_loc(gm_id, kind) is not None
+
+    def open(self, gm_id, kind):
+        """
+           Return a file object reading the kind record of gm_id
+        """
+        loc = self.locations.get_loc(gm_id, kind)
+        if not loc:
+            raise KeyError("No %s record for id %s." % (kind, gm_id))
+
+        return stream_utils.SliceReader(open(self._path(loc[0]), 'rb'), loc[1], loc[2])
+
+    @classmethod
+    def _parse_header(cls, header):
+        """
+           Return (gm_id, kind, dir, variant, length) of a header line (without \\n)
+           or None if it is not a valid header
+        """
+        fields = header.split(' ')
+        if len(fields) != 6 or fields[0] != cls.MAGIC:
+            return None
+
+        try:
+            return (long(fields[1]), intern(fields[2]), '' if fields[3] == '.' else intern(fields[3]), \
+                    '' if fields[4] == '-' else intern(fields[4]), long(fields[5]))
+        except ValueError:
+            return None
+
+    def scan(self, segments=None):
+        """
+           Iterate over the records of the segments in write order.
+           yield (segment, offset, kind, gm_id, dir, variant, length)
+        """
+        for segment in (segments if segments is not None else self.list_segments()):
+            path = self._path(segment)
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                while True:
+                    header = f.readline(self.MAX_HEADER_SIZE)
+                    if not header:
+                        break
+
+                    fields = self._parse_header(header[:-1]) if header.endswith('\n') else None
+                    offset = f.tell()
+                    if not fields or offset + fields[4] > size:
+                        LOG.critical("Ignore the end of segment %s from offset %d (not a complete record)." \
+                                     % (segment, offset - len(header)))
+                        break
+
+                    (gm_id, kind, the_dir, variant, length) = fields
+                    yield (segment, offset, kind, gm_id, the_dir, variant, length)
+
+                    f.seek(offset + length)
+
+    def compact(self, force=False):
+        """
+           Rewrite the live records of the segments containing too many dead records
+           (deleted or updated emails) in a new segment and delete them.
+           Small segments are merged as well. All segments are rewritten if force is True.
+        """
+        if self._shared:
+            LOG.debug("Do not compact segments written by several processes.")
+            return
+
+        self.close()
+
+        live = {}
+        for rec in self.locations.iteritems():
+            for loc in rec[1]:
+                if loc:
+                    live[loc[0]] = live.get(loc[0], 0) + loc[2]
+
+        segments = self.list_segments()
+        small    = [segment for segment in segments \
+                    if os.path.getsize(self._path(segment)) < self._max_size / 8]
+        to_compact = []
+        for segment in segments:
+            size = os.path.getsize(self._path(segment))
+            if force or size == 0 or live.get(segment, 0) < (1 - self.DEAD_RATIO) * size or \
+               (len(small) > 1 and segment in small):
+                to_compact.append(segment)
+
+        if not to_compact:
+            return
+
+        # the deletions have to be kept if older segments may still have records of the deleted ids
+        keep_deletions = len(to_compact) < len(segments)
+
+        timer = gmvault_utils.Timer()
+        timer.start()
+
+        # write in a new segment
+        self._writer_name = self._new_segment_name()
+        self._writer      = open(self._path(self._writer_name), 'ab')
+
+        for segment in to_compact:
+            with open(self._path(segment), 'rb') as f:
+                for (_, offset, kind, gm_id, the_dir, variant, length) in self.scan([segment]):
+                    if kind == DEL_KIND:
+                        if keep_deletions and gm_id not in self.locations:
+                            self._append_record(gm_id, DEL_KIND, None, None, None, 0)
+                    elif self.locations.get_loc(gm_id, kind) == (segment, offset, length):
+                        f.seek(offset)
+                        self.append(gm_id, kind, the_dir, variant, f, length)
+
+            os.remove(self._path(segment))
+
+        self.close()
+        LOG.critical("Compacted %d segments in %s." % (len(to_compact), timer.elapsed_human_time()))
+
+    def drop_records(self, kind):
+        """
+           Delete the kind (meta or data) records of all ids
+        """
+        self.locations.clear(kind)
+        self.compact(force = True)
+
+    def remove_all(self):
+        """
+           Delete all the segments and their index
+        """
+        self.close()
+        for segment in self.list_segments():
+            os.remove(self._path(segment))
+        self.locations.rebuild()
+
+    def close(self):
+        """
+           close the current segment
+        """
+        if self._writer:
+            self._writer.close()
+            self._writer      = None
+            self._writer_name = None
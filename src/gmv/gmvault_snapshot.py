@@ -0,0 +1,197 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Snapshot of the metadata of all the messages of a Gmail folder taken
+    with one streamed FETCH and spooled to a file of the .info dir, and
+    merge-join of a snapshot with the db to plan a sync.
+
+'''
+import os
+import json
+import heapq
+import imaplib
+
+import gmv.log_utils as log_utils
+import gmv.collections_utils as collections_utils
+import gmv.gmvault_utils as gmvault_utils
+import gmv.imap_utils as imap_utils
+
+LOG = log_utils.LoggerFactory.get_logger('gmvault_snapshot')
+
+class MetadataSnapshot(object):
+    """
+       Metadata of the messages of a Gmail folder. One json record per line in uid order:
+       [uid, gmail id, thread id, internal date (epoch), flags, labels]
+    """
+    ATTRIBUTES = [ imap_utils.GIMAPFetcher.GMAIL_ID, imap_utils.GIMAPFetcher.GMAIL_THREAD_ID, \
+                   imap_utils.GIMAPFetcher.GMAIL_LABELS, imap_utils.GIMAPFetcher.IMAP_FLAGS, \
+                   imap_utils.GIMAPFetcher.IMAP_INTERNALDATE ]
+
+    UID, GM_ID, THREAD_ID, INT_DATE, FLAGS, LABELS = range(6) # fields of the records
+
+    RUN_SIZE = 200000 # records sorted in memory by iter_by_gm_id
+
+    def __init__(self, a_path, complete = True):
+        self.path     = a_path
+        self.complete = complete # False if some messages could not be fetched
+
+    def exists(self):
+        """ True if the snapshot was taken """
+        return os.path.exists(self.path)
+
+    @classmethod
+    def to_record(cls, uid, values):
+        """
+           record of the FETCH attributes of uid
+        """
+        return [ uid, values[imap_utils.GIMAPFetcher.GMAIL_ID], values[imap_utils.GIMAPFetcher.GMAIL_THREAD_ID], \
+                 gmvault_utils.datetime2e(values[imap_utils.GIMAPFetcher.IMAP_INTERNALDATE]), \
+                 list(values[imap_utils.GIMAPFetcher.IMAP_FLAGS]), \
+                 imap_utils.decode_labels(values[imap_utils.GIMAPFetcher.GMAIL_LABELS]) ]
+
+    @classmethod
+    def take(cls, a_path, a_src):
+        """
+           Fetch the metadata of all the messages of the current folder of a_src (GIMAPFetcher)
+           with one UID FETCH 1:* read as a stream and write them in a_path.
+           Return the snapshot and its nb of records
+        """
+        tmp_path = '%s.tmp' % (a_path)
+        nb_records = 0
+        complete   = True
+        with open(tmp_path, 'w') as the_file:
+            try:
+                for uid, values in a_src.fetch_stream(cls.ATTRIBUTES):
+                    the_file.write('%s\n' % (json.dumps(cls.to_record(uid, values))))
+                    nb_records += 1
+            except imaplib.IMAP4.error, err:
+                # Gmail answers NO after the messages that could be fetched if some of them cannot be
+                if isinstance(err, imaplib.IMAP4.abort):
+                    raise
+                LOG.critical("Some messages could not be fetched in the snapshot (%s)." % (err))
+                complete = False
+
+        gmvault_utils.atomic_rename(tmp_path, a_path)
+        return cls(a_path, complete), nb_records
+
+    def __iter__(self):
+        """
+           records in uid order
+        """
+        with open(self.path) as the_file:
+            for line in the_file:
+                yield json.loads(line)
+
+    def iter_by_gm_id(self, run_size = None):
+        """
+           records in gm_id order.
+           Runs of run_size records are sorted in memory and merged from temporary files.
+        """
+        run_size  = run_size or self.RUN_SIZE
+        run_paths = []
+        try:
+            run = []
+            for record in self:
+                run.append(record)
+                if len(run) >= run_size:
+                    run_paths.append(self._write_run(run, len(run_paths)))
+                    run = []
+
+            if not run_paths:
+                run.sort(key = lambda record: record[self.GM_ID])
+                for record in run:
+                    yield record
+                return
+
+            if run:
+                run_paths.append(self._write_run(run, len(run_paths)))
+            del run
+
+            for _, record in heapq.merge(*[self._read_run(path) for path in run_paths]):
+                yield record
+        finally:
+            for path in run_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _write_run(self, run, run_nb):
+        """
+           Write the records of run sorted by gm_id in a temporary file. Return its path
+        """
+        path = '%s.run%d' % (self.path, run_nb)
+        run.sort(key = lambda record: record[self.GM_ID])
+        with open(path, 'w') as the_file:
+            for record in run:
+                the_file.write('%s\n' % (json.dumps(record)))
+        return path
+
+    def _read_run(self, path):
+        """
+           (gm_id, record) of a run file
+        """
+        with open(path) as the_file:
+            for line in the_file:
+                record = json.loads(line)
+                yield record[self.GM_ID], record
+
+class SyncPlan(object):
+    """
+       What a sync has to do to bring the db up to date with a folder
+    """
+    def __init__(self):
+        self.new     = collections_utils.id_array() # uids of the messages to fetch
+        self.updated = [] # (gm_id, dir, flags, labels) of the stored messages with other flags or labels
+        self.deleted = [] # (gm_id, dir) of the stored messages not in the folder
+
+    def __repr__(self):
+        return "SyncPlan(%d new, %d updated, %d deleted)" % (len(self.new), len(self.updated), len(self.deleted))
+
+def diff(remote, local):
+    """
+       Merge-join of 2 iterables sorted by gm_id:
+          remote: (gm_id, uid, dir, flags, labels) of the folder.
+                  A None dir matches any dir the message is stored in.
+          local : (gm_id, dir, flags, labels) of the db (see GmailStorer.iter_sorted_metadata)
+       The labels have to be normalised as when they are stored.
+       Return the SyncPlan. The updates have the remote flags and labels.
+    """
+    plan   = SyncPlan()
+    local  = iter(local)
+    stored = next(local, None)
+
+    for (gm_id, uid, the_dir, flags, labels) in remote:
+        while stored is not None and stored[0] < gm_id:
+            plan.deleted.append((stored[0], stored[1]))
+            stored = next(local, None)
+
+        if stored is None or stored[0] != gm_id:
+            plan.new.append(uid)
+            continue
+
+        if the_dir is not None and stored[1] != the_dir:
+            # stored in another month dir: fetch it again as _common_sync would
+            plan.new.append(uid)
+        elif set(flags) != set(stored[2]) or set(labels) != set(stored[3]):
+            plan.updated.append((gm_id, stored[1], flags, labels))
+
+        stored = next(local, None)
+
+    while stored is not None:
+        plan.deleted.append((stored[0], stored[1]))
+        stored = next(local, None)
+
+    return plan
@@ -405,6 +405,15 @@ def makedirs(a_path):
 
     os.makedirs(a_path)
 
+def atomic_rename(src, dst):
+    """
+       rename src into dst replacing dst if it exists.
+       os.rename cannot overwrite an existing file on windows.
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
 def __rmgeneric(path, __func__):
     """ private function that is part of delete_all_under """
     try:
@@ -528,6 +537,20 @@ def guess_encoding(byte_str, use_encoding_list=True):
     return encoding
 
 
+def get_email_encoding(a_str):
+    """
+       Return the encoding of an email content: the one forced in the conf
+       or the one guessed from the beginning of the string
+    """
+    #if email encoding is forced no more guessing
+    email_encoding = get_conf_defaults().get('Localisation', 'email_encoding', None)
+    if email_encoding:
+        return email_encoding
+
+    LOG.debug("Guess encoding")
+    #guess encoding based on the beginning of the string up to 128K character
+    return guess_encoding(a_str[:20000], use_encoding_list = False)
+
 def convert_to_unicode(a_str):
     """
     Convert a string to unicode (except terminal strings)
@@ -536,16 +559,8 @@ def convert_to_unicode(a_str):
     """
     encoding = None
 
-    #if email encoding is forced no more guessing
-    email_encoding = get_conf_defaults().get('Localisation', 'email_encoding', None)
-
     try:
-        if email_encoding:
-            encoding = email_encoding
-        else:
-            LOG.debug("Guess encoding")
-            #guess encoding based on the beginning of the string up to 128K character
-            encoding = guess_encoding(a_str[:20000], use_encoding_list = False)
+        encoding = get_email_encoding(a_str)
 
         LOG.debug("Convert to %s" % (encoding))
         u_str = unicode(a_str, encoding = encoding) #convert to unicode with given encoding
@@ -0,0 +1,858 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Event driven IMAP engine: non blocking connections driven by a select loop.
+    The commands are pipelined (sent without waiting for the previous responses)
+    and several connections can be driven by the same loop in one thread.
+    IMAP4Pipelined keeps the imaplib interface so that imapclient (and GIMAPFetcher)
+    work unchanged on top of it.
+
+'''
+import collections
+import errno
+import imaplib
+import select
+import socket
+import ssl
+import time
+import zlib
+
+import imapclient
+from imapclient.response_parser import parse_fetch_response
+
+import gmv.log_utils as log_utils
+import gmv.mod_imap as mod_imap
+import gmv.stream_utils as stream_utils
+
+LOG = log_utils.LoggerFactory.get_logger('imap_engine')
+
+CRLF = '\r\n'
+
+class IMAPCommand(object):
+    """
+       Tagged command sent on an IMAPStream.
+       The untagged responses received while it is the oldest command in flight
+       are stored in untagged like imaplib.IMAP4.untagged_responses.
+    """
+    def __init__(self, tag, name, data, literal=None, literator=None):
+        self.tag        = tag
+        self.name       = name
+        self.data       = data       # command line without CRLF
+        self.literal    = literal    # literal string sent after the line
+        self.literator  = literator  # callable answering the continuation requests (AUTHENTICATE)
+        self.untagged   = {}
+        self.typ        = None       # tagged response
+        self.text       = None
+        self.error      = None       # abort exception if the connection is lost
+        self.spool_dir      = None   # receive the literals bigger than spool_min_size in files
+        self.spool_min_size = 0
+        self.parser     = None       # convert the response in a result (see result())
+        self.streamed   = None       # deque receiving the items of each FETCH response (fetch_stream)
+        self.sent_time  = None       # when the command was sent
+        self.done_time  = None       # when the response was received
+        self.size       = 0          # bytes of the response (lines and literals)
+        self._callbacks = []
+
+    def done(self):
+        """ True if the tagged response is received or the command failed """
+        return self.typ is not None or self.error is not None
+
+    def add_done_callback(self, callback):
+        """ call callback(command) when the command is done """
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def append_untagged(self, typ, dat):
+        """ store an untagged response like imaplib """
+        self.untagged.setdefault(typ, []).append(dat)
+
+    def complete(self, typ, text):
+        """ the tagged response is received """
+        self.typ, self.text = typ, text
+        self.done_time = time.time()
+        self._run_callbacks()
+
+    def fail(self, error):
+        """ the connection is lost before the tagged response """
+        self.error = error
+        self.done_time = time.time()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        """ call the done callbacks once """
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def response(self):
+        """
+           Return (typ, [text]) like imaplib or raise imaplib.IMAP4.abort if the connection
+           was lost and imaplib.IMAP4.error for a BAD response
+        """
+        if self.error is not None:
+            raise imaplib.IMAP4.abort('command: %s => %s' % (self.name, self.error))
+        if self.typ == 'BAD':
+            raise imaplib.IMAP4.error('%s command error: %s %s' % (self.name, self.typ, [self.text]))
+        return self.typ, [self.text]
+
+    def result(self):
+        """
+           Return the response converted by the parser (or the response if no parser)
+           Raise imaplib.IMAP4.error if the command failed
+        """
+        typ, data = self.response()
+        if typ != 'OK':
+            raise imaplib.IMAP4.error('%s failed: %r' % (self.name.lower(), data[0]))
+        return self.parser(self) if self.parser else (typ, data)
+
+class IMAPStream(object): #pylint:disable=R0902
+    """
+       Non blocking IMAP connection driven by an IMAPLoop.
+       The commands are sent as soon as they are submitted except after a command
+       waiting for a continuation (synchronizing literal) or a COMPRESS command.
+       The untagged responses are attributed to the oldest command in flight.
+    """
+    RECV_SIZE    = 65536
+    SEND_SIZE    = 65536 # max bytes given to send at once
+    SOCK_TIMEOUT = 70    # abort the commands if nothing is received during that time
+
+    # nothing is sent after those commands until they are completed
+    BARRIER_COMMANDS = ('COMPRESS', 'LOGOUT')
+
+    # max size of the literals sent without waiting for a continuation with LITERAL-
+    LITERAL_MINUS_MAX = 4096
+
+    def __init__(self, loop, host, port, use_ssl=True, keyfile=None, certfile=None): #pylint:disable=R0913
+        """
+           Connect (blocking) then use the socket in non blocking mode
+        """
+        self.loop   = loop
+        self.host   = host
+        self.port   = port
+
+        sock = socket.create_connection((host, port), self.SOCK_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if use_ssl:
+            sock = ssl.wrap_socket(sock, keyfile, certfile)
+        sock.setblocking(0)
+        self.sock = sock
+        self._ssl = use_ssl
+
+        self.compressor     = None
+        self.decompressor   = None
+        self.literal_plus   = False # non synchronizing literals (LITERAL+)
+        self.literal_minus  = False # small non synchronizing literals (LITERAL-)
+
+        self.greeting       = None  # (typ, text) of the greeting
+        self.unsolicited    = {}    # untagged responses received when no command is in flight
+        self.error          = None
+
+        self.stats          = { 'wire_in' : 0, 'data_in' : 0, 'wire_out' : 0, 'data_out' : 0 }
+
+        self._recv_buf      = bytearray(self.RECV_SIZE)
+        self._in            = ''    # received data not parsed yet starts at _pos
+        self._pos           = 0
+        self._partial       = []    # chunks received after _in while the end of its line is missing
+        self._records       = []    # lines and (line, literal) of the response being received
+        self._literal       = None  # literal being received: list of chunks or SpooledLiteral
+        self._literal_left  = 0
+
+        self._out           = collections.deque() # data to send (chunks of at most SEND_SIZE)
+        self._queued        = collections.deque() # commands not sent yet
+        self._inflight      = collections.deque() # commands sent and not completed
+        self._cont          = None  # command waiting for a continuation
+        self._barrier       = None  # command to complete before to send the next ones
+
+        self.last_activity  = time.time()
+
+        loop.add(self)
+
+    def fileno(self):
+        """ for select """
+        return self.sock.fileno()
+
+    def busy(self):
+        """ True if responses are expected """
+        return bool(self._inflight or self._queued) or self.greeting is None
+
+    def wants_write(self):
+        """ True if there is data to send """
+        return bool(self._out)
+
+    def has_buffered_data(self):
+        """ True if data is decrypted but not read yet (not seen by select) """
+        return self._ssl and self.error is None and self.sock.pending() > 0
+
+    def submit(self, command):
+        """
+           Queue command. It is sent as soon as possible
+        """
+        if self.error is not None:
+            command.fail(self.error)
+            return command
+
+        if not self.busy():
+            # the timeout starts now
+            self.last_activity = time.time()
+
+        self._queued.append(command)
+        self._pump()
+        return command
+
+    def _write(self, data):
+        """ queue data to send (compressed if needed) """
+        self.stats['data_out'] += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.stats['wire_out'] += len(data)
+
+        for pos in xrange(0, len(data), self.SEND_SIZE):
+            self._out.append(data[pos:pos + self.SEND_SIZE])
+
+    def _pump(self):
+        """
+           Send the queued commands until one needs a continuation or is a barrier
+        """
+        while self._queued and self._cont is None and self._barrier is None:
+            command = self._queued.popleft()
+            command.sent_time = time.time()
+            self._inflight.append(command)
+
+            if command.literator:
+                self._write('%s%s' % (command.data, CRLF))
+                self._cont = command
+            elif command.literal is not None:
+                size = len(command.literal)
+                if self.literal_plus or (self.literal_minus and size <= self.LITERAL_MINUS_MAX):
+                    self._write('%s {%d+}%s' % (command.data, size, CRLF))
+                    self._write(command.literal)
+                    self._write(CRLF)
+                else:
+                    self._write('%s {%d}%s' % (command.data, size, CRLF))
+                    self._cont = command
+            else:
+                self._write('%s%s' % (command.data, CRLF))
+
+            if command.name in self.BARRIER_COMMANDS:
+                self._barrier = command
+
+    def handle_write(self):
+        """ send what can be sent without blocking """
+        while self._out:
+            if len(self._out) > 1 and len(self._out[0]) < self.SEND_SIZE:
+                # coalesce the small writes (pipelined commands) in one send
+                chunks, size = [], 0
+                while self._out and size + len(self._out[0]) <= self.SEND_SIZE:
+                    size += len(self._out[0])
+                    chunks.append(self._out.popleft())
+                if chunks:
+                    self._out.appendleft(''.join(chunks))
+            chunk = self._out[0]
+            try:
+                nb_bytes = self.sock.send(chunk)
+            except ssl.SSLError, err:
+                if err.args[0] in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+                    return # retry the same chunk later
+                raise
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            if nb_bytes < len(chunk):
+                self._out[0] = chunk[nb_bytes:]
+                return
+            self._out.popleft()
+
+    def handle_read(self, max_reads=16):
+        """ receive and parse what is available """
+        for _ in xrange(max_reads):
+            try:
+                nb_bytes = self.sock.recv_into(self._recv_buf, self.RECV_SIZE)
+            except ssl.SSLError, err:
+                if err.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            if not nb_bytes:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+
+            self.last_activity = time.time()
+            self.stats['wire_in'] += nb_bytes
+            if self.decompressor is None:
+                data = str(buffer(self._recv_buf, 0, nb_bytes))
+            else:
+                data = self.decompressor.decompress(buffer(self._recv_buf, 0, nb_bytes))
+            self.stats['data_in'] += len(data)
+
+            self._feed(data)
+
+            if self.error is not None:
+                return
+
+    def _feed(self, data):
+        """ parse the received data """
+        if self._pos < len(self._in):
+            # the end of a line is missing: join the chunks only when it is received
+            if '\n' not in data:
+                self._partial.append(data)
+                return
+            self._in = ''.join([self._in[self._pos:]] + self._partial + [data])
+            self._partial = []
+        else:
+            self._in = data
+        self._pos = 0
+
+        while self._pos < len(self._in):
+            if self._literal is not None:
+                if not self._read_literal():
+                    break
+                continue
+
+            end = self._in.find('\n', self._pos)
+            if end < 0:
+                break
+
+            line = self._in[self._pos:end + 1]
+            self._pos = end + 1
+            if self._inflight:
+                self._inflight[0].size += len(line)
+            if not line.endswith(CRLF):
+                raise imaplib.IMAP4.abort('socket error: unterminated line')
+            line = line[:-2]
+
+            match = imaplib.Literal.match(line)
+            if match:
+                self._start_literal(line, int(match.group('size')))
+            else:
+                self._records.append(line)
+                records, self._records = self._records, []
+                self._dispatch(records)
+
+    def _start_literal(self, line, size):
+        """ a literal of size bytes follows line """
+        command  = self._inflight[0] if self._inflight else None
+        self._records.append((line, None))
+        self._literal_left = size
+        if command and command.spool_dir is not None and size >= command.spool_min_size:
+            self._literal = stream_utils.SpooledLiteral(command.spool_dir)
+        else:
+            self._literal = []
+
+    def _read_literal(self):
+        """
+           Move the received bytes to the literal. Return True if it is complete
+        """
+        nb_bytes = min(len(self._in) - self._pos, self._literal_left)
+        if isinstance(self._literal, list):
+            self._literal.append(self._in[self._pos:self._pos + nb_bytes])
+        else:
+            self._literal.write(buffer(self._in, self._pos, nb_bytes))
+        self._pos          += nb_bytes
+        self._literal_left -= nb_bytes
+        if self._inflight:
+            self._inflight[0].size += nb_bytes
+
+        if self._literal_left > 0:
+            return False
+
+        literal = self._literal
+        if isinstance(literal, list):
+            literal = ''.join(literal)
+        else:
+            literal.close()
+
+        self._literal = None
+        self._records[-1] = (self._records[-1][0], literal)
+        return True
+
+    def _dispatch(self, records): #pylint:disable=R0912
+        """
+           Process a complete response (lines and (line, literal)) like imaplib._get_response
+        """
+        first = records[0]
+        resp  = first[0] if isinstance(first, tuple) else first
+
+        if resp.startswith('+'):
+            self._continuation(imaplib.Continuation.match(resp).group('data'))
+            return
+
+        tag, _, rest = resp.partition(' ')
+        if tag != '*':
+            self._tagged(tag, rest)
+            return
+
+        dat2  = None
+        match = imaplib.Untagged_response.match(resp)
+        if not match:
+            match = imaplib.Untagged_status.match(resp)
+            if match:
+                dat2 = match.group('data2')
+        if not match:
+            raise imaplib.IMAP4.abort("unexpected response: '%s'" % resp)
+
+        typ = match.group('type')
+        dat = match.group('data') or ''
+        if dat2:
+            dat = dat + ' ' + dat2
+
+        if self.greeting is None:
+            self.greeting = (typ, dat)
+            self.unsolicited.setdefault(typ, []).append(dat)
+            return
+
+        command = self._inflight[0] if self._inflight else None
+        untagged_append = command.append_untagged if command \
+                          else lambda t, d: self.unsolicited.setdefault(t, []).append(d)
+
+        # (line, literal) records then the trailer
+        items = []
+        for pos in xrange(len(records) - 1):
+            items.append((dat, records[pos][1]))
+            dat = records[pos + 1]
+            dat = dat[0] if isinstance(dat, tuple) else dat
+        items.append(dat)
+
+        if typ == 'FETCH' and command is not None and command.streamed is not None:
+            command.streamed.append(items)
+            return
+
+        for item in items:
+            untagged_append(typ, item)
+
+        if typ in ('OK', 'NO', 'BAD'):
+            match = imaplib.Response_code.match(dat)
+            if match:
+                untagged_append(match.group('type'), match.group('data'))
+
+    def _continuation(self, data):
+        """ the server waits for the literal of the command """
+        command = self._cont
+        if command is None:
+            raise imaplib.IMAP4.abort("unexpected continuation response: '+ %s'" % (data or ''))
+
+        if command.literator:
+            # stay in continuation mode until the tagged response
+            self._write('%s%s' % (command.literator(data), CRLF))
+        else:
+            self._write(command.literal)
+            self._write(CRLF)
+            self._cont = None
+            self._pump()
+
+    def _tagged(self, tag, rest):
+        """ completion of a command """
+        command = None
+        for cmd in self._inflight:
+            if cmd.tag == tag:
+                command = cmd
+                break
+        if command is None:
+            raise imaplib.IMAP4.abort('unexpected tagged response: %s %s' % (tag, rest))
+
+        self._inflight.remove(command)
+        typ, _, dat = rest.partition(' ')
+
+        if typ in ('OK', 'NO', 'BAD'):
+            match = imaplib.Response_code.match(dat)
+            if match:
+                command.append_untagged(match.group('type'), match.group('data'))
+
+        if command.name == 'COMPRESS' and typ == 'OK':
+            self._activate_compression()
+
+        if command is self._cont:
+            self._cont = None
+        if command is self._barrier:
+            self._barrier = None
+
+        command.complete(typ, dat)
+        self._pump()
+
+    def _activate_compression(self):
+        """ What follows the COMPRESS response is compressed in both directions (RFC 4978) """
+        self.decompressor = zlib.decompressobj(-15)
+        self.compressor   = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        rest = self._in[self._pos:]
+        self.stats['data_in'] -= len(rest)
+        self._in, self._pos = self.decompressor.decompress(rest), 0
+        self.stats['data_in'] += len(self._in)
+
+    def fail(self, error):
+        """ The connection is lost: fail all the commands """
+        if self.error is not None:
+            return
+        self.error = error
+        LOG.debug("IMAP connection to %s:%s lost: %s" % (self.host, self.port, error))
+
+        if isinstance(self._literal, stream_utils.SpooledLiteral):
+            self._literal.discard()
+        self._literal = None
+
+        commands = list(self._inflight) + list(self._queued)
+        self._inflight.clear()
+        self._queued.clear()
+        self._out.clear()
+        self._cont = self._barrier = None
+
+        self.close()
+
+        for command in commands:
+            command.fail(error)
+
+    def close(self):
+        """ close the socket """
+        self.loop.remove(self)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+class IMAPLoop(object):
+    """
+       select loop driving the IO of several IMAPStream in the current thread
+    """
+    def __init__(self):
+        self._streams = set()
+        self._list    = () # snapshot of _streams (a stream can be removed while its IO is processed)
+
+    def add(self, stream):
+        """ drive stream """
+        self._streams.add(stream)
+        self._list = tuple(self._streams)
+
+    def remove(self, stream):
+        """ stop driving stream """
+        self._streams.discard(stream)
+        self._list = tuple(self._streams)
+
+    def run_once(self, timeout=None):
+        """
+           Wait at most timeout for IO on the streams and process it.
+           The busy streams without IO for more than their SOCK_TIMEOUT fail.
+        """
+        streams = self._list
+        if not streams:
+            return
+
+        buffered = [stream for stream in streams if stream.has_buffered_data()]
+        if buffered:
+            timeout = 0
+
+        writers = [stream for stream in streams if stream.wants_write()]
+        try:
+            readables, writables, _ = select.select(streams, writers, [], timeout)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+
+        readables = set(readables).union(buffered)
+
+        for stream in writables:
+            self._handle(stream, stream.handle_write)
+
+        for stream in readables:
+            if stream.error is None:
+                self._handle(stream, stream.handle_read)
+
+        now = time.time()
+        for stream in streams:
+            if stream.error is None and stream.busy() and now - stream.last_activity > stream.SOCK_TIMEOUT:
+                stream.fail(imaplib.IMAP4.abort('Gmvault socket timeout: nothing received in %d sec.' \
+                                                % (stream.SOCK_TIMEOUT)))
+
+    @classmethod
+    def _handle(cls, stream, handler):
+        """ call the stream IO handler and fail the stream on connection errors """
+        try:
+            handler()
+        except (socket.error, ssl.SSLError, imaplib.IMAP4.abort, zlib.error), err:
+            stream.fail(imaplib.IMAP4.abort('socket error: %s' % (err)) \
+                        if not isinstance(err, imaplib.IMAP4.abort) else err)
+
+    def run_until(self, predicate, timeout=1):
+        """ process the IO until predicate() is True """
+        while not predicate():
+            if not self._streams:
+                raise imaplib.IMAP4.abort('no IMAP connection to wait for')
+            self.run_once(timeout)
+
+    def run_until_complete(self, commands):
+        """ process the IO until all the commands are done """
+        self.run_until(lambda: all(command.done() for command in commands))
+
+class IMAP4Pipelined(imaplib.IMAP4): #pylint:disable=R0904
+    """
+       imaplib interface on an IMAPStream.
+       _command only queues the command and _command_complete drives the loop until
+       its completion so the imaplib and imapclient commands work unchanged.
+       submit() returns the IMAPCommand without waiting for it.
+    """
+    def __init__(self, host, port, use_ssl=True, keyfile=None, certfile=None, loop=None, capabilities=None): #pylint:disable=R0913
+        """
+           constructor
+           capabilities: pre login capabilities known from a previous connection
+        """
+        self.greeting_capabilities = capabilities
+        self.use_ssl  = use_ssl
+        self.keyfile  = keyfile
+        self.certfile = certfile
+        self.loop     = loop or IMAPLoop()
+        self.stream   = None
+
+        # receive the literals bigger than spool_min_size in files of spool_dir (if set)
+        self.spool_dir      = None
+        self.spool_min_size = 0
+
+        self._commands = {}
+
+        imaplib.IMAP4.__init__(self, host, port)
+
+        if 'LITERAL+' in self.capabilities:
+            self.stream.literal_plus = True
+        elif 'LITERAL-' in self.capabilities:
+            self.stream.literal_minus = True
+
+    def open(self, host = '', port = imaplib.IMAP4_SSL_PORT):
+        """ connect the stream """
+        self.host   = host
+        self.port   = port
+        self.stream = IMAPStream(self.loop, host, port, self.use_ssl, self.keyfile, self.certfile)
+
+    @property
+    def compressor(self):
+        """ not None when the connection is compressed """
+        return self.stream.compressor
+
+    @property
+    def stats(self):
+        """ bytes sent and received on the socket (wire) and before/after compression (data) """
+        return self.stream.stats
+
+    def activate_compression(self):
+        """ nothing to do: done by the stream when the COMPRESS command succeeds """
+        pass
+
+    def _get_response(self):
+        """ only used by imaplib to read the greeting """
+        self.loop.run_until(lambda: self.stream.greeting is not None or self.stream.error is not None)
+        if self.stream.error is not None:
+            raise self.abort(str(self.stream.error))
+
+        self._merge_untagged(self.stream.unsolicited)
+        self.stream.unsolicited = {}
+        return '* %s %s' % self.stream.greeting
+
+    def capability(self):
+        """
+           CAPABILITY without round trip after the greeting if the capabilities are known
+        """
+        if self.state == 'NONAUTH' and self.greeting_capabilities:
+            capabilities, self.greeting_capabilities = self.greeting_capabilities, None
+            return 'OK', [capabilities]
+        return imaplib.IMAP4.capability(self)
+
+    def _merge_untagged(self, untagged):
+        """ make the untagged responses of a command visible like in imaplib """
+        for typ, values in untagged.iteritems():
+            self.untagged_responses.setdefault(typ, []).extend(values)
+
+    def _command(self, name, *args):
+        """ queue the command and return its tag """
+        return self.submit(name, *args).tag
+
+    def submit(self, name, *args):
+        """
+           Queue the command and return it (IMAPCommand) without waiting for the response
+        """
+        if self.state not in imaplib.Commands[name]:
+            self.literal = None
+            raise self.error("command %s illegal in state %s, "
+                             "only allowed in states %s" %
+                             (name, self.state,
+                              ', '.join(imaplib.Commands[name])))
+
+        for typ in ('OK', 'NO', 'BAD'):
+            if typ in self.untagged_responses:
+                del self.untagged_responses[typ]
+
+        tag  = self._new_tag()
+        data = '%s %s' % (tag, name)
+        for arg in args:
+            if arg is None:
+                continue
+            data = '%s %s' % (data, self._checkquote(arg))
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        literal, literator = self.literal, None
+        self.literal = None
+        if literal is not None and type(literal) is type(self._command):
+            literal, literator = None, literal
+
+        command = IMAPCommand(tag, name, data, literal, literator)
+        command.spool_dir, command.spool_min_size = self.spool_dir, self.spool_min_size
+        self._commands[tag] = command
+
+        if __debug__:
+            self._log('> %s' % data)
+        return self.stream.submit(command)
+
+    def _command_complete(self, name, tag):
+        """ drive the loop until the command is completed """
+        command = self._commands.pop(tag)
+        self.tagged_commands.pop(tag, None)
+
+        self.loop.run_until_complete([command])
+
+        self._merge_untagged(self.stream.unsolicited)
+        self.stream.unsolicited = {}
+        self._merge_untagged(command.untagged)
+
+        if name != 'LOGOUT' and 'BYE' in command.untagged:
+            raise self.abort(command.untagged['BYE'][-1])
+
+        return command.response()
+
+    def forget(self, command):
+        """ the command was submitted with submit() and its result is handled by the caller """
+        self._commands.pop(command.tag, None)
+        self.tagged_commands.pop(command.tag, None)
+
+    def send(self, data):
+        """ not used: the commands are sent by the stream """
+        raise self.error('use submit() to send commands on a pipelined connection')
+
+    def read(self, size):
+        """ not used: the responses are read by the stream """
+        raise self.error('the responses are read by the stream on a pipelined connection')
+
+    def readline(self):
+        """ not used: the responses are read by the stream """
+        raise self.error('the responses are read by the stream on a pipelined connection')
+
+    def shutdown(self):
+        """ close the connection """
+        if self.stream.error is None:
+            self.stream.close()
+
+class PipelinedIMAPClient(mod_imap.MonkeyIMAPClient): #pylint:disable=R0904
+    """
+       MonkeyIMAPClient on a pipelined connection (IMAP4Pipelined).
+       The imapclient methods are blocking (they drive the loop until their response)
+       and the *_async methods return an IMAPCommand whose result() is the value
+       returned by the blocking method.
+    """
+    def __init__(self, host, port=None, use_uid=True, need_ssl=False, loop=None, capabilities=None): #pylint:disable=R0913
+        """
+           constructor
+        """
+        self._loop = loop
+        super(PipelinedIMAPClient, self).__init__(host, port, use_uid, need_ssl, capabilities)
+
+    def _create_IMAP4(self, **kwargs): #pylint: disable=C0103
+        """ the pipelined connection """
+        return IMAP4Pipelined(self.host, self.port, self.ssl, loop = self._loop, **kwargs)
+
+    @property
+    def loop(self):
+        """ IMAPLoop driving the connection """
+        return self._imap.loop
+
+    def _submit(self, parser, name, *args):
+        """ submit a command whose response is converted by parser(command) """
+        command = self._imap.submit(name, *args)
+        self._imap.forget(command)
+        command.parser = parser
+        return command
+
+    def fetch_async(self, messages, data, modifiers=None):
+        """ pipelined fetch() """
+        args = [imapclient.imapclient.join_message_ids(messages),
+                imapclient.imapclient.seq_to_parenstr_upper(data),
+                imapclient.imapclient.seq_to_parenstr_upper(modifiers) if modifiers else None]
+
+        def parser(command):
+            """ like fetch() """
+            return parse_fetch_response(command.untagged.get('FETCH', []), self.normalise_times, self.use_uid)
+
+        if self.use_uid:
+            return self._submit(parser, 'UID', 'FETCH', *args)
+        return self._submit(parser, 'FETCH', *args)
+
+    def fetch_stream(self, messages, data, modifiers=None):
+        """
+           Generator version of fetch(): yield (msgid, attributes) as soon as each FETCH
+           response is received. The responses are not kept (flat memory for 1:*).
+        """
+        command = self.fetch_async(messages, data, modifiers)
+        command.streamed = collections.deque()
+
+        while True:
+            while command.streamed:
+                items = command.streamed.popleft()
+                for msgid, values in mod_imap.parse_fetch_items(items, self.normalise_times, self.use_uid):
+                    yield msgid, values
+            if command.done():
+                break
+            self.loop.run_once(1)
+
+        command.result() # raise the errors
+
+    def store_async(self, messages, cmd, flags):
+        """ pipelined UID STORE messages cmd (flags) (+X-GM-LABELS.SILENT for ex) """
+        return self._submit(None, 'UID', 'STORE', imapclient.imapclient.join_message_ids(messages), \
+                            cmd, imapclient.imapclient.seq_to_parenstr(flags))
+
+    def append_async(self, folder, msg, flags=(), msg_time=None):
+        """ pipelined append(). The result is the APPEND response text """
+        time_val = '"%s"' % mod_imap.datetime_to_imap(msg_time) if msg_time else None
+        flags    = imapclient.imapclient.seq_to_parenstr(flags)
+        self._imap.literal = imaplib.MapCRLF.sub(CRLF, mod_imap.to_bytes(msg))
+        return self._submit(lambda command: command.text, 'APPEND', self._normalise_folder(folder), \
+                            flags if flags != '()' else None, time_val)
+
+    def wait(self, commands):
+        """ drive the loop until the commands are done """
+        self.loop.run_until_complete(commands)
+
+    def expunge(self):
+        """ expunge without reading the responses from imaplib """
+        typ, data = self._imap._simple_command('EXPUNGE') #pylint: disable=W0212
+        self._checkok('expunge', typ, data)
+        return data[0], [(int(num), 'EXPUNGE') for num in self._imap.untagged_responses.pop('EXPUNGE', [])]
+
+    def noop(self):
+        """ noop without reading the responses from imaplib """
+        typ, data = self._imap._simple_command('NOOP') #pylint: disable=W0212
+        self._checkok('noop', typ, data)
+        responses = []
+        for name in ('EXISTS', 'RECENT', 'EXPUNGE'):
+            responses.extend([(int(num), name) for num in self._imap.untagged_responses.pop(name, [])])
+        return data[0], responses
+
+    def idle(self):
+        """ IDLE is not supported on a pipelined connection """
+        raise imaplib.IMAP4.error('IDLE is not supported by the pipelined IMAP engine')
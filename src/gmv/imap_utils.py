@@ -25,16 +25,21 @@ import socket
 import re
 
 import functools
+import copy
 
 import ssl
+import select
 import imaplib
+import threading
 
 import gmv.gmvault_const as gmvault_const
 import gmv.log_utils as log_utils
 import gmv.credential_utils as credential_utils
 
 import gmv.gmvault_utils as gmvault_utils
+import gmv.collections_utils as collections_utils
 import gmv.mod_imap as mimap
+import gmv.imap_engine as imap_engine
 
 LOG = log_utils.LoggerFactory.get_logger('imap_utils')
 
@@ -95,7 +100,7 @@ def retry(a_nb_tries=3, a_sleep_time=1, a_backoff=1): #pylint:disable=R0912
         while rec_nb_tries[0] < total_nb_tries:
             
             LOG.critical("Disconnecting from Gmail Server and sleeping ...")
-            the_self.disconnect()            
+            the_self.disconnect(keep_standby = True)
             
             # add X sec of wait
             time.sleep(rec_sleep_time[0])
@@ -197,6 +202,8 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     IMAP Class reading the information
     '''
     GMAIL_EXTENSION     = 'X-GM-EXT-1'  # GMAIL capability
+    CONDSTORE_CAPABILITY = 'CONDSTORE'  # MODSEQ of the messages (RFC 4551)
+    IDLE_CAPABILITY     = 'IDLE'        # changes pushed by the server (RFC 2177)
     GMAIL_ALL           = u'[Gmail]/All Mail' #GMAIL All Mail mailbox
     
     GENERIC_GMAIL_ALL   = u'\\AllMail' # unlocalised GMAIL ALL
@@ -211,6 +218,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     
     IMAP_INTERNALDATE = 'INTERNALDATE'
     IMAP_FLAGS        = 'FLAGS'
+    IMAP_RFC822_SIZE  = 'RFC822.SIZE'
     IMAP_ALL          = {'type':'imap', 'req':'ALL'}
     
     EMAIL_BODY        = 'BODY[]'
@@ -237,7 +245,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
                           IMAP_BODY_PEEK, IMAP_FLAGS, IMAP_HEADER_PEEK_FIELDS]
 
     GET_ALL_BUT_DATA  = [ GMAIL_ID, GMAIL_THREAD_ID, GMAIL_LABELS, IMAP_INTERNALDATE, \
-                          IMAP_FLAGS, IMAP_HEADER_PEEK_FIELDS]
+                          IMAP_FLAGS, IMAP_HEADER_PEEK_FIELDS, IMAP_RFC822_SIZE]
     
     GET_DATA_ONLY     = [ GMAIL_ID, IMAP_BODY_PEEK]
  
@@ -245,9 +253,14 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     
     GET_GMAIL_ID_DATE = [ GMAIL_ID,  IMAP_INTERNALDATE]
 
-    def __init__(self, host, port, login, credential, readonly_folder = True): #pylint:disable=R0913
+    # the oauth2 access token is renewed when it expires in less than X sec
+    OAUTH2_EXPIRY_MARGIN = 300
+
+    def __init__(self, host, port, login, credential, readonly_folder = True, use_standby = False): #pylint:disable=R0913
         '''
             Constructor
+            use_standby: keep a second connection logged in to replace the current one
+                         immediately when it is lost
         '''
         self.host                   = host
         self.port                   = port
@@ -264,6 +277,28 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         
         # memoize the current folder (All Mail or Chats) for reconnection management
         self.current_folder        = None
+        self.uidvalidity           = None # UIDVALIDITY of the current folder
+        self.highestmodseq         = None # HIGHESTMODSEQ of the current folder when selected (CONDSTORE)
+
+        # the fetched bodies (GET_DATA_ONLY) bigger than spool_min_size are received in files of spool_dir
+        self.spool_dir              = None
+        self.spool_min_size         = 0
+
+        # imapclient or pipelined (imap_engine). The pipelined connections are driven by imap_loop
+        self.imap_engine            = gmvault_utils.get_conf_defaults().get('General', 'imap_engine', 'imapclient')
+        self.imap_loop              = None
+
+        # kept from the previous connections to connect again faster
+        self._greeting_capabilities = None  # pre login capabilities (no CAPABILITY after the greeting)
+        self._capabilities          = None  # post login ones. If they change, the folders are found again
+        self._folders_found         = False # localized_folders are known (no XLIST)
+
+        # standby connection opened in a thread
+        self.use_standby            = use_standby
+        self._standby_enabled       = use_standby
+        self._standby               = None
+        self._standby_thread        = None
+        self._standby_lock          = threading.Lock()
         
         self.server                 = None
         self.go_to_all_folder       = True
@@ -274,63 +309,231 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         #update GENERIC_GMAIL_CHATS. Should be done at the class level
         self.GENERIC_GMAIL_CHATS.extend(gmvault_utils.get_conf_defaults().get_list('Localisation', 'chat_folder', []))
         
-    def spawn_connection(self):
+    def spawn_connection(self, share_loop = False):
         """
-           spawn a connection with the same parameters
+           spawn a connection with the same parameters.
+           share_loop: with the pipelined engine, drive the new connection with the loop
+           of this one (both connections must then be used from the same thread)
         """
         conn = GIMAPFetcher(self.host, self.port, self.login, self.credential, self.readonly_folder)
+        conn.ssl         = self.ssl
+        conn.imap_engine = self.imap_engine
+        # same server: no need to ask again the capabilities and folders
+        conn._greeting_capabilities = self._greeting_capabilities #pylint:disable=W0212
+        conn._capabilities          = self._capabilities #pylint:disable=W0212
+        conn._folders_found         = self._folders_found #pylint:disable=W0212
+        conn.localized_folders      = copy.deepcopy(self.localized_folders)
+        if share_loop:
+            conn.imap_loop = self.imap_loop
         conn.connect()
         return conn
+
+    def is_pipelined(self):
+        """
+           True if the connection uses the pipelined engine (fetch_async available)
+        """
+        return self.imap_engine == 'pipelined'
         
     def connect(self, go_to_current_folder = False):
         """
-           connect to the IMAP server
+           connect to the IMAP server.
+           When connecting again, the standby connection is used if it is ready and
+           the capabilities and folder names of the previous connection are reused
+           as long as the server announces the same capabilities
+        """
+        self._standby_enabled = self.use_standby
+
+        server = self._take_standby() if self.once_connected else None
+        if server is None:
+            server = self._open_server(self.imap_loop)
+        self.server = server
+        if self.is_pipelined():
+            self.imap_loop = server.loop
+
+        #set connected to True to handle reconnection in case of failure
+        self.once_connected = True
+
+        capabilities = set(self.get_capabilities())
+        if capabilities != self._capabilities:
+            if self._capabilities is not None:
+                LOG.debug("The server capabilities have changed. Check the server and find the folders again.")
+            self._capabilities  = capabilities
+            self._folders_found = False
+
+            # check gmailness
+            self.check_gmailness()
+
+        if not self._folders_found:
+            # find allmail chats and drafts folders
+            self.find_folder_names()
+            self._folders_found = True
+
+        if go_to_current_folder and self.current_folder:
+            self._select_current_folder()
+
+        self._start_standby()
+
+    def _open_server(self, loop = None):
+        """
+           Open a logged in connection (compressed if possible).
+           The pre login capabilities and the oauth2 access token of the previous
+           connections are reused
         """
         # create imap object
-        self.server = mimap.MonkeyIMAPClient(self.host, port = self.port, use_uid= self.use_uid, need_ssl= self.ssl)
+        if self.is_pipelined():
+            server = imap_engine.PipelinedIMAPClient(self.host, port = self.port, use_uid = self.use_uid, \
+                                                     need_ssl = self.ssl, loop = loop, \
+                                                     capabilities = self._greeting_capabilities)
+        elif self.imap_engine == 'imapclient':
+            server = mimap.MonkeyIMAPClient(self.host, port = self.port, use_uid= self.use_uid, need_ssl= self.ssl, \
+                                            capabilities = self._greeting_capabilities)
+        else:
+            raise Exception("Unknown imap engine %s. Please use imapclient or pipelined." % (self.imap_engine))
+
+        self._greeting_capabilities = server.greeting_capabilities()
+
         # connect with password or xoauth
         if self.credential['type'] == 'passwd':
-            self.server.login(self.login, self.credential['value'])
+            server.login(self.login, self.credential['value'])
         elif self.credential['type'] == 'oauth2':
             #connect with oauth2
-            if self.once_connected:
+            renewed = False
+            if self.once_connected and \
+               self.credential.get('expiry', 0) < gmvault_utils.get_utcnow_epoch() + self.OAUTH2_EXPIRY_MARGIN:
                 self.credential = credential_utils.CredentialHelper.get_oauth2_credential(self.login, renew_cred = False)
+                renewed = True
 
             LOG.debug("credential['value'] = %s" % (self.credential['value']))
             #try to login
-            self.server.oauth2_login(self.credential['value'])
+            try:
+                server.oauth2_login(self.credential['value'])
+            except imaplib.IMAP4.abort, _:
+                raise
+            except imaplib.IMAP4.error, _:
+                if renewed or not self.once_connected:
+                    raise
+                # the access token kept in memory has been revoked: read it again
+                LOG.debug("OAuth2 login refused. Get the OAuth2 credential again.")
+                self.credential = credential_utils.CredentialHelper.get_oauth2_credential(self.login, renew_cred = False)
+                server.oauth2_login(self.credential['value'])
         else:
             raise Exception("Unknown authentication method %s. Please use xoauth or passwd authentication " \
                             % (self.credential['type']))
-            
-        #set connected to True to handle reconnection in case of failure
-        self.once_connected = True
-        
-        # check gmailness
-        self.check_gmailness()
-         
-        # find allmail chats and drafts folders
-        self.find_folder_names()
 
-        if go_to_current_folder and self.current_folder:
-            self.server.select_folder(self.current_folder, readonly = self.readonly_folder)
-            
-        #enable compression
+        #enable compression (done again for each connection) before the other commands
         if gmvault_utils.get_conf_defaults().get_boolean('General', 'enable_imap_compression', True):
-            self.enable_compression()
-            LOG.debug("After Enabling compression.")
+            self.enable_compression(server)
         else:
             LOG.debug("Do not enable imap compression.") 
-            
-    def disconnect(self):
+
+        return server
+
+    def _select_current_folder(self):
+        """
+           select the current folder after a reconnection. If it does not exist
+           anymore, the folder names are searched again
+        """
+        try:
+            self._select(self.current_folder)
+            return
+        except imaplib.IMAP4.abort, _:
+            raise
+        except imaplib.IMAP4.error, err:
+            keys = [key for key, folder in self.localized_folders.iteritems() if folder['loc_dir'] == self.current_folder]
+            if not keys:
+                raise
+            LOG.debug("Cannot select %s (%s). Find the folders again." % (self.current_folder, err))
+
+        self.find_folder_names()
+        self.current_folder = self.localized_folders[keys[0]]['loc_dir']
+        self._select(self.current_folder)
+
+    def _select(self, folder):
+        """
+           select folder and remember its UIDVALIDITY
+        """
+        resp = self.server.select_folder(folder, readonly = self.readonly_folder)
+        self.uidvalidity   = resp.get('UIDVALIDITY')
+        self.highestmodseq = resp.get('HIGHESTMODSEQ')
+
+    def _start_standby(self):
         """
-           disconnect to avoid too many simultaneous connection problem
+           open a standby connection in a thread if none is ready or being opened
         """
+        with self._standby_lock:
+            if not self._standby_enabled or self._standby is not None or \
+               (self._standby_thread is not None and self._standby_thread.is_alive()):
+                return
+            self._standby_thread = threading.Thread(target = self._open_standby, name = 'gmv-standby-connection')
+            self._standby_thread.daemon = True
+            self._standby_thread.start()
+
+    def _open_standby(self):
+        """
+           standby thread: open the connection and keep it if it is still wanted
+        """
+        try:
+            # pipelined standby connections have their own loop until they are used
+            server = self._open_server()
+        except Exception, err: #pylint:disable-msg=W0703
+            LOG.debug("Cannot open the standby connection: %s" % (err))
+            return
+
+        with self._standby_lock:
+            if self._standby_enabled and self._standby is None:
+                self._standby = server
+                return
+
+        self._logout(server)
+
+    def _take_standby(self):
+        """
+           Return the standby connection if it is ready and still alive, None otherwise
+        """
+        with self._standby_lock:
+            server, self._standby = self._standby, None
+
+        if server is None:
+            return None
+
+        try:
+            server.noop()
+        except Exception, err: #pylint:disable-msg=W0703
+            LOG.debug("The standby connection has been lost: %s" % (err))
+            self._logout(server)
+            return None
+
+        LOG.debug("Use the standby connection.")
+        return server
+
+    @classmethod
+    def _logout(cls, server):
+        """
+           logout and ignore the errors
+        """
+        try:
+            server.logout()
+        except Exception, ignored: #ignored exception but still log it in log file if activated
+            LOG.exception(ignored)
+
+    def disconnect(self, keep_standby = False):
+        """
+           disconnect to avoid too many simultaneous connection problem.
+           keep_standby: keep the standby connection for the next connect
+        """
+        if not keep_standby:
+            with self._standby_lock:
+                self._standby_enabled = False
+                standby, self._standby = self._standby, None
+            if standby:
+                self._logout(standby)
+
         if self.server:
-            try:
-                self.server.logout()
-            except Exception, ignored: #ignored exception but still log it in log file if activated
-                LOG.exception(ignored)
+            stats = self.get_transfer_stats()
+            if stats:
+                LOG.debug("IMAP connection transfer: received %d bytes (%d on the wire), sent %d bytes (%d on the wire)." \
+                          % (stats['data_in'], stats['wire_in'], stats['data_out'], stats['wire_out']))
+            self._logout(self.server)
                 
             self.server = None
     
@@ -338,15 +541,36 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         """
            disconnect and connect again
         """
-        self.disconnect()
+        self.disconnect(keep_standby = True)
         self.connect()
     
-    def enable_compression(self):
+    COMPRESS_CAPABILITY = 'COMPRESS=DEFLATE'
+
+    def enable_compression(self, server = None):
+        """
+           Try to enable the compression (RFC 4978) on server (the current connection by default)
+           if the server supports it.
+           Return True if the connection is compressed
+        """
+        server = server or self.server
+        if GIMAPFetcher.COMPRESS_CAPABILITY not in server.capabilities():
+            LOG.debug("The server does not support %s. No imap compression." % (GIMAPFetcher.COMPRESS_CAPABILITY))
+            return False
+
+        if server.enable_compression():
+            LOG.debug("Imap compression enabled.")
+            return True
+
+        LOG.debug("The server refused the imap compression. Continue without it.")
+        return False
+
+    def get_transfer_stats(self):
         """
-           Try to enable the compression
+           Return the bytes received and sent by the current connection:
+           data_in/data_out (imap data) and wire_in/wire_out (on the socket after compression).
+           None if not connected
         """
-        #self.server.enable_compression()
-        pass
+        return self.server.get_transfer_stats() if self.server else None
 
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
     def find_folder_names(self):
@@ -469,11 +693,11 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
             folder = self.localized_folders.get(a_folder_name, {'loc_dir' : 'GMVNONAME'})['loc_dir']
             
             if self.current_folder != folder:
-                self.server.select_folder(folder, readonly = self.readonly_folder)
+                self._select(folder)
                 self.current_folder = folder
             
         elif self.current_folder != a_folder_name:
-            self.server.select_folder(a_folder_name, readonly = self.readonly_folder)
+            self._select(a_folder_name)
             self.current_folder = a_folder_name
         
         return self.current_folder
@@ -495,6 +719,60 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
         
         return self.server.capabilities()
     
+    def has_condstore(self):
+        """
+           True if the server tracks the changes of the messages with a MODSEQ (CONDSTORE)
+        """
+        return self.CONDSTORE_CAPABILITY in (self._capabilities or self.get_capabilities())
+
+    def has_idle(self):
+        """
+           True if the changes of the current folder can be waited with IDLE
+           (not supported by the pipelined engine)
+        """
+        return not self.is_pipelined() and self.IDLE_CAPABILITY in (self._capabilities or self.get_capabilities())
+
+    @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
+    def wait_for_changes(self, a_timeout):
+        """
+           Wait at most a_timeout sec for the server to report changes in the current folder (IDLE).
+           Without IDLE, sleep a_timeout sec and poll the folder with a NOOP.
+           Return the untagged responses received (EXISTS, EXPUNGE, FETCH ...)
+        """
+        if not self.has_idle():
+            time.sleep(a_timeout)
+            return self.server.noop()[1]
+
+        self.server.idle()
+
+        # a response already received (buffered by the transport or ssl) would not wake up select
+        imap = self.server._imap #pylint:disable=W0212
+        sock = getattr(imap, 'sslobj', None) or imap.sock
+        if not ((hasattr(imap, 'pending') and imap.pending()) or (hasattr(sock, 'pending') and sock.pending())):
+            select.select([sock], [], [], a_timeout)
+
+        # the responses are read (blocking) with the end of IDLE
+        return self.server.idle_done()[1]
+
+    @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
+    def get_changed_since(self, a_modseq):
+        """
+           Return the uids of the current folder whose labels or flags changed (or that
+           were added) after a_modseq (CONDSTORE CHANGEDSINCE) and the highest MODSEQ
+           of these messages (a_modseq if nothing changed)
+        """
+        data = self.server.fetch('1:*', [GIMAPFetcher.GMAIL_ID], modifiers = ['CHANGEDSINCE %d' % (a_modseq)])
+
+        highest = a_modseq
+        for values in data.itervalues():
+            modseq = values.get('MODSEQ')
+            if isinstance(modseq, (tuple, list)):
+                modseq = modseq[0]
+            if modseq is not None:
+                highest = max(highest, long(modseq))
+
+        return sorted(data.keys()), highest
+
     @retry(3,1,2) # try 3 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 4 sec
     def check_gmailness(self):
         """
@@ -516,9 +794,81 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
     @retry(3,1,2) # try 4 times to reconnect with a sleep time of 1 sec and a backoff of 2. The fourth time will wait 8 sec
     def fetch(self, a_ids, a_attributes):
         """
-           Return all attributes associated to each message
+           Return all attributes associated to each message.
+           With a literal spool, the big bodies of GET_DATA_ONLY are returned as
+           stream_utils.SpooledLiteral written to disk while being received.
+        """
+        return self.fetch_no_retry(a_ids, a_attributes)
+
+    def fetch_no_retry(self, a_ids, a_attributes):
+        """
+           fetch without reconnection and retry: the errors are raised immediately
+        """
+        if self.spool_dir is None or a_attributes != GIMAPFetcher.GET_DATA_ONLY:
+            return self.server.fetch(a_ids, a_attributes)
+
+        self.server.set_literal_spool(self.spool_dir, self.spool_min_size)
+        try:
+            return self.server.fetch(a_ids, a_attributes)
+        finally:
+            self.server.set_literal_spool(None)
+
+    def fetch_stream(self, a_attributes, a_nb_tries = 3):
+        """
+           Generator returning (uid, attributes) of all the messages of the current folder
+           with one UID FETCH 1:* whose responses are read as a stream.
+           When the connection is lost, reconnect and fetch again from the uid following
+           the last one received (at most a_nb_tries times).
+        """
+        last_uid, nb_tries = 0, 0
+        while True:
+            try:
+                for uid, values in self.server.fetch_stream('%d:*' % (last_uid + 1), a_attributes):
+                    # n:* returns the highest uid even if it is lower than n
+                    if uid > last_uid:
+                        last_uid = uid
+                        yield uid, values
+                return
+            except (imaplib.IMAP4.abort, socket.error, ssl.SSLError), err:
+                if nb_tries >= a_nb_tries:
+                    raise
+                nb_tries += 1
+                LOG.critical("Connection lost while receiving the messages (%s). "\
+                             "Reconnect and continue after uid %d." % (err, last_uid))
+                self.disconnect(keep_standby = True)
+                time.sleep(nb_tries)
+                self.total_nb_reconns += 1
+                self.connect(go_to_current_folder = True)
+
+    def fetch_async(self, a_ids, a_attributes):
+        """
+           Pipelined fetch (pipelined engine only): send the command and return it
+           (imap_engine.IMAPCommand) without waiting. command.result() returns what fetch returns.
+           There is no retry: on error, call fetch() that reconnects.
+        """
+        if self.spool_dir is None or a_attributes != GIMAPFetcher.GET_DATA_ONLY:
+            return self.server.fetch_async(a_ids, a_attributes)
+
+        # the spool settings are taken by the command when it is submitted
+        self.server.set_literal_spool(self.spool_dir, self.spool_min_size)
+        try:
+            return self.server.fetch_async(a_ids, a_attributes)
+        finally:
+            self.server.set_literal_spool(None)
+
+    def wait(self, commands):
+        """
+           Drive the imap loop (pipelined engine) until the commands are done
+        """
+        self.imap_loop.run_until_complete(commands)
+
+    def set_literal_spool(self, spool_dir, min_size=0):
+        """
+           Receive the fetched bodies of at least min_size bytes in files of spool_dir
+           instead of in memory. None to keep them in memory.
         """
-        return self.server.fetch(a_ids, a_attributes)
+        self.spool_dir      = spool_dir
+        self.spool_min_size = min_size
 
     @classmethod
     def _build_labels_str(cls, a_labels):
@@ -648,7 +998,7 @@ class GIMAPFetcher(object): #pylint:disable=R0902,R0904
             #has labels so update email  
             the_timer.start()
             LOG.debug("Before to store labels %s" % (labels_str))
-            id_list = ",".join(map(str, imap_ids))
+            id_list = collections_utils.IdSet(imap_ids).sequence_set()
             #+X-GM-LABELS.SILENT to have not returned data
             try:
                 ret_code, data = self.server._imap.uid('STORE', id_list, '+X-GM-LABELS.SILENT', labels_str) #pylint: disable=W0212
@@ -24,11 +24,13 @@ import datetime
 import re
 import socket
 import ssl
-import cStringIO
 import os
 
 import imaplib  #for the exception
 import imapclient
+from imapclient.response_parser import parse_fetch_response
+
+import gmv.stream_utils as stream_utils
 
 #enable imap debugging if GMV_IMAP_DEBUG is set 
 if os.getenv("GMV_IMAP_DEBUG"):
@@ -92,6 +94,70 @@ def datetime_to_imap(dt):
         dt = dt.replace(tzinfo=imapclient.fixed_offset.FixedOffset.for_system())
     return dt.strftime("%d-%b-%Y %H:%M:%S %z")
 
+# tokens of a FETCH response: quoted string, parenthesis, atom or anything else (not handled)
+FETCH_TOKEN_RE   = re.compile(r'"((?:[^"\\]|\\.)*)"|([()])|([^\s()"\[\]]+)|(\S)')
+QUOTED_ESCAPE_RE = re.compile(r'\\([\\"])')
+
+def parse_fetch_items(items, normalise_times=True, uid_is_key=True):
+    """
+       parse_fetch_response() of the items of one FETCH response. Return [(msgid, attributes)].
+       A response without literal nor section (BODY[...]) is parsed with a regular expression
+       (much faster than the imapclient lexer for the metadata of a whole mailbox).
+    """
+    if len(items) == 1 and isinstance(items[0], str):
+        parsed = _parse_fetch_line(items[0], normalise_times, uid_is_key)
+        if parsed is not None:
+            return [parsed]
+    return parse_fetch_response(items, normalise_times, uid_is_key).items()
+
+def _parse_fetch_line(dat, normalise_times, uid_is_key):
+    """
+       (msgid, attributes) of the FETCH response dat ('12 (UID 5 FLAGS (\\Seen))')
+       or None if it cannot be parsed here
+    """
+    stack = [[]]
+    for match in FETCH_TOKEN_RE.finditer(dat):
+        kind, token = match.lastindex, match.group(match.lastindex)
+        if kind == 1:
+            stack[-1].append(QUOTED_ESCAPE_RE.sub(r'\1', token))
+        elif kind == 2:
+            if token == '(':
+                stack.append([])
+            elif len(stack) > 1:
+                values = tuple(stack.pop())
+                stack[-1].append(values)
+            else:
+                return None
+        elif kind == 3:
+            stack[-1].append(None if token == 'NIL' else (int(token) if token.isdigit() else token))
+        else:
+            return None
+
+    if len(stack) != 1 or len(stack[0]) != 2 or not isinstance(stack[0][0], (int, long)) \
+       or not isinstance(stack[0][1], tuple) or len(stack[0][1]) % 2:
+        return None
+
+    msgid, response = stack[0]
+    attributes = { 'SEQ' : msgid }
+    for pos in xrange(0, len(response), 2):
+        word, value = response[pos].upper(), response[pos + 1]
+        if word == 'UID':
+            if uid_is_key:
+                msgid = value
+            else:
+                attributes[word] = value
+        elif word == 'INTERNALDATE':
+            try:
+                attributes[word] = mod_convert_INTERNALDATE(value, normalise_times)
+            except ValueError:
+                attributes[word] = None
+        elif word in ('ENVELOPE', 'BODY', 'BODYSTRUCTURE'):
+            return None
+        else:
+            attributes[word] = value
+
+    return msgid, attributes
+
 def to_unicode(s):
     if isinstance(s, imapclient.six.binary_type):
         return s.decode('ascii')
@@ -105,17 +171,51 @@ def to_bytes(s):
 class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable=R0904
     """
        Add support for compression inspired by http://www.janeelix.com/piers/python/py2html.cgi/piers/python/imaplib2
+       The responses are received in a buffer: the lines are split in the buffer
+       and the literals are received directly in a preallocated bytearray.
     """
     SOCK_TIMEOUT = 70 # set a socket timeout of 70 sec to avoid for ever blockage in ssl.read
 
-    def __init__(self, host = '', port = imaplib.IMAP4_SSL_PORT, keyfile = None, certfile = None):
+    RECV_SIZE = 65536 # max bytes received from the socket at once
+
+    # literals of at least spool_min_size bytes are written in files of spool_dir (if set)
+    spool_dir      = None
+    spool_min_size = 0
+
+    def __init__(self, host = '', port = imaplib.IMAP4_SSL_PORT, keyfile = None, certfile = None, capabilities = None): #pylint:disable=R0913
         """
            constructor
+           capabilities: capabilities announced by the server before login in a previous
+                         connection. Used instead of asking them again after the greeting
         """
         self.compressor = None
         self.decompressor = None
+
+        self.greeting_capabilities = capabilities
+
+        self._init_buffers()
         
         imaplib.IMAP4_SSL.__init__(self, host, port, keyfile, certfile)
+
+    def capability(self):
+        """
+           CAPABILITY without round trip after the greeting if the capabilities are known
+        """
+        if self.state == 'NONAUTH' and self.greeting_capabilities:
+            capabilities, self.greeting_capabilities = self.greeting_capabilities, None
+            return 'OK', [capabilities]
+        return imaplib.IMAP4_SSL.capability(self)
+
+    def _init_buffers(self):
+        """
+           Create the receive buffers
+        """
+        self._recv_buf = bytearray(self.RECV_SIZE) # raw (compressed) data from the socket
+        self._buffer   = ''                        # received data not read yet starts at _offset
+        self._offset   = 0
+
+        # bytes sent and received on the socket (wire) and before/after compression (data)
+        self.stats     = { 'wire_in' : 0, 'data_in' : 0, 'wire_out' : 0, 'data_out' : 0 }
         
     def activate_compression(self):
         """
@@ -125,6 +225,10 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable=R0904
         # rfc 1951 - pure DEFLATE, so use -15 for both windows
         self.decompressor = zlib.decompressobj(-15)
         self.compressor   = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        # what has been received after the COMPRESS response is compressed
+        if self.pending():
+            self._buffer, self._offset = self.decompressor.decompress(self._buffer[self._offset:]), 0
         
     def open(self, host = '', port = imaplib.IMAP4_SSL_PORT): 
         """Setup connection to remote server on "host:port".
@@ -141,75 +245,134 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable=R0904
 
         self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
         #self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile, suppress_ragged_eofs = False)
-        
-        # This is the last correction added to avoid memory fragmentation in imaplib
-        # makefile creates a file object that makes use of cStringIO to avoid mem fragmentation
-        # it could be used without the compression 
-        # (maybe make 2 set of methods without compression and with compression)
-        #self.file   = self.sslobj.makefile('rb')
 
-    def new_read(self, size):
+        # no file object: read and readline use the receive buffer
+        self._init_buffers()
+
+    def _recv_into(self, view, size):
         """
-            Read 'size' bytes from remote.
-            Call _intern_read that takes care of the compression
+            Receive at most size bytes from the socket in view.
+            Raise abort when the connection is closed
         """
-        
-        chunks = cStringIO.StringIO() #use cStringIO.cStringIO to avoir too much fragmentation
-        read = 0
-        while read < size:
-            try:
-                data = self._intern_read(min(size-read, 16384)) #never ask more than 16384 because imaplib can do it
-            except ssl.SSLError, err:
-                print("************* SSLError received %s" % (err)) 
-                raise self.abort('Gmvault ssl socket error: EOF. Connection lost, reconnect.')
-            read += len(data)
-            chunks.write(data)
-        
-        return chunks.getvalue() #return the cStringIO content
-    
-    def read(self, size):
+        nb_bytes = self.sslobj.recv_into(view, size)
+        if not nb_bytes:
+            #to avoid infinite looping due to empty string returned
+            raise self.abort('Gmvault ssl socket error: EOF. Connection lost, reconnect.')
+
+        self.stats['wire_in'] += nb_bytes
+        if self.decompressor is None:
+            self.stats['data_in'] += nb_bytes
+
+        return nb_bytes
+
+    def _recv(self):
         """
-            Read 'size' bytes from remote.
-            Call _intern_read that takes care of the compression
+            Receive the next data from the socket. Takes care of the compression
         """
-        
-        chunks = cStringIO.StringIO() #use cStringIO.cStringIO to avoir too much fragmentation
-        read = 0
-        while read < size:
-            data = self._intern_read(min(size-read, 16384)) #never ask more than 16384 because imaplib can do it
-            if not data: 
-                #to avoid infinite looping due to empty string returned
-                raise self.abort('Gmvault ssl socket error: EOF. Connection lost, reconnect.') 
-            read += len(data)
-            chunks.write(data)
-        
-        return chunks.getvalue() #return the cStringIO content
-  
-    def _intern_read(self, size):
+        while True:
+            nb_bytes = self._recv_into(self._recv_buf, self.RECV_SIZE)
+
+            if self.decompressor is None:
+                return str(buffer(self._recv_buf, 0, nb_bytes))
+
+            data = self.decompressor.decompress(buffer(self._recv_buf, 0, nb_bytes))
+            self.stats['data_in'] += len(data)
+            if data: # a compressed block can be split between 2 receptions
+                return data
+
+    def pending(self):
         """
-            Read at most 'size' bytes from remote.
-            Takes care of the compression
+            Return True if received data has not been read yet
         """
-        if self.decompressor is None:
-            return self.sslobj.read(size)
-
-        if self.decompressor.unconsumed_tail:
-            data = self.decompressor.unconsumed_tail
-        else:
-            data = self.sslobj.read(8192) #Fixed buffer size. maybe change to 16384
+        return self._offset < len(self._buffer)
 
-        return self.decompressor.decompress(data, size)
+    def read(self, size):
+        """
+            Read 'size' bytes from remote (a literal).
+            The bytes are received in a preallocated buffer or
+            in a spool file for the big literals.
+        """
+        if self.spool_dir is not None and size >= self.spool_min_size:
+            return self._read_to_spool(size)
+
+        end = self._offset + size
+        if end <= len(self._buffer):
+            data = self._buffer[self._offset:end]
+            self._offset = end
+            return data
+
+        literal = bytearray(size)
+        view    = memoryview(literal)
+
+        # start with the already received data
+        pos = len(self._buffer) - self._offset
+        view[:pos] = buffer(self._buffer, self._offset)
+        self._buffer, self._offset = '', 0
+
+        while pos < size:
+            if self.decompressor is None:
+                # directly in the literal
+                pos += self._recv_into(view[pos:], size - pos)
+            else:
+                data = self._recv()
+                nb_bytes = min(len(data), size - pos)
+                view[pos:pos + nb_bytes] = buffer(data, 0, nb_bytes)
+                pos += nb_bytes
+                if nb_bytes < len(data):
+                    # keep the beginning of the next response
+                    self._buffer, self._offset = data, nb_bytes
+
+        return str(literal)
+
+    def _read_to_spool(self, size):
+        """
+            Receive a literal of 'size' bytes in a spool file chunk by chunk.
+            Return a SpooledLiteral
+        """
+        literal = stream_utils.SpooledLiteral(self.spool_dir)
+        try:
+            # start with the already received data
+            nb_bytes = min(len(self._buffer) - self._offset, size)
+            literal.write(buffer(self._buffer, self._offset, nb_bytes))
+            self._offset += nb_bytes
+            if not self.pending():
+                self._buffer, self._offset = '', 0
+
+            left = size - nb_bytes
+            while left > 0:
+                if self.decompressor is None:
+                    nb_bytes = self._recv_into(self._recv_buf, min(left, self.RECV_SIZE))
+                    literal.write(buffer(self._recv_buf, 0, nb_bytes))
+                else:
+                    data = self._recv()
+                    nb_bytes = min(len(data), left)
+                    literal.write(buffer(data, 0, nb_bytes))
+                    if nb_bytes < len(data):
+                        # keep the beginning of the next response
+                        self._buffer, self._offset = data, nb_bytes
+                left -= nb_bytes
+
+            literal.close()
+        except:
+            literal.discard()
+            raise
+
+        return literal
         
     def readline(self):
         """Read line from remote."""
-        line = cStringIO.StringIO() #use cStringIO to avoid memory fragmentation
-        while 1:
-            #make use of read that takes care of the compression
-            #it could be simplified without compression
-            char = self.read(1) 
-            line.write(char)
-            if char in ("\n", ""): 
-                return line.getvalue()
+        parts = []
+        while True:
+            pos = self._buffer.find('\n', self._offset)
+            if pos >= 0:
+                parts.append(self._buffer[self._offset:pos + 1])
+                self._offset = pos + 1
+                return ''.join(parts) if len(parts) > 1 else parts[0]
+
+            # long line: keep the parts and join them at the end
+            if self._offset < len(self._buffer):
+                parts.append(self._buffer[self._offset:])
+            self._buffer, self._offset = self._recv(), 0
     
     def shutdown(self):
         """Close I/O established in "open"."""
@@ -220,9 +383,11 @@ class IMAP4COMPSSL(imaplib.IMAP4_SSL): #pylint:disable=R0904
     def send(self, data):
         """send(data)
         Send 'data' to remote."""
+        self.stats['data_out'] += len(data)
         if self.compressor is not None:
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.stats['wire_out'] += len(data)
         self.sslobj.sendall(data)
        
 def seq_to_parenlist(flags):
@@ -241,11 +406,28 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
        Compression inspired by http://www.janeelix.com/piers/python/py2html.cgi/piers/python/imaplib2
     """
     
-    def __init__(self, host, port=None, use_uid=True, need_ssl=False):
+    def __init__(self, host, port=None, use_uid=True, need_ssl=False, capabilities=None): #pylint:disable=R0913
         """
            constructor
+           capabilities: pre login capabilities of a previous connection to the same server
+                         (no CAPABILITY command after the greeting)
+        """
+        super(MonkeyIMAPClient, self).__init__(host, port, use_uid, need_ssl, capabilities = capabilities)
+
+    def _create_IMAP4(self, **kwargs): #pylint: disable=C0103
+        """
+           Use the buffered transport (supporting compression) for ssl connections
         """
-        super(MonkeyIMAPClient, self).__init__(host, port, use_uid, need_ssl)
+        if self.ssl:
+            return IMAP4COMPSSL(self.host, self.port, **kwargs)
+        kwargs.pop('capabilities', None)
+        return super(MonkeyIMAPClient, self)._create_IMAP4(**kwargs)
+
+    def greeting_capabilities(self):
+        """
+           Capabilities announced by the server before login (to connect again faster)
+        """
+        return ' '.join(self._imap.capabilities)
 
     def oauth2_login(self, oauth2_cred):
         """
@@ -298,6 +480,53 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
 
         return [ long(i) for i in data[0].split() ]
 
+    def fetch_stream(self, messages, data, modifiers=None):
+        """
+           Generator version of fetch(): yield (msgid, attributes) as soon as each FETCH
+           response is received. The responses are not kept (flat memory for 1:*).
+           The generator has to be consumed until the end to read the tagged response.
+        """
+        args = ['FETCH', imapclient.imapclient.join_message_ids(messages),
+                imapclient.imapclient.seq_to_parenstr_upper(data),
+                imapclient.imapclient.seq_to_parenstr_upper(modifiers) if modifiers else None]
+        tag = self._imap._command('UID', *args) if self.use_uid else self._imap._command(*args) #pylint: disable=W0212
+
+        while True:
+            # a response is a line or (line, literal) records followed by a line
+            records = []
+            line = self._imap._get_line() #pylint: disable=W0212
+            match = imaplib.Literal.match(line)
+            while match:
+                records.append((line, self._imap.read(int(match.group('size')))))
+                line  = self._imap._get_line() #pylint: disable=W0212
+                match = imaplib.Literal.match(line)
+
+            resp = records[0][0] if records else line
+            if resp.startswith('%s ' % (tag)):
+                del self._imap.tagged_commands[tag]
+                typ, _, text = resp[len(tag) + 1:].partition(' ')
+                self._checkok('fetch', typ, [text])
+                return
+
+            match = imaplib.Untagged_response.match(resp) or imaplib.Untagged_status.match(resp)
+            if not match:
+                raise self.AbortError("unexpected response: '%s'" % (resp))
+
+            # same items as imaplib.IMAP4.untagged_responses
+            dat = match.group('data') or ''
+            if match.groupdict().get('data2'):
+                dat = '%s %s' % (dat, match.group('data2'))
+            items = [(dat if pos == 0 else rec_line, literal) for pos, (rec_line, literal) in enumerate(records)]
+            items.append(line if records else dat)
+
+            if match.group('type') != 'FETCH':
+                for item in items:
+                    self._imap._append_untagged(match.group('type'), item) #pylint: disable=W0212
+                continue
+
+            for msgid, values in parse_fetch_items(items, self.normalise_times, self.use_uid):
+                yield msgid, values
+
     def append(self, folder, msg, flags=(), msg_time=None):
         """Append a message to *folder*.
 
@@ -334,12 +563,41 @@ class MonkeyIMAPClient(imapclient.IMAPClient): #pylint:disable=R0903,R0904
         Should be called from user of this class after instantiation, as in:
             if 'COMPRESS=DEFLATE' in imapobj.capabilities:
                 imapobj.enable_compression()
+        Return True if the connection is compressed.
         """
-        ret_code, _ = self._imap._simple_command('COMPRESS', 'DEFLATE') #pylint: disable=W0212
+        if not hasattr(self._imap, 'activate_compression'):
+            # not an IMAP4COMPSSL connection
+            return False
+
+        if self._imap.compressor is not None:
+            return True
+
+        try:
+            ret_code, _ = self._imap._simple_command('COMPRESS', 'DEFLATE') #pylint: disable=W0212
+        except imaplib.IMAP4.error, err: # BAD: stay uncompressed
+            ret_code = str(err)
+
         if ret_code == 'OK':
             self._imap.activate_compression()
-        else:
-            #no errors for the moment
-            pass
+            return True
+
+        return False
+
+    def set_literal_spool(self, spool_dir, min_size=0):
+        """
+           Receive the literals of at least min_size bytes in files of spool_dir
+           (stream_utils.SpooledLiteral) instead of strings. None to stop spooling.
+        """
+        if hasattr(self._imap, 'activate_compression'): # IMAP4COMPSSL connection
+            self._imap.spool_dir      = spool_dir
+            self._imap.spool_min_size = min_size
+
+    def get_transfer_stats(self):
+        """
+           Return the bytes sent and received on the socket (wire_in, wire_out) and
+           before compression (data_in, data_out) or None if not available
+        """
+        stats = getattr(self._imap, 'stats', None)
+        return dict(stats) if stats is not None else None
 
         
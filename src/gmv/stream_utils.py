@@ -0,0 +1,355 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Streaming writers and readers used to store and read the email contents
+    with a bounded memory:
+    unicode normalisation -> gzip compression -> CTR encryption -> file
+    file -> CTR decryption -> gzip decompression
+
+'''
+import os
+import codecs
+import gzip
+import shutil
+import tempfile
+import zlib
+
+import gmv.log_utils as log_utils
+import gmv.gmvault_utils as gmvault_utils
+
+LOG = log_utils.LoggerFactory.get_logger('stream_utils')
+
+# size of the chunks going through the writers stack
+CHUNK_SIZE = 65536
+
+class CTRWriter(object):
+    """
+       File object encrypting with a CTR cipher what is written in the wrapped file object
+    """
+    def __init__(self, fileobj, cipher):
+        """
+           fileobj: wrapped file object
+           cipher : blowfish cipher already initialised with initCTR()
+        """
+        self._fileobj = fileobj
+        self._cipher  = cipher
+        self.name     = getattr(fileobj, 'name', '')
+
+    def write(self, data):
+        """ encrypt and write """
+        if data:
+            self._fileobj.write(self._cipher.encryptCTR(str(data)))
+
+    def flush(self):
+        """ flush wrapped file object """
+        self._fileobj.flush()
+
+    def close(self):
+        """ close wrapped file object """
+        self._fileobj.close()
+
+# the charset of an email is guessed from its beginning
+ENCODING_HEAD_SIZE = 20000
+
+class SpooledLiteral(object):
+    """
+       IMAP literal received in a file of a spool dir instead of in memory.
+       The imap response parser only needs its length and the storage reads it
+       chunk by chunk. The file is removed when the object is released.
+    """
+    def __init__(self, spool_dir):
+        fd, self.path = tempfile.mkstemp(suffix = '.literal', dir = spool_dir)
+        self._fileobj = os.fdopen(fd, 'wb')
+        self._size    = 0
+
+    def write(self, data):
+        """ append data while receiving the literal """
+        self._fileobj.write(data)
+        self._size += len(data)
+
+    def close(self):
+        """ the literal is received """
+        if self._fileobj:
+            self._fileobj.close()
+            self._fileobj = None
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return '<SpooledLiteral %s (%d bytes)>' % (self.path, self._size)
+
+    def head(self, size):
+        """ Return the first size bytes """
+        with open(self.path, 'rb') as f:
+            return f.read(size)
+
+    def open(self):
+        """ Return a file object reading the literal """
+        return open(self.path, 'rb')
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """ Iterate over the literal chunk by chunk """
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                yield chunk
+
+    def move(self, a_path):
+        """ Move the file of the literal to a_path (no copy in the same filesystem) """
+        self.close()
+        shutil.move(self.path, a_path)
+        self.path = None
+
+    def discard(self):
+        """ Remove the file of the literal """
+        self.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def __del__(self):
+        self.discard()
+
+def is_spooled(a_str):
+    """ True if a_str is a literal received in a spool file """
+    return isinstance(a_str, SpooledLiteral)
+
+def iter_chunks(a_str, chunk_size=CHUNK_SIZE):
+    """
+       Iterate over the byte string (or spooled literal) chunk by chunk
+    """
+    if is_spooled(a_str):
+        for chunk in a_str.iter_chunks(chunk_size):
+            yield chunk
+        return
+
+    for pos in xrange(0, len(a_str), chunk_size):
+        yield a_str[pos:pos + chunk_size]
+
+def iter_utf8_chunks(a_str, encoding, errors='strict', chunk_size=CHUNK_SIZE):
+    """
+       Iterate over the byte string chunk by chunk converting each chunk from
+       encoding to utf-8. Characters split between two chunks are handled by
+       an incremental decoder.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for chunk in iter_chunks(a_str, chunk_size):
+        u_chunk = decoder.decode(chunk)
+        if u_chunk:
+            yield u_chunk.encode('utf-8')
+
+    u_chunk = decoder.decode('', final = True)
+    if u_chunk:
+        yield u_chunk.encode('utf-8')
+
+def _write_chunks(fileobj, chunks, compress, cipher):
+    """
+       Write the chunks in fileobj through the compression and encryption writers
+    """
+    if cipher:
+        # need to be done for every encryption
+        cipher.initCTR()
+        fileobj = CTRWriter(fileobj, cipher)
+
+    if compress:
+        # the wrapped fileobj is not closed by GzipFile
+        gz_obj = gzip.GzipFile(filename = '', mode = 'wb', fileobj = fileobj)
+        try:
+            for chunk in chunks:
+                gz_obj.write(chunk)
+        finally:
+            gz_obj.close()
+    else:
+        for chunk in chunks:
+            fileobj.write(chunk)
+
+    fileobj.flush()
+
+def encode_data(fileobj, a_str, compress=False, cipher=None, to_utf8=False):
+    """
+       Write a_str (string or spooled literal) in the seekable fileobj chunk by chunk.
+       The data is first converted to utf-8 if to_utf8 is True then compressed
+       if compress is True then encrypted if a cipher is given.
+    """
+    if to_utf8:
+        start    = fileobj.tell()
+        encoding = None
+        try:
+            encoding = gmvault_utils.get_email_encoding(a_str.head(ENCODING_HEAD_SIZE) \
+                                                        if is_spooled(a_str) else a_str)
+            LOG.debug("Convert to %s" % (encoding))
+            _write_chunks(fileobj, iter_utf8_chunks(a_str, encoding), compress, cipher)
+        except (UnicodeError, LookupError, gmvault_utils.GuessEncoding), e:
+            LOG.debug("Exception: %s" % (e))
+            LOG.info("Warning: Guessed encoding = (%s). Ignore those characters" \
+                     % (encoding if encoding else "Not defined"))
+            #try utf-8 from the start
+            fileobj.seek(start)
+            fileobj.truncate()
+            _write_chunks(fileobj, iter_utf8_chunks(a_str, 'utf-8', 'replace'), compress, cipher)
+    else:
+        _write_chunks(fileobj, iter_chunks(a_str), compress, cipher)
+
+def write_data(a_path, a_str, compress=False, cipher=None, to_utf8=False):
+    """
+       Write a_str in a_path chunk by chunk (see encode_data).
+       It is written in a temporary file renamed as a_path once complete so
+       a_path never contains a partially written email.
+       A spooled literal stored as it is received is moved instead of copied.
+    """
+    tmp_path = '%s.tmp' % (a_path)
+    try:
+        if is_spooled(a_str) and not (compress or cipher or to_utf8):
+            a_str.move(tmp_path)
+        else:
+            with open(tmp_path, 'wb') as f:
+                encode_data(f, a_str, compress, cipher, to_utf8)
+
+        gmvault_utils.atomic_rename(tmp_path, a_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class SliceReader(object):
+    """
+       Read only file object over length bytes of the wrapped file starting at offset
+    """
+    def __init__(self, fileobj, offset, length):
+        self._fileobj = fileobj
+        self._left    = length
+        self.name     = getattr(fileobj, 'name', '')
+        self._fileobj.seek(offset)
+
+    def read(self, size=-1):
+        """ read at most size bytes of the slice """
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._fileobj.read(size)
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        """ close wrapped file object """
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class DataReader(object):
+    """
+       Read only file object decrypting and decompressing the wrapped file
+       chunk by chunk
+    """
+    def __init__(self, fileobj, cipher=None, compressed=False, chunk_size=CHUNK_SIZE):
+        """
+           fileobj   : wrapped file object
+           cipher    : blowfish cipher if the data is encrypted
+           compressed: True if the data is gzipped (before to be encrypted)
+        """
+        self._fileobj    = fileobj
+        self._cipher     = cipher
+        self._decomp     = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+        self._chunk_size = chunk_size
+        self._buffer     = ''
+        self._eof        = False
+        self.name        = getattr(fileobj, 'name', '')
+
+        if self._cipher:
+            # need to be done for every decryption
+            self._cipher.initCTR()
+
+    def _next_chunk(self):
+        """
+           Return the next decoded chunk ('' when nothing was decoded)
+        """
+        # limit the decompressed size to protect from highly compressed data
+        if self._decomp and self._decomp.unconsumed_tail:
+            return self._decomp.decompress(self._decomp.unconsumed_tail, self._chunk_size)
+
+        data = self._fileobj.read(self._chunk_size)
+        if not data:
+            self._eof = True
+            return self._decomp.flush() if self._decomp else ''
+
+        if self._cipher:
+            data = self._cipher.decryptCTR(data)
+
+        if self._decomp:
+            data = self._decomp.decompress(data, self._chunk_size)
+
+        return data
+
+    def read(self, size=-1):
+        """
+           Read at most size bytes (all if size is negative)
+        """
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            while not self._eof:
+                chunks.append(self._next_chunk())
+            self._buffer = ''
+            return ''.join(chunks)
+
+        while len(self._buffer) < size and not self._eof:
+            self._buffer += self._next_chunk()
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        """
+           Read a line (or at most size bytes)
+        """
+        pos = self._buffer.find('\n')
+        while pos < 0 and not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            start = len(self._buffer)
+            self._buffer += self._next_chunk()
+            pos = self._buffer.find('\n', start)
+
+        end = pos + 1 if pos >= 0 else len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        """ close wrapped file object """
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def copy(src, dst, chunk_size=CHUNK_SIZE):
+    """
+       Copy the src file object in dst chunk by chunk
+    """
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        dst.write(data)
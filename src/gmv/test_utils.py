@@ -19,11 +19,19 @@
 '''
 import base64
 import os
+import re
 import datetime
 import hashlib
+import socket
+import ssl
+import threading
+import time
+import types
+import zlib
 
 import gmv.gmvault as gmvault
 import gmv.imap_utils       as imap_utils
+import gmv.mod_imap         as mod_imap
 import gmv.credential_utils as cred_utils
 import gmv.gmvault_db as gmvault_db
 import gmv.gmvault_utils    as gmvault_utils
@@ -454,3 +462,607 @@ def delete_db_dir(a_db_dir):
        delete the db directory
     """
     gmvault_utils.delete_all_under(a_db_dir, delete_top_dir = True)
+
+class FakeSSL(object): #pylint:disable-msg=R0903
+    """ ssl object returning the data in chunks like a socket """
+    def __init__(self, data, chunk_size):
+        self.data, self.pos, self.chunk_size = data, 0, chunk_size
+
+    def recv_into(self, buf, nbytes):
+        """ receive at most nbytes in buf """
+        data = self.data[self.pos:self.pos + min(nbytes, self.chunk_size)]
+        self.pos += len(data)
+        buf[:len(data)] = data
+        return len(data)
+
+def create_fake_imap(data, chunk_size=16384, compress=False):
+    """
+       IMAP4COMPSSL receiving data (compressed on the wire if compress is True)
+    """
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    imap = types.InstanceType(mod_imap.IMAP4COMPSSL)
+    imap.compressor = imap.decompressor = None
+    imap._init_buffers() #pylint:disable-msg=W0212
+    if compress:
+        imap.activate_compression()
+    imap.sslobj = FakeSSL(data, chunk_size)
+    return imap
+
+class FakeGmailServer(object): #pylint:disable=R0902
+    """
+       Local IMAP server (plain TCP or SSL with certfile) behaving like Gmail for the offline tests:
+       All Mail, Chats and Drafts folders, X-GM-MSGID, X-GM-THRID and X-GM-LABELS.
+       With CONDSTORE, each message has a MODSEQ updated when its labels or flags change.
+       The sessions in IDLE receive an EXISTS when a message is added to their folder.
+       Every connection is handled by its own thread. The commands are read as they
+       come so the clients can pipeline them.
+       latency simulates the network round trip: it is waited each time the server
+       has to wait for the next command of a client (not when it is already received).
+    """
+    ALLMAIL = '[Gmail]/All Mail'
+    CHATS   = '[Gmail]/Chats'
+    DRAFTS  = '[Gmail]/Drafts'
+
+    CAPABILITIES = 'IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA ID XLIST CHILDREN X-GM-EXT-1 ' \
+                   'UIDPLUS COMPRESS=DEFLATE ENABLE MOVE CONDSTORE ESEARCH LITERAL-'
+
+    HEADER_FIELDS_RE = re.compile(r'BODY(\.PEEK)?\[HEADER\.FIELDS \((?P<fields>[^\)]*)\)\]', re.IGNORECASE)
+    LITERAL_RE       = re.compile(r'\{(?P<size>\d+)(?P<plus>\+?)\}$')
+
+    def __init__(self, capabilities=None, uidvalidity=1, latency=0, certfile=None, keyfile=None): #pylint:disable=R0913
+        self.capabilities = capabilities if capabilities is not None else self.CAPABILITIES
+        self.certfile     = certfile
+        self.keyfile      = keyfile
+        self.uidvalidity  = uidvalidity
+        self.latency      = latency
+        self.messages     = {} # uid => message dict
+        self.folders      = set([self.ALLMAIL, self.CHATS, self.DRAFTS, 'INBOX'])
+        self.next_uid     = 1
+        self.next_gm_id   = 1000000000000000001L
+        self.highest_modseq = 1
+
+        self.commands      = []  # received commands (name, args)
+        self.unavailable   = set() # uids whose body FETCH fails with a temporary error
+        self.rejected      = set() # bodies whose APPEND fails
+        self.max_pipelined = 0   # max nb of commands received before the previous ones were answered
+        self.nb_connections = 0
+        self.nb_open       = 0   # connections currently open
+        self.max_open      = 0   # max nb of connections open at the same time
+        self.idling        = []  # sessions in IDLE
+
+        self._lock   = threading.RLock()
+        self._sock   = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.host, self.port = self._sock.getsockname()
+        self._thread = None
+        self._stopped = False
+        self._conns   = []
+
+    def start(self):
+        """ accept the connections in a thread """
+        self._thread = threading.Thread(target = self._accept, name = 'fake-gmail-server')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ stop accepting connections and close the current ones """
+        self._stopped = True
+        with self._lock:
+            for conn in self._conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        try:
+            socket.create_connection((self.host, self.port), 1).close()
+        except socket.error:
+            pass
+        self._sock.close()
+
+    def _accept(self):
+        """ accept loop """
+        while not self._stopped:
+            conn, _ = self._sock.accept()
+            # without NODELAY the end of a response can wait for the delayed ack of the client (40 ms)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self._stopped:
+                conn.close()
+                break
+            if self.certfile:
+                conn = ssl.wrap_socket(conn, self.keyfile, self.certfile, server_side = True)
+            with self._lock:
+                self.nb_connections += 1
+                self.nb_open += 1
+                self.max_open = max(self.max_open, self.nb_open)
+                self._conns.append(conn)
+            handler = threading.Thread(target = _FakeGmailSession(self, conn).run, name = 'fake-gmail-session')
+            handler.daemon = True
+            handler.start()
+
+    def add_message(self, body, labels=(), flags=(), internal_date=None, thr_id=None, chat=False, broken=False): #pylint:disable=R0913
+        """
+           Store a message. Return its uid.
+           The FETCH of a broken message fails like on Gmail (NO Some messages could not be FETCHed).
+           The body FETCH of the uids in unavailable fails with a temporary server error.
+        """
+        with self._lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            gm_id = self.next_gm_id
+            self.next_gm_id += 1
+            self.highest_modseq += 1
+            self.messages[uid] = { 'uid'     : uid,
+                                   'gm_id'   : gm_id,
+                                   'thr_id'  : thr_id or gm_id,
+                                   'labels'  : list(labels),
+                                   'flags'   : list(flags),
+                                   'date'    : internal_date or datetime.datetime(2012, 1, 1, 10, 0, 0),
+                                   'body'    : body,
+                                   'chat'    : chat,
+                                   'broken'  : broken,
+                                   'modseq'  : self.highest_modseq }
+
+            folder = self.CHATS if chat else self.ALLMAIL
+            for session in self.idling:
+                if session.folder == folder:
+                    session.notify('* %d EXISTS\r\n' % (len(self.folder_uids(folder))))
+            return uid
+
+    def change_message(self, uid, labels=None, flags=None):
+        """
+           Replace the labels and/or flags of a message and update its MODSEQ
+        """
+        with self._lock:
+            msg = self.messages[uid]
+            if labels is not None:
+                msg['labels'] = list(labels)
+            if flags is not None:
+                msg['flags'] = list(flags)
+            self.highest_modseq += 1
+            msg['modseq'] = self.highest_modseq
+
+    def folder_uids(self, folder):
+        """ sorted uids of the messages in folder """
+        with self._lock:
+            if folder == self.ALLMAIL:
+                uids = [uid for uid, msg in self.messages.iteritems() if not msg['chat']]
+            elif folder == self.CHATS:
+                uids = [uid for uid, msg in self.messages.iteritems() if msg['chat']]
+            elif folder == self.DRAFTS:
+                uids = [uid for uid, msg in self.messages.iteritems() if '\\Draft' in msg['flags']]
+            else:
+                uids = [uid for uid, msg in self.messages.iteritems() if folder in msg['labels']]
+            return sorted(uids)
+
+class _FakeGmailSession(object): #pylint:disable=R0902
+    """
+       One client connection of the FakeGmailServer
+    """
+    def __init__(self, server, conn):
+        self.server       = server
+        self.conn         = conn
+        self.folder       = None
+        self.readonly     = False
+        self.compressor   = None
+        self.decompressor = None
+        self._buf         = ''
+
+    # IO
+
+    def _recv(self):
+        """ receive data (decompressed) """
+        data = self.conn.recv(65536)
+        if not data:
+            raise EOFError()
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self._buf += data
+
+    def _readline(self):
+        """ read a line without CRLF """
+        while '\r\n' not in self._buf:
+            self._recv()
+        line, self._buf = self._buf.split('\r\n', 1)
+        return line
+
+    def _read(self, size):
+        """ read size bytes """
+        while len(self._buf) < size:
+            self._recv()
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def _send(self, data):
+        """ send data (compressed) """
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.conn.sendall(data)
+
+    # parsing
+
+    def _read_command(self):
+        """
+           Read a command. Return (tag, name, args) where args is a list of
+           atoms, strings (literals included) and lists
+        """
+        round_trip = '\r\n' not in self._buf
+        line  = self._readline()
+        if round_trip and self.server.latency:
+            time.sleep(self.server.latency)
+        items = []
+        match = self.server.LITERAL_RE.search(line)
+        while match:
+            items.extend(self._tokenize(line[:match.start()]))
+            if not match.group('plus'):
+                self._send('+ go ahead\r\n')
+            items.append(('LITERAL', self._read(int(match.group('size')))))
+            line  = self._readline()
+            match = self.server.LITERAL_RE.search(line)
+        items.extend(self._tokenize(line))
+
+        # count the commands already received behind this one
+        with self.server._lock: #pylint:disable=W0212
+            self.server.max_pipelined = max(self.server.max_pipelined, self._buf.count('\r\n') + 1)
+
+        args = self._nest(items)
+        tag, name = args[0], args[1].upper()
+        args = args[2:]
+        if name == 'UID':
+            name, args = 'UID %s' % (args[0].upper()), args[1:]
+        return tag, name, args
+
+    @classmethod
+    def _tokenize(cls, text):
+        """ split text in atoms, quoted strings and parenthesis """
+        tokens, pos = [], 0
+        while pos < len(text):
+            char = text[pos]
+            if char == ' ':
+                pos += 1
+            elif char in '()':
+                tokens.append(char)
+                pos += 1
+            elif char == '"':
+                end, value = pos + 1, []
+                while text[end] != '"':
+                    if text[end] == '\\':
+                        end += 1
+                    value.append(text[end])
+                    end += 1
+                tokens.append(('STRING', ''.join(value)))
+                pos = end + 1
+            else:
+                end, depth = pos, 0
+                while end < len(text) and (depth or text[end] not in ' ()'):
+                    if text[end] == '[':
+                        depth += 1
+                    elif text[end] == ']':
+                        depth -= 1
+                    end += 1
+                tokens.append(text[pos:end])
+                pos = end
+        return tokens
+
+    @classmethod
+    def _nest(cls, tokens):
+        """ parenthesis => lists, strings and literals => str """
+        stack = [[]]
+        for token in tokens:
+            if token == '(':
+                stack.append([])
+            elif token == ')':
+                lst = stack.pop()
+                stack[-1].append(lst)
+            elif isinstance(token, tuple):
+                stack[-1].append(token[1])
+            else:
+                stack[-1].append(token)
+        return stack[0]
+
+    @classmethod
+    def _quote(cls, value):
+        """ IMAP quoted string """
+        return '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"'))
+
+    @classmethod
+    def _parse_set(cls, a_set, max_value):
+        """ '1,3:5,7:*' => set of ints """
+        values = set()
+        for part in str(a_set).split(','):
+            if ':' in part:
+                start, end = part.split(':')
+                start = max_value if start == '*' else int(start)
+                end   = max_value if end == '*' else int(end)
+                values.update(xrange(min(start, end), max(start, end) + 1))
+            else:
+                values.add(max_value if part == '*' else int(part))
+        return values
+
+    # commands
+
+    def run(self):
+        """ serve the client """
+        try:
+            self._send('* OK Gimap ready for requests from 127.0.0.1\r\n')
+            while True:
+                tag, name, args = self._read_command()
+                with self.server._lock: #pylint:disable=W0212
+                    self.server.commands.append((name, args))
+                handler = getattr(self, '_cmd_%s' % (name.replace(' ', '_').lower()), None)
+                if handler is None:
+                    self._send('%s BAD Unknown command %s\r\n' % (tag, name))
+                elif handler(tag, args) is False:
+                    break
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.conn.close()
+            with self.server._lock: #pylint:disable=W0212
+                self.server.nb_open -= 1
+
+    def _cmd_capability(self, tag, _):
+        """ CAPABILITY """
+        self._send('* CAPABILITY %s\r\n%s OK Thats all she wrote!\r\n' % (self.server.capabilities, tag))
+
+    def _cmd_login(self, tag, _):
+        """ LOGIN user password """
+        self._send('* CAPABILITY %s\r\n%s OK user authenticated (Success)\r\n' % (self.server.capabilities, tag))
+
+    def _cmd_authenticate(self, tag, args):
+        """ AUTHENTICATE XOAUTH2 """
+        if len(args) < 2:
+            self._send('+ \r\n')
+            self._readline()
+        self._send('%s OK user authenticated (Success)\r\n' % (tag))
+
+    def _cmd_id(self, tag, _):
+        """ ID """
+        self._send('* ID ("name" "GImap")\r\n%s OK Success\r\n' % (tag))
+
+    def _cmd_noop(self, tag, _):
+        """ NOOP """
+        self._send('%s OK Success\r\n' % (tag))
+
+    def _cmd_idle(self, tag, _):
+        """ IDLE until DONE """
+        with self.server._lock: #pylint:disable=W0212
+            self._send('+ idling\r\n')
+            self.server.idling.append(self)
+        try:
+            while self._readline().upper() != 'DONE':
+                pass
+        finally:
+            with self.server._lock: #pylint:disable=W0212
+                self.server.idling.remove(self)
+        self._send('%s OK IDLE terminated (Success)\r\n' % (tag))
+
+    def notify(self, data):
+        """ send an untagged response while in IDLE """
+        self._send(data)
+
+    def _cmd_logout(self, tag, _):
+        """ LOGOUT """
+        self._send('* BYE LOGOUT Requested\r\n%s OK 73 good day (Success)\r\n' % (tag))
+        return False
+
+    def _cmd_compress(self, tag, _):
+        """ COMPRESS DEFLATE """
+        if 'COMPRESS=DEFLATE' not in self.server.capabilities:
+            self._send('%s BAD Unknown command\r\n' % (tag))
+            return
+        self._send('%s OK Success\r\n' % (tag))
+        self.compressor   = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self._buf = self.decompressor.decompress(self._buf)
+
+    def _folder_line(self, cmd, folder):
+        """ LIST/XLIST response of folder """
+        flags = ['\\HasNoChildren']
+        if folder == self.server.ALLMAIL:
+            flags.append('\\AllMail')
+        elif folder == self.server.DRAFTS:
+            flags.append('\\Drafts')
+        elif folder == 'INBOX' and cmd == 'XLIST':
+            flags.append('\\Inbox')
+        return '* %s (%s) "/" %s\r\n' % (cmd, ' '.join(flags), self._quote(folder))
+
+    def _cmd_list(self, tag, args, cmd='LIST'):
+        """ LIST reference pattern """
+        pattern = args[1] if len(args) > 1 else '*'
+        with self.server._lock: #pylint:disable=W0212
+            folders = sorted(self.server.folders)
+        lines = [self._folder_line(cmd, folder) for folder in folders if pattern in ('*', '%', folder)]
+        self._send('%s%s OK Success\r\n' % (''.join(lines), tag))
+
+    def _cmd_xlist(self, tag, args):
+        """ XLIST reference pattern """
+        self._cmd_list(tag, args, 'XLIST')
+
+    def _cmd_create(self, tag, args):
+        """ CREATE folder """
+        with self.server._lock: #pylint:disable=W0212
+            if args[0] in self.server.folders:
+                self._send('%s NO [ALREADYEXISTS] Duplicate folder name %s (Failure)\r\n' % (tag, args[0]))
+                return
+            self.server.folders.add(args[0])
+        self._send('%s OK Success\r\n' % (tag))
+
+    def _cmd_delete(self, tag, args):
+        """ DELETE folder """
+        with self.server._lock: #pylint:disable=W0212
+            self.server.folders.discard(args[0])
+        self._send('%s OK Success\r\n' % (tag))
+
+    def _cmd_select(self, tag, args, readonly=False):
+        """ SELECT folder """
+        folder = args[0]
+        if folder not in self.server.folders:
+            self._send('%s NO [NONEXISTENT] Unknown Mailbox: %s (Failure)\r\n' % (tag, folder))
+            return
+        self.folder, self.readonly = folder, readonly
+        uids = self.server.folder_uids(folder)
+        modseq = '* OK [HIGHESTMODSEQ %d]\r\n' % (self.server.highest_modseq) \
+                 if 'CONDSTORE' in self.server.capabilities else ''
+        self._send('* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n'
+                   '* OK [UIDVALIDITY %d] UIDs valid.\r\n'
+                   '* %d EXISTS\r\n'
+                   '* 0 RECENT\r\n'
+                   '* OK [UIDNEXT %d] Predicted next UID.\r\n'
+                   '%s'
+                   '%s OK [%s] %s selected. (Success)\r\n' \
+                   % (self.server.uidvalidity, len(uids), self.server.next_uid, modseq, tag, \
+                      'READ-ONLY' if readonly else 'READ-WRITE', folder))
+
+    def _cmd_examine(self, tag, args):
+        """ EXAMINE folder """
+        self._cmd_select(tag, args, readonly = True)
+
+    def _cmd_uid_search(self, tag, args):
+        """ UID SEARCH [CHARSET x] criteria (UID set, SINCE and BEFORE dates. The others match all) """
+        uids = self.server.folder_uids(self.folder)
+        if args and str(args[0]).upper() == 'CHARSET':
+            args = args[2:]
+        tokens = []
+        for arg in args: # (criteria) => criteria
+            tokens.extend(arg if isinstance(arg, list) else [arg])
+        pos = 0
+        while pos < len(tokens):
+            key = str(tokens[pos]).upper()
+            if key == 'UID' and pos + 1 < len(tokens):
+                wanted = self._parse_set(tokens[pos + 1], uids[-1] if uids else 0)
+                uids   = [uid for uid in uids if uid in wanted]
+                pos   += 1
+            elif key in ('SINCE', 'BEFORE') and pos + 1 < len(tokens):
+                day  = datetime.datetime.strptime(str(tokens[pos + 1]), '%d-%b-%Y').date()
+                uids = [uid for uid in uids if (self.server.messages[uid]['date'].date() >= day) == (key == 'SINCE')]
+                pos += 1
+            pos += 1
+        self._send('* SEARCH %s\r\n%s OK SEARCH completed (Success)\r\n' % (' '.join(map(str, uids)), tag))
+
+    def _fetch_item(self, item, msg):
+        """ value of a FETCH item """
+        upper = item.upper()
+        if upper == 'UID':
+            return None
+        elif upper == 'X-GM-MSGID':
+            return 'X-GM-MSGID %d' % (msg['gm_id'])
+        elif upper == 'X-GM-THRID':
+            return 'X-GM-THRID %d' % (msg['thr_id'])
+        elif upper == 'X-GM-LABELS':
+            return 'X-GM-LABELS (%s)' % (' '.join([self._quote(lab) for lab in msg['labels']]))
+        elif upper == 'FLAGS':
+            return 'FLAGS (%s)' % (' '.join(msg['flags']))
+        elif upper == 'INTERNALDATE':
+            return 'INTERNALDATE "%s"' % (msg['date'].strftime('%d-%b-%Y %H:%M:%S +0000'))
+        elif upper == 'RFC822.SIZE':
+            return 'RFC822.SIZE %d' % (len(msg['body']))
+        elif upper == 'MODSEQ':
+            return 'MODSEQ (%d)' % (msg['modseq'])
+        elif upper in ('BODY[]', 'BODY.PEEK[]', 'RFC822'):
+            return 'BODY[] {%d}\r\n%s' % (len(msg['body']), msg['body'])
+
+        match = self.server.HEADER_FIELDS_RE.match(item)
+        if match:
+            fields  = match.group('fields').upper().split()
+            headers = msg['body'].split('\r\n\r\n', 1)[0].split('\r\n')
+            value   = ''.join(['%s\r\n' % (hdr) for hdr in headers \
+                               if hdr.split(':', 1)[0].upper() in fields]) + '\r\n'
+            return 'BODY[HEADER.FIELDS (%s)] {%d}\r\n%s' % (match.group('fields').upper(), len(value), value)
+        raise ValueError('Unknown FETCH item %s' % (item))
+
+    def _cmd_uid_fetch(self, tag, args):
+        """ UID FETCH set (items) [(CHANGEDSINCE modseq)] """
+        uids   = self.server.folder_uids(self.folder)
+        wanted = self._parse_set(args[0], uids[-1] if uids else 0)
+        items  = args[1] if isinstance(args[1], list) else [args[1]]
+        changed_since = None
+        if len(args) > 2 and str(args[2][0]).upper() == 'CHANGEDSINCE':
+            changed_since = int(args[2][1])
+            items = items + ['MODSEQ']
+        body  = any(str(item).upper().endswith('[]') for item in items)
+        try:
+            lines, broken = [], False
+            for seq, uid in enumerate(uids, 1):
+                if uid not in wanted:
+                    continue
+                if body and uid in self.server.unavailable:
+                    self._send('%s NO [UNAVAILABLE] Temporary System Problem (Failure)\r\n' % (tag))
+                    return
+                with self.server._lock: #pylint:disable=W0212
+                    msg = dict(self.server.messages[uid])
+                if changed_since is not None and msg['modseq'] <= changed_since:
+                    continue
+                if msg['broken']:
+                    broken = True
+                    continue
+                values = [value for value in [self._fetch_item(item, msg) for item in items] if value]
+                lines.append('* %d FETCH (UID %d %s)\r\n' % (seq, uid, ' '.join(values)))
+        except ValueError, err:
+            self._send('%s BAD %s\r\n' % (tag, err))
+            return
+        if broken:
+            self._send('%s%s NO Some messages could not be FETCHed (Failure)\r\n' % (''.join(lines), tag))
+        else:
+            self._send('%s%s OK Success\r\n' % (''.join(lines), tag))
+
+    def _cmd_uid_store(self, tag, args):
+        """ UID STORE set [+-]X-GM-LABELS|FLAGS[.SILENT] (values) """
+        uids   = self.server.folder_uids(self.folder)
+        wanted = self._parse_set(args[0], uids[-1] if uids else 0)
+        cmd    = args[1].upper()
+        values = args[2] if isinstance(args[2], list) else [args[2]]
+        silent = cmd.endswith('.SILENT')
+        key    = 'labels' if 'X-GM-LABELS' in cmd else 'flags'
+        lines  = []
+        with self.server._lock: #pylint:disable=W0212
+            for seq, uid in enumerate(uids, 1):
+                if uid not in wanted:
+                    continue
+                msg = self.server.messages[uid]
+                if cmd.startswith('+'):
+                    new_values = msg[key] + [val for val in values if val not in msg[key]]
+                elif cmd.startswith('-'):
+                    new_values = [val for val in msg[key] if val not in values]
+                else:
+                    new_values = list(values)
+                self.server.change_message(uid, **{key : new_values})
+                if not silent:
+                    lines.append('* %d FETCH (UID %d %s)\r\n' \
+                                 % (seq, uid, self._fetch_item('X-GM-LABELS' if key == 'labels' else 'FLAGS', msg)))
+        self._send('%s%s OK Success\r\n' % (''.join(lines), tag))
+
+    def _cmd_append(self, tag, args):
+        """ APPEND folder [(flags)] ["date"] literal """
+        folder, body = args[0], args[-1]
+        flags = args[1] if len(args) > 2 and isinstance(args[1], list) else []
+        date  = None
+        if len(args) > 2 and not isinstance(args[-2], list):
+            date = datetime.datetime.strptime(args[-2][:20], '%d-%b-%Y %H:%M:%S')
+        if folder not in self.server.folders:
+            self._send('%s NO [TRYCREATE] Folder doesn\'t exist. (Failure)\r\n' % (tag))
+            return
+        if body in self.server.rejected:
+            self._send('%s NO [UNAVAILABLE] Temporary System Problem (Failure)\r\n' % (tag))
+            return
+        labels = [folder] if folder not in (self.server.ALLMAIL, self.server.DRAFTS, 'INBOX') else []
+        if folder == 'INBOX':
+            labels = ['\\Inbox']
+        uid = self.server.add_message(body, labels, flags, date)
+        self._send('%s OK [APPENDUID %d %d] (Success)\r\n' % (tag, self.server.uidvalidity, uid))
+
+    def _cmd_expunge(self, tag, _):
+        """ EXPUNGE: remove the \\Deleted messages of the folder """
+        uids  = self.server.folder_uids(self.folder)
+        lines = []
+        with self.server._lock: #pylint:disable=W0212
+            for seq in xrange(len(uids), 0, -1):
+                if '\\Deleted' in self.server.messages[uids[seq - 1]]['flags']:
+                    del self.server.messages[uids[seq - 1]]
+                    lines.append('* %d EXPUNGE\r\n' % (seq))
+        self._send('%s%s OK Success\r\n' % (''.join(lines), tag))
@@ -628,6 +628,96 @@ class TestGMVCMD(unittest.TestCase): #pylint:disable-msg=R0904
         #clean db dir
         delete_db_dir('/tmp/new-db-1')
                
+    def _parse_error(self, argv):
+        """
+           Check that parsing argv fails with a usage error
+        """
+        sys.argv = argv
+        try:
+            gmv_cmd.GMVaultLauncher().parse_args()
+        except SystemExit, err:
+            self.assertEquals(err.code, 2)
+        else:
+            self.fail('SystemExit exception expected for %s' % (argv))
+
+    def test_connections_args(self):
+        """
+           Test the --connections option of sync and restore
+        """
+        sys.argv = ['gmvault.py', 'sync', '--db-dir', '/tmp/new-db-1', self.login]
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['connections'], 1)
+
+        sys.argv = ['gmvault.py', 'sync', '--connections', '3', '--db-dir', '/tmp/new-db-1', self.login]
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['command'], 'sync')
+        self.assertEquals(args['connections'], 3)
+
+        sys.argv = ['gmvault.py', 'restore', '--connections', '4', '--db-dir', '/tmp/new-db-1', self.login]
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['command'], 'restore')
+        self.assertEquals(args['connections'], 4)
+
+        self._parse_error(['gmvault.py', 'sync', '--connections', '0', self.login])
+        self._parse_error(['gmvault.py', 'sync', '--connections', \
+                           str(gmvault.GMVaulter.MAX_SYNC_CONNECTIONS + 1), self.login])
+        self._parse_error(['gmvault.py', 'restore', '--connections', \
+                           str(gmvault.GMVaulter.MAX_RESTORE_CONNECTIONS + 1), self.login])
+
+    def test_daemon_args(self):
+        """
+           Test the daemon command args
+        """
+        sys.argv = ['gmvault.py', 'daemon', '--emails-only', '--no-compression', \
+                    '--db-dir', '/tmp/new-db-1', self.login]
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+
+        self.assertEquals(args['command'], 'daemon')
+        self.assertEquals(args['email'], self.login)
+        self.assertEquals(args['type'], 'full')
+        self.assertEquals(args['db-dir'], '/tmp/new-db-1')
+        self.assertEquals(args['emails_only'], True)
+        self.assertEquals(args['chats_only'], False)
+        self.assertEquals(args['compression'], False)
+        self.assertEquals(args['ownership_control'], True)
+        self.assertEquals(args['host'], 'imap.gmail.com')
+        self.assertEquals(args['port'], 993)
+
+        self._parse_error(['gmvault.py', 'daemon', '--emails-only', '--chats-only', self.login])
+
+    def test_migrate_args(self):
+        """
+           Test the migrate command args
+        """
+        # segments by default
+        sys.argv = ['gmvault.py', 'migrate', '-d', '/tmp/new-db-1']
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['command'], 'migrate')
+        self.assertEquals(args['db-dir'], '/tmp/new-db-1')
+        self.assertEquals(args['backend'], 'segments')
+        self.assertEquals(args['metadata'], None)
+        self.assertEquals(args['utf8'], False)
+
+        sys.argv = ['gmvault.py', 'migrate', '-b', 'files', '-m', 'SQLite', '-d', '/tmp/new-db-1']
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['backend'], 'files')
+        self.assertEquals(args['metadata'], 'sqlite')
+
+        sys.argv = ['gmvault.py', 'migrate', '--utf8', '-d', '/tmp/new-db-1']
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['backend'], None)
+        self.assertEquals(args['utf8'], True)
+        self.assertEquals(args['raw'], False)
+
+        sys.argv = ['gmvault.py', 'migrate', '--raw', '-d', '/tmp/new-db-1']
+        args = gmv_cmd.GMVaultLauncher().parse_args()
+        self.assertEquals(args['backend'], None)
+        self.assertEquals(args['raw'], True)
+
+        self._parse_error(['gmvault.py', 'migrate', '-b', 'tapes'])
+        self._parse_error(['gmvault.py', 'migrate', '-m', 'xml'])
+        self._parse_error(['gmvault.py', 'migrate', '--utf8', '--raw'])
+
 
 def tests():
     """
@@ -0,0 +1,1206 @@
+'''
+    Gmvault: a tool to backup and restore your gmail account.
+    Copyright (C) <since 2011>  <guillaume Aubert (guillaume dot aubert at gmail do com)>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+import datetime
+import os
+import time
+import gzip
+import json
+import threading
+import StringIO
+import glob
+import mailbox
+import email.generator
+import gmv.gmvault_utils as gmvault_utils
+import gmv.collections_utils as collections_utils
+import gmv.gmvault_db as gmvault_db
+import gmv.gmvault as gmvault
+import gmv.gmvault_snapshot as gmvault_snapshot
+import gmv.gmvault_export as gmvault_export
+import gmv.blowfish as blowfish
+import gmv.stream_utils as stream_utils
+import gmv.imap_utils as imap_utils
+import gmv.test_utils as test_utils
+
+
+class TestGMVaultOffline(unittest.TestCase): #pylint:disable-msg=R0904
+    """
+       Tests of the sync, restore and storage against the fake Gmail server
+       (no Gmail account needed)
+    """
+
+    def __init__(self, stuff):
+        """ constructor """
+        super(TestGMVaultOffline, self).__init__(stuff)
+    
+    def setUp(self): #pylint:disable-msg=C0103
+        pass
+    
+    @classmethod
+    def _create_vaulter(cls, root_dir, server):
+        """
+           GMVaulter of the db root_dir connected to the fake gmail server (without ssl)
+        """
+        credential = {'type': 'passwd', 'value': 'x'}
+        src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', credential)
+        src.ssl = False
+        return gmvault.GMVaulter(root_dir, server.host, server.port, 'gmvault', credential, src = src)
+
+    def test_segments_storage(self):
+        """
+           Round trip of a files db to the segments backend and back: same
+           emails and metadata
+        """
+        root_dir = '/tmp/gmvault-db-segments-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        gstorer = gmvault_db.create_storer(root_dir)
+        for gm_id in xrange(1, 201):
+            gstorer.bury_email({'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ['label'],
+                                'FLAGS': (), 'INTERNALDATE': datetime.datetime(2012, gm_id % 12 + 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                                'BODY[]': 'Subject: hello %d\r\n\r\nbody\r\n' % (gm_id)},
+                               '2012-%02d' % (gm_id % 12 + 1), compress = (gm_id % 2 == 0))
+
+        def read_all(storer):
+            """ read all emails """
+            return dict((gm_id, (storer.unbury_email(gm_id)[1], storer.unbury_metadata(gm_id))) \
+                        for gm_id in storer.get_all_existing_gmail_ids())
+
+        files_content = read_all(gstorer)
+        self.assertEquals(len(files_content), 200)
+
+        gmvault_db.migrate_storage(root_dir, 'segments')
+        gstorer = gmvault_db.create_storer(root_dir)
+        self.assertTrue(isinstance(gstorer, gmvault_db.GmailSegmentStorer))
+        self.assertEquals(read_all(gstorer), files_content)
+
+        gmvault_db.migrate_storage(root_dir, 'files')
+        self.assertEquals(read_all(gmvault_db.create_storer(root_dir)), files_content)
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_metadata_diff(self):
+        """
+           Changed and new emails of a sync batch found with the .meta files
+           and with the SQLite metadata store
+        """
+        root_dir = '/tmp/gmvault-db-metadata-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        gstorer = gmvault_db.create_storer(root_dir)
+        remote  = {}
+        for gm_id in xrange(1, 301):
+            email_info = {'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ['label', 'other'],
+                          'FLAGS': ('\\Seen',), 'INTERNALDATE': datetime.datetime(2012, gm_id % 12 + 1, 1),
+                          'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                          'BODY[]': 'Subject: hello\r\n\r\nbody\r\n'}
+            gstorer.bury_email(email_info, '2012-%02d' % (gm_id % 12 + 1))
+            remote[gm_id] = dict(email_info)
+
+        # some relabeled, flagged and new emails
+        for gm_id in xrange(1, 301, 50):
+            remote[gm_id]['X-GM-LABELS'] = ['label']
+        remote[7]['FLAGS'] = ()
+        for gm_id in xrange(1001, 1011):
+            remote[gm_id] = dict(remote[2], **{'X-GM-MSGID': gm_id})
+
+        server  = test_utils.FakeGmailServer().start()
+        vaulter = self._create_vaulter(root_dir, server)
+        batch   = [(gm_id, gm_id, None, '2012-%02d' % (gm_id % 12 + 1)) for gm_id in remote]
+        expected = (set(xrange(1001, 1011)), set(xrange(1, 301, 50)) | set([7]))
+
+        vaulter.gstorer = gstorer
+        self.assertEquals(vaulter._get_metadata_changes(batch, remote), expected) #pylint:disable-msg=W0212
+
+        gmvault_db.migrate_metadata(root_dir, 'sqlite')
+        vaulter.gstorer = gmvault_db.create_storer(root_dir)
+        self.assertEquals(vaulter._get_metadata_changes(batch, remote), expected) #pylint:disable-msg=W0212
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_imap_transport(self):
+        """
+           Read FETCH responses with the buffered IMAP transport, with and without
+           compression and in chunks of a few bytes: same data and wire stats
+        """
+        response = ''.join(['* %d FETCH (UID %d BODY[] {%d}\r\n%s)\r\n' \
+                            % (nb, nb, 25 * 40, ('%06d line of the email\r\n' % (nb)) * 40) for nb in xrange(20)])
+        response += 'A001 OK Success\r\n'
+
+        for compress in (False, True):
+            for chunk_size in (16384, 7):
+                imap = test_utils.create_fake_imap(response, chunk_size, compress)
+                raw  = imap.sslobj.data
+
+                read = []
+                while True:
+                    line = imap.readline()
+                    read.append(line)
+                    if line.endswith('}\r\n'):
+                        read.append(imap.read(int(line[line.rfind('{') + 1:-3])))
+                    elif line.startswith('A001'):
+                        break
+
+                self.assertEquals(''.join(read), response)
+                self.assertRaises(imap.abort, imap.readline) # EOF
+                self.assertEquals((imap.stats['wire_in'], imap.stats['data_in']), (len(raw), len(response)))
+
+    def test_spooled_body_literal(self):
+        """
+           A body literal bigger than the spool threshold is received in a spool file
+           of the db, then moved or streamed in place when the email is stored
+        """
+        root_dir = '/tmp/gmvault-db-spool-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+        gstorer   = gmvault_db.create_storer(root_dir)
+        spool_dir = gstorer.get_spool_dir()
+
+        body = 'Subject: big\r\n\r\n' + 'a line of a big email with an attachment 0123456789\r\n' * 2000
+        data = 'A001 OK Success\r\n'
+
+        for compress in (False, True):
+            imap = test_utils.create_fake_imap('%s)\r\n%s' % (body, data), compress = compress)
+            imap.spool_dir, imap.spool_min_size = spool_dir, 4096
+
+            literal = imap.read(len(body))
+            self.assertEquals(imap.readline(), ')\r\n')
+            self.assertEquals(imap.readline(), data)
+
+            self.assertEquals(len(literal), len(body))
+            self.assertEquals(len(os.listdir(spool_dir)), 1)
+
+            gstorer.bury_email({'X-GM-MSGID': 1, 'X-GM-THRID': 1, 'X-GM-LABELS': [], 'FLAGS': (),
+                                'INTERNALDATE': datetime.datetime(2012, 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: big',
+                                'BODY[]': literal}, '2012-01', compress = compress)
+            del literal
+            self.assertEquals(os.listdir(spool_dir), [])
+            self.assertEquals(gstorer.unbury_data(1), body)
+
+        # a small literal stays in memory
+        imap = test_utils.create_fake_imap('%s)\r\n%s' % (body[:100], data))
+        imap.spool_dir, imap.spool_min_size = spool_dir, 4096
+        self.assertEquals(imap.read(100), body[:100])
+        self.assertEquals(os.listdir(spool_dir), [])
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_pipelined_imap_engine(self):
+        """
+           Fetch the metadata and bodies of the fake Gmail server with the imapclient
+           and pipelined engines: same results, several commands in flight
+        """
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(100):
+            server.add_message('Message-ID: <%d@gmvault>\r\nSubject: email %d\r\n\r\n%s\r\n' \
+                               % (num, num, 'body line\r\n' * (num % 50)), \
+                               labels = ['label%d' % (num % 4), '\\Inbox'], flags = ['\\Seen'])
+
+        def sync(engine):
+            """ fetch everything like the sync does """
+            src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', {'type': 'passwd', 'value': 'x'})
+            src.ssl, src.imap_engine = False, engine
+            src.connect()
+            src.select_folder('ALLMAIL')
+
+            imap_ids = src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+            fetcher  = gmvault.IMAPBatchFetcher(src, imap_ids, {}, imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA, 20)
+            downloader_class = gmvault.PipelinedBodyDownloader if src.is_pipelined() else gmvault.IMAPBodyDownloader
+            downloader = downloader_class(src, batch_size = 5)
+            downloader.start()
+
+            emails = {}
+            def store(max_outstanding):
+                """ get the downloaded bodies """
+                for _, metadata, data, error in downloader.downloaded(max_outstanding):
+                    self.assertEquals(error, None)
+                    metadata['BODY[]'] = data['BODY[]']
+                    emails[metadata['X-GM-MSGID']] = metadata
+
+            for new_data in fetcher:
+                for the_id, metadata in new_data.iteritems():
+                    del metadata['SEQ']
+                    downloader.submit(the_id, metadata['RFC822.SIZE'], metadata)
+                store(20)
+            store(0)
+
+            downloader.stop()
+            src.disconnect()
+            return emails
+
+        blocking  = sync('imapclient')
+        server.max_pipelined = 0
+        pipelined = sync('pipelined')
+        server.stop()
+
+        self.assertEquals(len(blocking), 100)
+        self.assertEquals(pipelined, blocking)
+        self.assertTrue(server.max_pipelined > 1)
+
+    def test_fast_reconnect(self):
+        """
+           The reconnections use the cached capabilities and folders and the
+           standby connection. The folders are found again when the capabilities change
+        """
+        server = test_utils.FakeGmailServer().start()
+        server.add_message('Subject: hello\r\n\r\nbody\r\n')
+
+        def reconnect(src):
+            """ reconnect to the current folder. Return the names of the commands sent """
+            time.sleep(0.1) # let the standby connection open
+            del server.commands[:]
+            src.disconnect(keep_standby = True)
+            src.connect(go_to_current_folder = True)
+            return [name for name, _ in server.commands]
+
+        for use_standby in (False, True):
+            src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', {'type': 'passwd', 'value': 'x'}, \
+                                          use_standby = use_standby)
+            src.ssl = False
+            src.connect()
+            src.select_folder('ALLMAIL')
+
+            # first connection: everything is asked
+            src._folders_found = src._capabilities = src._greeting_capabilities = None #pylint:disable-msg=W0212
+            self.assertTrue('XLIST' in reconnect(src))
+
+            names = reconnect(src)
+            self.assertFalse('XLIST' in names)
+            self.assertEquals('NOOP' in names, use_standby) # check of the standby connection
+            self.assertEquals(src.search(imap_utils.GIMAPFetcher.IMAP_ALL), [1])
+
+            # the server capabilities changed: the folders are found again
+            server.capabilities += ' NEWCAPABILITY'
+            self.assertTrue('XLIST' in reconnect(src))
+            server.capabilities = test_utils.FakeGmailServer.CAPABILITIES
+
+            src.disconnect()
+
+        server.stop()
+
+    def test_id_set(self):
+        """
+           IdSet of uids with gaps and of sparse gmail ids: same results as a set
+           and a sorted list
+        """
+        import random
+        random.seed(42)
+        uids = [uid for uid in xrange(1, 20001) if uid % 5000 != 0]
+        gm_ids = sorted(random.sample(xrange(1400000000000000000, 1500000000000000000, 1000), 2000))
+
+        for ids in (uids, gm_ids):
+            the_set = set(ids)
+            id_set  = collections_utils.IdSet(ids)
+            self.assertEquals(len(id_set), len(the_set))
+            self.assertEquals(list(id_set), ids)
+
+            # difference with the ids found on the server, all but one per 100
+            found = collections_utils.IdSet(ids[i] for i in xrange(len(ids)) if i % 100 != 1)
+            self.assertEquals(list(id_set - found), sorted(the_set - set(found)))
+
+            for the_id in ids[::97] + [ids[0] - 1, ids[-1] + 1, 5000, 1400000000000000001]:
+                self.assertEquals(the_id in id_set, the_id in the_set)
+                if the_id in the_set:
+                    self.assertEquals(id_set[id_set.index(the_id)], the_id)
+            for pos in (0, 998, 999, len(ids) - 1):
+                self.assertEquals(list(id_set.after(ids[pos])), ids[pos:])
+            self.assertEquals(id_set[990:1010], ids[990:1010])
+
+        # sequence set sent to the server
+        self.assertEquals(collections_utils.IdSet(uids[:5100]).sequence_set(), '1:4999,5001:5101')
+
+    def test_sorted_id_map(self):
+        """
+           SortedIdMap of gm_id => dir: same items as the OrderedDict sorted by gm_id
+           and restart after an id
+        """
+        import random
+        random.seed(7)
+        dirs = ['%d-%02d' % (2010 + nb / 12, nb % 12 + 1) for nb in xrange(60)]
+        items = [(1400000000000000000 + num * 7919, dirs[num * 60 / 6000]) for num in xrange(6000)]
+        random.shuffle(items)
+
+        ordered = collections_utils.OrderedDict(sorted(items, key=lambda t: t[0]))
+        id_map  = collections_utils.SortedIdMap(items)
+        self.assertEquals(id_map.items(), ordered.items())
+
+        last_id  = ordered.keys()[3456]
+        left     = ordered.keys()[3457:]
+        left_map = id_map.after(last_id)
+        self.assertEquals(len(left_map), len(left))
+        self.assertEquals(list(left_map), left)
+        self.assertEquals(left_map[left[0]], ordered[left[0]])
+        self.assertFalse(last_id in left_map)
+        self.assertEquals(id_map.index(last_id), 3456)
+        self.assertEquals(list(id_map.tail(3457)), left)
+
+    def test_metadata_snapshot(self):
+        """
+           Metadata snapshot of All Mail with one streamed UID FETCH 1:*: same records
+           as FETCH batches, ids and uid index of the full sync taken from it
+        """
+        root_dir = '/tmp/gmvault-db-snapshot-test'
+
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(2000):
+            server.add_message('Subject: email %d\r\n\r\nbody %d\r\n' % (num, num), \
+                               labels = ['label', 'label%d' % (num % 7)], flags = ['\\Seen'] if num % 3 else [])
+
+        for engine in ('imapclient', 'pipelined'):
+            gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+            vaulter = self._create_vaulter(root_dir, server)
+            vaulter.src.imap_engine = engine
+            vaulter.src.connect()
+            vaulter.src.select_folder('ALLMAIL')
+
+            uids = vaulter.src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+            expected = []
+            for pos in xrange(0, len(uids), 500):
+                data = vaulter.src.fetch(uids[pos:pos + 500], gmvault_snapshot.MetadataSnapshot.ATTRIBUTES)
+                expected.extend([gmvault_snapshot.MetadataSnapshot.to_record(uid, data[uid]) for uid in sorted(data)])
+
+            snapshot, nb_messages = vaulter.take_snapshot('ALLMAIL')
+            self.assertEquals(nb_messages, 2000)
+            self.assertEquals(list(snapshot), expected)
+
+            # the full sync takes the ids from the snapshot and fills the uid index
+            self.assertEquals(list(vaulter._get_snapshot_ids('ALLMAIL')), uids) #pylint:disable-msg=W0212
+            self.assertEquals(len(vaulter._get_uid_index('ALLMAIL')), 2000) #pylint:disable-msg=W0212
+
+            # the literals are streamed like fetch returns them
+            self.assertEquals(dict(vaulter.src.server.fetch_stream(uids[:5], imap_utils.GIMAPFetcher.GET_DATA_ONLY)), \
+                              vaulter.src.server.fetch(uids[:5], imap_utils.GIMAPFetcher.GET_DATA_ONLY))
+
+            vaulter.src.disconnect()
+
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_blowfish_ctr(self):
+        """
+           The bulk CTR keystream gives the bytes of the byte per byte one, also
+           with successive calls of all sizes
+        """
+        key = 'This is a test key for gmvault'
+        data = os.urandom(32 * 1024 + 5)
+
+        cipher = blowfish.Blowfish(key)
+        cipher.initCTR()
+        expected = ''.join([chr(ord(ch) ^ cipher._nextCTRByte()) for ch in data]) #pylint:disable-msg=W0212
+
+        cipher.initCTR()
+        crypted = cipher.encryptCTR(data)
+        self.assertEquals(crypted, expected)
+
+        cipher.initCTR()
+        chunks, pos = [], 0
+        for size in [0, 1, 7, 8, 9, 3, 16, 5, 1000, 8191, 1] * 2:
+            chunks.append(cipher.encryptCTR(data[pos:pos + size]))
+            pos += size
+        chunks.append(cipher.encryptCTR(data[pos:]))
+        self.assertEquals(''.join(chunks), expected)
+
+        cipher.initCTR()
+        self.assertEquals(cipher.decryptCTR(crypted), data)
+
+    def test_stream_export(self):
+        """
+           Export a multi-MB compressed and encrypted email in maildir and mbox
+           chunk by chunk: same content as the email read with unbury_email
+        """
+        root_dir = '/tmp/gmvault-db-export-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        body = ''.join(['line %d %s\r\n' % (num, os.urandom(num % 97).encode('hex')) for num in xrange(30000)])
+        gstorer = gmvault_db.create_storer(root_dir, encrypt_data = True)
+        for gm_id, labels in ((1, ['label', 'other']), (2, ['label'])):
+            gstorer.bury_email({'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': labels,
+                                'FLAGS': ('\\Seen',), 'INTERNALDATE': datetime.datetime(2012, 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                                'BODY[]': 'Subject: hello %d\r\n\r\n%sFrom me\r\nend\r\n' % (gm_id, body)},
+                               '2012-01', compress = True)
+        gstorer = gmvault_db.create_storer(root_dir, encrypt_data = True)
+        data = dict((gm_id, gstorer.unbury_email(gm_id)[1]) for gm_id in (1, 2))
+
+        gmvault_export.GMVaultExporter(root_dir, gmvault_export.Maildir('%s/maildir' % (root_dir))).export()
+
+        exported = {}
+        for folder in ('label', 'other'):
+            for path in glob.glob('%s/maildir/%s/cur/*:2,S' % (root_dir, folder)):
+                with open(path, 'rb') as f:
+                    exported.setdefault(folder, []).append(f.read())
+        self.assertEquals(sorted(exported['label']), sorted(data.values()))
+        self.assertEquals(exported['other'], [data[1]])
+
+        exporter = gmvault_export.MBox('%s/mbox' % (root_dir))
+        gmvault_export.GMVaultExporter(root_dir, exporter).export()
+        exporter.close()
+
+        # mbox written from the whole message parsed in memory like before
+        expected = mailbox.mbox('%s/expected' % (root_dir))
+        for gm_id in (1, 2):
+            mmsg = mailbox.mboxMessage(data[gm_id])
+            mmsg.add_flag('R')
+            headers = StringIO.StringIO()
+            email.generator.Generator(headers, False, 0).flatten(mmsg)
+            expected.add(headers.getvalue())
+        expected.close()
+
+        def content(path):
+            """ content of the mbox without the From_ lines (they have a timestamp) """
+            with open(path, 'rb') as f:
+                return [line for line in f if not line.startswith('From ')]
+
+        self.assertTrue(content('%s/mbox/label' % (root_dir)) == content('%s/expected' % (root_dir)))
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_raw_email_format(self):
+        """
+           Emails stored raw next to older emails converted to utf-8: the content
+           and the format recorded in the metadata are kept by the metadata updates,
+           the restore and the conversion to utf-8
+        """
+        root_dir = '/tmp/gmvault-db-raw-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        def email_info(gm_id, labels):
+            """ latin-1 email """
+            return {'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': labels, 'FLAGS': (),
+                    'INTERNALDATE': datetime.datetime(2012, 1, gm_id),
+                    'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: caf\xe9 %d' % (gm_id),
+                    'BODY[]': 'Subject: caf\xe9 %d\r\n\r\n%s\r\n' % (gm_id, 'Un caf\xe9 cr\xe8me. ' * 500)}
+
+        raw  = dict((gm_id, email_info(gm_id, [])['BODY[]']) for gm_id in xrange(1, 5))
+        utf8 = dict((gm_id, gmvault_utils.convert_to_unicode(body).encode('utf-8')) for gm_id, body in raw.iteritems())
+        self.assertNotEquals(raw[1], utf8[1])
+
+        # older emails converted to utf-8, with their format recorded or stored before it was recorded
+        gstorer = gmvault_db.create_storer(root_dir)
+        for gm_id in (1, 2):
+            gstorer.bury_email(email_info(gm_id, ['old']), '2012-01')
+        meta = gstorer._read_metadata(2) #pylint:disable-msg=W0212
+        del meta[gstorer.EMAIL_FMT_K]
+        gstorer._write_metadata(meta, '2012-01') #pylint:disable-msg=W0212
+
+        gmvault_db.write_email_format(root_dir, gmvault_db.GmailStorer.RAW_FORMAT)
+        gstorer = gmvault_db.create_storer(root_dir)
+        gstorer.bury_email(email_info(3, ['new']), '2012-01')
+        gstorer.bury_email(email_info(4, ['new']), '2012-01', compress = True)
+
+        # a metadata update keeps the format
+        gstorer.bury_metadata(email_info(3, ['new', 'updated']), '2012-01')
+
+        expected = {1: utf8[1], 2: utf8[2], 3: raw[3], 4: raw[4]}
+        formats  = {1: 'utf-8', 2: None, 3: 'raw', 4: 'raw'}
+        for gm_id in xrange(1, 5):
+            meta, data = gstorer.unbury_email(gm_id)
+            self.assertEquals(data, expected[gm_id])
+            self.assertEquals(meta.get(gstorer.EMAIL_FMT_K), formats[gm_id])
+        self.assertEquals(gstorer.unbury_metadata(3)['labels'], ['new', 'updated'])
+
+        # the stored contents are restored as they are
+        server  = test_utils.FakeGmailServer().start()
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter.src.readonly_folder = False
+        vaulter.restore_emails()
+        self.assertEquals(sorted(msg['body'] for msg in server.messages.itervalues()), sorted(expected.values()))
+        vaulter.src.disconnect()
+        server.stop()
+
+        # only the emails stored raw are converted to utf-8
+        gmvault_db.normalize_emails(root_dir)
+        gstorer = gmvault_db.create_storer(root_dir)
+        formats.update({3: 'utf-8', 4: 'utf-8'})
+        for gm_id in xrange(1, 5):
+            meta, data = gstorer.unbury_email(gm_id)
+            self.assertEquals(data, utf8[gm_id])
+            self.assertEquals(meta.get(gstorer.EMAIL_FMT_K), formats[gm_id])
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_email_format_opt_in(self):
+        """
+           A db created before the email format was recorded keeps storing utf-8 and so
+           does a new db by default. The raw storage is only used once chosen for the db
+        """
+        root_dir = '/tmp/gmvault-db-format-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        body = 'Subject: caf\xe9\r\n\r\nUn caf\xe9 cr\xe8me.\r\n'
+        def bury(gstorer, gm_id):
+            """ store a latin-1 email and return its content and format """
+            gstorer.bury_email({'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': [], 'FLAGS': (),
+                                'INTERNALDATE': datetime.datetime(2012, 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: caf\xe9',
+                                'BODY[]': body}, '2012-01')
+            meta, data = gstorer.unbury_email(gm_id)
+            return data, meta[gstorer.EMAIL_FMT_K]
+
+        utf8 = gmvault_utils.convert_to_unicode(body).encode('utf-8')
+
+        # new db: utf-8 by default and recorded
+        self.assertEquals(bury(gmvault_db.create_storer(root_dir), 1), (utf8, 'utf-8'))
+        self.assertEquals(gmvault_db.get_email_format(root_dir), 'utf-8')
+
+        # older db without the recorded format
+        os.remove('%s/.info/%s' % (root_dir, gmvault_db.GmailStorer.EMAIL_FORMAT_FILENAME))
+        self.assertEquals(bury(gmvault_db.create_storer(root_dir), 2), (utf8, 'utf-8'))
+        self.assertEquals(gmvault_db.get_email_format(root_dir), 'utf-8')
+
+        # opt in (migrate --raw): the next emails are stored raw, the older ones are kept
+        gmvault_db.write_email_format(root_dir, gmvault_db.GmailStorer.RAW_FORMAT)
+        gstorer = gmvault_db.create_storer(root_dir)
+        self.assertEquals(bury(gstorer, 3), (body, 'raw'))
+        self.assertEquals(gstorer.unbury_email(1)[1], utf8)
+
+        # back to utf-8 (migrate --utf8)
+        gmvault_db.normalize_emails(root_dir)
+        self.assertEquals(bury(gmvault_db.create_storer(root_dir), 4), (utf8, 'utf-8'))
+        self.assertEquals(gmvault_db.create_storer(root_dir).unbury_email(3)[1], utf8)
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_gm_id_index_lookup(self):
+        """
+           Find the directory of an email and of a chat (chats/subchats-x) with the gm_id index.
+           An email missing in a stale index is found by walking the db once and added to it
+        """
+        root_dir = '/tmp/gmvault-db-index-lookup-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        def email_info(gm_id):
+            """ email to bury """
+            return {'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ['label'], 'FLAGS': (),
+                    'INTERNALDATE': datetime.datetime(2012, 1, 1),
+                    'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                    'BODY[]': 'Subject: hello %d\r\n\r\nbody\r\n' % (gm_id)}
+
+        gstorer = gmvault_db.GmailStorer(root_dir)
+        gstorer.bury_email(email_info(1), '2012-01')
+        chats_dir = gstorer.get_sub_chats_dir()
+        gstorer.bury_chat(email_info(2), chats_dir)
+
+        # the index does not know the email 3 (db modified by an older gmvault)
+        index_path = '%s/.info/gm_id.index' % (root_dir)
+        with open(index_path) as f:
+            stale_index = f.read()
+        gstorer.bury_email(email_info(3), '2012-02')
+        with open(index_path, 'w') as f:
+            f.write(stale_index)
+
+        db_dir  = '%s/db' % (root_dir)
+        gstorer = gmvault_db.GmailStorer(root_dir)
+        self.assertEquals(gstorer.get_directory_from_id(1), '%s/2012-01' % (db_dir))
+        self.assertEquals(gstorer.get_directory_from_id(2), '%s/%s' % (db_dir, chats_dir))
+        self.assertTrue(chats_dir.startswith('chats/subchats-'))
+        self.assertFalse(3 in gstorer.get_index())
+
+        # the miss walks the db and completes the index
+        self.assertEquals(gstorer.get_directory_from_id(3), '%s/2012-02' % (db_dir))
+        self.assertEquals(gstorer.unbury_email(3)[1], email_info(3)['BODY[]'])
+        self.assertEquals(gstorer.get_directory_from_id(4), None)
+        self.assertEquals(gmvault_db.GmailStorer(root_dir).get_index().get(3), gstorer.get_index().get(3))
+
+    def test_adaptive_batch_fetch(self):
+        """
+           Fetch the metadata of 2000 emails with 2 that cannot be fetched: the culprits
+           are found by bisection and the batch size adapts
+        """
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(2000):
+            server.add_message('Subject: email %d\r\n\r\nbody\r\n' % (num), labels = ['label'], \
+                               broken = num in (333, 1500))
+
+        for engine in ('imapclient', 'pipelined'):
+            src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', {'type': 'passwd', 'value': 'x'})
+            src.ssl, src.imap_engine = False, engine
+            src.connect()
+            src.select_folder('ALLMAIL')
+            imap_ids = src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+
+            error_report = {'cannot_be_fetched': []}
+            fetcher = gmvault.IMAPBatchFetcher(src, imap_ids, error_report, \
+                                               imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA, 100)
+            del server.commands[:]
+            fetched = {}
+            for new_data in fetcher:
+                fetched.update(new_data)
+            nb_fetches = len([name for name, _ in server.commands if name == 'UID FETCH'])
+            src.disconnect()
+
+            self.assertEquals(sorted(fetched.keys()), [uid for uid in imap_ids if uid not in (334, 1501)])
+            self.assertEquals(sorted(uid for uid, _ in error_report['cannot_be_fetched']), [334, 1501])
+            # bisections instead of 200 individual fetches
+            self.assertTrue(nb_fetches < 100)
+            self.assertTrue(fetcher.batch_size > 100)
+
+        server.stop()
+
+    def test_body_downloader(self):
+        """
+           Download 40 bodies with the IMAPBodyDownloader: they are returned in the order of
+           submission, at most max_bytes_in_flight are downloaded ahead of the consumer and
+           the body that cannot be fetched fails alone
+        """
+        server = test_utils.FakeGmailServer().start()
+        size = 1000
+        for num in xrange(40):
+            server.add_message('Subject: email %02d\r\n\r\n%s' % (num, 'x' * (size - 20)), labels = ['label'])
+        server.unavailable.add(13)
+
+        src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', {'type': 'passwd', 'value': 'x'})
+        src.ssl = False
+        src.connect()
+        src.select_folder('ALLMAIL')
+        imap_ids = src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+
+        downloader = gmvault.IMAPBodyDownloader(src, batch_size = 5, max_bytes_in_flight = 10 * size)
+        downloader.start()
+        del server.commands[:]
+        for pos, the_id in enumerate(imap_ids):
+            downloader.submit(the_id, size, pos)
+
+        def body_fetches():
+            """ nb of body FETCH received by the server """
+            return len([name for name, args in server.commands if name == 'UID FETCH' and 'BODY' in str(args)])
+
+        # nothing is consumed: only 2 batches of 5 bodies are downloaded
+        start = time.time()
+        while body_fetches() < 2 and time.time() - start < 5:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        self.assertEquals(body_fetches(), 2)
+
+        ids, payloads, errors = [], [], {}
+        for the_id, payload, data, error in downloader.downloaded():
+            self.assertTrue(downloader._bytes_in_flight <= 10 * size) #pylint:disable-msg=W0212
+            ids.append(the_id)
+            payloads.append(payload)
+            if error:
+                errors[the_id] = error
+            else:
+                self.assertTrue(data[imap_utils.GIMAPFetcher.EMAIL_BODY].startswith('Subject: email %02d' % (payload)))
+
+        downloader.stop()
+        src.disconnect()
+        server.stop()
+
+        self.assertEquals(ids, imap_ids)
+        self.assertEquals(payloads, range(40))
+        # the other bodies of the batch of uid 13 are fetched individually
+        self.assertEquals(errors.keys(), [13])
+        self.assertEquals(downloader.nb_outstanding(), 0)
+
+    def test_uid_index_deletion_check(self):
+        """
+           Find the emails deleted from Gmail after a sync: with the uid => gm_id index
+           filled by the sync only the new uids are fetched
+        """
+        root_dir = '/tmp/gmvault-db-uid-index-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(3000):
+            server.add_message('Subject: email %d\r\n\r\nbody\r\n' % (num), labels = ['label'])
+
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter._sync_emails(imap_utils.GIMAPFetcher.IMAP_ALL, compress = False, restart = False) #pylint:disable-msg=W0212
+
+        def check(deleted):
+            """ delete the uids from Gmail and check the db. Return the nb of fetched uids """
+            for uid in deleted:
+                del server.messages[uid]
+            del server.commands[:]
+            vaulter.check_clean_db(db_cleaning = True)
+            nb_fetched = sum(len(test_utils._FakeGmailSession._parse_set(args[0], server.next_uid)) \
+                             for name, args in server.commands if name == 'UID FETCH') #pylint:disable-msg=W0212
+            remote_ids = set(msg['gm_id'] for msg in server.messages.itervalues())
+            db_ids     = vaulter.gstorer.get_all_existing_gmail_ids()
+            self.assertEquals(len(db_ids), len(remote_ids) - len(remote_ids.difference(db_ids))) # never synced
+            self.assertFalse(set(db_ids) - remote_ids)
+            return nb_fetched
+
+        with_index = check([10, 11, 12, 2999])
+        server.add_message('Subject: new\r\n\r\nbody\r\n') # not synced: its gm_id has to be fetched
+        new_uid = check([20])
+        vaulter._uid_indexes = {} #pylint:disable-msg=W0212
+        for path in os.listdir('%s/.info' % (root_dir)):
+            if path.endswith('.uid_index'):
+                os.remove('%s/.info/%s' % (root_dir, path))
+        without_index = check([30])
+        server.uidvalidity += 1 # the uids have changed: full rescan
+        vaulter.src.disconnect()
+        vaulter.src.connect()
+        new_validity = check([])
+
+        self.assertEquals(with_index, 0)
+        self.assertEquals(new_uid, 1)
+        self.assertTrue(without_index > 2900)
+        self.assertTrue(new_validity > 2900)
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_parallel_sync_restart(self):
+        """
+           Sync 6000 emails with 3 workers. A worker fails and the sync is interrupted:
+           the restart only syncs the ids after the checkpoint of each range
+        """
+        root_dir = '/tmp/gmvault-db-parallel-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(6000):
+            server.add_message('Subject: email %d\r\n\r\nbody %d\r\n' % (num, num), labels = ['label%d' % (num % 5)], \
+                               internal_date = datetime.datetime(2012, num % 12 + 1, 1))
+        server.unavailable.add(1900) # at the end of the first range
+
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter.src.use_standby = True
+
+        self.assertRaises(Exception, vaulter._sync_emails_parallel, imap_utils.GIMAPFetcher.IMAP_ALL, \
+                          compress = False, restart = False, nb_connections = 3) #pylint:disable-msg=W0212
+
+        parts = vaulter._load_sync_parts(vaulter.OP_EMAIL_SYNC) #pylint:disable-msg=W0212
+        self.assertTrue(parts)
+        self.assertTrue(set(tuple(part['range']) for part in parts) <= set([(1, 2000), (2001, 4000), (4001, 6000)]))
+        vaulter.gstorer.reload_index()
+        nb_stored = len(vaulter.gstorer.get_all_existing_gmail_ids())
+
+        # the main connection and its standby are logged out while the workers run
+        while vaulter.src._standby is None or server.nb_open > 2: #pylint:disable-msg=W0212
+            time.sleep(0.05)
+        server.max_open = server.nb_open
+
+        server.unavailable.clear()
+        del server.commands[:]
+        vaulter._sync_emails_parallel(imap_utils.GIMAPFetcher.IMAP_ALL, compress = False, restart = True, \
+                                      nb_connections = 3) #pylint:disable-msg=W0212
+
+        nb_fetched = sum(len(test_utils._FakeGmailSession._parse_set(args[0], server.next_uid)) \
+                         for name, args in server.commands if name == 'UID FETCH' and '[]' in str(args[1:])) #pylint:disable-msg=W0212
+
+        # 2 connections per worker
+        self.assertTrue(server.max_open <= 2 * 3)
+        # at most the 9 emails after the last checkpoint of each range are fetched again
+        self.assertTrue(nb_fetched <= 6000 - nb_stored + 3 * 9)
+        self.assertFalse(vaulter._load_sync_parts(vaulter.OP_EMAIL_SYNC)) #pylint:disable-msg=W0212
+
+        gstorer = gmvault_db.create_storer(root_dir)
+        self.assertEquals(set(gstorer.get_all_existing_gmail_ids()), \
+                          set(msg['gm_id'] for msg in server.messages.itervalues()))
+        for uid in (1, 1900, 2001, 6000):
+            msg = server.messages[uid]
+            self.assertEquals(gstorer.unbury_email(msg['gm_id'])[1], msg['body'])
+            self.assertEquals(gstorer.unbury_metadata(msg['gm_id'])['labels'], msg['labels'])
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_parallel_restore_restart(self):
+        """
+           Restore 500 emails with 3 uploaders. Every email is appended once with its labels
+           and the restart of an interrupted restore resumes after the last labelled batch
+        """
+        root_dir = '/tmp/gmvault-db-restore-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        gstorer = gmvault_db.create_storer(root_dir)
+        for gm_id in xrange(1, 501):
+            gstorer.bury_email({'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ['label%d' % (gm_id % 5)],
+                                'FLAGS': (), 'INTERNALDATE': datetime.datetime(2012, gm_id % 12 + 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                                'BODY[]': 'Subject: hello %d\r\n\r\nbody\r\n' % (gm_id)},
+                               '2012-%02d' % (gm_id % 12 + 1), compress = (gm_id % 2 == 0))
+        gm_ids = list(gstorer.get_all_existing_gmail_ids())
+        bodies = dict((gm_id, gstorer.unbury_email(gm_id)[1]) for gm_id in gm_ids)
+
+        server = test_utils.FakeGmailServer().start()
+        server.rejected.add(bodies[gm_ids[300]]) # in the 4th batch of 80 emails
+
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter.src.readonly_folder = False
+
+        self.assertRaises(Exception, vaulter.restore_emails, connections = 3)
+        while any(thread.name in ('gmv-uploader', 'gmv-labelling') for thread in threading.enumerate()):
+            time.sleep(0.1)
+
+        with open('%s/gmvault_%s' % (vaulter.gstorer.get_info_dir(), vaulter.EMAIL_RESTORE_PROGRESS)) as f:
+            last_pos = gm_ids.index(json.load(f)['last_id']) + 1
+        first_run = dict((uid, dict(msg)) for uid, msg in server.messages.iteritems())
+
+        server.rejected.clear()
+        vaulter.restore_emails(restart = True, connections = 3)
+
+        restarted = [msg for uid, msg in server.messages.iteritems() if uid not in first_run]
+
+        # the checkpoint is the last id of a labelled batch before the failing one
+        self.assertTrue(0 < last_pos <= 240 and last_pos % 80 == 0)
+        self.assertFalse(vaulter.error_report['emails_in_quarantine'])
+
+        def check_appended(gm_ids_part, messages):
+            """ each email of gm_ids_part is appended once in messages with its labels """
+            appended = dict((msg['body'], msg) for msg in messages)
+            self.assertEquals(len(appended), len(messages))
+            for gm_id in gm_ids_part:
+                self.assertEquals(appended[bodies[gm_id]]['labels'], ['label%d' % (gm_id % 5)])
+
+        check_appended(gm_ids[:last_pos], [msg for msg in server.messages.itervalues() \
+                                           if msg['body'] in set(bodies[gm_id] for gm_id in gm_ids[:last_pos])])
+        self.assertEquals(len(restarted), len(gm_ids) - last_pos)
+        check_appended(gm_ids[last_pos:], restarted)
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_watermark_sync(self):
+        """
+           Incremental sync of 3000 synced emails and 20 new ones: full sync of ALL
+           against the watermark mode fetching the new uids and the recent emails
+        """
+        root_dir = '/tmp/gmvault-db-watermark-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        # without CONDSTORE the labels changes are found in the recent emails
+        server = test_utils.FakeGmailServer(capabilities = \
+                     test_utils.FakeGmailServer.CAPABILITIES.replace(' CONDSTORE', '')).start()
+        for num in xrange(3000):
+            server.add_message('Subject: email %d\r\n\r\nbody\r\n' % (num), labels = ['label'])
+
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter.src.select_folder('ALLMAIL')
+
+        def sync(mode):
+            """ sync ALLMAIL. Return the nb of fetched uids """
+            del server.commands[:]
+            vaulter._common_sync(vaulter.timer, "email", {'mode': mode, 'type': 'imap', 'req': 'ALL'}, \
+                                 False, False) #pylint:disable-msg=W0212
+            nb_fetched = sum(len(test_utils._FakeGmailSession._parse_set(args[0], server.next_uid)) \
+                             for name, args in server.commands if name == 'UID FETCH' \
+                             and 'X-GM-LABELS' in str(args)) #pylint:disable-msg=W0212
+            return nb_fetched
+
+        vaulter.timer = gmvault_utils.Timer()
+        vaulter.timer.start()
+        self.assertEquals(sync('watermark'), 3000) # no watermark yet
+
+        for num in xrange(20):
+            server.add_message('Subject: new %d\r\n\r\nbody\r\n' % (num), labels = ['label'], \
+                               internal_date = datetime.datetime.now() if num < 5 else None)
+        server.messages[5]['date'] = datetime.datetime.now() # recent email with a new label
+        server.messages[5]['labels'].append('new label')
+
+        watermark = sync('watermark')
+        self.assertEquals(vaulter.load_watermark('ALLMAIL')['last_uid'], 3020)
+        self.assertEquals(vaulter.gstorer.unbury_metadata(server.messages[5]['gm_id'])['labels'], \
+                          ['label', 'new label'])
+        self.assertEquals(watermark, 21)
+        self.assertEquals(sync('full'), 3020)
+        self.assertEquals(len(vaulter.gstorer.get_all_existing_gmail_ids()), 3020)
+
+        # an email that cannot be fetched is synced again by the next watermark sync
+        uid = server.add_message('Subject: broken\r\n\r\nbody\r\n', labels = ['label'], broken = True)
+        server.add_message('Subject: after\r\n\r\nbody\r\n', labels = ['label'])
+        sync('watermark')
+        self.assertEquals(vaulter.load_watermark('ALLMAIL')['failed_uids'], [uid])
+        self.assertFalse(server.messages[uid]['gm_id'] in vaulter.gstorer.get_all_existing_gmail_ids())
+
+        server.messages[uid]['broken'] = False
+        sync('watermark')
+        self.assertEquals(vaulter.load_watermark('ALLMAIL')['failed_uids'], [])
+        self.assertEquals(vaulter.load_watermark('ALLMAIL')['last_uid'], uid + 1)
+        self.assertEquals(vaulter.gstorer.unbury_email(server.messages[uid]['gm_id'])[1], server.messages[uid]['body'])
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_condstore_changes(self):
+        """
+           Watermark sync of 3000 synced emails with CONDSTORE: only the emails relabeled
+           or flagged since the last sync are fetched (with both IMAP engines)
+        """
+        root_dir = '/tmp/gmvault-db-condstore-test'
+
+        for engine in ('imapclient', 'pipelined'):
+            gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+            server = test_utils.FakeGmailServer().start()
+            for num in xrange(3000):
+                server.add_message('Subject: email %d\r\n\r\nbody\r\n' % (num), labels = ['label'])
+
+            vaulter = self._create_vaulter(root_dir, server)
+            vaulter.src.imap_engine = engine
+            vaulter.src.connect()
+            vaulter.src.select_folder('ALLMAIL')
+            vaulter.timer = gmvault_utils.Timer()
+            vaulter.timer.start()
+            vaulter._common_sync(vaulter.timer, "email", {'mode': 'full', 'type': 'imap', 'req': 'ALL'}, \
+                                 False, False) #pylint:disable-msg=W0212
+
+            for uid in xrange(100, 3000, 300):
+                server.change_message(uid, labels = ['label', 'relabeled'])
+            server.change_message(7, flags = ['\\Seen'])
+
+            del server.commands[:]
+            synced = vaulter._common_sync(vaulter.timer, "email", {'mode': 'watermark', 'type': 'imap', 'req': 'ALL'}, \
+                                          False, False) #pylint:disable-msg=W0212
+
+            self.assertEquals(list(synced), [7] + range(100, 3000, 300))
+            self.assertEquals(vaulter.gstorer.unbury_metadata(server.messages[400]['gm_id'])['labels'], \
+                              ['label', 'relabeled'])
+            self.assertEquals(vaulter.gstorer.unbury_metadata(server.messages[7]['gm_id'])['flags'], ['\\Seen'])
+            self.assertEquals(vaulter.load_watermark('ALLMAIL')['highestmodseq'], server.highest_modseq)
+
+            # nothing changed since
+            synced = vaulter._common_sync(vaulter.timer, "email", {'mode': 'watermark', 'type': 'imap', 'req': 'ALL'}, \
+                                          False, False) #pylint:disable-msg=W0212
+            self.assertEquals(len(synced), 0)
+
+            vaulter.src.disconnect()
+            server.stop()
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_daemon_new_email_lag(self):
+        """
+           Daemon mode: an email received while the daemon waits in IDLE is stored
+           within seconds without connecting or searching All Mail again
+        """
+        root_dir = '/tmp/gmvault-db-daemon-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(500):
+            server.add_message('Subject: email %d\r\n\r\nbody\r\n' % (num), labels = ['label'])
+
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter.timer = gmvault_utils.Timer()
+
+        daemon = threading.Thread(target = vaulter.daemon, \
+                                  kwargs = { 'compress_on_disk' : False, 'emails_only' : True, 'max_nb_wakeups' : 1 })
+        daemon.start()
+
+        # wait for the first sync to end
+        for _ in xrange(600):
+            if server.idling:
+                break
+            time.sleep(0.1)
+        self.assertTrue(server.idling)
+        nb_connections = server.nb_connections
+        del server.commands[:]
+
+        t1 = datetime.datetime.now()
+        uid = server.add_message('Subject: new email\r\n\r\nnew body\r\n', labels = ['new'])
+        daemon.join(60)
+        lag = (datetime.datetime.now() - t1).total_seconds()
+
+        self.assertFalse(daemon.is_alive())
+        self.assertEquals(vaulter.gstorer.unbury_metadata(server.messages[uid]['gm_id'])['labels'], ['new'])
+        self.assertTrue(lag < 10)
+
+        # same connection, no full search: only the new email is fetched
+        self.assertEquals(server.nb_connections, nb_connections)
+        self.assertFalse(('UID SEARCH', ['ALL']) in server.commands)
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_snapshot_sync_plan(self):
+        """
+           Plan the sync of 5000 stored emails from a snapshot: per id comparison with the db
+           against a merge-join of the snapshot and the db sorted by gm_id. Then sync with the plan
+        """
+        root_dir = '/tmp/gmvault-db-sync-plan-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        server = test_utils.FakeGmailServer().start()
+        for num in xrange(5000):
+            server.add_message('Subject: email %d\r\n\r\nbody\r\n' % (num), labels = ['label'], \
+                               internal_date = datetime.datetime(2012, num % 12 + 1, 1))
+
+        vaulter = self._create_vaulter(root_dir, server)
+        vaulter._sync_emails(imap_utils.GIMAPFetcher.IMAP_ALL, compress = False, restart = False) #pylint:disable-msg=W0212
+
+        for uid in xrange(50, 5000, 100):
+            server.change_message(uid, labels = ['label', 'relabeled'])
+        for uid in xrange(3000, 3010):
+            del server.messages[uid]
+        for num in xrange(20):
+            server.add_message('Subject: new %d\r\n\r\nbody\r\n' % (num), labels = ['label'])
+
+        vaulter.src.select_folder('ALLMAIL')
+        snapshot, _ = vaulter.take_snapshot('ALLMAIL')
+
+        # sorted in several runs merged from files
+        self.assertEquals(list(snapshot.iter_by_gm_id(run_size = 700)), list(snapshot.iter_by_gm_id()))
+
+        batch, new_data = [], {}
+        for record in snapshot:
+            new_data[record[snapshot.UID]] = {'X-GM-MSGID': record[snapshot.GM_ID], 'FLAGS': record[snapshot.FLAGS], \
+                                              'X-GM-LABELS': record[snapshot.LABELS]}
+            batch.append((record[snapshot.UID], record[snapshot.GM_ID], None, \
+                          gmvault_utils.get_ym_from_datetime(gmvault_utils.e2datetime(record[snapshot.INT_DATE]))))
+
+        def compare():
+            """ compare by batches of 500 ids then with the merge-join. Return the changes and the plan """
+            missing, changed = set(), set()
+            for pos in xrange(0, len(batch), 500):
+                b_missing, b_changed = vaulter._get_metadata_changes(batch[pos:pos + 500], new_data) #pylint:disable-msg=W0212
+                missing.update(b_missing)
+                changed.update(b_changed)
+            return (missing, changed), vaulter.get_sync_plan(snapshot, 'email')
+
+        json_changes, plan = compare()
+
+        # same plan with the SQLite metadata store
+        gmvault_db.migrate_metadata(root_dir, 'sqlite')
+        vaulter.gstorer = gmvault_db.create_storer(root_dir)
+        sqlite_changes, sqlite_plan = compare()
+
+        gm_ids = dict((uid, msg['gm_id']) for uid, msg in server.messages.iteritems())
+        self.assertEquals(list(plan.new), range(5001, 5021))
+        self.assertEquals(json_changes, sqlite_changes)
+        self.assertEquals(json_changes, (set(gm_ids[uid] for uid in plan.new), \
+                                         set(gm_id for (gm_id, _, _, _) in plan.updated)))
+        self.assertEquals(len(plan.updated), 50)
+        self.assertEquals(len(plan.deleted), 10)
+        self.assertEquals((list(sqlite_plan.new), sqlite_plan.updated, sqlite_plan.deleted), \
+                          (list(plan.new), plan.updated, plan.deleted))
+
+        # the sync only fetches the new emails
+        vaulter._snapshots['ALLMAIL'] = snapshot #pylint:disable-msg=W0212
+        vaulter.timer = gmvault_utils.Timer()
+        vaulter.timer.start()
+        del server.commands[:]
+        synced = vaulter._common_sync(vaulter.timer, "email", {'mode': 'full', 'type': 'imap', 'req': 'ALL'}, \
+                                      False, False) #pylint:disable-msg=W0212
+        self.assertEquals(list(synced), range(5001, 5021))
+        self.assertEquals(sum(len(test_utils._FakeGmailSession._parse_set(args[0], server.next_uid)) \
+                              for name, args in server.commands if name == 'UID FETCH'), 40) #pylint:disable-msg=W0212
+        self.assertEquals(vaulter.gstorer.unbury_metadata(gm_ids[150])['labels'], ['label', 'relabeled'])
+
+        del server.commands[:]
+        vaulter.check_clean_db(db_cleaning = True)
+        # only the chats are searched
+        self.assertEquals([name for name, _ in server.commands if name.startswith('UID')], ['UID SEARCH'])
+        self.assertEquals(set(vaulter.gstorer.get_all_existing_gmail_ids()), set(gm_ids.itervalues()))
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_stream_round_trip(self):
+        """
+           Write and read back an email with and without gzip and Blowfish CTR:
+           same bytes as the whole buffer format and as the original with chunks
+           not aligned on the 8 bytes cipher blocks
+        """
+        root_dir = '/tmp/gmvault-stream-test'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+        gmvault_utils.makedirs(root_dir)
+
+        key  = 'This is a test key for gmvault'
+        data = ''.join(['line %d %s\r\n' % (num, os.urandom(num % 97).encode('hex')) for num in xrange(5000)]) + 'end'
+
+        def whole_buffer(a_str, cipher):
+            """ encrypt or decrypt a_str in one call like the old storage """
+            cipher.initCTR()
+            return cipher.encryptCTR(a_str)
+
+        # the CTR writer gives the same stream with writes of all sizes
+        crypted = whole_buffer(data, blowfish.Blowfish(key))
+        fileobj, pos = StringIO.StringIO(), 0
+        cipher = blowfish.Blowfish(key)
+        cipher.initCTR()
+        writer = stream_utils.CTRWriter(fileobj, cipher)
+        for size in [1, 7, 9, 3, 16, 5, 1000, 8191, 0] * 10:
+            writer.write(data[pos:pos + size])
+            pos += size
+        writer.write(data[pos:])
+        self.assertEquals(fileobj.getvalue(), crypted)
+
+        for compress in (False, True):
+            for encrypt in (False, True):
+                cipher   = blowfish.Blowfish(key) if encrypt else None
+                the_path = '%s/email-%s-%s.eml' % (root_dir, compress, encrypt)
+
+                stream_utils.write_data(the_path, data, compress, cipher)
+
+                # on disk format of the whole buffer writes: compressed then encrypted
+                with open(the_path, 'rb') as f:
+                    stored = f.read()
+                if encrypt:
+                    if not compress:
+                        self.assertEquals(stored, crypted)
+                    stored = whole_buffer(stored, blowfish.Blowfish(key))
+                if compress:
+                    stored = gzip.GzipFile(fileobj = StringIO.StringIO(stored)).read()
+                self.assertEquals(stored, data)
+
+                with stream_utils.DataReader(open(the_path, 'rb'), cipher, compress) as reader:
+                    self.assertEquals(reader.read(), data)
+
+                # chunks and reads of sizes not aligned on the cipher blocks
+                for chunk_size in (7, 4097):
+                    with stream_utils.DataReader(open(the_path, 'rb'), cipher, compress, chunk_size) as reader:
+                        chunks, size = [], 0
+                        while True:
+                            chunk = reader.read(size % 13 + 1 if size < 100 else 1001)
+                            if not chunk:
+                                break
+                            chunks.append(chunk)
+                            size += 1
+                        self.assertEquals(''.join(chunks), data)
+
+                    with stream_utils.DataReader(open(the_path, 'rb'), cipher, compress, chunk_size) as reader:
+                        self.assertEquals(list(reader), data.splitlines(True))
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+        
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPerf)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+ 
+if __name__ == '__main__':
+    
+    tests()
+
+
+def tests():
+    """
+       main test function
+    """
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGMVaultOffline)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+ 
+if __name__ == '__main__':
+    
+    tests()
@@ -19,8 +19,15 @@
 import unittest
 import datetime
 import os
+import time
 import gmv.gmvault_utils as gmvault_utils
 import gmv.collections_utils as collections_utils
+import gmv.gmvault_db as gmvault_db
+import gmv.gmvault as gmvault
+import gmv.gmvault_snapshot as gmvault_snapshot
+import gmv.blowfish as blowfish
+import gmv.imap_utils as imap_utils
+import gmv.test_utils as test_utils
 
 
 class TestPerf(unittest.TestCase): #pylint:disable-msg=R0904
@@ -36,6 +43,16 @@ class TestPerf(unittest.TestCase): #pylint:disable-msg=R0904
     def setUp(self): #pylint:disable-msg=C0103
         pass
     
+    @classmethod
+    def _create_vaulter(cls, root_dir, server):
+        """
+           GMVaulter of the db root_dir connected to the fake gmail server (without ssl)
+        """
+        credential = {'type': 'passwd', 'value': 'x'}
+        src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', credential)
+        src.ssl = False
+        return gmvault.GMVaulter(root_dir, server.host, server.port, 'gmvault', credential, src = src)
+
     def _create_dirs(self, working_dir, nb_dirs, nb_files_per_dir):
         """
            create all the dirs and files
@@ -96,6 +113,455 @@ class TestPerf(unittest.TestCase): #pylint:disable-msg=R0904
         
         print("\nnb of files = %s" % (len(gmail_ids.keys())))
         print("\nTime to read all meta files : %s\n" % (t2-t1))
+
+    def test_list_ids_with_index(self):
+        """
+           List the ids of a db with the gm_id index and compare with the ids
+           of the index rebuilt from the files on disk
+        """
+        root_dir = '/tmp/gmvault-db-index-perf'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        self._create_dirs('%s/db' % (root_dir), 20, 500)
+        # rename the dirs as yyyy-mm dirs and the files as gm_ids
+        for nb in xrange(0, 20):
+            the_dir = '%s/db/2012-%02d' % (root_dir, nb % 12 + 1) if nb < 12 else '%s/db/2013-%02d' % (root_dir, nb - 11)
+            os.rename('%s/db/dir_%d' % (root_dir, nb), the_dir)
+            for fname in os.listdir(the_dir):
+                the_id, ext = fname.split('_')[2].split('.')
+                gm_id = nb * 1000 + int(the_id)
+                os.rename('%s/%s' % (the_dir, fname), '%s/%d.%s' % (the_dir, gm_id, ext))
+                if ext == 'meta':
+                    with open('%s/%d.meta' % (the_dir, gm_id), 'w') as f:
+                        f.write('{"gm_id": %d, "internal_date": 1330819200}' % (gm_id))
+
+        gstorer = gmvault_db.GmailStorer(root_dir)
+        t1 = datetime.datetime.now()
+        gmail_ids = gstorer.get_all_existing_gmail_ids() # build the index
+        t2 = datetime.datetime.now()
+        print("\nTime to build the index of %d ids: %s\n" % (len(gmail_ids), t2-t1))
+
+        gstorer = gmvault_db.GmailStorer(root_dir)
+        t1 = datetime.datetime.now()
+        indexed_ids = gstorer.get_all_existing_gmail_ids()
+        t2 = datetime.datetime.now()
+        print("\nTime to list %d ids with the index: %s\n" % (len(indexed_ids), t2-t1))
+
+        self.assertEquals(len(indexed_ids), 20 * 500)
+        self.assertEquals(indexed_ids.items(), gmail_ids.items())
+        self.assertEquals(list(gstorer.get_all_existing_gmail_ids('2013-01').keys()), \
+                          [gm_id for gm_id in indexed_ids.keys() if gm_id >= 12000])
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_segments_storage(self):
+        """
+           Migrate a files db to the segments backend, compare the read time
+           of all emails and check that the content is unchanged after a
+           round trip files -> segments -> files
+        """
+        root_dir = '/tmp/gmvault-db-segments-perf'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        gstorer = gmvault_db.create_storer(root_dir)
+        for gm_id in xrange(1, 5001):
+            gstorer.bury_email({'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ['label'],
+                                'FLAGS': (), 'INTERNALDATE': datetime.datetime(2012, gm_id % 12 + 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                                'BODY[]': 'Subject: hello %d\r\n\r\nbody\r\n' % (gm_id)},
+                               '2012-%02d' % (gm_id % 12 + 1), compress = (gm_id % 2 == 0))
+
+        def read_all(storer):
+            """ read all emails """
+            t1 = datetime.datetime.now()
+            content = dict((gm_id, (storer.unbury_email(gm_id)[1], storer.unbury_metadata(gm_id))) \
+                           for gm_id in storer.get_all_existing_gmail_ids())
+            return content, datetime.datetime.now() - t1
+
+        files_content, files_time = read_all(gstorer)
+
+        gmvault_db.migrate_storage(root_dir, 'segments')
+        gstorer = gmvault_db.create_storer(root_dir)
+        self.assertTrue(isinstance(gstorer, gmvault_db.GmailSegmentStorer))
+        seg_content, seg_time = read_all(gstorer)
+
+        print("\nTime to read %d emails with files: %s, with segments: %s\n" \
+              % (len(files_content), files_time, seg_time))
+
+        self.assertEquals(seg_content, files_content)
+
+        gmvault_db.migrate_storage(root_dir, 'files')
+        self.assertEquals(read_all(gmvault_db.create_storer(root_dir))[0], files_content)
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_metadata_diff(self):
+        """
+           Compare the metadata of a sync batch with the db: one .meta file per id
+           against a few queries on the SQLite metadata store
+        """
+        root_dir = '/tmp/gmvault-db-metadata-perf'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+        gstorer = gmvault_db.create_storer(root_dir)
+        remote  = {}
+        for gm_id in xrange(1, 5001):
+            email_info = {'X-GM-MSGID': gm_id, 'X-GM-THRID': gm_id, 'X-GM-LABELS': ['label', 'other'],
+                          'FLAGS': ('\\Seen',), 'INTERNALDATE': datetime.datetime(2012, gm_id % 12 + 1, 1),
+                          'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: hello',
+                          'BODY[]': 'Subject: hello\r\n\r\nbody\r\n'}
+            gstorer.bury_email(email_info, '2012-%02d' % (gm_id % 12 + 1))
+            remote[gm_id] = dict(email_info)
+
+        # some changed and some new emails
+        for gm_id in xrange(1, 5001, 100):
+            remote[gm_id]['X-GM-LABELS'] = ['label']
+        for gm_id in xrange(10001, 10011):
+            remote[gm_id] = dict(remote[1], **{'X-GM-MSGID': gm_id})
+
+        server  = test_utils.FakeGmailServer().start()
+        vaulter = self._create_vaulter(root_dir, server)
+        batch   = [(gm_id, gm_id, None, '2012-%02d' % (gm_id % 12 + 1)) for gm_id in remote]
+
+        def diff(storer):
+            """ diff the batch """
+            vaulter.gstorer = storer
+            t1 = datetime.datetime.now()
+            changes = vaulter._get_metadata_changes(batch, remote) #pylint:disable-msg=W0212
+            return changes, datetime.datetime.now() - t1
+
+        json_changes, json_time = diff(gstorer)
+
+        gmvault_db.migrate_metadata(root_dir, 'sqlite')
+        sqlite_changes, sqlite_time = diff(gmvault_db.create_storer(root_dir))
+
+        print("\nTime to diff %d ids with .meta files: %s, with SQLite: %s\n" \
+              % (len(batch), json_time, sqlite_time))
+
+        self.assertEquals(json_changes, sqlite_changes)
+        self.assertEquals(json_changes, (set(xrange(10001, 10011)), set(xrange(1, 5001, 100))))
+
+        vaulter.src.disconnect()
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_imap_transport_throughput(self):
+        """
+           Read FETCH responses (bodies and metadata only) with the buffered
+           IMAP transport with and without compression
+        """
+        bodies = ''.join(['* %d FETCH (UID %d FLAGS (\\Seen) BODY[] {%d}\r\n%s)\r\n' \
+                          % (nb, nb, 20000, ('%06d line of the email\r\n' % (nb)) * 800) for nb in xrange(500)])
+        metadata = ''.join(['* %d FETCH (X-GM-LABELS ("\\\\Inbox" "foo bar") UID %d X-GM-MSGID %d '
+                            'INTERNALDATE "14-Mar-2012 10:00:00 +0000" FLAGS (\\Seen) RFC822.SIZE 12345)\r\n' \
+                            % (nb, nb, 10**18 + nb) for nb in xrange(20000)])
+
+        for name, response in (('bodies', bodies), ('metadata', metadata)):
+            response += 'A001 OK Success\r\n'
+            for compress in (False, True):
+                for chunk_size in (16384, 7):
+                    data = response if chunk_size > 7 else response[:20000]
+                    data = data[:data.rfind('* ')] + 'A001 OK Success\r\n'
+                    imap = test_utils.create_fake_imap(data, chunk_size, compress)
+                    raw  = imap.sslobj.data
+
+                    t1 = datetime.datetime.now()
+                    read = []
+                    while True:
+                        line = imap.readline()
+                        read.append(line)
+                        if line.endswith('}\r\n'):
+                            read.append(imap.read(int(line[line.rfind('{') + 1:-3])))
+                        elif line.startswith('A001'):
+                            break
+                    elapsed = (datetime.datetime.now() - t1).total_seconds()
+
+                    self.assertEquals(''.join(read), data)
+
+                    if chunk_size > 7:
+                        print("\nIMAP transport %s compress=%s: %.1f MB/s, %d bytes on the wire for %d (%.1f%%)\n" \
+                              % (name, compress, len(data) / (max(elapsed, 1e-6) * 1024 * 1024), \
+                                 len(raw), len(data), 100.0 * len(raw) / len(data)))
+
+    def test_spooled_body_literal(self):
+        """
+           Receive a big body literal in a spool file of the db and store it
+           (moved in place when stored as received, streamed when compressed)
+        """
+        root_dir = '/tmp/gmvault-db-spool-perf'
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+        gstorer   = gmvault_db.create_storer(root_dir)
+        spool_dir = gstorer.get_spool_dir()
+
+        body = 'Subject: big\r\n\r\n' + 'a line of a big email with an attachment 0123456789\r\n' * 400000
+        data = 'A001 OK Success\r\n'
+
+        for compress in (False, True):
+            imap = test_utils.create_fake_imap('%s)\r\n%s' % (body, data), compress = compress)
+            imap.spool_dir, imap.spool_min_size = spool_dir, 1024 * 1024
+
+            t1 = datetime.datetime.now()
+            literal = imap.read(len(body))
+            self.assertEquals(imap.readline(), ')\r\n')
+            self.assertEquals(imap.readline(), data)
+            elapsed = (datetime.datetime.now() - t1).total_seconds()
+
+            gstorer.bury_email({'X-GM-MSGID': 1, 'X-GM-THRID': 1, 'X-GM-LABELS': [], 'FLAGS': (),
+                                'INTERNALDATE': datetime.datetime(2012, 1, 1),
+                                'BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT X-GMAIL-RECEIVED)]': 'Subject: big',
+                                'BODY[]': literal}, '2012-01', compress = compress)
+            del literal
+            self.assertEquals(gstorer.unbury_data(1), body)
+
+            print("\nSpooled literal compress=%s: %.1f MB/s\n" \
+                  % (compress, len(body) / (max(elapsed, 1e-6) * 1024 * 1024)))
+
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_pipelined_imap_engine(self):
+        """
+           Fetch the metadata and bodies of a fake Gmail server with 20 ms of round trip
+           with the imapclient and pipelined engines: same results and the pipelined engine is faster.
+           300 emails: imapclient 1.46 s (78 round trips), pipelined 0.47 s (28 round trips).
+           With 5 ms of round trip: 0.45 s and 0.26 s.
+        """
+        server = test_utils.FakeGmailServer(latency = 0.02).start()
+        for num in xrange(300):
+            server.add_message('Message-ID: <%d@gmvault>\r\nSubject: email %d\r\n\r\n%s\r\n' \
+                               % (num, num, 'body line\r\n' * (num % 50)), \
+                               labels = ['label%d' % (num % 4), '\\Inbox'], flags = ['\\Seen'])
+
+        def sync(engine):
+            """ fetch everything like the sync does """
+            src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', {'type': 'passwd', 'value': 'x'})
+            src.ssl, src.imap_engine = False, engine
+            src.connect()
+            src.select_folder('ALLMAIL')
+
+            t1 = datetime.datetime.now()
+            imap_ids = src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+            fetcher  = gmvault.IMAPBatchFetcher(src, imap_ids, {}, imap_utils.GIMAPFetcher.GET_ALL_BUT_DATA, 20)
+            downloader_class = gmvault.PipelinedBodyDownloader if src.is_pipelined() else gmvault.IMAPBodyDownloader
+            downloader = downloader_class(src, batch_size = 5)
+            downloader.start()
+
+            emails = {}
+            def store(max_outstanding):
+                """ get the downloaded bodies """
+                for _, metadata, data, error in downloader.downloaded(max_outstanding):
+                    self.assertEquals(error, None)
+                    metadata['BODY[]'] = data['BODY[]']
+                    emails[metadata['X-GM-MSGID']] = metadata
+
+            for new_data in fetcher:
+                for the_id, metadata in new_data.iteritems():
+                    del metadata['SEQ']
+                    downloader.submit(the_id, metadata['RFC822.SIZE'], metadata)
+                store(20)
+            store(0)
+            elapsed = (datetime.datetime.now() - t1).total_seconds()
+
+            downloader.stop()
+            src.disconnect()
+            return emails, elapsed
+
+        blocking, blocking_time   = sync('imapclient')
+        server.max_pipelined      = 0
+        pipelined, pipelined_time = sync('pipelined')
+        server.stop()
+
+        print("\nFetch of %d emails with imapclient: %.2f s, pipelined: %.2f s\n" \
+              % (len(blocking), blocking_time, pipelined_time))
+
+        self.assertEquals(len(blocking), 300)
+        self.assertEquals(pipelined, blocking)
+        self.assertTrue(server.max_pipelined > 1)
+        self.assertTrue(pipelined_time < blocking_time)
+
+    def test_fast_reconnect(self):
+        """
+           Reconnect to a fake Gmail server with 10 ms of round trip: without cache,
+           with the cached capabilities and folders and with the standby connection
+        """
+        server = test_utils.FakeGmailServer(latency = 0.01).start()
+        server.add_message('Subject: hello\r\n\r\nbody\r\n')
+
+        def reconnect_time(src, nb_times = 5):
+            """ average time of a reconnection to the current folder """
+            elapsed = 0
+            for _ in xrange(nb_times):
+                time.sleep(0.1) # let the standby connection open
+                del server.commands[:]
+                t1 = datetime.datetime.now()
+                src.disconnect(keep_standby = True)
+                src.connect(go_to_current_folder = True)
+                elapsed += (datetime.datetime.now() - t1).total_seconds()
+            return elapsed / nb_times
+
+        times = []
+        for use_standby in (False, True):
+            src = imap_utils.GIMAPFetcher(server.host, server.port, 'gmvault', {'type': 'passwd', 'value': 'x'}, \
+                                          use_standby = use_standby)
+            src.ssl = False
+            src.connect()
+            src.select_folder('ALLMAIL')
+
+            # first connection: everything is asked
+            src._folders_found = src._capabilities = src._greeting_capabilities = None #pylint:disable-msg=W0212
+            times.append(reconnect_time(src, 1))
+            times.append(reconnect_time(src))
+            src.disconnect()
+
+        server.stop()
+        print("\nReconnection without cache: %.3f s, with cache: %.3f s, with standby: %.3f s\n" \
+              % (times[0], times[1], times[3]))
+        self.assertTrue(times[3] < times[0])
+
+    def test_id_set(self):
+        """
+           IdSet of 1M uids with a few gaps and of sparse gmail ids: memory and
+           time compared to a list and a set, results compared to the set ones
+        """
+        import sys
+        import random
+        random.seed(42)
+        uids = [uid for uid in xrange(1, 1000001) if uid % 5000 != 0]
+        gm_ids = sorted(random.sample(xrange(1400000000000000000, 1500000000000000000, 1000), 20000))
+
+        for name, ids in (('uids', uids), ('gmail ids', gm_ids)):
+            t1 = datetime.datetime.now()
+            the_set = set(ids)
+            set_time = (datetime.datetime.now() - t1).total_seconds()
+            t1 = datetime.datetime.now()
+            id_set = collections_utils.IdSet(ids)
+            id_set_time = (datetime.datetime.now() - t1).total_seconds()
+            list_size = sys.getsizeof(ids) + sum(sys.getsizeof(the_id) for the_id in ids)
+            set_size  = sys.getsizeof(the_set) + sum(sys.getsizeof(the_id) for the_id in the_set)
+            print("\n%d %s: list %d KB, set %d KB (%.2f s), IdSet %d KB (%.2f s)\n" \
+                  % (len(ids), name, list_size / 1024, set_size / 1024, set_time, \
+                     sys.getsizeof(id_set) / 1024, id_set_time))
+
+            self.assertEquals(len(id_set), len(the_set))
+            self.assertTrue(sys.getsizeof(id_set) < set_size)
+
+            # difference with the ids found on the server, all but one per 1000
+            found = collections_utils.IdSet(ids[i] for i in xrange(len(ids)) if i % 1000 != 1)
+            t1 = datetime.datetime.now()
+            missing = id_set - found
+            diff_time = (datetime.datetime.now() - t1).total_seconds()
+            t1 = datetime.datetime.now()
+            expected = the_set - set(ids[i] for i in xrange(len(ids)) if i % 1000 != 1)
+            set_diff_time = (datetime.datetime.now() - t1).total_seconds()
+            print("difference: set %.3f s, IdSet %.3f s\n" % (set_diff_time, diff_time))
+            self.assertEquals(list(missing), sorted(expected))
+
+    def test_sorted_id_map(self):
+        """
+           gm_id => dir of 200000 emails in 60 months: SortedIdMap compared to the
+           OrderedDict previously returned (build, memory, restart from the middle)
+        """
+        import sys
+        import random
+        random.seed(7)
+        dirs = ['%d-%02d' % (2010 + nb / 12, nb % 12 + 1) for nb in xrange(60)]
+        items = [(1400000000000000000 + num * 7919, dirs[num * 60 / 200000]) for num in xrange(200000)]
+        random.shuffle(items)
+
+        t1 = datetime.datetime.now()
+        ordered = collections_utils.OrderedDict(sorted(items, key=lambda t: t[0]))
+        ordered_time = (datetime.datetime.now() - t1).total_seconds()
+        t1 = datetime.datetime.now()
+        id_map = collections_utils.SortedIdMap(items)
+        map_time = (datetime.datetime.now() - t1).total_seconds()
+
+        # dict + 3 links per key + key + value strings
+        ordered_size = sys.getsizeof(ordered) + sum(sys.getsizeof(key) + sys.getsizeof(val) + 3 * 64 \
+                                                    for key, val in items)
+        print("\n%d ids: OrderedDict %d KB (%.2f s), SortedIdMap %d KB (%.2f s)\n" \
+              % (len(items), ordered_size / 1024, ordered_time, sys.getsizeof(id_map) / 1024, map_time))
+        self.assertTrue(sys.getsizeof(id_map) * 10 < ordered_size)
+        self.assertEquals(id_map.items(), ordered.items())
+
+        last_id = ordered.keys()[123456]
+        t1 = datetime.datetime.now()
+        keys = ordered.keys()
+        left = keys[keys.index(last_id) + 1:]
+        ordered_time = (datetime.datetime.now() - t1).total_seconds()
+        t1 = datetime.datetime.now()
+        left_map = id_map.after(last_id)
+        map_time = (datetime.datetime.now() - t1).total_seconds()
+        print("restart: OrderedDict %.4f s, SortedIdMap %.6f s\n" % (ordered_time, map_time))
+
+        self.assertEquals(len(left_map), len(left))
+        self.assertEquals(list(left_map), left)
+
+    def test_metadata_snapshot(self):
+        """
+           Metadata of 20000 emails with one streamed UID FETCH 1:* (snapshot) compared with
+           FETCH batches of 500 uids (with both IMAP engines)
+        """
+        root_dir = '/tmp/gmvault-db-snapshot-perf'
+
+        server = test_utils.FakeGmailServer(latency = 0.005).start()
+        for num in xrange(20000):
+            server.add_message('Subject: email %d\r\n\r\nbody %d\r\n' % (num, num), \
+                               labels = ['label', 'label%d' % (num % 7)], flags = ['\\Seen'] if num % 3 else [])
+
+        for engine in ('imapclient', 'pipelined'):
+            gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+            vaulter = self._create_vaulter(root_dir, server)
+            vaulter.src.imap_engine = engine
+            vaulter.src.connect()
+            vaulter.src.select_folder('ALLMAIL')
+
+            t1 = datetime.datetime.now()
+            uids = vaulter.src.search(imap_utils.GIMAPFetcher.IMAP_ALL)
+            expected = []
+            for pos in xrange(0, len(uids), 500):
+                data = vaulter.src.fetch(uids[pos:pos + 500], gmvault_snapshot.MetadataSnapshot.ATTRIBUTES)
+                expected.extend([gmvault_snapshot.MetadataSnapshot.to_record(uid, data[uid]) for uid in sorted(data)])
+            batches_time = (datetime.datetime.now() - t1).total_seconds()
+
+            t1 = datetime.datetime.now()
+            snapshot, nb_messages = vaulter.take_snapshot('ALLMAIL')
+            snapshot_time = (datetime.datetime.now() - t1).total_seconds()
+
+            print("\n%s: metadata of %d emails in %.3f s with FETCH batches, %.3f s with a snapshot\n" \
+                  % (engine, nb_messages, batches_time, snapshot_time))
+
+            self.assertEquals(nb_messages, 20000)
+            self.assertEquals(list(snapshot), expected)
+
+            vaulter.src.disconnect()
+
+        server.stop()
+        gmvault_utils.delete_all_under(root_dir, delete_top_dir = True)
+
+    def test_blowfish_ctr_throughput(self):
+        """
+           Compare the bulk CTR keystream with the byte per byte one:
+           same bytes and MB/s of both
+        """
+        key = 'This is a test key for gmvault'
+        data = os.urandom(256 * 1024 + 5)
+
+        cipher = blowfish.Blowfish(key)
+        cipher.initCTR()
+        t1 = datetime.datetime.now()
+        expected = ''.join([chr(ord(ch) ^ cipher._nextCTRByte()) for ch in data]) #pylint:disable-msg=W0212
+        t2 = datetime.datetime.now()
+        ref_time = (t2 - t1).total_seconds()
+
+        cipher.initCTR()
+        t1 = datetime.datetime.now()
+        crypted = cipher.encryptCTR(data)
+        t2 = datetime.datetime.now()
+        bulk_time = (t2 - t1).total_seconds()
+
+        print("\nBlowfish CTR byte per byte: %.2f MB/s, bulk: %.2f MB/s\n" \
+              % (len(data) / (ref_time * 1024 * 1024), len(data) / (max(bulk_time, 1e-6) * 1024 * 1024)))
+
+        self.assertEquals(crypted, expected)
         
 
 def tests():